@@ -0,0 +1,367 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Internal metrics the monitoring agent keeps about itself.
+
+The registry holds counters, gauges and histograms that are updated from
+the sampling loop and exported at a low rate under a separate metric prefix,
+so agent saturation can be alerted on independently of the GPU metrics.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+from google.cloud import monitoring_v3
+
+AGENT_METRIC_PREFIX = 'custom.googleapis.com/gce/gpu-agent/'
+
+# Bucket bounds (seconds) used for the latency histograms
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1.0, 2.5, 5.0, 10.0, 30.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class _CounterValue(object):
+    """A monotonically increasing integer value."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError('Counters can only be incremented')
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeValue(object):
+    """A value that can go up and down."""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class _HistogramValue(object):
+    """A distribution of observations over fixed bucket bounds."""
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self.bounds = tuple(bounds)
+        self.bucket_counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.sum_of_squares = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_right(self.bounds, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.sum_of_squares += value * value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    @property
+    def sum_of_squared_deviation(self):
+        if not self.count:
+            return 0.0
+        return max(0.0, self.sum_of_squares - self.sum * self.sum / self.count)
+
+
+class Metric(object):
+    """A named metric family with an optional set of label keys."""
+
+    def __init__(self, name, kind, description, unit, label_keys, bounds=None):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.unit = unit
+        self.label_keys = tuple(label_keys)
+        self._bounds = bounds
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, **labels):
+        """Returns the value cell for the given label values."""
+
+        if set(labels) != set(self.label_keys):
+            raise ValueError('Metric {} expects labels {}, got {}'.format(
+                self.name, self.label_keys, tuple(labels)))
+        key = tuple(str(labels[k]) for k in self.label_keys)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    self._children[key] = child
+        return child
+
+    def _new_child(self):
+        if self.kind == COUNTER:
+            return _CounterValue()
+        if self.kind == GAUGE:
+            return _GaugeValue()
+        return _HistogramValue(self._bounds)
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def collect(self):
+        """Returns a list of (labels, value cell) pairs."""
+
+        with self._lock:
+            items = list(self._children.items())
+        return [(dict(zip(self.label_keys, key)), child) for key, child in items]
+
+
+class MetricsRegistry(object):
+    """A collection of agent metrics."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, name, kind, description, unit, label_keys, bounds=None):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = Metric(name, kind, description, unit, label_keys, bounds)
+                self._metrics[name] = metric
+            elif metric.kind != kind:
+                raise ValueError('Metric {} already registered as a {}'.format(
+                    name, metric.kind))
+        return metric
+
+    def counter(self, name, description, unit='1', label_keys=()):
+        return self._register(name, COUNTER, description, unit, label_keys)
+
+    def gauge(self, name, description, unit='1', label_keys=()):
+        return self._register(name, GAUGE, description, unit, label_keys)
+
+    def histogram(self, name, description, unit='s', label_keys=(),
+                  bounds=LATENCY_BOUNDS):
+        return self._register(name, HISTOGRAM, description, unit, label_keys,
+                              bounds)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+
+class ProcessStats(object):
+    """Samples resident memory and CPU utilization of the agent process.
+
+    The resident memory is read from /proc and not reported without it.
+    """
+
+    def __init__(self, rss, cpu_utilization):
+        self._rss = rss
+        self._cpu_utilization = cpu_utilization
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._last_wall = time.monotonic()
+        self._last_cpu = self._cpu_seconds()
+
+    @staticmethod
+    def _cpu_seconds():
+        times = os.times()
+        return times.user + times.system
+
+    def _rss_bytes(self):
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * self._page_size
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def update(self):
+        now = time.monotonic()
+        cpu = self._cpu_seconds()
+        elapsed = now - self._last_wall
+        if elapsed > 0:
+            self._cpu_utilization.set((cpu - self._last_cpu) / elapsed)
+        self._last_wall = now
+        self._last_cpu = cpu
+        rss = self._rss_bytes()
+        if rss is not None:
+            self._rss.set(rss)
+
+
+class AgentMetrics(object):
+    """The standard set of metrics describing the agent sampling loop."""
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.dcgm_fetch_latency = r.histogram(
+            'dcgm_fetch_latency', 'Time spent fetching field values from DCGM')
+        self.series_build_latency = r.histogram(
+            'series_build_latency', 'Time spent building time series')
+        self.export_latency = r.histogram(
+            'export_latency', 'Latency of exporting a batch to a sink',
+            label_keys=('sink',))
+        self.schedule_lateness = r.histogram(
+            'schedule_lateness', 'Delay of a sampling cycle past its schedule')
+        self.blank_values = r.counter(
+            'blank_values', 'Blank field values reported by DCGM')
+        self.points_written = r.counter(
+            'points_written', 'Points accepted by a sink', label_keys=('sink',))
+        self.points_dropped = r.counter(
+            'points_dropped', 'Points dropped from a full sink queue',
+            label_keys=('sink',))
+        self.points_rejected = r.counter(
+            'points_rejected', 'Points in failed export calls', label_keys=('sink',))
+        self.export_queue_depth = r.gauge(
+            'export_queue_depth', 'Batches waiting in a sink queue',
+            label_keys=('sink',))
+        self.sampling_backend = r.gauge(
+            'sampling_backend', 'Backend the GPU fields are sampled through',
+            label_keys=('backend',))
+        self.gpus_in_state = r.gauge(
+            'gpus_in_state', 'GPUs per idle detector state', label_keys=('state',))
+        self.gpu_state_events = r.counter(
+            'gpu_state_events', 'Idle, stalled and recovered GPU events',
+            label_keys=('event',))
+        self.alert_events = r.counter(
+            'alert_events', 'Alert rules starting or stopping to fire',
+            label_keys=('state',))
+        self.alert_action_errors = r.counter(
+            'alert_action_errors', 'Alert notifications that could not be sent',
+            label_keys=('action',))
+        self.gpu_health_events = r.counter(
+            'gpu_health_events', 'GPU health changes reported by the health monitor',
+            label_keys=('event',))
+        self.gpu_ecc_errors = r.counter(
+            'gpu_ecc_errors', 'Volatile ECC errors counted on the GPUs',
+            label_keys=('type',))
+        self.gpu_xid_errors = r.counter(
+            'gpu_xid_errors', 'XID errors reported by the driver', label_keys=('xid',))
+        self.gpus_throttled = r.gauge(
+            'gpus_throttled', 'GPUs with clocks throttled per reason',
+            label_keys=('reason',))
+        self.remote_hosts = r.gauge(
+            'remote_hosts', 'Remote host engines per collector state',
+            label_keys=('state',))
+        self.remote_host_failures = r.counter(
+            'remote_host_failures', 'Remote host polls that timed out or failed',
+            label_keys=('reason',))
+        self.points_degraded = r.counter(
+            'points_degraded', 'Points deferred or folded into distributions to stay '
+            'within the write budget', label_keys=('mode',))
+        self.write_budget_scale = r.gauge(
+            'write_budget_scale', 'Fraction of the configured write budget in use',
+            unit='ratio')
+        self.gateway_points = r.counter(
+            'gateway_points', 'Points handled by the aggregation gateway',
+            label_keys=('outcome',))
+        self.spool_batches = r.gauge(
+            'spool_batches', 'Batches waiting in the spool to be written')
+        self.metadata_events = r.counter(
+            'metadata_events', 'Metadata changes, preemption and maintenance notices seen '
+            'by the metadata watcher', label_keys=('event',))
+        self.watchdog_events = r.counter(
+            'watchdog_events', 'Sampling cycles that timed out or failed and readers '
+            'reconnected by the watchdog', label_keys=('event',))
+        self.process_rss = r.gauge(
+            'process_rss', 'Resident memory of the agent process', unit='By')
+        self.process_cpu_utilization = r.gauge(
+            'process_cpu_utilization', 'CPU used by the agent process',
+            unit='ratio')
+        self.process_stats = ProcessStats(self.process_rss,
+                                          self.process_cpu_utilization)
+
+
+def _set_time(timestamp, seconds):
+    timestamp.seconds = int(seconds)
+    timestamp.nanos = int((seconds - int(seconds)) * 10**9)
+
+
+def create_metric_descriptors(client, project_name, registry,
+                              prefix=AGENT_METRIC_PREFIX):
+    """Creates SD metric descriptors for the registered agent metrics."""
+
+    for metric in registry.metrics():
+        descriptor = monitoring_v3.types.MetricDescriptor()
+        descriptor.type = prefix + metric.name
+        descriptor.description = metric.description
+        descriptor.unit = metric.unit
+        if metric.kind == COUNTER:
+            descriptor.metric_kind = monitoring_v3.enums.MetricDescriptor.MetricKind.CUMULATIVE
+            descriptor.value_type = monitoring_v3.enums.MetricDescriptor.ValueType.INT64
+        elif metric.kind == GAUGE:
+            descriptor.metric_kind = monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE
+            descriptor.value_type = monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE
+        else:
+            descriptor.metric_kind = monitoring_v3.enums.MetricDescriptor.MetricKind.CUMULATIVE
+            descriptor.value_type = monitoring_v3.enums.MetricDescriptor.ValueType.DISTRIBUTION
+        for label_key in metric.label_keys:
+            label = descriptor.labels.add()
+            label.key = label_key
+        client.create_metric_descriptor(project_name, descriptor)
+
+
+def to_time_series(registry, resource_type, resource_labels,
+                   prefix=AGENT_METRIC_PREFIX, end_time=None):
+    """Converts the current registry values to SD time series."""
+
+    end_time = end_time or time.time()
+    time_series = []
+    for metric in registry.metrics():
+        for labels, value in metric.collect():
+            series = monitoring_v3.types.TimeSeries()
+            series.resource.type = resource_type
+            for label_key, label_value in resource_labels.items():
+                series.resource.labels[label_key] = label_value
+            series.metric.type = prefix + metric.name
+            for label_key, label_value in labels.items():
+                series.metric.labels[label_key] = label_value
+
+            point = series.points.add()
+            _set_time(point.interval.end_time, end_time)
+            if metric.kind == COUNTER:
+                _set_time(point.interval.start_time, registry.start_time)
+                point.value.int64_value = value.value
+            elif metric.kind == GAUGE:
+                point.value.double_value = value.value
+            else:
+                _set_time(point.interval.start_time, registry.start_time)
+                distribution = point.value.distribution_value
+                distribution.count = value.count
+                distribution.mean = value.mean
+                distribution.sum_of_squared_deviation = value.sum_of_squared_deviation
+                distribution.bucket_options.explicit_buckets.bounds.extend(value.bounds)
+                distribution.bucket_counts.extend(value.bucket_counts)
+            time_series.append(series)
+
+    return time_series
@@ -0,0 +1,106 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+import agent_metrics
+
+
+@pytest.fixture
+def metrics():
+    return agent_metrics.AgentMetrics()
+
+
+def test_counter_and_gauge(metrics):
+    metrics.blank_values.inc(14)
+    metrics.blank_values.inc()
+    metrics.schedule_lateness.observe(0.1)
+    metrics.export_queue_depth.labels(sink='file').set(3)
+
+    assert metrics.blank_values.labels().value == 15
+    assert metrics.export_queue_depth.labels(sink='file').value == 3.0
+    with pytest.raises(ValueError):
+        metrics.blank_values.inc(-1)
+
+
+def test_histogram_buckets(metrics):
+    for value in (0.0005, 0.003, 0.003, 42.0):
+        metrics.dcgm_fetch_latency.observe(value)
+
+    histogram = metrics.dcgm_fetch_latency.labels()
+    assert histogram.count == 4
+    assert histogram.bucket_counts[0] == 1
+    assert histogram.bucket_counts[2] == 2
+    assert histogram.bucket_counts[-1] == 1
+    assert histogram.mean == pytest.approx(42.0065 / 4)
+
+
+def test_labeled_metric():
+    registry = agent_metrics.MetricsRegistry()
+    dropped = registry.counter('dropped', 'Dropped points', label_keys=('sink',))
+    dropped.labels(sink='file').inc(2)
+    dropped.labels(sink='stdout').inc()
+
+    assert sorted((l['sink'], v.value) for l, v in dropped.collect()) == [
+        ('file', 2), ('stdout', 1)]
+    with pytest.raises(ValueError):
+        dropped.labels(gpu='0')
+    assert registry.counter('dropped', 'Dropped points', label_keys=('sink',)) is dropped
+    with pytest.raises(ValueError):
+        registry.gauge('dropped', 'Dropped points')
+
+
+def test_process_stats(metrics):
+    metrics.process_stats.update()
+
+    assert metrics.process_rss.labels().value > 0
+    assert metrics.process_cpu_utilization.labels().value >= 0
+
+
+def test_process_stats_without_proc(metrics, monkeypatch):
+    def no_proc(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(agent_metrics, 'open', no_proc, raising=False)
+    metrics.process_stats.update()
+    # No peak RSS stands in for the current one
+    assert metrics.process_rss.labels().value == 0
+
+
+def test_to_time_series(metrics):
+    metrics.points_written.labels(sink='cloud_monitoring').inc(5)
+    metrics.schedule_lateness.observe(0.2)
+    metrics.export_queue_depth.labels(sink='cloud_monitoring').set(1)
+
+    time_series = agent_metrics.to_time_series(
+        metrics.registry, 'gce_instance', {'instance_id': '1'}, end_time=100.5)
+    by_type = {series.metric.type: series for series in time_series}
+
+    written = by_type[agent_metrics.AGENT_METRIC_PREFIX + 'points_written']
+    assert written.resource.labels['instance_id'] == '1'
+    assert written.metric.labels['sink'] == 'cloud_monitoring'
+    assert written.points[0].value.int64_value == 5
+    assert written.points[0].interval.end_time.seconds == 100
+    assert written.points[0].interval.end_time.nanos == 500000000
+
+    lateness = by_type[agent_metrics.AGENT_METRIC_PREFIX + 'schedule_lateness']
+    distribution = lateness.points[0].value.distribution_value
+    assert distribution.count == 1
+    assert sum(distribution.bucket_counts) == 1
+    assert list(distribution.bucket_options.explicit_buckets.bounds) == list(
+        agent_metrics.LATENCY_BOUNDS)
+
+    depth = by_type[agent_metrics.AGENT_METRIC_PREFIX + 'export_queue_depth']
+    assert depth.points[0].value.double_value == 1.0
@@ -0,0 +1,354 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Alert rules evaluated in the agent against every DCGM sample.
+
+Rules are read from a JSON file:
+
+    {
+      "actions": {
+        "oncall": {"type": "webhook", "url": "https://hooks.example.com/gpu"},
+        "local": {"type": "file", "path": "/var/log/dcgm_stackdriver/alerts.jsonl"},
+        "agent": {"type": "socket", "address": "unix:/run/gpu-alerts.sock"}
+      },
+      "rules": [
+        {"name": "hot", "type": "threshold", "field": "sm_active", "op": ">",
+         "value": 0.95, "for_seconds": 60, "actions": ["oncall", "local"]},
+        {"name": "pcie_burst", "type": "rate", "field": 1009, "op": ">",
+         "value": 1e9, "actions": ["local"]},
+        {"name": "no_power", "type": "absence", "field": "power_usage",
+         "seconds": 120, "actions": ["agent"]}
+      ]
+    }
+
+threshold  fires when the value compares true for for_seconds (0: any sample)
+rate       like threshold, on the change per second between samples
+absence    fires when a GPU reported no sample of the field for seconds
+
+Fields are DCGM field ids or the metric names of the watched fields. A rule
+may be limited to some "gpus". Rules are compiled once into numpy
+predicates applied to the columns of each batch, so the evaluation cost per
+sample is a few vectorized operations per rule. Notifications are sent
+when a rule starts and stops firing for a GPU.
+"""
+
+import json
+import operator
+import socket
+
+import numpy as np
+
+from absl import logging
+
+import cycle_trace
+
+THRESHOLD = 'threshold'
+RATE = 'rate'
+ABSENCE = 'absence'
+FIRING = 'firing'
+RESOLVED = 'resolved'
+
+_OPERATORS = {
+    '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le,
+    '==': operator.eq, '!=': operator.ne,
+}
+
+
+class Columns(object):
+    """A batch of samples as numpy columns, sorted by GPU, field and time."""
+
+    def __init__(self, samples):
+        count = len(samples)
+        gpus = np.fromiter((s.gpu for s in samples), np.int64, count)
+        fields = np.fromiter((s.field_id for s in samples), np.int64, count)
+        timestamps = np.fromiter((s.timestamp for s in samples), np.int64, count)
+        values = np.fromiter((s.value for s in samples), np.float64, count)
+        order = np.lexsort((timestamps, fields, gpus))
+        self.gpus = gpus[order]
+        self.fields = fields[order]
+        self.timestamps = timestamps[order]
+        self.values = values[order]
+        self.now = int(timestamps.max()) if count else None
+
+
+class Rule(object):
+    """A compiled rule with its per-GPU state."""
+
+    def __init__(self, name, kind, field_id, actions, op=None, value=None,
+                 for_seconds=0, seconds=None, gpus=None):
+        if kind not in (THRESHOLD, RATE, ABSENCE):
+            raise ValueError('Rule {}: unknown type {}'.format(name, kind))
+        if kind != ABSENCE and op not in _OPERATORS:
+            raise ValueError('Rule {}: unknown operator {}'.format(name, op))
+        if kind == ABSENCE and not seconds:
+            raise ValueError('Rule {}: absence rules need seconds'.format(name))
+        self.name = name
+        self.kind = kind
+        self.field_id = field_id
+        self.actions = actions
+        self._predicate = _OPERATORS.get(op)
+        self.op = op
+        self.value = value
+        self._for_us = int(for_seconds * 10**6)
+        self._seconds_us = int((seconds or 0) * 10**6)
+        self._gpus = np.asarray(sorted(gpus), dtype=np.int64) if gpus else None
+        # Per GPU: start of the current violation, last sample, firing flag
+        self._since = {}
+        self._last = {}
+        self.firing = set()
+
+    def _select(self, columns):
+        mask = columns.fields == self.field_id
+        if self._gpus is not None:
+            mask &= np.isin(columns.gpus, self._gpus)
+        return columns.gpus[mask], columns.timestamps[mask], columns.values[mask]
+
+    def _rates(self, gpus, timestamps, values):
+        # Prepend the last sample of every GPU from the previous batch
+        previous = [(gpu,) + self._last[gpu] for gpu in np.unique(gpus).tolist()
+                    if gpu in self._last]
+        if len(gpus):
+            for index in np.flatnonzero(np.append(gpus[1:] != gpus[:-1], True)).tolist():
+                self._last[int(gpus[index])] = (int(timestamps[index]), float(values[index]))
+        if previous:
+            prev_gpus, prev_timestamps, prev_values = zip(*previous)
+            gpus = np.concatenate((np.asarray(prev_gpus, dtype=np.int64), gpus))
+            timestamps = np.concatenate((np.asarray(prev_timestamps, dtype=np.int64),
+                                         timestamps))
+            values = np.concatenate((np.asarray(prev_values, dtype=np.float64), values))
+            order = np.lexsort((timestamps, gpus))
+            gpus, timestamps, values = gpus[order], timestamps[order], values[order]
+        same = gpus[1:] == gpus[:-1]
+        elapsed = np.diff(timestamps) / 10**6
+        valid = same & (elapsed > 0)
+        rates = np.diff(values)[valid] / elapsed[valid]
+        return gpus[1:][valid], timestamps[1:][valid], rates
+
+    def evaluate(self, columns):
+        """Returns the (gpu, state, details) transitions of a batch."""
+
+        gpus, timestamps, values = self._select(columns)
+        if self.kind == ABSENCE:
+            return self._evaluate_absence(columns, gpus, timestamps)
+        if self.kind == RATE:
+            gpus, timestamps, values = self._rates(gpus, timestamps, values)
+        if not len(gpus):
+            return []
+
+        violated = self._predicate(values, self.value)
+        transitions = []
+        starts = np.flatnonzero(np.append(True, gpus[1:] != gpus[:-1]))
+        ends = np.append(starts[1:], len(gpus))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            gpu = int(gpus[start])
+            bad = violated[start:end]
+            ts = timestamps[start:end]
+            # Start time of the violation run every sample belongs to
+            run_starts = bad & ~np.append(self._since.get(gpu) is not None, bad[:-1])
+            runs = np.cumsum(run_starts)
+            run_since = np.append(self._since.get(gpu) or 0, ts[run_starts])[runs]
+            firing = bad & (ts - run_since >= self._for_us)
+            self._since[gpu] = int(run_since[-1]) if bad[-1] else None
+            transitions.extend(self._transitions(gpu, firing, ts, values[start:end],
+                                                 run_since))
+        return transitions
+
+    def _transitions(self, gpu, firing, ts, values, run_since):
+        # A spike between two exports fires and resolves within the batch
+        transitions = []
+        position = 0
+        while position < len(firing):
+            changes = np.flatnonzero(firing[position:] != (gpu in self.firing))
+            if not len(changes):
+                break
+            position += int(changes[0])
+            state = self._transition(gpu, bool(firing[position]))
+            transitions.append((gpu, state, {
+                'value': float(values[position]),
+                'since': int(run_since[position]) / 10**6 if state == FIRING else None,
+                'timestamp': int(ts[position]) / 10**6}))
+        return transitions
+
+    def _evaluate_absence(self, columns, gpus, timestamps):
+        if len(gpus):
+            for index in np.flatnonzero(np.append(gpus[1:] != gpus[:-1], True)).tolist():
+                self._last[int(gpus[index])] = int(timestamps[index])
+        # Every GPU that reported anything is expected to report the field
+        known = np.unique(columns.gpus)
+        if self._gpus is not None:
+            known = known[np.isin(known, self._gpus)]
+        transitions = []
+        for gpu in known.tolist():
+            last = self._last.setdefault(gpu, columns.now)
+            firing = columns.now - last >= self._seconds_us
+            transition = self._transition(gpu, firing)
+            if transition:
+                transitions.append((gpu, transition, {
+                    'last_seen': last / 10**6, 'timestamp': columns.now / 10**6}))
+        return transitions
+
+    def _transition(self, gpu, firing):
+        if firing and gpu not in self.firing:
+            self.firing.add(gpu)
+            return FIRING
+        if not firing and gpu in self.firing:
+            self.firing.discard(gpu)
+            return RESOLVED
+        return None
+
+
+class WebhookAction(object):
+
+    def __init__(self, url, timeout=5.0, headers=None):
+        import requests
+
+        self._session = requests.Session()
+        self._url = url
+        self._timeout = timeout
+        self._headers = headers or {}
+
+    def send(self, notification):
+        response = self._session.post(self._url, json=notification, timeout=self._timeout,
+                                      headers=self._headers)
+        response.raise_for_status()
+
+    def close(self):
+        self._session.close()
+
+
+class FileAction(object):
+
+    def __init__(self, path):
+        self._writer = cycle_trace.JsonLinesWriter(path)
+
+    def send(self, notification):
+        self._writer.write(notification)
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+
+class SocketAction(object):
+    """Sends a JSON line per notification to unix:<path> or <host>:<port>."""
+
+    def __init__(self, address, timeout=2.0):
+        self._address = address
+        self._timeout = timeout
+
+    def send(self, notification):
+        if self._address.startswith('unix:'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            target = self._address[len('unix:'):]
+        else:
+            host, port = self._address.rsplit(':', 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            target = (host, int(port))
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(target)
+            sock.sendall((json.dumps(notification, sort_keys=True) + '\n').encode('utf-8'))
+        finally:
+            sock.close()
+
+    def close(self):
+        pass
+
+
+_ACTIONS = {'webhook': WebhookAction, 'file': FileAction, 'socket': SocketAction}
+
+
+def create_action(config):
+    config = dict(config)
+    kind = config.pop('type', None)
+    if kind not in _ACTIONS:
+        raise ValueError('Unknown alert action type: {}'.format(kind))
+    return _ACTIONS[kind](**config)
+
+
+class RuleEngine(object):
+    """Evaluates compiled rules and dispatches their notifications."""
+
+    def __init__(self, rules, actions, metrics=None, labels=None, attribution=None):
+        self.rules = rules
+        self._actions = actions
+        self._metrics = metrics
+        # Held, not copied, so that resource label updates apply
+        self._labels = labels if labels is not None else {}
+        self._attribution = attribution
+
+    def evaluate(self, samples):
+        """Evaluates all rules against a batch. Returns the notifications."""
+
+        columns = Columns(samples)
+        if columns.now is None:
+            return []
+        notifications = []
+        for rule in self.rules:
+            for gpu, state, details in rule.evaluate(columns):
+                notification = {'rule': rule.name, 'state': state, 'gpu': gpu,
+                                'field_id': rule.field_id}
+                notification.update(details)
+                notification.update(self._labels)
+                if self._attribution is not None:
+                    notification.update(self._attribution.labels(gpu))
+                notifications.append(notification)
+                self._dispatch(rule, notification)
+        return notifications
+
+    def _dispatch(self, rule, notification):
+        logging.info('Alert {} {} on GPU {}'.format(
+            notification['rule'], notification['state'], notification['gpu']))
+        if self._metrics is not None:
+            self._metrics.alert_events.labels(state=notification['state']).inc()
+        for name in rule.actions:
+            try:
+                self._actions[name].send(notification)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Alert action {} failed: {}'.format(name, err))
+                if self._metrics is not None:
+                    self._metrics.alert_action_errors.labels(action=name).inc()
+
+    def close(self):
+        for action in self._actions.values():
+            action.close()
+
+
+def load_rules(config, field_names=None, metrics=None, labels=None, attribution=None):
+    """Compiles a rules config (a dict or a JSON file path) into an engine.
+
+    field_names maps metric names to DCGM field ids.
+    """
+
+    if not isinstance(config, dict):
+        with open(config) as f:
+            config = json.load(f)
+    field_names = field_names or {}
+    actions = {name: create_action(action)
+               for name, action in config.get('actions', {}).items()}
+
+    rules = []
+    for item in config.get('rules', []):
+        field = item['field']
+        field_id = field if isinstance(field, int) else field_names.get(field)
+        if field_id is None:
+            raise ValueError('Rule {}: unknown field {}'.format(item['name'], field))
+        unknown = [name for name in item.get('actions', []) if name not in actions]
+        if unknown:
+            raise ValueError('Rule {}: unknown actions {}'.format(item['name'], unknown))
+        rules.append(Rule(item['name'], item['type'], field_id, item.get('actions', []),
+                          op=item.get('op'), value=item.get('value'),
+                          for_seconds=item.get('for_seconds', 0),
+                          seconds=item.get('seconds'), gpus=item.get('gpus')))
+    return RuleEngine(rules, actions, metrics, labels, attribution)
@@ -0,0 +1,170 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+import agent_metrics
+import alert_rules
+from exporters import Sample
+
+START = 1600000000
+SM_ACTIVE = 1002
+POWER_USAGE = 155
+
+
+def _batch(second, values, field_id=SM_ACTIVE):
+    # values: {gpu: [value per 100 ms]}
+    return [Sample(gpu, field_id, (START + second) * 10**6 + i * 100000, value)
+            for gpu, series in values.items() for i, value in enumerate(series)]
+
+
+def _engine(rules, tmp_path, metrics=None):
+    config = {'actions': {'log': {'type': 'file', 'path': str(tmp_path / 'alerts.jsonl')}},
+              'rules': [dict(rule, actions=['log']) for rule in rules]}
+    return alert_rules.load_rules(config, {'sm_active': SM_ACTIVE}, metrics,
+                                  labels={'instance_id': 'vm-1'})
+
+
+def _transitions(notifications):
+    return [(n['rule'], n['gpu'], n['state']) for n in notifications]
+
+
+def test_threshold_catches_spikes_between_exports(tmp_path):
+    engine = _engine([{'name': 'hot', 'type': 'threshold', 'field': 'sm_active',
+                       'op': '>', 'value': 0.9}], tmp_path)
+    # A single sample over the threshold inside the batch fires
+    fired = engine.evaluate(_batch(0, {0: [0.5] * 5 + [0.95] + [0.5] * 4, 1: [0.5] * 10}))
+    assert _transitions(fired) == [('hot', 0, 'firing'), ('hot', 0, 'resolved')]
+    assert fired[0]['value'] == 0.95
+    assert fired[0]['timestamp'] == START + 0.5
+    assert fired[0]['instance_id'] == 'vm-1'
+    assert fired[1]['timestamp'] == START + 0.6
+
+    fired = engine.evaluate(_batch(1, {0: [0.95] * 10, 1: [0.5] * 10}))
+    assert _transitions(fired) == [('hot', 0, 'firing')]
+    assert engine.evaluate(_batch(2, {0: [0.95] * 10})) == []
+
+    engine.close()
+    with open(str(tmp_path / 'alerts.jsonl')) as f:
+        assert [json.loads(line)['state'] for line in f] == ['firing', 'resolved', 'firing']
+
+
+def test_threshold_for_seconds_spans_batches(tmp_path):
+    engine = _engine([{'name': 'hot', 'type': 'threshold', 'field': SM_ACTIVE,
+                       'op': '>=', 'value': 0.9, 'for_seconds': 15}], tmp_path)
+    fired = []
+    for second in range(0, 50, 10):
+        value = 0.2 if second == 0 else 0.95
+        fired.append(_transitions(engine.evaluate(_batch(second, {0: [value] * 10}))))
+    # Violating since 10 s, firing with the first sample 15 s later
+    assert fired == [[], [], [], [('hot', 0, 'firing')], []]
+    engine.close()
+
+
+def test_rate(tmp_path):
+    engine = _engine([{'name': 'jump', 'type': 'rate', 'field': SM_ACTIVE,
+                       'op': '>', 'value': 1.0}], tmp_path)
+    assert engine.evaluate(_batch(0, {0: [0.1] * 10})) == []
+    # 0.1 -> 0.5 across the batch boundary in 100 ms is 4 per second
+    fired = engine.evaluate(_batch(1, {0: [0.5] * 10}))
+    assert _transitions(fired) == [('jump', 0, 'firing'), ('jump', 0, 'resolved')]
+    assert fired[0]['value'] == pytest.approx(4.0)
+    assert engine.evaluate(_batch(2, {0: [0.5] * 10})) == []
+    engine.close()
+
+
+def test_absence(tmp_path):
+    metrics = agent_metrics.AgentMetrics()
+    engine = _engine([{'name': 'no_power', 'type': 'absence', 'field': POWER_USAGE,
+                       'seconds': 30}], tmp_path, metrics)
+    transitions = []
+    for second in range(0, 100, 10):
+        samples = _batch(second, {0: [0.5], 1: [0.5]})
+        # GPU 1 stops reporting power after 20 s
+        gpus = (0, 1) if second <= 20 else (0,)
+        samples += _batch(second, {gpu: [100.0] for gpu in gpus}, POWER_USAGE)
+        transitions += [(second,) + t for t in _transitions(engine.evaluate(samples))]
+    assert transitions == [(50, 'no_power', 1, 'firing')]
+    assert metrics.alert_events.labels(state='firing').value == 1
+    engine.close()
+
+
+def test_absence_on_all_gpus(tmp_path):
+    engine = _engine([{'name': 'no_power', 'type': 'absence', 'field': POWER_USAGE,
+                       'seconds': 30},
+                      {'name': 'power_rate', 'type': 'rate', 'field': POWER_USAGE,
+                       'op': '>', 'value': 100}], tmp_path)
+    transitions = []
+    for second in range(0, 100, 10):
+        samples = _batch(second, {0: [0.5], 1: [0.5]})
+        # Power disappears from every GPU after 20 s
+        if second <= 20:
+            samples += _batch(second, {0: [100.0], 1: [100.0]}, POWER_USAGE)
+        transitions += [(second,) + t for t in _transitions(engine.evaluate(samples))]
+    assert transitions == [(50, 'no_power', 0, 'firing'), (50, 'no_power', 1, 'firing')]
+    engine.close()
+
+
+def test_gpu_filter_and_validation(tmp_path):
+    engine = _engine([{'name': 'hot', 'type': 'threshold', 'field': SM_ACTIVE,
+                       'op': '>', 'value': 0.9, 'gpus': [1]}], tmp_path)
+    assert _transitions(engine.evaluate(_batch(0, {0: [1.0], 1: [1.0]}))) == [
+        ('hot', 1, 'firing')]
+    engine.close()
+
+    with pytest.raises(ValueError):
+        _engine([{'name': 'bad', 'type': 'threshold', 'field': 'nope', 'op': '>',
+                  'value': 1}], tmp_path)
+    with pytest.raises(ValueError):
+        _engine([{'name': 'bad', 'type': 'threshold', 'field': SM_ACTIVE, 'op': '~',
+                  'value': 1}], tmp_path)
+    with pytest.raises(ValueError):
+        alert_rules.load_rules({'rules': [{'name': 'bad', 'type': 'absence',
+                                           'field': SM_ACTIVE, 'seconds': 5,
+                                           'actions': ['missing']}]})
+
+
+def test_socket_action_and_failures(tmp_path):
+    path = str(tmp_path / 'alerts.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    received = []
+
+    def accept():
+        connection, _ = server.accept()
+        received.append(connection.makefile().readline())
+        connection.close()
+
+    thread = threading.Thread(target=accept)
+    thread.start()
+    metrics = agent_metrics.AgentMetrics()
+    engine = alert_rules.load_rules({
+        'actions': {'sock': {'type': 'socket', 'address': 'unix:' + path},
+                    'down': {'type': 'socket', 'address': 'unix:' + path + '.missing'}},
+        'rules': [{'name': 'hot', 'type': 'threshold', 'field': SM_ACTIVE, 'op': '>',
+                   'value': 0.9, 'actions': ['sock', 'down']}]}, metrics=metrics)
+    engine.evaluate(_batch(0, {0: [1.0]}))
+    thread.join()
+    server.close()
+    os.remove(path)
+
+    assert json.loads(received[0])['rule'] == 'hot'
+    assert metrics.alert_action_errors.labels(action='down').value == 1
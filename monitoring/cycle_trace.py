@@ -0,0 +1,180 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Structured per-cycle trace records written as JSON lines."""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+class JsonLinesWriter(object):
+    """Appends JSON records to a size-rotated file using buffered writes."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUP_COUNT, buffer_size=DEFAULT_BUFFER_SIZE):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = None
+        self._size = 0
+        self._open()
+
+    def _open(self):
+        self._file = open(self._path, 'a', buffering=self._buffer_size)
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self._backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self._path, index)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self._path, index + 1))
+        if self._backup_count > 0:
+            os.replace(self._path, self._path + '.1')
+        else:
+            os.remove(self._path)
+        self._open()
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            if self._size and self._size + len(line) > self._max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+class CycleSpan(object):
+    """Timing and outcome of a single sampling/export cycle.
+
+    Exporter sinks that finish after the cycle itself hold the span until
+    they have reported; the span is completed when the last hold is released.
+    """
+
+    def __init__(self, cycle_id, scheduled_start, detailed=False, on_complete=None):
+        self.cycle_id = cycle_id
+        self.scheduled_start = scheduled_start
+        self.actual_start = time.time()
+        # Attributes that are expensive to compute are only collected
+        # when the span is going to be written
+        self.detailed = detailed
+        self.phases = {}
+        self.attributes = {}
+        self._start = time.monotonic()
+        self.duration = None
+        self._lock = threading.Lock()
+        self._holds = 1
+        self._on_complete = on_complete
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as the named phase."""
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - start)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def increment(self, name, amount=1):
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def set_sink(self, name, **attributes):
+        """Records the outcome of exporting this cycle's samples to a sink."""
+
+        with self._lock:
+            self.attributes.setdefault('sinks', {})[name] = attributes
+
+    def hold(self):
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            complete = self._holds == 0
+        if complete and self._on_complete is not None:
+            self._on_complete(self)
+
+    def end(self):
+        self.duration = time.monotonic() - self._start
+        self.release()
+
+    def to_record(self):
+        record = {
+            'cycle_id': self.cycle_id,
+            'scheduled_start': self.scheduled_start,
+            'actual_start': self.actual_start,
+            'lateness': self.actual_start - self.scheduled_start,
+            'duration': self.duration,
+            'phases': self.phases,
+        }
+        record.update(self.attributes)
+        return record
+
+
+class CycleTracer(object):
+    """Creates cycle spans and writes finished spans to a JSON lines file."""
+
+    def __init__(self, writer=None):
+        self._writer = writer
+        self._next_id = 0
+
+    def start_cycle(self, scheduled_start):
+        self._next_id += 1
+        return CycleSpan(self._next_id, scheduled_start,
+                         detailed=self._writer is not None,
+                         on_complete=self._write)
+
+    def _write(self, span):
+        if self._writer is not None:
+            self._writer.write(span.to_record())
+
+    def finish(self, span):
+        """Ends the cycle; the record is written once all sinks reported."""
+
+        span.end()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,90 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import time
+
+import cycle_trace
+
+
+def _read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_cycle_record(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    tracer = cycle_trace.CycleTracer(cycle_trace.JsonLinesWriter(path))
+
+    scheduled = time.time() - 0.5
+    span = tracer.start_cycle(scheduled)
+    assert span.detailed
+    with span.phase('fetch'):
+        time.sleep(0.01)
+    span.add_phase('export', 0.25)
+    span.set(series_count=14, rpc_status='OK', retries=0)
+    span.increment('retries')
+    tracer.finish(span)
+    tracer.close()
+
+    records = _read_records(path)
+    assert len(records) == 1
+    record = records[0]
+    assert record['cycle_id'] == 1
+    assert record['scheduled_start'] == scheduled
+    assert record['lateness'] >= 0.5
+    assert record['phases']['fetch'] >= 0.01
+    assert record['phases']['export'] == 0.25
+    assert record['series_count'] == 14
+    assert record['retries'] == 1
+    assert record['duration'] >= record['phases']['fetch']
+
+
+def test_tracer_without_writer():
+    tracer = cycle_trace.CycleTracer()
+    first = tracer.start_cycle(time.time())
+    second = tracer.start_cycle(time.time())
+
+    assert not first.detailed
+    assert (first.cycle_id, second.cycle_id) == (1, 2)
+    tracer.finish(first)
+    tracer.close()
+
+
+def test_rotation(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    writer = cycle_trace.JsonLinesWriter(path, max_bytes=200, backup_count=2,
+                                         buffer_size=64)
+    for index in range(30):
+        writer.write({'cycle_id': index, 'padding': 'x' * 20})
+    writer.close()
+
+    assert os.path.exists(path + '.1')
+    assert os.path.exists(path + '.2')
+    assert not os.path.exists(path + '.3')
+    for name in (path, path + '.1', path + '.2'):
+        assert os.path.getsize(name) <= 200
+    assert _read_records(path)[-1]['cycle_id'] == 29
+
+
+def test_appends_to_existing_file(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    for cycle_id in (1, 2):
+        writer = cycle_trace.JsonLinesWriter(path)
+        writer.write({'cycle_id': cycle_id})
+        writer.close()
+
+    assert [r['cycle_id'] for r in _read_records(path)] == [1, 2]
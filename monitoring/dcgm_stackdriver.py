@@ -15,7 +15,9 @@
 """A command line utility that monitors attached GPUs and 
 reports the stats to Cloud Monitoring"""
 
+import os
 import requests
+import tempfile
 import time
 import datetime
 import dcgm_fields
@@ -24,24 +26,49 @@ from absl import app
 from absl import flags
 from absl import logging
 
-from google.api_core import exceptions
 from google.cloud import monitoring_v3
 
 from DcgmReader import DcgmReader
 
+import agent_metrics
+import alert_rules
+import cycle_trace
+import entities
+import exporters
+import health_monitor
+import idle_detector
+import job_attribution
+import kubernetes_resources
+import metadata_watcher
+import nvml_reader
+import profiling
+import prometheus_exporter
+import quantile_sketch
+import rate_limit
+import remote_collector
+import rollups
+import routing
+import sample_store
+import shutdown
+import spool
+import synthetic_reader
+import watchdog
+
 FLAGS = flags.FLAGS
 
 FIELD_GROUP_NAME = 'dcgm_stackdriver'
 GLOBAL_RESOURCE_TYPE = 'global'
 GCE_RESOUCE_TYPE = 'gce_instance'
 
-# DCGM fields to SD metrics mapping
+# DCGM fields to SD metrics mapping. Fields with a lower priority value are
+# written first when the write budget is tight.
 DCGM_FIELDS = {
     # Equivalents of the basic metrics in nvidia-smi
     dcgm_fields.DCGM_FI_DEV_GPU_UTIL: # 203
         {
             'name': 'custom.googleapis.com/gce/gpu-test/utilization',
             'desc': 'GPU utilization',
+            'priority': 0,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64,
             'sd_units': '%',
@@ -51,6 +78,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/mem_used',
             'desc': 'GPU memory used',
+            'priority': 0,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64, 
             'sd_units': 'MBy',
@@ -60,6 +88,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/power_usage',
             'desc': 'Power usage',
+            'priority': 0,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE, 
             'sd_units': 'watt',
@@ -70,6 +99,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/gr_engine_active',
             'desc': 'Ratio of time the graphics engine is active',
+            'priority': 2,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE, 
             'sd_units': 'ratio',
@@ -79,6 +109,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/sm_active',
             'desc': 'Ratio of cycles an SM has at least 1 warp assigned',
+            'priority': 1,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE,  
             'sd_units': 'ratio',
@@ -88,6 +119,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/sm_occupancy',
             'desc': 'Ratio of number of warps resident on an SM',
+            'priority': 2,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE, 
             'sd_units': 'ratio',
@@ -97,6 +129,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/memory_active',
             'desc': 'Ratio of cycles the device memory inteface is active sending or receiving data',
+            'priority': 1,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE, 
             'sd_units': 'ratio',
@@ -106,6 +139,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/tensor_active',
             'desc': 'Ratio of cycles the tensor cores are active',
+            'priority': 1,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE, 
             'sd_units': 'ratio',
@@ -115,6 +149,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/fp32_active',
             'desc': 'Ratio of cycles the FP32 cores are active',
+            'priority': 2,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE, 
             'sd_units': 'ratio',
@@ -124,6 +159,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/pcie_tx_throughput',
             'desc': 'PCIE transmit througput',
+            'priority': 3,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64, 
             #'sd_units': 'number',
@@ -133,6 +169,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/pcie_rx_throughput',
             'desc': 'PCIE receive througput',
+            'priority': 3,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64, 
             #'sd_units': 'number',
@@ -142,6 +179,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/nvlink_tx_throughput',
             'desc': 'NVLink transmit througput',
+            'priority': 3,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64, 
             #'sd_units': 'number',
@@ -151,6 +189,7 @@ DCGM_FIELDS = {
         {
             'name': 'custom.googleapis.com/gce/gpu-test/nvlink_rx_throughput',
             'desc': 'NVLink receive througput',
+            'priority': 3,
             'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
             'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64, 
             #'sd_units': 'number',
@@ -164,6 +203,17 @@ DCGM_FIELDS = {
     # dcgm_fields.DCGM_FI_PROF_PIPE_FP16_ACTIVE:
 }
 
+# Metrics derived from DCGM fields served on the Prometheus endpoint.
+# Each derived series is the sum of its source fields.
+PROMETHEUS_DERIVED_METRICS = {
+    'dcgm_pcie_throughput': (
+        'PCIE transmit and receive throughput',
+        (dcgm_fields.DCGM_FI_PROF_PCIE_TX_BYTES, dcgm_fields.DCGM_FI_PROF_PCIE_RX_BYTES)),
+    'dcgm_nvlink_throughput': (
+        'NVLink transmit and receive throughput',
+        (dcgm_fields.DCGM_FI_PROF_NVLINK_TX_BYTES, dcgm_fields.DCGM_FI_PROF_NVLINK_RX_BYTES)),
+}
+
 
 _GCP_METADATA_URI = 'http://metadata.google.internal/computeMetadata/v1/'
 _GCP_METADATA_URI_HEADER = {'Metadata-Flavor': 'Google'}
@@ -181,144 +231,172 @@ _GCE_ATTRIBUTES = {
     }
 }
 
-def get_gce_resource_labels():
+_GKE_NODE_ATTRIBUTES = {
+    'project_id': {
+        'metadata_key': 'project/project-id'
+    },
+    'location': {
+        'metadata_key': 'instance/attributes/cluster-location',
+    },
+    'cluster_name': {
+        'metadata_key': 'instance/attributes/cluster-name',
+    },
+    'node_name': {
+        'metadata_key': 'instance/name',
+    }
+}
+
+def get_gce_resource_labels(attributes=_GCE_ATTRIBUTES):
     """Retrieve GCE metadata and sets GCE instance resource labels."""
 
     resource_labels = {}
-    for label, gce_metadata in _GCE_ATTRIBUTES.items():
+    for label, gce_metadata in attributes.items():
         response = requests.get(_GCP_METADATA_URI + gce_metadata['metadata_key'], 
                                 headers=_GCP_METADATA_URI_HEADER)
 
-        if 'transformation' in _GCE_ATTRIBUTES[label]:
-            label_value = _GCE_ATTRIBUTES[label]['transformation'](response.text)
+        if 'transformation' in attributes[label]:
+            label_value = attributes[label]['transformation'](response.text)
         else:
             label_value = response.text
-        resource_labels[label] = label_value.decode('utf-8')
+        resource_labels[label] = label_value
 
     return resource_labels
 
 
 
+def watch_metadata(watcher, sinks, resource_labels, attributes, metrics, flush_seconds):
+    """Keeps the resource labels current and flushes the sinks before preemption."""
+
+    def on_attributes(_):
+        metrics.metadata_events.labels(event='attributes_changed').inc()
+        labels = get_gce_resource_labels(attributes)
+        if labels != resource_labels:
+            logging.info('Resource labels changed to {}'.format(labels))
+            # Updated in place: the exporters and the Kubernetes resources hold
+            # this dict, the routes were resolved at startup
+            resource_labels.update(labels)
+
+    def flush(reason):
+        logging.info('{}, flushing the sinks'.format(reason))
+        if not sinks.flush(flush_seconds):
+            logging.info('Flush did not finish within {} seconds'.format(flush_seconds))
+
+    def on_preempted(value):
+        if value.strip() == 'TRUE':
+            metrics.metadata_events.labels(event='preempted').inc()
+            flush('Instance preempted')
+
+    def on_maintenance(value):
+        if value.strip() != 'NONE':
+            metrics.metadata_events.labels(event='maintenance').inc()
+            flush('Host maintenance event {}'.format(value.strip()))
+
+    watcher.watch(metadata_watcher.ATTRIBUTES, on_attributes)
+    watcher.watch(metadata_watcher.PREEMPTED, on_preempted, initial=True)
+    watcher.watch(metadata_watcher.MAINTENANCE_EVENT, on_maintenance)
+
+
 class DcgmStackdriver(DcgmReader):
     """
-    Custom DCGM reader that pushes DCGM metrics to GCP Cloud Monitoring
+    Custom DCGM reader that publishes DCGM metrics to the exporter sinks
     """
  
-    def __init__(self, update_frequency, fields_to_watch, project_id, resource_type, resource_labels):
+    def __init__(self, update_frequency, fields_to_watch, sinks, metrics=None,
+                 sampling_interval_ms=None, raise_when_disconnected=False, topology=None,
+                 hostname='localhost', watermarks=None):
        
-        DcgmReader.__init__(self, fieldIds=fields_to_watch.keys(), 
+        # DCGM samples the fields every sampling interval, all samples
+        # since the previous cycle are published every update_frequency
+        if sampling_interval_ms is None:
+            sampling_interval_ms = update_frequency * 1000
+        DcgmReader.__init__(self, hostname=hostname, fieldIds=fields_to_watch.keys(), 
                             fieldGroupName=FIELD_GROUP_NAME, 
-                            updateFrequency=update_frequency * 1000 * 1000)
+                            updateFrequency=sampling_interval_ms * 1000)
         
         self._fields_to_watch = fields_to_watch
-        self._project_id = project_id
-        self._resource_type = resource_type
-        self._resource_labels = resource_labels
-
-        self._client =  monitoring_v3.MetricServiceClient()
-        self._project_name = self._client.project_path(self._project_id)
-        self._create_sd_metric_descriptors()
+        self._sinks = sinks
         self._counter = 0
-    
-    def _create_sd_metric_descriptors(self):
-        """
-        Creates SD metric descriptors for the watched DCGM fields.
-        """
-        project_name = self._client.project_path(self._project_id) 
-        for key, item in self._fields_to_watch.items():
-            descriptor = monitoring_v3.types.MetricDescriptor()
-            descriptor.type = item['name']
-            descriptor.metric_kind = item['metric_kind'] 
-            descriptor.value_type =  item['value_type']
-            descriptor.description = item['desc']
-            if 'sd_units' in item.keys():
-                descriptor.unit = item['sd_units']
-            descriptor = self._client.create_metric_descriptor(project_name, descriptor)
-
-
-    def _add_point(self, series, field_id, field):
-        """Adds a point to SD time series."""
-
-        if 'value_converter' in self._fields_to_watch[field_id]:
-            field_value = self._fields_to_watch[field_id]['value_converter'](field.value)
-        else:
-            field_value = field.value 
-
-        seconds = field.ts // 10**6
-        nanos = (field.ts % 10**6) * 10**3
-        point = series.points.add()
-        point.interval.end_time.seconds = seconds
-        point.interval.end_time.nanos = nanos 
-
-        sd_value_type = self._fields_to_watch[field_id]['value_type']
-        if sd_value_type == monitoring_v3.enums.MetricDescriptor.ValueType.INT64:
-            point.value.int64_value = field_value
-        elif sd_value_type == monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE:
-            point.value.double_value = field_value
-        elif sd_value_type == monitoring_v3.enums.MetricDescriptor.ValueType.BOOL:
-            point.value.bool = field_value 
-        elif sd_value_type == monitoring_v3.enums.MetricDescriptor.ValueType.STRING: 
-            point.value.string = field_value
-        else:
-            raise TypeError('Unsupported metric type: {}'.format(sd_value_type))
-
-
-    def _construct_sd_series(self, field_id, field_time_series, metric_labels):
-        """Constructs SD time series from the DCGM field time_series."""
-
-        series = None
-        field = field_time_series[-1]
-        if (field_id in self._fields_to_watch.keys()) and (not field.isBlank):
 
-            series = monitoring_v3.types.TimeSeries()
-            series.resource.type = self._resource_type
-            for label_key, label_value in self._resource_labels.items():
-                series.resource.labels[label_key] = label_value
+        self._metrics = metrics or agent_metrics.AgentMetrics()
+        self._handler_seconds = 0.0
+        self._span = None
+        self._raise_when_disconnected = raise_when_disconnected
+        # With a topology the MIG instances are watched and published too
+        self._topology = topology
+        self._entity_values = None
+        # Restored watermarks let the first measurement be published
+        self._watermarks = watermarks if watermarks is not None and watermarks.restored else None
 
-            series.metric.type = self._fields_to_watch[field_id]['name']
-            for label_key, label_value in metric_labels.items():
-                series.metric.labels[label_key] = label_value
-            self._add_point(series, field_id, field)
-
-        return series
 
+    def Process(self, span=None):
+        """
+        Fetches the latest field values and records how long DCGM took.
+        """
 
-    def _create_time_series(self, fvs):
+        self._span = span or cycle_trace.CycleSpan(0, time.time())
+        start = time.monotonic()
+        self._handler_seconds = 0.0
+        DcgmReader.Process(self)
+        fetch_seconds = time.monotonic() - start - self._handler_seconds
+        self._metrics.dcgm_fetch_latency.observe(fetch_seconds)
+        self._span.add_phase('fetch', fetch_seconds)
+        # DcgmReader logs and drops its handle when nv-hostengine is down
+        if self._raise_when_disconnected and getattr(self, 'm_dcgmHandle', True) is None:
+            raise nvml_reader.ReaderUnavailable('Cannot connect to nv-hostengine')
+
+    def close(self):
+        self.Shutdown()
+
+    def InitializeFromHandle(self):
         """
-        Calls SD to create time series based on the latest values
-        of DCGM watched fields/
+        Sets up the field group, adding the MIG instances in MIG mode.
         """
-        time_series = []
-        for gpu in fvs:
-            for field_id, field_time_series in fvs[gpu].items():
-                metric_labels = {'gpu': str(gpu)}
-                series = self._construct_sd_series(field_id, field_time_series, metric_labels)
-                if series:
-                    time_series.append(series)
+
+        DcgmReader.InitializeFromHandle(self)
+        if self._topology is None:
+            return
+        entities.read_dcgm_topology(self.m_dcgmHandle.handle, self.m_dcgmGroup.GetGpuIds(),
+                                    self._topology)
+        instances = [entity for entity in self._topology.entities()
+                     if entity.group != entities.ENTITY_GPU]
+        for entity in instances:
+            self.m_dcgmGroup.AddEntity(entity.group, entity.entity_id)
+        # Watches only cover the entities in the group when they are set
+        self.m_dcgmGroup.samples.WatchFields(self.m_fieldGroup, self.m_updateFreq,
+                                             self.m_maxKeepAge, 0)
+        self._entity_values = None
+        logging.info('Watching {} MIG instances'.format(len(instances)))
+
+    def _entity_samples(self):
+        # GetAllSinceLastCall_v2 keeps its own cursor in the collection
+        self._entity_values = self.m_dcgmGroup.samples.GetAllSinceLastCall_v2(
+            self._entity_values, self.m_fieldGroup)
+        samples, blank = exporters.samples_from_entity_fvs(self._entity_values.values)
+        self._entity_values.EmptyValues()
+        return samples, blank
         
-        if time_series:
-            try:
-                self._client.create_time_series(
-                    name=self._project_name, 
-                    time_series=time_series)
-                logging.info('Successfully logged time series')
-            except exceptions.GoogleAPICallError as err:
-                logging.info(err)
-            except exceptions.RetryError as err:
-                logging.info('Retry attempts to create time series failed')
-            except Exception:    
-                logging.info('Create_time_series: exception encountered')
-            
         
     def CustomDataHandler(self, fvs):
         """
-        Writes reported field values to Cloud Monitoring.
+        Publishes reported field values to the exporter sinks.
         """
 
+        start = time.monotonic()
         self._counter += 1 
-        # Skip the first measurement to avoid duplicates in DCGM
-        if self._counter > 1:
-            self._create_time_series(fvs)
+        # Skip the first measurement to avoid duplicates in DCGM, unless the
+        # watermarks of the previous run tell which samples are new
+        if self._counter > 1 or self._watermarks is not None:
+            if self._topology is None:
+                samples, blank = exporters.samples_from_fvs(fvs)
+            else:
+                samples, blank = self._entity_samples()
+            if self._counter == 1:
+                samples = self._watermarks.newer(samples)
+            self._metrics.blank_values.inc(blank)
+            self._span.set(samples=len(samples))
+            with self._span.phase('publish'):
+                self._sinks.publish(samples, self._span)
+        self._handler_seconds = time.monotonic() - start
     
     def LogInfo(self, msg):
         logging.info(msg)  # pylint: disable=no-member
@@ -327,6 +405,131 @@ class DcgmStackdriver(DcgmReader):
         logging.info(msg)  # pylint: disable=no-member
 
 
+def create_sinks(metrics, resource_type, resource_labels, attribution=None, topology=None,
+                 host_label=False, resources=None, watermarks=None):
+    """Creates the exporter sinks selected on the command line."""
+
+    exporter_list = []
+    servers = []
+    rollup_forward = None
+    for name in FLAGS.exporters:
+        if name == exporters.CloudMonitoringExporter.name:
+            # Destinations share the client and its connections
+            client = monitoring_v3.MetricServiceClient()
+
+            def cloud_monitoring_factory(project_id):
+                return exporters.CloudMonitoringExporter(
+                    client=client,
+                    project_id=project_id,
+                    fields=DCGM_FIELDS,
+                    resource_type=resource_type,
+                    resource_labels=resource_labels,
+                    metrics=metrics,
+                    agent_metrics_interval=(FLAGS.agent_metrics_interval
+                                            if project_id == FLAGS.project_id else None),
+                    timeout=FLAGS.update_interval,
+                    attribution=attribution,
+                    topology=topology,
+                    host_label=host_label,
+                    budget=rate_limit.WriteBudget(
+                        points_per_second=FLAGS.write_points_per_second,
+                        requests_per_minute=FLAGS.write_requests_per_minute),
+                    distributions=FLAGS.write_distributions,
+                    resources=resources,
+                    client_factory=monitoring_v3.MetricServiceClient)
+
+            if FLAGS.routes:
+                cloud_monitoring = exporters.RoutingExporter(
+                    routing.Router(routing.load_routes(FLAGS.routes), FLAGS.project_id,
+                                   resource_labels, attribution, topology),
+                    cloud_monitoring_factory)
+            else:
+                cloud_monitoring = cloud_monitoring_factory(FLAGS.project_id)
+            if FLAGS.cloud_monitoring_rollups:
+                rollup_forward = exporters.QueuedExporter(
+                    cloud_monitoring, metrics, queue_size=FLAGS.sink_queue_size)
+            else:
+                exporter_list.append(cloud_monitoring)
+        elif name == exporters.GatewayExporter.name:
+            exporter_list.append(exporters.GatewayExporter(
+                FLAGS.gateway_address, FLAGS.project_id, DCGM_FIELDS, resource_type,
+                resource_labels, metrics, attribution=attribution, topology=topology,
+                host_label=host_label))
+        elif name == exporters.FileExporter.name:
+            exporter_list.append(exporters.FileExporter(FLAGS.export_file, DCGM_FIELDS,
+                                                        attribution=attribution,
+                                                        topology=topology))
+        elif name == exporters.StdoutExporter.name:
+            exporter_list.append(exporters.StdoutExporter(DCGM_FIELDS,
+                                                          attribution=attribution,
+                                                          topology=topology))
+        elif name == exporters.OtlpExporter.name:
+            exporter_list.append(exporters.OtlpExporter(
+                FLAGS.otlp_endpoint, DCGM_FIELDS, resource_labels,
+                attribution=attribution, topology=topology))
+
+    if FLAGS.store_dir:
+        exporter_list.append(exporters.SampleStoreExporter(sample_store.SampleStore(
+            FLAGS.store_dir,
+            retention_bytes=FLAGS.store_retention_mb * 1024 * 1024,
+            retention_seconds=FLAGS.store_retention_hours * 3600)))
+
+    if FLAGS.store_dir or rollup_forward is not None:
+        resolutions = [int(resolution) for resolution in FLAGS.rollup_resolutions]
+        rollup_store = None
+        if FLAGS.store_dir:
+            rollup_store = rollups.RollupStore(os.path.join(FLAGS.store_dir, 'rollups'),
+                                               resolutions)
+        exporter_list.append(exporters.RollupExporter(
+            rollups.RollupEngine(resolutions), rollup_store, rollup_forward))
+
+    if FLAGS.sketch_file:
+        sketches = quantile_sketch.SketchSet(alpha=FLAGS.sketch_alpha)
+        if os.path.exists(FLAGS.sketch_file):
+            sketches = quantile_sketch.SketchSet.load(FLAGS.sketch_file)
+        exporter_list.append(exporters.QuantileSketchExporter(
+            sketches, FLAGS.sketch_file,
+            field_ids=[int(field_id) for field_id in FLAGS.sketch_fields],
+            job_for_gpu=attribution.job if attribution is not None else None))
+
+    # Idle detection keys its state by GPU index only, like the sketches and rules
+    if FLAGS.idle_detection and not host_label:
+        exporter_list.append(exporters.IdleDetectorExporter(
+            idle_detector.IdleDetector(idle_seconds=FLAGS.idle_seconds,
+                                       stall_seconds=FLAGS.stall_seconds,
+                                       recover_seconds=FLAGS.recover_seconds),
+            idle_detector.IdleEventLog(FLAGS.idle_event_log or None, metrics, attribution)))
+
+    if FLAGS.alert_rules:
+        field_names = {item['name'].rsplit('/', 1)[-1]: field_id
+                       for field_id, item in DCGM_FIELDS.items()}
+        exporter_list.append(exporters.AlertRulesExporter(alert_rules.load_rules(
+            FLAGS.alert_rules, field_names, metrics, resource_labels, attribution)))
+
+    if FLAGS.prometheus_port:
+        exposition = prometheus_exporter.ExpositionBuffer(DCGM_FIELDS,
+                                                          PROMETHEUS_DERIVED_METRICS,
+                                                          topology)
+        servers.append(prometheus_exporter.PrometheusServer(
+            exposition, FLAGS.prometheus_port, FLAGS.prometheus_address))
+        exporter_list.append(exporters.PrometheusExporter(exposition))
+
+    sinks = exporters.FanOut(
+        [exporters.QueuedExporter(exporter, metrics, queue_size=FLAGS.sink_queue_size)
+         for exporter in exporter_list], watermarks,
+        downstream=[rollup_forward] if rollup_forward is not None else ())
+    return sinks, servers
+
+
+def get_log_dir():
+    """Returns the directory the agent log is written to."""
+
+    log_file = logging.get_log_file_name()
+    if log_file:
+        return os.path.dirname(os.path.abspath(log_file))
+    return FLAGS.log_dir or tempfile.gettempdir()
+
+
 def main(argv):
     del argv
     
@@ -335,37 +538,359 @@ def main(argv):
 
     logging.info('Entering monitoring loop with update interval: ' + str(FLAGS.update_interval))
 
-    # Only GCE resource type supported at this point
-    # In future GKE will be added
+    resources = None
     if FLAGS.resource_type == GCE_RESOUCE_TYPE:
-        resource_labels = get_gce_resource_labels()
+        metadata_attributes = _GCE_ATTRIBUTES
+        resource_labels = get_gce_resource_labels(metadata_attributes)
         resource_type = GCE_RESOUCE_TYPE
+    elif FLAGS.resource_type in (kubernetes_resources.K8S_NODE,
+                                 kubernetes_resources.K8S_CONTAINER):
+        # The agent's own metrics and unallocated GPUs stay on the node
+        metadata_attributes = _GKE_NODE_ATTRIBUTES
+        resource_labels = get_gce_resource_labels(metadata_attributes)
+        resource_type = kubernetes_resources.K8S_NODE
+        if FLAGS.resource_type == kubernetes_resources.K8S_CONTAINER:
+            resources = kubernetes_resources.KubernetesResources(
+                kubernetes_resources.PodResourcesClient(FLAGS.pod_resources_socket),
+                resource_labels,
+                uuids=kubernetes_resources.nvml_gpu_uuids(),
+                refresh_seconds=FLAGS.pod_resources_refresh_seconds)
     else:
         raise ValueError('Unsupported resource type: {}'.format(FLAGS.resource_type))
 
-    with DcgmStackdriver(fields_to_watch=DCGM_FIELDS, 
-                         update_frequency=FLAGS.update_interval,
-                         project_id=FLAGS.project_id,
-                         resource_type=resource_type,
-                         resource_labels=resource_labels) as dcgm_reader:
+    profiler = None
+    if FLAGS.profiling:
+        profiler = profiling.ProfilingController(
+            output_dir=os.path.join(get_log_dir(), 'profiles'),
+            control_socket=FLAGS.profiling_socket,
+            default_seconds=FLAGS.profiling_seconds)
+        profiler.start()
+
+    metrics = agent_metrics.AgentMetrics()
+    trace_writer = None
+    if FLAGS.trace_file:
+        trace_writer = cycle_trace.JsonLinesWriter(
+            FLAGS.trace_file,
+            max_bytes=FLAGS.trace_max_bytes,
+            backup_count=FLAGS.trace_backup_count)
+    tracer = cycle_trace.CycleTracer(trace_writer)
+
+    attribution = None
+    if FLAGS.job_attribution == 'nvml':
+        attribution = job_attribution.JobAttribution(
+            job_attribution.NvmlProcessSource(),
+            job_attribution.ProcResolver(FLAGS.job_env_vars),
+            refresh_seconds=FLAGS.job_refresh_seconds,
+            log_path=FLAGS.job_log or None)
+        attribution.start()
+
+    health = None
+    if FLAGS.health_monitoring == 'nvml':
+        health = health_monitor.HealthMonitor(
+            health_monitor.NvmlHealthSource(),
+            interval_seconds=FLAGS.health_interval_seconds,
+            log_path=FLAGS.health_event_log or None,
+            metrics=metrics,
+            attribution=attribution)
+        health.start()
+
+    remote = FLAGS.collector == remote_collector.REMOTE
+    if remote and not FLAGS.remote_hosts:
+        raise ValueError('--collector=remote requires --remote_hosts')
+    if remote and (FLAGS.mig or FLAGS.store_dir or FLAGS.cloud_monitoring_rollups or
+                   FLAGS.sketch_file or FLAGS.alert_rules):
+        raise ValueError('--collector=remote does not support --mig, --store_dir, '
+                         '--cloud_monitoring_rollups, --sketch_file and --alert_rules')
+
+    topology = None
+    if FLAGS.mig or (FLAGS.collector == 'synthetic' and FLAGS.synthetic_gpu_instances):
+        topology = entities.EntityTopology()
+
+    unsent_spool = None
+    watermarks = None
+    if FLAGS.spool_dir:
+        unsent_spool = spool.Spool(FLAGS.spool_dir,
+                                   max_bytes=FLAGS.spool_max_mb * 1024 * 1024)
+        watermarks = shutdown.Watermarks(os.path.join(FLAGS.spool_dir,
+                                                      shutdown.WATERMARKS_FILE))
+
+    if resources:
+        resources.start()
+    sinks, servers = create_sinks(metrics, resource_type, resource_labels, attribution,
+                                  topology, host_label=remote, resources=resources,
+                                  watermarks=watermarks)
+    for server in servers:
+        server.start()
+    if unsent_spool is not None:
+        shutdown.replay(unsent_spool, sinks)
+
+    watcher = None
+    if FLAGS.metadata_watch:
+        watcher = metadata_watcher.MetadataWatcher(_GCP_METADATA_URI, metrics=metrics)
+        watch_metadata(watcher, sinks, resource_labels, metadata_attributes, metrics,
+                       FLAGS.preemption_flush_seconds)
+        watcher.start()
+
+    def dcgm_factory(raise_when_disconnected=True):
+        return DcgmStackdriver(fields_to_watch=DCGM_FIELDS,
+                               update_frequency=FLAGS.update_interval,
+                               sinks=sinks,
+                               metrics=metrics,
+                               sampling_interval_ms=FLAGS.sampling_interval_ms,
+                               raise_when_disconnected=raise_when_disconnected,
+                               topology=topology if FLAGS.mig else None,
+                               watermarks=watermarks)
+
+    def nvml_factory():
+        return nvml_reader.NvmlReader(DCGM_FIELDS, sinks, metrics)
+
+    def remote_factory(address, host_sinks):
+        return DcgmStackdriver(fields_to_watch=DCGM_FIELDS,
+                               update_frequency=FLAGS.update_interval,
+                               sinks=host_sinks,
+                               metrics=metrics,
+                               sampling_interval_ms=FLAGS.sampling_interval_ms,
+                               raise_when_disconnected=True,
+                               hostname=address)
+
+    def reader_factory():
+        if FLAGS.collector == nvml_reader.DCGM:
+            return dcgm_factory(raise_when_disconnected=False)
+        if FLAGS.collector == nvml_reader.NVML:
+            return nvml_factory()
+        if remote:
+            return remote_collector.RemoteCollector(
+                FLAGS.remote_hosts, remote_factory, sinks, metrics,
+                max_workers=FLAGS.remote_workers,
+                timeout_seconds=FLAGS.remote_timeout_seconds,
+                retry_seconds=FLAGS.dcgm_retry_seconds)
+        if FLAGS.collector == 'synthetic':
+            return synthetic_reader.SyntheticReader(
+                DCGM_FIELDS, sinks, metrics, gpus=FLAGS.synthetic_gpus,
+                gpu_instances=FLAGS.synthetic_gpu_instances,
+                compute_instances=FLAGS.synthetic_compute_instances, topology=topology)
+        return nvml_reader.SwitchingReader(dcgm_factory, nvml_factory,
+                                           retry_seconds=FLAGS.dcgm_retry_seconds,
+                                           metrics=metrics)
+
+    # A hung fetch makes the watchdog recreate the reader and its connections
+    if FLAGS.watchdog_deadline_seconds:
+        reader = watchdog.WatchdogReader(reader_factory, FLAGS.watchdog_deadline_seconds,
+                                         metrics,
+                                         max_backoff_seconds=FLAGS.dcgm_retry_seconds,
+                                         run=profiler.profiled if profiler else None)
+        if profiler:
+            profiler.profile_calls()
+    else:
+        reader = reader_factory()
+    if FLAGS.probe_port and FLAGS.watchdog_deadline_seconds:
+        probes = watchdog.Probes(
+            reader, sinks,
+            stuck_seconds=3 * (FLAGS.update_interval + FLAGS.watchdog_deadline_seconds),
+            export_deadline_seconds=FLAGS.watchdog_deadline_seconds)
+        probe_server = watchdog.ProbeServer(probes, FLAGS.probe_port, FLAGS.probe_address)
+        probe_server.start()
+        servers.append(probe_server)
+
+    # SIGTERM and SIGINT stop sampling, then the sinks are drained
+    stop = shutdown.ShutdownSignal()
+    stop.install()
+    status = shutdown.EXIT_OK
+    with reader as dcgm_reader:
         
         nexttime = time.time()
         try:
-            while True:
-            #while False:
-                dcgm_reader.Process()
+            while not stop.is_set():
+                metrics.schedule_lateness.observe(max(0.0, time.time() - nexttime))
+                span = tracer.start_cycle(nexttime)
+                dcgm_reader.Process(span)
+                tracer.finish(span)
                 nexttime += FLAGS.update_interval
                 sleep_time = nexttime - time.time() 
                 if sleep_time > 0:
-                    time.sleep(sleep_time)
+                    stop.wait(sleep_time)
         except KeyboardInterrupt:
-            logging.info("Caught CTRL-C. Exiting ...")
+            logging.info("Interrupted during shutdown")
+        finally:
+            if watcher:
+                watcher.stop()
+            status = shutdown.finish(sinks, FLAGS.shutdown_deadline_seconds, unsent_spool,
+                                     watermarks)
+            tracer.close()
+            if health:
+                health.stop()
+            if attribution:
+                attribution.stop()
+            if resources:
+                resources.stop()
+            for server in servers:
+                server.stop()
+            if profiler:
+                profiler.stop()
+    return status
 
 # Command line parameters
 flags.DEFINE_integer('update_interval', 10, 'Metrics update frequency - seconds', 
                      lower_bound=10)
-flags.DEFINE_enum('resource_type', 'gce_instance', ['gce_instance'], 'Stackdriver resource type')
+flags.DEFINE_enum('resource_type', 'gce_instance',
+                  ['gce_instance', kubernetes_resources.K8S_NODE,
+                   kubernetes_resources.K8S_CONTAINER],
+                  'Stackdriver resource type; k8s_container writes the series of every '
+                  'GPU to the container it is allocated to, and the others to the k8s_node')
+flags.DEFINE_integer('watchdog_deadline_seconds', watchdog.DEFAULT_DEADLINE_SECONDS,
+                     'Deadline of a sampling cycle and of an export call; a reader that '
+                     'misses it is recreated with backoff - seconds, 0 disables the '
+                     'watchdog', lower_bound=0)
+flags.DEFINE_integer('probe_port', 0,
+                     'Port serving the /healthz liveness and /readyz readiness probes, '
+                     '0 to disable; requires the watchdog', lower_bound=0)
+flags.DEFINE_string('probe_address', '', 'Address the probes are served on')
+flags.DEFINE_integer('shutdown_deadline_seconds', shutdown.DEFAULT_DEADLINE_SECONDS,
+                     'Time the sinks get to export their queued batches on SIGTERM or '
+                     'SIGINT - seconds', lower_bound=1)
+flags.DEFINE_string('spool_dir', '',
+                    'Directory keeping the samples unsent at shutdown, replayed on the '
+                    'next start, and the per-series watermarks; empty to disable')
+flags.DEFINE_integer('spool_max_mb', spool.DEFAULT_MAX_BYTES // (1024 * 1024),
+                     'Size budget of the spool - MB', lower_bound=1)
+flags.DEFINE_bool('metadata_watch', True,
+                  'Watch the metadata server for instance attribute changes, which '
+                  'refresh the resource labels, and for preemption and host maintenance '
+                  'notices, which flush the sinks')
+flags.DEFINE_integer('preemption_flush_seconds', 20,
+                     'Deadline of the flush of the sinks on a preemption or maintenance '
+                     'notice - seconds', lower_bound=1)
+flags.DEFINE_string('pod_resources_socket', kubernetes_resources.POD_RESOURCES_SOCKET,
+                    'Kubelet pod-resources socket listing the GPUs of every container')
+flags.DEFINE_integer('pod_resources_refresh_seconds',
+                     kubernetes_resources.DEFAULT_REFRESH_SECONDS,
+                     'GPU to container mapping refresh interval - seconds', lower_bound=1)
 flags.DEFINE_string('project_id', None, 'GCP Project ID')
+flags.DEFINE_integer('agent_metrics_interval', 60,
+                     'Export frequency of the agent\'s own metrics - seconds',
+                     lower_bound=10)
+flags.DEFINE_bool('profiling', False,
+                  'Enable SIGUSR1/SIGUSR2 and control socket profiling hooks')
+flags.DEFINE_string('profiling_socket', '/tmp/dcgm_stackdriver.sock',
+                    'Unix socket accepting profiling commands, empty to disable')
+flags.DEFINE_integer('profiling_seconds', 30,
+                     'Default duration of a profiling session - seconds',
+                     lower_bound=1)
+flags.DEFINE_string('trace_file', '',
+                    'JSON lines file receiving one record per sampling cycle, '
+                    'empty to disable')
+flags.DEFINE_integer('trace_max_bytes', cycle_trace.DEFAULT_MAX_BYTES,
+                     'Size at which the trace file is rotated - bytes',
+                     lower_bound=1024)
+flags.DEFINE_integer('trace_backup_count', cycle_trace.DEFAULT_BACKUP_COUNT,
+                     'Number of rotated trace files to keep', lower_bound=0)
+flags.DEFINE_integer('sampling_interval_ms', None,
+                     'DCGM sampling frequency - milliseconds. Defaults to the '
+                     'update interval; all samples are published to the sinks',
+                     lower_bound=100)
+flags.DEFINE_string('store_dir', '',
+                    'Directory of the local high resolution sample store, '
+                    'empty to disable')
+flags.DEFINE_integer('store_retention_mb', 10240,
+                     'Size budget of the local sample store - MB', lower_bound=1)
+flags.DEFINE_integer('store_retention_hours', 168,
+                     'Age limit of the local sample store - hours', lower_bound=1)
+flags.DEFINE_list('rollup_resolutions', ['60', '3600'],
+                  'Rollup tier resolutions kept in the sample store - seconds')
+flags.DEFINE_bool('cloud_monitoring_rollups', False,
+                  'Export the means of the finest rollup windows to Cloud Monitoring '
+                  'instead of the latest raw values')
+flags.DEFINE_string('sketch_file', '',
+                    'Maintain quantile sketches of --sketch_fields and checkpoint them '
+                    'to this file')
+flags.DEFINE_list('sketch_fields', [str(dcgm_fields.DCGM_FI_PROF_SM_ACTIVE),
+                                    str(dcgm_fields.DCGM_FI_PROF_PIPE_TENSOR_ACTIVE),
+                                    str(dcgm_fields.DCGM_FI_PROF_DRAM_ACTIVE)],
+                  'DCGM field ids of the sketched series')
+flags.DEFINE_float('sketch_alpha', quantile_sketch.DEFAULT_ALPHA,
+                   'Relative accuracy of the quantile sketches')
+flags.DEFINE_enum('job_attribution', 'none', ['none', 'nvml'],
+                  'Label the exported series with the job using each GPU, found from '
+                  'the NVML process lists; requires pynvml')
+flags.DEFINE_integer('job_refresh_seconds', job_attribution.DEFAULT_REFRESH_SECONDS,
+                     'Job attribution refresh interval - seconds', lower_bound=1)
+flags.DEFINE_list('job_env_vars', list(job_attribution.DEFAULT_JOB_ENV_VARS),
+                  'Environment variables naming the job of a GPU process')
+flags.DEFINE_string('job_log', '',
+                    'Append the job changes of every GPU to this JSON lines file')
+flags.DEFINE_bool('idle_detection', True,
+                  'Detect idle and stalled GPUs, reported in the agent metrics')
+flags.DEFINE_string('idle_event_log', '',
+                    'Append idle, stalled and recovered GPU events to this JSON lines file')
+flags.DEFINE_integer('idle_seconds', idle_detector.DEFAULT_IDLE_SECONDS,
+                     'Time a GPU must be idle before it is reported - seconds')
+flags.DEFINE_integer('stall_seconds', idle_detector.DEFAULT_STALL_SECONDS,
+                     'Time a GPU must be stalled before it is reported - seconds')
+flags.DEFINE_integer('recover_seconds', idle_detector.DEFAULT_RECOVER_SECONDS,
+                     'Time a GPU must be active again to recover - seconds')
+flags.DEFINE_enum('collector', 'auto', ['auto', 'dcgm', 'nvml', 'remote', 'synthetic'],
+                  'Sampling backend; auto samples through NVML while nv-hostengine is '
+                  'unavailable and switches to DCGM once it answers, remote samples the '
+                  'host engines of --remote_hosts, synthetic publishes random values '
+                  'for load tests')
+flags.DEFINE_list('remote_hosts', [],
+                  'host[:port] of the nv-hostengine instances sampled by the remote '
+                  'collector')
+flags.DEFINE_integer('remote_workers', remote_collector.DEFAULT_WORKERS,
+                     'Host engines the remote collector polls concurrently', lower_bound=1)
+flags.DEFINE_float('remote_timeout_seconds', remote_collector.DEFAULT_TIMEOUT_SECONDS,
+                   'Time the remote collector waits for the host engines each cycle - '
+                   'seconds', lower_bound=0.1)
+flags.DEFINE_bool('mig', False,
+                  'Watch and export the MIG GPU and compute instances of every GPU')
+flags.DEFINE_integer('synthetic_gpus', 8, 'GPUs of the synthetic collector')
+flags.DEFINE_integer('synthetic_gpu_instances', 0,
+                     'MIG GPU instances per GPU of the synthetic collector')
+flags.DEFINE_integer('synthetic_compute_instances', 1,
+                     'Compute instances per GPU instance of the synthetic collector')
+flags.DEFINE_integer('dcgm_retry_seconds', nvml_reader.DEFAULT_RETRY_SECONDS,
+                     'Interval of the DCGM connection attempts in auto and remote mode - '
+                     'seconds',
+                     lower_bound=1)
+flags.DEFINE_enum('health_monitoring', 'none', ['none', 'nvml'],
+                  'Report XID errors, ECC errors, retired pages and clock throttling '
+                  'of every GPU as they change; requires pynvml')
+flags.DEFINE_integer('health_interval_seconds', health_monitor.DEFAULT_INTERVAL_SECONDS,
+                     'GPU health polling interval - seconds', lower_bound=1)
+flags.DEFINE_string('health_event_log', '',
+                    'Append GPU health events to this JSON lines file')
+flags.DEFINE_string('alert_rules', '',
+                    'JSON file of alert rules evaluated against every sample')
+flags.DEFINE_multi_enum('exporters', ['cloud_monitoring'],
+                        ['cloud_monitoring', 'gateway', 'file', 'stdout', 'otlp'],
+                        'Exporter sinks receiving the sampled values')
+flags.DEFINE_string('routes', '',
+                    'JSON file of routes sending series to other projects than '
+                    '--project_id by GPU, job or resource label')
+flags.DEFINE_float('write_points_per_second', 0,
+                   'Budget of the points written to Cloud Monitoring per second, 0 for '
+                   'unlimited', lower_bound=0)
+flags.DEFINE_integer('write_requests_per_minute', 0,
+                     'Budget of the Cloud Monitoring write requests per minute, 0 for '
+                     'unlimited', lower_bound=0)
+flags.DEFINE_bool('write_distributions', True,
+                  'Write fields that exceed the write budget as one distribution over '
+                  'the GPUs instead of deferring them')
+flags.DEFINE_integer('sink_queue_size', exporters.DEFAULT_QUEUE_SIZE,
+                     'Batches an exporter sink can fall behind before dropping',
+                     lower_bound=1)
+flags.DEFINE_string('gateway_address', 'unix:/tmp/dcgm_gateway.sock',
+                    'unix:<path> or <host>:<port> of the aggregation gateway used by the '
+                    'gateway exporter')
+flags.DEFINE_string('export_file', '/tmp/dcgm_samples.jsonl',
+                    'JSON lines file written by the file exporter')
+flags.DEFINE_string('otlp_endpoint', 'http://localhost:4318/v1/metrics',
+                    'OTLP/HTTP metrics endpoint used by the otlp exporter')
+flags.DEFINE_integer('prometheus_port', 0,
+                     'Port of the Prometheus /metrics endpoint, 0 to disable',
+                     lower_bound=0)
+flags.DEFINE_string('prometheus_address', '',
+                    'Address the Prometheus endpoint binds to')
 flags.mark_flag_as_required('project_id')
 
 if __name__ == '__main__':
@@ -0,0 +1,287 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inventory of the GPUs of the host, read through NVML.
+
+Static attributes (name, serial, UUID, brand, PCI bus id, ...) do not change
+while the host is up. They are read once and cached by UUID, optionally in a
+cache file that stays valid until the next boot. Dynamic attributes
+(temperature, power, clocks, memory use, ...) are read on every call, one
+device per worker thread, since NVML blocks on the driver for each call.
+
+The inventory is returned as Device tuples and only rendered on demand, by
+streaming writers that emit one device at a time:
+
+    python device_inventory.py --format=xml --cache_file=/var/tmp/gpu_inventory.json
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import sys
+from xml.sax import saxutils
+
+from absl import app
+from absl import flags
+
+StaticInfo = collections.namedtuple('StaticInfo', [
+    'uuid', 'name', 'brand', 'serial', 'pci_bus_id', 'minor_number', 'vbios_version',
+    'board_id', 'multi_gpu_board', 'memory_total_mib', 'power_limit_default_watts',
+    'max_sm_clock_mhz', 'max_memory_clock_mhz'])
+
+DynamicInfo = collections.namedtuple('DynamicInfo', [
+    'temperature_c', 'fan_speed_percent', 'performance_state', 'power_draw_watts',
+    'power_limit_watts', 'gpu_utilization', 'memory_utilization', 'memory_used_mib',
+    'memory_free_mib', 'sm_clock_mhz', 'memory_clock_mhz', 'persistence_mode',
+    'compute_mode'])
+
+Device = collections.namedtuple('Device', ['index', 'static', 'dynamic'])
+
+BRANDS = {0: 'Unknown', 1: 'Quadro', 2: 'Tesla', 3: 'NVS', 4: 'Grid', 5: 'GeForce',
+          6: 'Titan'}
+COMPUTE_MODES = {0: 'Default', 1: 'Exclusive_Thread', 2: 'Prohibited',
+                 3: 'Exclusive_Process'}
+
+_MIB = 1024 * 1024
+_BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+# NVML clock types
+_CLOCK_SM = 1
+_CLOCK_MEM = 2
+_TEMPERATURE_GPU = 0
+
+
+def _text(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+
+def boot_id(path=_BOOT_ID_PATH):
+    """Returns an id that changes on every boot of the host."""
+
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return ''
+
+
+class DeviceInventory(object):
+    """Reads the static and dynamic attributes of every GPU through NVML."""
+
+    def __init__(self, nvml=None, cache_path=None, max_workers=16):
+        if nvml is None:
+            try:
+                import pynvml as nvml
+            except ImportError:
+                raise ImportError('The device inventory requires the pynvml package')
+        self._nvml = nvml
+        nvml.nvmlInit()
+        self._cache_path = cache_path
+        self._boot_id = boot_id()
+        self._handles = [nvml.nvmlDeviceGetHandleByIndex(index)
+                         for index in range(nvml.nvmlDeviceGetCount())]
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self._handles))))
+        self.driver_version = _text(self._call(nvml.nvmlSystemGetDriverVersion))
+        self._static = self._load_cache()
+        uuids = list(self._executor.map(
+            lambda handle: _text(nvml.nvmlDeviceGetUUID(handle)), self._handles))
+        missing = [index for index, uuid in enumerate(uuids) if uuid not in self._static]
+        for info in self._executor.map(self._read_static,
+                                       [self._handles[index] for index in missing]):
+            self._static[info.uuid] = info
+        self._uuids = uuids
+        if missing:
+            self._save_cache()
+
+    def _call(self, function, *args):
+        # Attributes a device does not support are None
+        try:
+            return function(*args)
+        except self._nvml.NVMLError:
+            return None
+
+    def _load_cache(self):
+        if not self._cache_path or not os.path.exists(self._cache_path):
+            return {}
+        try:
+            with open(self._cache_path) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if cache.get('boot_id') != self._boot_id or not self._boot_id:
+            return {}
+        return {uuid: StaticInfo(**info) for uuid, info in cache['devices'].items()}
+
+    def _save_cache(self):
+        if not self._cache_path:
+            return
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'boot_id': self._boot_id,
+                       'devices': {uuid: info._asdict() for uuid, info in self._static.items()}},
+                      f, sort_keys=True)
+        os.replace(tmp_path, self._cache_path)
+
+    def _read_static(self, handle):
+        nvml = self._nvml
+        call = self._call
+        pci = call(nvml.nvmlDeviceGetPciInfo, handle)
+        memory = call(nvml.nvmlDeviceGetMemoryInfo, handle)
+        power_limit = call(nvml.nvmlDeviceGetPowerManagementDefaultLimit, handle)
+        multi_gpu = call(nvml.nvmlDeviceGetMultiGpuBoard, handle)
+        return StaticInfo(
+            uuid=_text(nvml.nvmlDeviceGetUUID(handle)),
+            name=_text(call(nvml.nvmlDeviceGetName, handle)),
+            brand=BRANDS.get(call(nvml.nvmlDeviceGetBrand, handle)),
+            serial=_text(call(nvml.nvmlDeviceGetSerial, handle)),
+            pci_bus_id=_text(pci.busId) if pci is not None else None,
+            minor_number=call(nvml.nvmlDeviceGetMinorNumber, handle),
+            vbios_version=_text(call(nvml.nvmlDeviceGetVbiosVersion, handle)),
+            board_id=call(nvml.nvmlDeviceGetBoardId, handle),
+            multi_gpu_board=bool(multi_gpu) if multi_gpu is not None else None,
+            memory_total_mib=memory.total // _MIB if memory is not None else None,
+            power_limit_default_watts=(power_limit / 1000.0 if power_limit is not None
+                                       else None),
+            max_sm_clock_mhz=call(nvml.nvmlDeviceGetMaxClockInfo, handle, _CLOCK_SM),
+            max_memory_clock_mhz=call(nvml.nvmlDeviceGetMaxClockInfo, handle, _CLOCK_MEM))
+
+    def _read_dynamic(self, handle):
+        nvml = self._nvml
+        call = self._call
+        utilization = call(nvml.nvmlDeviceGetUtilizationRates, handle)
+        memory = call(nvml.nvmlDeviceGetMemoryInfo, handle)
+        power = call(nvml.nvmlDeviceGetPowerUsage, handle)
+        power_limit = call(nvml.nvmlDeviceGetEnforcedPowerLimit, handle)
+        persistence = call(nvml.nvmlDeviceGetPersistenceMode, handle)
+        performance_state = call(nvml.nvmlDeviceGetPerformanceState, handle)
+        return DynamicInfo(
+            temperature_c=call(nvml.nvmlDeviceGetTemperature, handle, _TEMPERATURE_GPU),
+            fan_speed_percent=call(nvml.nvmlDeviceGetFanSpeed, handle),
+            performance_state=('P{}'.format(performance_state)
+                               if performance_state is not None else None),
+            power_draw_watts=power / 1000.0 if power is not None else None,
+            power_limit_watts=power_limit / 1000.0 if power_limit is not None else None,
+            gpu_utilization=utilization.gpu if utilization is not None else None,
+            memory_utilization=utilization.memory if utilization is not None else None,
+            memory_used_mib=memory.used // _MIB if memory is not None else None,
+            memory_free_mib=memory.free // _MIB if memory is not None else None,
+            sm_clock_mhz=call(nvml.nvmlDeviceGetClockInfo, handle, _CLOCK_SM),
+            memory_clock_mhz=call(nvml.nvmlDeviceGetClockInfo, handle, _CLOCK_MEM),
+            persistence_mode=bool(persistence) if persistence is not None else None,
+            compute_mode=COMPUTE_MODES.get(call(nvml.nvmlDeviceGetComputeMode, handle)))
+
+    def static(self):
+        """Returns the cached static attributes of every GPU."""
+
+        return [self._static[uuid] for uuid in self._uuids]
+
+    def devices(self, dynamic=True):
+        """Returns a Device per GPU, reading the dynamic attributes now."""
+
+        if dynamic:
+            readings = list(self._executor.map(self._read_dynamic, self._handles))
+        else:
+            readings = [None] * len(self._handles)
+        return [Device(index, self._static[uuid], reading)
+                for index, (uuid, reading) in enumerate(zip(self._uuids, readings))]
+
+    def close(self):
+        self._executor.shutdown()
+        self._nvml.nvmlShutdown()
+
+
+def _value(value):
+    if value is None:
+        return 'N/A'
+    if isinstance(value, bool):
+        return 'Enabled' if value else 'Disabled'
+    return str(value)
+
+
+def write_xml(devices, stream, driver_version=None):
+    """Streams the inventory as XML, one device at a time."""
+
+    writer = saxutils.XMLGenerator(stream, encoding='utf-8')
+    writer.startDocument()
+
+    def element(name, value, indent):
+        writer.ignorableWhitespace('\n' + '  ' * indent)
+        writer.startElement(name, {})
+        writer.characters(_value(value))
+        writer.endElement(name)
+
+    writer.startElement('gpu_inventory', {})
+    element('timestamp', datetime.datetime.now().isoformat(), 1)
+    element('driver_version', driver_version, 1)
+    element('attached_gpus', len(devices), 1)
+    for device in devices:
+        writer.ignorableWhitespace('\n  ')
+        writer.startElement('gpu', {'index': str(device.index),
+                                    'id': _value(device.static.pci_bus_id)})
+        for name, value in device.static._asdict().items():
+            element(name, value, 2)
+        if device.dynamic is not None:
+            for name, value in device.dynamic._asdict().items():
+                element(name, value, 2)
+        writer.ignorableWhitespace('\n  ')
+        writer.endElement('gpu')
+    writer.ignorableWhitespace('\n')
+    writer.endElement('gpu_inventory')
+    writer.ignorableWhitespace('\n')
+    writer.endDocument()
+
+
+def write_json(devices, stream, driver_version=None):
+    """Streams the inventory as JSON, one device at a time."""
+
+    stream.write('{{"timestamp": {}, "driver_version": {}, "gpus": ['.format(
+        json.dumps(datetime.datetime.now().isoformat()), json.dumps(driver_version)))
+    for position, device in enumerate(devices):
+        record = {'index': device.index}
+        record.update(device.static._asdict())
+        if device.dynamic is not None:
+            record.update(device.dynamic._asdict())
+        stream.write((',\n  ' if position else '\n  ') + json.dumps(record, sort_keys=True))
+    stream.write('\n]}\n')
+
+
+WRITERS = {'xml': write_xml, 'json': write_json}
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+    del argv
+
+    inventory = DeviceInventory(cache_path=FLAGS.cache_file or None)
+    try:
+        devices = inventory.devices(dynamic=not FLAGS.static_only)
+    finally:
+        inventory.close()
+    WRITERS[FLAGS.format](devices, sys.stdout, inventory.driver_version)
+
+
+def _define_flags():
+    flags.DEFINE_enum('format', 'json', sorted(WRITERS), 'Output format')
+    flags.DEFINE_string('cache_file', '',
+                        'Cache the static attributes in this file until the next boot')
+    flags.DEFINE_bool('static_only', False, 'Only list the static attributes')
+
+
+if __name__ == '__main__':
+    _define_flags()
+    app.run(main)
@@ -0,0 +1,201 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import io
+import json
+import threading
+import time
+from xml.etree import ElementTree
+
+import device_inventory
+
+Pci = collections.namedtuple('Pci', ['busId'])
+Memory = collections.namedtuple('Memory', ['total', 'free', 'used'])
+Utilization = collections.namedtuple('Utilization', ['gpu', 'memory'])
+MIB = 1024 * 1024
+
+
+class NVMLError(Exception):
+    pass
+
+
+class FakeNvml(object):
+    """Answers every query after a driver round trip of latency seconds."""
+
+    NVMLError = NVMLError
+
+    def __init__(self, count=16, latency=0.002):
+        self.count = count
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _query(self, name, value):
+        with self._lock:
+            self.calls[name] += 1
+        time.sleep(self.latency)
+        return value
+
+    def __getattr__(self, name):
+        raise AttributeError(name)
+
+    def nvmlInit(self):
+        pass
+
+    def nvmlShutdown(self):
+        pass
+
+    def nvmlSystemGetDriverVersion(self):
+        return b'450.51.06'
+
+    def nvmlDeviceGetCount(self):
+        return self.count
+
+    def nvmlDeviceGetHandleByIndex(self, index):
+        return index
+
+    def nvmlDeviceGetUUID(self, handle):
+        return self._query('uuid', 'GPU-{:04d}'.format(handle))
+
+    def nvmlDeviceGetName(self, handle):
+        return self._query('name', b'Tesla V100-SXM2-16GB')
+
+    def nvmlDeviceGetBrand(self, handle):
+        return self._query('brand', 2)
+
+    def nvmlDeviceGetSerial(self, handle):
+        return self._query('serial', '03231190{:05d}'.format(handle))
+
+    def nvmlDeviceGetPciInfo(self, handle):
+        return self._query('pci', Pci('00000000:00:{:02X}.0'.format(handle + 4)))
+
+    def nvmlDeviceGetMinorNumber(self, handle):
+        return self._query('minor', handle)
+
+    def nvmlDeviceGetVbiosVersion(self, handle):
+        return self._query('vbios', '88.00.4F.00.09')
+
+    def nvmlDeviceGetBoardId(self, handle):
+        return self._query('board', 0x400 + handle)
+
+    def nvmlDeviceGetMultiGpuBoard(self, handle):
+        raise NVMLError('Not Supported')
+
+    def nvmlDeviceGetMemoryInfo(self, handle):
+        return self._query('memory', Memory(16160 * MIB, 16000 * MIB, 160 * MIB))
+
+    def nvmlDeviceGetPowerManagementDefaultLimit(self, handle):
+        return self._query('power_default', 300000)
+
+    def nvmlDeviceGetMaxClockInfo(self, handle, clock):
+        return self._query('max_clock', 1530 if clock == 1 else 877)
+
+    def nvmlDeviceGetUtilizationRates(self, handle):
+        return self._query('utilization', Utilization(87, 40))
+
+    def nvmlDeviceGetPowerUsage(self, handle):
+        return self._query('power', 254000)
+
+    def nvmlDeviceGetEnforcedPowerLimit(self, handle):
+        return self._query('power_limit', 300000)
+
+    def nvmlDeviceGetPersistenceMode(self, handle):
+        return self._query('persistence', 1)
+
+    def nvmlDeviceGetPerformanceState(self, handle):
+        return self._query('pstate', 0)
+
+    def nvmlDeviceGetTemperature(self, handle, sensor):
+        return self._query('temperature', 61)
+
+    def nvmlDeviceGetFanSpeed(self, handle):
+        raise NVMLError('Not Supported')
+
+    def nvmlDeviceGetClockInfo(self, handle, clock):
+        return self._query('clock', 1530 if clock == 1 else 877)
+
+    def nvmlDeviceGetComputeMode(self, handle):
+        return self._query('compute_mode', 0)
+
+
+def test_static_attributes_are_cached_per_boot(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'inventory.json')
+    monkeypatch.setattr(device_inventory, 'boot_id', lambda: 'boot-1')
+    nvml = FakeNvml(count=2, latency=0)
+    inventory = device_inventory.DeviceInventory(nvml, cache_path=cache)
+    devices = inventory.devices()
+    inventory.devices()
+    inventory.close()
+
+    assert devices[1].static.uuid == 'GPU-0001'
+    assert devices[1].static.name == 'Tesla V100-SXM2-16GB'
+    assert devices[1].static.brand == 'Tesla'
+    assert devices[1].static.multi_gpu_board is None
+    assert devices[1].static.memory_total_mib == 16160
+    assert devices[1].dynamic.power_draw_watts == 254.0
+    assert devices[1].dynamic.performance_state == 'P0'
+    assert devices[1].dynamic.fan_speed_percent is None
+    assert nvml.calls['serial'] == 2
+    assert nvml.calls['temperature'] == 4
+
+    # The next agent start on the same boot only looks the UUIDs up
+    nvml = FakeNvml(count=2, latency=0)
+    inventory = device_inventory.DeviceInventory(nvml, cache_path=cache)
+    assert inventory.static() == [device.static for device in devices]
+    assert nvml.calls['serial'] == 0 and nvml.calls['uuid'] == 2
+
+    monkeypatch.setattr(device_inventory, 'boot_id', lambda: 'boot-2')
+    nvml = FakeNvml(count=2, latency=0)
+    device_inventory.DeviceInventory(nvml, cache_path=cache)
+    assert nvml.calls['serial'] == 2
+
+
+def test_full_inventory_of_16_gpus_is_concurrent():
+    nvml = FakeNvml(count=16, latency=0.002)
+    inventory = device_inventory.DeviceInventory(nvml)
+    inventory.devices()
+    start = time.monotonic()
+    devices = inventory.devices()
+    elapsed = time.monotonic() - start
+    inventory.close()
+
+    assert len(devices) == 16
+    # 11 queries of 2 ms per device take 350 ms one device after the other
+    assert elapsed < 0.1
+
+
+def test_writers():
+    nvml = FakeNvml(count=2, latency=0)
+    inventory = device_inventory.DeviceInventory(nvml)
+    devices = inventory.devices()
+    inventory.close()
+
+    stream = io.StringIO()
+    device_inventory.write_json(devices, stream, inventory.driver_version)
+    document = json.loads(stream.getvalue())
+    assert document['driver_version'] == '450.51.06'
+    assert [gpu['uuid'] for gpu in document['gpus']] == ['GPU-0000', 'GPU-0001']
+    assert document['gpus'][0]['temperature_c'] == 61
+
+    stream = io.BytesIO()
+    device_inventory.write_xml(devices, stream, inventory.driver_version)
+    root = ElementTree.fromstring(stream.getvalue())
+    assert root.find('attached_gpus').text == '2'
+    gpus = root.findall('gpu')
+    assert gpus[1].get('id') == '00000000:00:05.0'
+    assert gpus[1].find('serial').text == '0323119000001'
+    assert gpus[1].find('multi_gpu_board').text == 'N/A'
+    assert gpus[1].find('persistence_mode').text == 'Enabled'
@@ -0,0 +1,130 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""DCGM entities: GPUs and their MIG GPU and compute instances.
+
+On a MIG partitioned A100, DCGM reports the profiling fields per GPU
+instance and compute instance. Their entity ids are unique within their
+entity group across the host, and the topology maps every entity to the
+hierarchical labels of its series:
+
+    GPU                gpu="0"
+    GPU instance       gpu="0", gpu_instance="3"
+    compute instance   gpu="0", gpu_instance="3", compute_instance="1"
+
+Label dicts are built once per entity when the topology is loaded and
+shared by all the series of the entity, so labelling a sample is a dict
+lookup however many entities the host has.
+"""
+
+import collections
+
+# DCGM entity groups (dcgm_fields.DCGM_FE_*)
+ENTITY_GPU = 1
+ENTITY_GPU_I = 4
+ENTITY_GPU_CI = 5
+ENTITY_GROUPS = {ENTITY_GPU: 'gpu', ENTITY_GPU_I: 'gpu_instance',
+                 ENTITY_GPU_CI: 'compute_instance'}
+
+GPU_LABEL = 'gpu'
+GPU_INSTANCE_LABEL = 'gpu_instance'
+COMPUTE_INSTANCE_LABEL = 'compute_instance'
+LABEL_KEYS = (GPU_LABEL, GPU_INSTANCE_LABEL, COMPUTE_INSTANCE_LABEL)
+
+Entity = collections.namedtuple('Entity', ['group', 'entity_id', 'gpu', 'gpu_instance',
+                                           'compute_instance'])
+
+
+class EntityTopology(object):
+    """Maps DCGM entities to their GPU and hierarchical labels."""
+
+    def __init__(self, entities=()):
+        self._entities = {}
+        self._labels = {}
+        for entity in entities:
+            self.add(entity)
+
+    def add(self, entity):
+        labels = {GPU_LABEL: str(entity.gpu)}
+        if entity.gpu_instance is not None:
+            labels[GPU_INSTANCE_LABEL] = str(entity.gpu_instance)
+        if entity.compute_instance is not None:
+            labels[COMPUTE_INSTANCE_LABEL] = str(entity.compute_instance)
+        key = (entity.group, entity.entity_id)
+        self._entities[key] = entity
+        self._labels[key] = labels
+
+    def entities(self, group=None):
+        return [entity for key, entity in sorted(self._entities.items())
+                if group is None or key[0] == group]
+
+    def labels(self, group, entity_id):
+        """Returns the labels of an entity; do not modify the dict."""
+
+        labels = self._labels.get((group, entity_id))
+        if labels is None:
+            # GPUs are their own parent, whether listed or not
+            labels = {GPU_LABEL: str(entity_id)}
+            if group != ENTITY_GPU:
+                labels[ENTITY_GROUPS.get(group, 'entity')] = str(entity_id)
+            self._labels[(group, entity_id)] = labels
+        return labels
+
+    def gpu(self, group, entity_id):
+        """Returns the GPU id an entity belongs to."""
+
+        entity = self._entities.get((group, entity_id))
+        return entity.gpu if entity is not None else entity_id
+
+    def __len__(self):
+        return len(self._entities)
+
+
+def topology_from_hierarchy(gpu_ids, hierarchy, topology=None):
+    """Adds the entities of a DCGM MIG hierarchy to a topology.
+
+    hierarchy lists (entity group, entity id, parent group, parent id, MIG
+    instance id) tuples, in the order dcgmGetGpuInstanceHierarchy returns
+    them: every GPU instance before its compute instances.
+    """
+
+    topology = topology if topology is not None else EntityTopology()
+    for gpu in gpu_ids:
+        topology.add(Entity(ENTITY_GPU, gpu, gpu, None, None))
+    instances = {}
+    for group, entity_id, parent_group, parent_id, instance_id in hierarchy:
+        if group == ENTITY_GPU_I and parent_group == ENTITY_GPU:
+            instances[entity_id] = (parent_id, instance_id)
+            topology.add(Entity(group, entity_id, parent_id, instance_id, None))
+        elif group == ENTITY_GPU_CI and parent_group == ENTITY_GPU_I and parent_id in instances:
+            gpu, gpu_instance = instances[parent_id]
+            topology.add(Entity(group, entity_id, gpu, gpu_instance, instance_id))
+    return topology
+
+
+def read_dcgm_topology(handle, gpu_ids, topology=None):
+    """Reads the MIG hierarchy of a DCGM host engine into a topology."""
+
+    import dcgm_agent
+
+    hierarchy = dcgm_agent.dcgmGetGpuInstanceHierarchy(handle)
+    rows = []
+    for index in range(hierarchy.count):
+        info = hierarchy.entityList[index]
+        instance_id = (info.info.nvmlComputeInstanceId
+                       if info.entity.entityGroupId == ENTITY_GPU_CI
+                       else info.info.nvmlInstanceId)
+        rows.append((info.entity.entityGroupId, info.entity.entityId,
+                     info.parent.entityGroupId, info.parent.entityId, instance_id))
+    return topology_from_hierarchy(gpu_ids, rows, topology)
@@ -0,0 +1,48 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import entities
+from entities import ENTITY_GPU, ENTITY_GPU_CI, ENTITY_GPU_I
+
+
+def test_topology_from_hierarchy():
+    hierarchy = [
+        # GPU instances 0 and 1 of GPU 0, MIG instance ids 1 and 2
+        (ENTITY_GPU_I, 0, ENTITY_GPU, 0, 1),
+        (ENTITY_GPU_I, 1, ENTITY_GPU, 0, 2),
+        (ENTITY_GPU_CI, 0, ENTITY_GPU_I, 0, 0),
+        (ENTITY_GPU_CI, 1, ENTITY_GPU_I, 1, 0),
+        (ENTITY_GPU_CI, 2, ENTITY_GPU_I, 1, 1),
+        # A compute instance of an unknown GPU instance is skipped
+        (ENTITY_GPU_CI, 3, ENTITY_GPU_I, 9, 0),
+    ]
+    topology = entities.topology_from_hierarchy([0, 1], hierarchy)
+
+    assert len(topology) == 7
+    assert topology.labels(ENTITY_GPU, 1) == {'gpu': '1'}
+    assert topology.labels(ENTITY_GPU_I, 1) == {'gpu': '0', 'gpu_instance': '2'}
+    assert topology.labels(ENTITY_GPU_CI, 2) == {'gpu': '0', 'gpu_instance': '2',
+                                                 'compute_instance': '1'}
+    assert topology.gpu(ENTITY_GPU_CI, 2) == 0
+    assert [entity.entity_id for entity in topology.entities(ENTITY_GPU_CI)] == [0, 1, 2]
+    # Label dicts are shared by all the series of an entity
+    assert topology.labels(ENTITY_GPU_I, 1) is topology.labels(ENTITY_GPU_I, 1)
+
+
+def test_unknown_entities():
+    topology = entities.EntityTopology()
+    assert topology.labels(ENTITY_GPU, 3) == {'gpu': '3'}
+    assert topology.labels(ENTITY_GPU_I, 3) == {'gpu': '3', 'gpu_instance': '3'}
+    assert topology.gpu(ENTITY_GPU_I, 3) == 3
@@ -0,0 +1,1165 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Exporter sinks fed from a single sampling pass.
+
+Every sampling cycle produces a list of samples which is published to all
+configured sinks. Each sink runs on its own thread behind a bounded queue,
+so a slow or failing sink can neither stall sampling nor the other sinks.
+"""
+
+import collections
+import json
+import math
+import socket
+import sys
+import threading
+import time
+
+from absl import logging
+
+from google.api_core import exceptions
+from google.api_core import retry
+from google.cloud import monitoring_v3
+from google.protobuf import json_format
+
+import agent_metrics
+import cycle_trace
+import entities
+import idle_detector
+import job_attribution
+
+# A single DCGM reading. The timestamp is in microseconds, as reported by DCGM.
+# gpu is the entity id within entity_group: the GPU id of GPU samples, the
+# DCGM GPU or compute instance id of MIG samples. host is the host engine
+# address of samples read from remote nodes, None for the local host.
+Sample = collections.namedtuple('Sample', ['gpu', 'field_id', 'timestamp', 'value',
+                                           'entity_group', 'host'],
+                                defaults=(entities.ENTITY_GPU, None))
+
+HOST_LABEL = 'host'
+
+_DEFAULT_TOPOLOGY = entities.EntityTopology()
+
+# Cloud Monitoring accepts at most 200 time series per request
+MAX_SERIES_PER_REQUEST = 200
+
+# Field catalog priority of fields without one; lower values are written first
+# when the write budget is tight
+DEFAULT_PRIORITY = 9
+DISTRIBUTION_SUFFIX = '_distribution'
+# Exponential buckets from 0.001 up to about 2.8e11
+DISTRIBUTION_SCALE = 0.001
+DISTRIBUTION_GROWTH = 2.0
+DISTRIBUTION_BUCKETS = 48
+
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_MAX_BATCH_SAMPLES = 100000
+
+
+def samples_from_fvs(fvs):
+    """Converts DCGM field values to samples.
+
+    Returns the samples and the number of blank values that were skipped.
+    """
+
+    samples = []
+    blank = 0
+    for gpu, fields in fvs.items():
+        for field_id, field_time_series in fields.items():
+            for field in field_time_series:
+                if field.isBlank:
+                    blank += 1
+                else:
+                    samples.append(Sample(gpu, field_id, field.ts, field.value))
+    return samples, blank
+
+
+def samples_from_entity_fvs(values):
+    """Converts DCGM field values of any entity group to samples.
+
+    values maps entity groups to entity ids to field ids to field values,
+    as in DcgmFieldValueEntityCollection.values. Returns the samples and the
+    number of blank values that were skipped.
+    """
+
+    samples = []
+    blank = 0
+    for entity_group, group_values in values.items():
+        for entity_id, fields in group_values.items():
+            for field_id, field_time_series in fields.items():
+                for field in field_time_series:
+                    if field.isBlank:
+                        blank += 1
+                    else:
+                        samples.append(Sample(entity_id, field_id, field.ts, field.value,
+                                              entity_group))
+    return samples, blank
+
+
+def gpu_samples(samples):
+    """Returns the samples of local GPU entities, without the MIG instances."""
+
+    return [sample for sample in samples
+            if sample.entity_group == entities.ENTITY_GPU and sample.host is None]
+
+
+def sample_labels(sample, topology=None, attribution=None):
+    """Returns the entity labels of a sample, with the job labels of its GPU.
+
+    Samples of remote hosts carry the host label instead of the job labels.
+    """
+
+    topology = topology or _DEFAULT_TOPOLOGY
+    labels = topology.labels(sample.entity_group, sample.gpu)
+    if sample.host is not None:
+        labels = dict(labels, **{HOST_LABEL: sample.host})
+    elif attribution is not None:
+        job_labels = attribution.labels(topology.gpu(sample.entity_group, sample.gpu))
+        if job_labels:
+            labels = dict(labels, **job_labels)
+    return labels
+
+
+def latest_samples(samples):
+    """Returns the most recent sample of every (host, entity, field) series."""
+
+    latest = {}
+    for sample in samples:
+        key = (sample.host, sample.entity_group, sample.gpu, sample.field_id)
+        current = latest.get(key)
+        if current is None or sample.timestamp >= current.timestamp:
+            latest[key] = sample
+    return list(latest.values())
+
+
+def series_label_keys(topology=None, attribution=None, host_label=False):
+    """Returns the metric label keys of the exported GPU series."""
+
+    label_keys = []
+    if topology is not None:
+        label_keys.extend(entities.LABEL_KEYS)
+    if attribution is not None:
+        label_keys = label_keys or [entities.GPU_LABEL]
+        label_keys.append(job_attribution.JOB_LABEL)
+    if host_label:
+        label_keys = label_keys or [entities.GPU_LABEL]
+        label_keys.append(HOST_LABEL)
+    return label_keys
+
+
+def metric_descriptor(item, label_keys=()):
+    """Builds the SD metric descriptor of a field catalog entry."""
+
+    descriptor = monitoring_v3.types.MetricDescriptor()
+    descriptor.type = item['name']
+    descriptor.metric_kind = item['metric_kind']
+    descriptor.value_type = item['value_type']
+    descriptor.description = item['desc']
+    if 'sd_units' in item:
+        descriptor.unit = item['sd_units']
+    for label_key in label_keys:
+        label = descriptor.labels.add()
+        label.key = label_key
+        label.value_type = monitoring_v3.enums.LabelDescriptor.ValueType.STRING
+    return descriptor
+
+
+def typed_value(value_type, value):
+    """Converts a sample value to the Python type of an SD value type."""
+
+    if value_type == monitoring_v3.enums.MetricDescriptor.ValueType.INT64:
+        # Rollups carry window means
+        return int(round(value))
+    if value_type == monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE:
+        return float(value)
+    if value_type == monitoring_v3.enums.MetricDescriptor.ValueType.BOOL:
+        return bool(value)
+    if value_type == monitoring_v3.enums.MetricDescriptor.ValueType.STRING:
+        return str(value)
+    raise TypeError('Unsupported metric type: {}'.format(value_type))
+
+
+def set_typed_value(typed, value):
+    """Sets an SD TypedValue from a value converted by typed_value."""
+
+    if isinstance(value, bool):
+        typed.bool_value = value
+    elif isinstance(value, int):
+        typed.int64_value = value
+    elif isinstance(value, float):
+        typed.double_value = value
+    else:
+        typed.string_value = value
+
+
+class Exporter(object):
+    """Base class of exporter sinks.
+
+    export() is only ever called from the sink's own thread. It returns an
+    optional dict describing the outcome, which is recorded in the cycle trace.
+    detailed is set before each call when a span of the batch is going to be
+    written; outcome attributes that are expensive to compute are only
+    returned then.
+    """
+
+    name = 'exporter'
+    detailed = False
+
+    def export(self, samples):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueuedExporter(object):
+    """Runs an exporter on its own thread behind a bounded queue.
+
+    When the queue is full the oldest batch is dropped. Batches that queued
+    up while the exporter was busy are coalesced into a single export call.
+    Batches not exported when close() times out are returned as unsent. The
+    exporter is flushed and closed on the sink thread as it stops, within
+    the close deadline.
+    """
+
+    def __init__(self, exporter, metrics, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_batch_samples=DEFAULT_MAX_BATCH_SAMPLES):
+        self.exporter = exporter
+        self.name = exporter.name
+        self._queue_size = queue_size
+        self._max_batch_samples = max_batch_samples
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._busy = False
+        self._flush_requested = False
+        self._inflight = None
+        self._export_started = None
+        self._dropped = metrics.points_dropped.labels(sink=self.name)
+        self._depth = metrics.export_queue_depth.labels(sink=self.name)
+        self._latency = metrics.export_latency.labels(sink=self.name)
+        self._thread = threading.Thread(target=self._run,
+                                        name='exporter-' + self.name, daemon=True)
+        self._thread.start()
+
+    def submit(self, samples, span=None):
+        """Queues a batch of samples without blocking."""
+
+        if span is not None:
+            span.hold()
+        dropped = None
+        with self._condition:
+            if self._closed:
+                dropped = (samples, span)
+            else:
+                if len(self._queue) >= self._queue_size:
+                    dropped = self._queue.popleft()
+                self._queue.append((samples, span))
+                self._depth.set(len(self._queue))
+                self._condition.notify()
+        if dropped is not None:
+            self._dropped.inc(len(dropped[0]))
+            if dropped[1] is not None:
+                dropped[1].set_sink(self.name, status='dropped')
+                dropped[1].release()
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def busy_seconds(self):
+        """Returns how long the running export call has taken, 0 when idle."""
+
+        started = self._export_started
+        return time.monotonic() - started if started is not None else 0.0
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue and not self._closed and not self._flush_requested:
+                self._condition.wait()
+            if not self._queue:
+                if self._closed:
+                    return None, None
+                self._busy = True
+                return [], []
+            samples, spans = [], []
+            while self._queue and (not samples or
+                                   len(samples) + len(self._queue[0][0]) <= self._max_batch_samples):
+                batch, span = self._queue.popleft()
+                samples.extend(batch)
+                if span is not None:
+                    spans.append(span)
+            self._depth.set(len(self._queue))
+            self._busy = True
+            self._inflight = samples
+            return samples, spans
+
+    def _run(self):
+        while True:
+            samples, spans = self._next_batch()
+            if samples is None:
+                break
+            if samples:
+                self._export(samples, spans)
+            with self._condition:
+                flush = self._flush_requested and not self._queue
+            if flush:
+                try:
+                    self.exporter.flush()
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.info('Failed to flush exporter {}: {}'.format(self.name, err))
+            with self._condition:
+                if flush:
+                    self._flush_requested = False
+                self._busy = False
+                self._inflight = None
+                self._condition.notify_all()
+        try:
+            self.exporter.flush()
+            self.exporter.close()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Failed to close exporter {}: {}'.format(self.name, err))
+
+    def _export(self, samples, spans):
+        start = self._export_started = time.monotonic()
+        self.exporter.detailed = any(span.detailed for span in spans)
+        try:
+            result = self.exporter.export(samples) or {}
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Exporter {} failed: {}'.format(self.name, err))
+            result = {'status': type(err).__name__}
+        self._export_started = None
+        latency = time.monotonic() - start
+        self._latency.observe(latency)
+        for span in spans:
+            span.set_sink(self.name, latency=latency, samples=len(samples), **result)
+            span.release()
+
+    def request_flush(self):
+        """Has the sink thread flush the exporter once the queue is exported."""
+
+        with self._condition:
+            if not self._closed:
+                self._flush_requested = True
+                self._condition.notify_all()
+
+    def drain(self, timeout):
+        """Waits until the queue is empty and any requested flush is done.
+
+        Returns False on timeout.
+        """
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._queue or self._busy or self._flush_requested:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stop(self):
+        """Stops the sink thread once its running call, if any, returns.
+
+        Returns the unsent samples: the queued batches and those of an export
+        call still running. That call may still complete, so replaying them
+        can duplicate points.
+        """
+
+        unsent, spans = [], []
+        with self._condition:
+            self._closed = True
+            self._flush_requested = False
+            if self._busy and self._inflight:
+                unsent.extend(self._inflight)
+            while self._queue:
+                batch, span = self._queue.popleft()
+                unsent.extend(batch)
+                if span is not None:
+                    spans.append(span)
+            self._depth.set(0)
+            self._condition.notify_all()
+        for span in spans:
+            span.set_sink(self.name, status='unsent')
+            span.release()
+        return unsent
+
+    def join(self, timeout):
+        """Waits for the sink thread to close the exporter. Returns False on timeout."""
+
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.info('Exporter {} did not close within the deadline'.format(self.name))
+            return False
+        return True
+
+    def close(self, timeout=10.0):
+        """Exports the queued batches, then stops the sink thread within timeout.
+
+        Returns the samples not exported, see stop().
+        """
+
+        deadline = time.monotonic() + timeout
+        self.drain(timeout)
+        unsent = self.stop()
+        self.join(max(0.0, deadline - time.monotonic()))
+        return unsent
+
+
+class FanOut(object):
+    """Publishes the samples of each sampling cycle to all sinks.
+
+    watermarks, if set, records the latest published timestamp of every series.
+    downstream are the sinks fed by other sinks, such as the forward sink of
+    the rollups. They get no published samples, and are flushed and closed
+    after the sinks feeding them.
+    """
+
+    def __init__(self, sinks, watermarks=None, downstream=()):
+        self._published = list(sinks)
+        self._downstream = list(downstream)
+        self.sinks = self._published + self._downstream
+        self.watermarks = watermarks
+
+    def publish(self, samples, span=None):
+        if self.watermarks is not None:
+            self.watermarks.observe(samples)
+        for sink in self._published:
+            sink.submit(samples, span)
+
+    def flush(self, timeout=10.0):
+        """Exports the queued batches and flushes all sinks in parallel.
+
+        Returns False if a sink did not finish within timeout.
+        """
+
+        deadline = time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.request_flush()
+        return all([sink.drain(max(0.0, deadline - time.monotonic())) for sink in self.sinks])
+
+    def close(self, timeout=10.0):
+        """Drains and closes all sinks in parallel within timeout.
+
+        Closing the exporters counts against timeout too. Returns the unsent
+        samples of every sink.
+        """
+
+        deadline = time.monotonic() + timeout
+        unsent = {}
+        for sinks in (self._published, self._downstream):
+            # The sink threads export, flush and close concurrently
+            for sink in sinks:
+                sink.request_flush()
+            for sink in sinks:
+                sink.drain(max(0.0, deadline - time.monotonic()))
+            for sink in sinks:
+                unsent[sink.name] = sink.stop()
+            for sink in sinks:
+                sink.join(max(0.0, deadline - time.monotonic()))
+        return unsent
+
+
+def distribution_descriptor(item):
+    """Builds the descriptor of the distribution of a field over its series."""
+
+    descriptor = monitoring_v3.types.MetricDescriptor()
+    descriptor.type = item['name'] + DISTRIBUTION_SUFFIX
+    descriptor.metric_kind = monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE
+    descriptor.value_type = monitoring_v3.enums.MetricDescriptor.ValueType.DISTRIBUTION
+    descriptor.description = item['desc'] + ', distribution over the GPUs'
+    if 'sd_units' in item:
+        descriptor.unit = item['sd_units']
+    return descriptor
+
+
+def set_distribution(distribution, values):
+    """Sets an SD distribution from a list of values."""
+
+    count = len(values)
+    mean = sum(values) / float(count)
+    distribution.count = count
+    distribution.mean = mean
+    distribution.sum_of_squared_deviation = sum((value - mean) ** 2 for value in values)
+    buckets = distribution.bucket_options.exponential_buckets
+    buckets.num_finite_buckets = DISTRIBUTION_BUCKETS
+    buckets.growth_factor = DISTRIBUTION_GROWTH
+    buckets.scale = DISTRIBUTION_SCALE
+    # Bucket 0 is the underflow bucket, DISTRIBUTION_BUCKETS + 1 the overflow bucket
+    counts = [0] * (DISTRIBUTION_BUCKETS + 2)
+    for value in values:
+        if value < DISTRIBUTION_SCALE:
+            index = 0
+        else:
+            index = min(DISTRIBUTION_BUCKETS + 1,
+                        1 + int(math.log(value / DISTRIBUTION_SCALE, DISTRIBUTION_GROWTH)))
+        counts[index] += 1
+    distribution.bucket_counts.extend(counts)
+
+
+class CloudMonitoringExporter(Exporter):
+    """Writes the latest value of every series to Cloud Monitoring.
+
+    The agent's own metrics are written from the same thread at a low rate,
+    unless agent_metrics_interval is None.
+
+    With a limited write budget the fields are written in the order of their
+    catalog priority, the least recently written first among equals. A field
+    that does not fit is written as a single distribution over its series,
+    if distributions is set and one point fits, and otherwise waits for a
+    later cycle, which coarsens its resolution. A RESOURCE_EXHAUSTED error
+    halves the budget until writes succeed again.
+
+    resources, if set, gives the (type, labels) monitored resource of every
+    local GPU, such as the Kubernetes container the GPU is allocated to; the
+    other series and the distributions are written to resource_type.
+
+    Every write attempt is bounded by timeout. After a write missed its
+    deadline, the client is recreated with client_factory, if set, before
+    the next export, so a stuck channel does not stall the sink for good.
+    """
+
+    name = 'cloud_monitoring'
+
+    def __init__(self, client, project_id, fields, resource_type, resource_labels,
+                 metrics, agent_metrics_interval=60, timeout=30.0, attribution=None,
+                 topology=None, host_label=False, budget=None, distributions=True,
+                 resources=None, client_factory=None):
+        self._client = client
+        self._client_factory = client_factory
+        self._reconnect = False
+        self._project_name = client.project_path(project_id)
+        self._fields = fields
+        self._resource_type = resource_type
+        self._resource_labels = resource_labels
+        self._metrics = metrics
+        self._agent_metrics_interval = agent_metrics_interval
+        self._agent_metrics_exported = time.monotonic()
+        self._timeout = timeout
+        self._attribution = attribution
+        self._topology = topology
+        self._host_label = host_label
+        self._resources = resources
+        self._budget = budget if budget is not None and budget.limited else None
+        self._distributions = distributions and self._budget is not None
+        self._field_written = {}
+        if self._budget is not None:
+            metrics.write_budget_scale.set(self._budget.scale)
+        self._written = metrics.points_written.labels(sink=self.name)
+        self._rejected = metrics.points_rejected.labels(sink=self.name)
+        self._create_sd_metric_descriptors()
+        if agent_metrics_interval is not None:
+            agent_metrics.create_metric_descriptors(client, self._project_name,
+                                                    metrics.registry)
+
+    def _create_sd_metric_descriptors(self):
+        """
+        Creates SD metric descriptors for the watched DCGM fields.
+        """
+        label_keys = series_label_keys(self._topology, self._attribution, self._host_label)
+        for key, item in self._fields.items():
+            self._client.create_metric_descriptor(self._project_name,
+                                                  metric_descriptor(item, label_keys))
+            if self._distributions:
+                self._client.create_metric_descriptor(self._project_name,
+                                                      distribution_descriptor(item))
+
+    def _add_point(self, series, sample):
+        """Adds a point to SD time series."""
+
+        item = self._fields[sample.field_id]
+        if 'value_converter' in item:
+            field_value = item['value_converter'](sample.value)
+        else:
+            field_value = sample.value
+
+        point = series.points.add()
+        point.interval.end_time.seconds = sample.timestamp // 10**6
+        point.interval.end_time.nanos = (sample.timestamp % 10**6) * 10**3
+        set_typed_value(point.value, typed_value(item['value_type'], field_value))
+
+    def _construct_sd_series(self, sample):
+        """Constructs SD time series from a sample."""
+
+        resource_type, resource_labels = self._resource_type, self._resource_labels
+        if self._resources is not None and sample.host is None:
+            resource_type, resource_labels = self._resources.resource(
+                (self._topology or _DEFAULT_TOPOLOGY).gpu(sample.entity_group, sample.gpu))
+        series = monitoring_v3.types.TimeSeries()
+        series.resource.type = resource_type
+        for label_key, label_value in resource_labels.items():
+            series.resource.labels[label_key] = label_value
+
+        series.metric.type = self._fields[sample.field_id]['name']
+        series.metric.labels.update(sample_labels(sample, self._topology, self._attribution))
+        self._add_point(series, sample)
+        return series
+
+    def _construct_distribution_series(self, field_id, samples):
+        """Constructs the SD distribution series of a field over its series."""
+
+        item = self._fields[field_id]
+        converter = item.get('value_converter', lambda value: value)
+        series = monitoring_v3.types.TimeSeries()
+        series.resource.type = self._resource_type
+        for label_key, label_value in self._resource_labels.items():
+            series.resource.labels[label_key] = label_value
+        series.metric.type = item['name'] + DISTRIBUTION_SUFFIX
+        timestamp = max(sample.timestamp for sample in samples)
+        point = series.points.add()
+        point.interval.end_time.seconds = timestamp // 10**6
+        point.interval.end_time.nanos = (timestamp % 10**6) * 10**3
+        set_distribution(point.value.distribution_value,
+                         [float(converter(sample.value)) for sample in samples])
+        return series
+
+    def _plan(self, samples):
+        """Returns the samples to write, the fields to write as distributions
+        and the number of deferred samples."""
+
+        if self._budget is None:
+            return samples, {}, 0
+        by_field = collections.defaultdict(list)
+        for sample in samples:
+            by_field[sample.field_id].append(sample)
+        capacity = self._budget.capacity()
+        now = time.monotonic()
+        selected, distributions, deferred = [], {}, 0
+        for field_id in sorted(by_field, key=lambda field_id: (
+                self._fields[field_id].get('priority', DEFAULT_PRIORITY),
+                self._field_written.get(field_id, 0.0), field_id)):
+            field_samples = by_field[field_id]
+            if len(field_samples) <= capacity:
+                selected.extend(field_samples)
+                capacity -= len(field_samples)
+                self._field_written[field_id] = now
+            elif self._distributions and capacity >= 1 and len(field_samples) > 1:
+                distributions[field_id] = field_samples
+                capacity -= 1
+                self._metrics.points_degraded.labels(mode='distribution').inc(
+                    len(field_samples) - 1)
+            else:
+                deferred += len(field_samples)
+        self._metrics.points_degraded.labels(mode='deferred').inc(deferred)
+        return selected, distributions, deferred
+
+    def export(self, samples):
+        if self._reconnect:
+            self._reconnect = False
+            logging.info('Recreating the Cloud Monitoring client')
+            self._client = self._client_factory()
+            self._metrics.watchdog_events.labels(event='client_recreated').inc()
+        build_start = time.monotonic()
+        # A request can only carry one point per series
+        candidates = [sample for sample in latest_samples(samples)
+                      if sample.field_id in self._fields]
+        selected, distributions, deferred = self._plan(candidates)
+        time_series = [self._construct_sd_series(sample) for sample in selected]
+        time_series.extend(self._construct_distribution_series(field_id, field_samples)
+                           for field_id, field_samples in sorted(distributions.items()))
+        self._metrics.series_build_latency.observe(time.monotonic() - build_start)
+
+        result = {'series': len(time_series), 'retries': 0, 'status': 'OK'}
+        if self.detailed:
+            result['bytes'] = sum(series.ByteSize() for series in time_series)
+        if self._budget is not None:
+            self._budget.spend(len(time_series))
+            result.update(deferred=deferred, distributions=len(distributions))
+        for start in range(0, len(time_series), MAX_SERIES_PER_REQUEST):
+            status = self._write_time_series(
+                time_series[start:start + MAX_SERIES_PER_REQUEST], result)
+            if status != 'OK':
+                result['status'] = status
+
+        self._export_agent_metrics()
+        return result
+
+    def _write_time_series(self, time_series, result):
+        """Writes a batch of time series and returns the RPC status."""
+
+        def on_error(err):
+            result['retries'] += 1
+
+        # CreateTimeSeries is not idempotent: a call that missed its deadline
+        # may have been applied, and writing its points again is rejected
+        rpc_retry = retry.Retry(
+            predicate=retry.if_exception_type(exceptions.ServiceUnavailable),
+            deadline=self._timeout,
+            on_error=on_error)
+        try:
+            self._client.create_time_series(
+                name=self._project_name,
+                time_series=time_series,
+                retry=rpc_retry,
+                timeout=self._timeout)
+            self._written.inc(len(time_series))
+            logging.info('Successfully logged time series')
+            if self._budget is not None:
+                self._budget.recover()
+                self._metrics.write_budget_scale.set(self._budget.scale)
+            return 'OK'
+        except exceptions.ResourceExhausted as err:
+            logging.info('Write quota exceeded, reducing the write budget: {}'.format(err))
+            status = type(err).__name__
+            if self._budget is not None:
+                self._budget.throttle()
+                self._metrics.write_budget_scale.set(self._budget.scale)
+        except exceptions.GoogleAPICallError as err:
+            logging.info(err)
+            status = type(err).__name__
+            self._reconnect = (isinstance(err, exceptions.DeadlineExceeded) and
+                               self._client_factory is not None)
+        except exceptions.RetryError:
+            logging.info('Retry attempts to create time series failed')
+            status = 'RetryError'
+            self._reconnect = self._client_factory is not None
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Create_time_series: exception encountered')
+            status = type(err).__name__
+        self._rejected.inc(len(time_series))
+        return status
+
+    def _export_agent_metrics(self):
+        """Writes the agent's own metrics at a low rate."""
+
+        now = time.monotonic()
+        if (self._agent_metrics_interval is None or
+                now - self._agent_metrics_exported < self._agent_metrics_interval):
+            return
+        self._agent_metrics_exported = now
+        self._metrics.process_stats.update()
+        time_series = agent_metrics.to_time_series(self._metrics.registry,
+                                                   self._resource_type,
+                                                   self._resource_labels)
+        try:
+            for start in range(0, len(time_series), MAX_SERIES_PER_REQUEST):
+                self._client.create_time_series(
+                    name=self._project_name,
+                    time_series=time_series[start:start + MAX_SERIES_PER_REQUEST],
+                    timeout=self._timeout)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Failed to log agent metrics: {}'.format(err))
+
+
+class RoutingExporter(Exporter):
+    """Writes the series to the Cloud Monitoring project of their route.
+
+    destination_factory(project) creates the exporter of a project on first
+    use, with its own descriptors and write budget. The default project's
+    exporter is called every cycle, so it keeps writing the agent's own
+    metrics.
+    """
+
+    name = 'cloud_monitoring'
+
+    def __init__(self, router, destination_factory):
+        self._router = router
+        self._factory = destination_factory
+        self._destinations = {}
+
+    def _destination(self, project):
+        exporter = self._destinations.get(project)
+        if exporter is None:
+            exporter = self._destinations[project] = self._factory(project)
+        return exporter
+
+    def export(self, samples):
+        by_project = self._router.split(samples)
+        by_project.setdefault(self._router.default_project, [])
+        result = {'series': 0, 'retries': 0, 'status': 'OK', 'projects': {}}
+        for project, project_samples in sorted(by_project.items()):
+            try:
+                destination = self._destination(project)
+                destination.detailed = self.detailed
+                project_result = destination.export(project_samples) or {}
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Export to project {} failed: {}'.format(project, err))
+                project_result = {'status': type(err).__name__}
+            status = project_result.get('status', 'OK')
+            result['series'] += project_result.get('series', 0)
+            result['retries'] += project_result.get('retries', 0)
+            if 'bytes' in project_result:
+                result['bytes'] = result.get('bytes', 0) + project_result['bytes']
+            result['projects'][project] = status
+            if status != 'OK':
+                result['status'] = status
+        return result
+
+    def flush(self):
+        for exporter in self._destinations.values():
+            exporter.flush()
+
+    def close(self):
+        for exporter in self._destinations.values():
+            exporter.close()
+
+
+def _sample_record(sample, fields, attribution=None, topology=None):
+    record = {'gpu': sample.gpu, 'field_id': sample.field_id,
+              'timestamp': sample.timestamp, 'value': sample.value}
+    if sample.entity_group != entities.ENTITY_GPU:
+        record['entity_group'] = sample.entity_group
+        record['entity_id'] = sample.gpu
+        for key, value in (topology or _DEFAULT_TOPOLOGY).labels(sample.entity_group,
+                                                                 sample.gpu).items():
+            record[key] = int(value)
+    item = fields.get(sample.field_id)
+    if item is not None:
+        record['metric'] = item['name']
+    if sample.host is not None:
+        record[HOST_LABEL] = sample.host
+    elif attribution is not None:
+        gpu = (topology or _DEFAULT_TOPOLOGY).gpu(sample.entity_group, sample.gpu)
+        record.update(attribution.labels(gpu))
+    return record
+
+
+class FileExporter(Exporter):
+    """Appends every sample to a rotating JSON lines file."""
+
+    name = 'file'
+
+    def __init__(self, path, fields, max_bytes=cycle_trace.DEFAULT_MAX_BYTES,
+                 backup_count=cycle_trace.DEFAULT_BACKUP_COUNT, attribution=None,
+                 topology=None):
+        self._fields = fields
+        self._attribution = attribution
+        self._topology = topology
+        self._writer = cycle_trace.JsonLinesWriter(path, max_bytes=max_bytes,
+                                                   backup_count=backup_count)
+
+    def export(self, samples):
+        for sample in samples:
+            self._writer.write(_sample_record(sample, self._fields, self._attribution,
+                                              self._topology))
+        return {'status': 'OK'}
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+
+class StdoutExporter(Exporter):
+    """Prints the latest value of every series as JSON lines."""
+
+    name = 'stdout'
+
+    def __init__(self, fields, stream=None, attribution=None, topology=None):
+        self._fields = fields
+        self._stream = stream or sys.stdout
+        self._attribution = attribution
+        self._topology = topology
+
+    def export(self, samples):
+        lines = [json.dumps(_sample_record(sample, self._fields, self._attribution,
+                                           self._topology),
+                            sort_keys=True)
+                 for sample in latest_samples(samples)]
+        self._stream.write(''.join(line + '\n' for line in lines))
+        self._stream.flush()
+        return {'status': 'OK'}
+
+
+class PrometheusExporter(Exporter):
+    """Updates the exposition buffer served on the Prometheus endpoint."""
+
+    name = 'prometheus'
+
+    def __init__(self, exposition):
+        self._exposition = exposition
+
+    def export(self, samples):
+        self._exposition.update(samples)
+        return {'status': 'OK'}
+
+
+class SampleStoreExporter(Exporter):
+    """Persists every sample to the local columnar sample store."""
+
+    name = 'store'
+
+    def __init__(self, store):
+        self._store = store
+
+    def export(self, samples):
+        self._store.append(samples)
+        return {'status': 'OK'}
+
+    def flush(self):
+        self._store.flush()
+
+    def close(self):
+        self._store.close()
+
+
+class RollupExporter(Exporter):
+    """Feeds the rollup engine and persists the windows that close.
+
+    The rollups of forward_resolution are handed on to the forward sink as
+    one sample per series and window, carrying the window mean. The windows
+    still open are only emitted on close(), so a flush, on a metadata event
+    for example, does not cut them short. The forward sink is a downstream
+    sink of the FanOut, which closes it after this exporter.
+    """
+
+    name = 'rollups'
+
+    def __init__(self, engine, store=None, forward=None, forward_resolution=None):
+        self._engine = engine
+        self._store = store
+        self._forward = forward
+        self._forward_resolution = forward_resolution or engine.resolutions[0]
+
+    def _emit(self, closed):
+        windows = 0
+        for resolution, records in closed.items():
+            windows += len(records)
+            if self._store is not None:
+                self._store.append(resolution, records)
+            if (self._forward is not None and resolution == self._forward_resolution
+                    and len(records)):
+                end = resolution * 10**6
+                self._forward.submit([
+                    Sample(int(r['entity_id']), int(r['field_id']), int(r['start']) + end,
+                           float(r['sum'] / r['count']), int(r['entity_group']))
+                    for r in records])
+        return windows
+
+    def export(self, samples):
+        return {'status': 'OK', 'windows': self._emit(self._engine.add(samples))}
+
+    def close(self):
+        self._emit(self._engine.flush())
+        if self._store is not None:
+            self._store.close()
+
+
+class QuantileSketchExporter(Exporter):
+    """Updates quantile sketches and checkpoints them to a file."""
+
+    name = 'sketches'
+
+    def __init__(self, sketches, path, field_ids=None, job_for_gpu=None,
+                 checkpoint_seconds=300):
+        self._sketches = sketches
+        self._path = path
+        self._field_ids = set(field_ids) if field_ids is not None else None
+        self._job_for_gpu = job_for_gpu
+        self._checkpoint_seconds = checkpoint_seconds
+        self._checkpointed = time.monotonic()
+
+    def export(self, samples):
+        self._sketches.update(gpu_samples(samples), self._field_ids, self._job_for_gpu)
+        if time.monotonic() - self._checkpointed >= self._checkpoint_seconds:
+            self.flush()
+        return {'status': 'OK', 'sketches': len(self._sketches.sketches)}
+
+    def flush(self):
+        self._sketches.save(self._path)
+        self._checkpointed = time.monotonic()
+
+
+class IdleDetectorExporter(Exporter):
+    """Runs the idle and stall detector over every batch."""
+
+    name = 'idle_detector'
+
+    def __init__(self, detector, log):
+        self._detector = detector
+        self._log = log
+
+    def export(self, samples):
+        events = idle_detector.evaluate(self._detector, self._log, gpu_samples(samples))
+        return {'status': 'OK', 'events': len(events)}
+
+    def close(self):
+        self._log.close()
+
+
+class AlertRulesExporter(Exporter):
+    """Evaluates the alert rules against every sample."""
+
+    name = 'alert_rules'
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def export(self, samples):
+        notifications = self._engine.evaluate(gpu_samples(samples))
+        return {'status': 'OK', 'notifications': len(notifications)}
+
+    def close(self):
+        self._engine.close()
+
+
+class OtlpExporter(Exporter):
+    """Sends gauge points to an OpenTelemetry collector over OTLP/HTTP.
+
+    Requires the optional opentelemetry-proto package.
+    """
+
+    name = 'otlp'
+
+    def __init__(self, endpoint, fields, resource_labels, timeout=10.0, attribution=None,
+                 topology=None):
+        try:
+            from opentelemetry.proto.collector.metrics.v1 import metrics_service_pb2
+        except ImportError:
+            raise ImportError('The OTLP exporter requires the opentelemetry-proto package')
+        import requests
+
+        self._pb2 = metrics_service_pb2
+        self._session = requests.Session()
+        self._endpoint = endpoint
+        self._fields = fields
+        self._resource_labels = resource_labels
+        self._timeout = timeout
+        self._attribution = attribution
+        self._topology = topology
+
+    def _request(self, samples):
+        request = self._pb2.ExportMetricsServiceRequest()
+        resource_metrics = request.resource_metrics.add()
+        for key, value in sorted(self._resource_labels.items()):
+            attribute = resource_metrics.resource.attributes.add()
+            attribute.key = key
+            attribute.value.string_value = value
+        scope_metrics = resource_metrics.scope_metrics.add()
+        scope_metrics.scope.name = 'dcgm_stackdriver'
+
+        by_field = collections.defaultdict(list)
+        for sample in samples:
+            if sample.field_id in self._fields:
+                by_field[sample.field_id].append(sample)
+        for field_id, field_samples in by_field.items():
+            item = self._fields[field_id]
+            metric = scope_metrics.metrics.add()
+            metric.name = item['name']
+            metric.description = item['desc']
+            metric.unit = item.get('sd_units', '1')
+            for sample in field_samples:
+                point = metric.gauge.data_points.add()
+                point.time_unix_nano = sample.timestamp * 1000
+                if isinstance(sample.value, float):
+                    point.as_double = sample.value
+                else:
+                    point.as_int = int(sample.value)
+                labels = sample_labels(sample, self._topology, self._attribution)
+                for key, value in sorted(labels.items()):
+                    attribute = point.attributes.add()
+                    attribute.key = key
+                    attribute.value.string_value = value
+        return request
+
+    def export(self, samples):
+        body = self._request(samples).SerializeToString()
+        response = self._session.post(
+            self._endpoint, data=body, timeout=self._timeout,
+            headers={'Content-Type': 'application/x-protobuf'})
+        response.raise_for_status()
+        return {'status': 'OK', 'bytes': len(body)}
+
+
+def connect(address, timeout):
+    """Connects a stream socket to unix:<path> or <host>:<port>."""
+
+    if address.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        target = address[len('unix:'):]
+    else:
+        host, port = address.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target = (host, int(port))
+    sock.settimeout(timeout)
+    try:
+        sock.connect(target)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class GatewayExporter(Exporter):
+    """Streams the latest value of every series to an aggregation gateway.
+
+    The gateway, listening on unix:<path> or <host>:<port>, writes the
+    series to Cloud Monitoring packed with those of the other agents. The
+    metric descriptors are sent first on every new connection. See
+    gateway.py for the protocol.
+    """
+
+    name = 'gateway'
+
+    def __init__(self, address, project_id, fields, resource_type, resource_labels,
+                 metrics, timeout=10.0, attribution=None, topology=None, host_label=False):
+        self._address = address
+        self._project_id = project_id
+        self._fields = fields
+        # Held, not copied, so that label updates apply to the next export
+        self._resource = {'type': resource_type, 'labels': resource_labels}
+        self._timeout = timeout
+        self._attribution = attribution
+        self._topology = topology
+        label_keys = series_label_keys(topology, attribution, host_label)
+        self._descriptors = [json_format.MessageToDict(metric_descriptor(item, label_keys))
+                             for item in fields.values()]
+        self._written = metrics.points_written.labels(sink=self.name)
+        self._rejected = metrics.points_rejected.labels(sink=self.name)
+        self._sock = None
+
+    def _send(self, message):
+        line = (json.dumps(message, sort_keys=True) + '\n').encode('utf-8')
+        if self._sock is None:
+            self._sock = connect(self._address, self._timeout)
+            self._sock.sendall((json.dumps({'project': self._project_id,
+                                            'descriptors': self._descriptors}) +
+                                '\n').encode('utf-8'))
+        self._sock.sendall(line)
+        return len(line)
+
+    def export(self, samples):
+        points = []
+        for sample in latest_samples(samples):
+            item = self._fields.get(sample.field_id)
+            if item is None:
+                continue
+            value = sample.value
+            if 'value_converter' in item:
+                value = item['value_converter'](value)
+            points.append([item['name'],
+                           sample_labels(sample, self._topology, self._attribution),
+                           typed_value(item['value_type'], value), sample.timestamp])
+        if not points:
+            return {'status': 'OK', 'series': 0}
+        try:
+            size = self._send({'project': self._project_id, 'resource': self._resource,
+                               'points': points})
+        except (OSError, ValueError) as err:
+            logging.info('Cannot send to the gateway at {}: {}'.format(self._address, err))
+            self.close()
+            self._rejected.inc(len(points))
+            return {'status': type(err).__name__, 'series': len(points)}
+        self._written.inc(len(points))
+        return {'status': 'OK', 'series': len(points), 'bytes': size}
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
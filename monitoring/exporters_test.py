@@ -0,0 +1,551 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import io
+import json
+import threading
+import time
+
+import pytest
+
+from google.api_core import exceptions
+from google.cloud import monitoring_v3
+
+import agent_metrics
+import cycle_trace
+import entities
+import exporters
+import rate_limit
+import routing
+import synthetic_reader
+from exporters import Sample
+
+FieldValue = collections.namedtuple('FieldValue', ['ts', 'value', 'isBlank'])
+
+GPU_UTIL = 203
+POWER_USAGE = 155
+POWER_TYPE = 'custom.googleapis.com/gce/gpu-test/power_usage'
+
+FIELDS = {
+    GPU_UTIL: {
+        'name': 'custom.googleapis.com/gce/gpu-test/utilization',
+        'desc': 'GPU utilization',
+        'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
+        'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64,
+        'sd_units': '%',
+    },
+    POWER_USAGE: {
+        'name': 'custom.googleapis.com/gce/gpu-test/power_usage',
+        'desc': 'Power usage',
+        'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
+        'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.DOUBLE,
+        'sd_units': 'watt',
+    },
+}
+
+
+class RecordingExporter(exporters.Exporter):
+
+    name = 'recording'
+
+    def __init__(self, delay=0.0, error=None):
+        self.batches = []
+        self.delay = delay
+        self.error = error
+        self.closed = False
+        self.flushes = 0
+
+    def export(self, samples):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        self.batches.append(list(samples))
+        return {'status': 'OK'}
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMetricServiceClient(object):
+    """Records the requests the Cloud Monitoring exporter makes."""
+
+    def __init__(self, errors=()):
+        self.descriptors = []
+        self.requests = []
+        self.errors = list(errors)
+
+    def project_path(self, project_id):
+        return 'projects/' + project_id
+
+    def create_metric_descriptor(self, name, descriptor):
+        self.descriptors.append(descriptor)
+        return descriptor
+
+    def create_time_series(self, name, time_series, retry=None, timeout=None):
+        def call():
+            if self.errors:
+                raise self.errors.pop(0)
+            self.requests.append(list(time_series))
+        if retry is not None:
+            call = retry(call)
+        call()
+
+
+@pytest.fixture
+def metrics():
+    return agent_metrics.AgentMetrics()
+
+
+def test_samples_from_fvs():
+    fvs = {
+        0: {GPU_UTIL: [FieldValue(1, 10, False), FieldValue(2, 20, False)],
+            POWER_USAGE: [FieldValue(2, 0, True)]},
+        1: {GPU_UTIL: [FieldValue(2, 30, False)]},
+    }
+    samples, blank = exporters.samples_from_fvs(fvs)
+
+    assert blank == 1
+    assert sorted(samples) == [Sample(0, GPU_UTIL, 1, 10), Sample(0, GPU_UTIL, 2, 20),
+                               Sample(1, GPU_UTIL, 2, 30)]
+    assert sorted(exporters.latest_samples(samples)) == [
+        Sample(0, GPU_UTIL, 2, 20), Sample(1, GPU_UTIL, 2, 30)]
+
+
+def test_fan_out_isolates_slow_and_failing_sinks(metrics):
+    slow = RecordingExporter(delay=0.5)
+    slow.name = 'slow'
+    failing = RecordingExporter(error=RuntimeError('boom'))
+    failing.name = 'failing'
+    fast = RecordingExporter()
+    sinks = exporters.FanOut(exporters.QueuedExporter(e, metrics)
+                             for e in (slow, failing, fast))
+
+    start = time.monotonic()
+    for ts in range(3):
+        sinks.publish([Sample(0, GPU_UTIL, ts, ts)])
+    assert time.monotonic() - start < 0.1
+
+    sinks.sinks[2].drain(1.0)
+    assert [s.timestamp for batch in fast.batches for s in batch] == [0, 1, 2]
+    sinks.close()
+    assert slow.closed and failing.closed
+    assert sum(len(batch) for batch in slow.batches) == 3
+
+
+def test_queue_drops_oldest_batch(metrics):
+    blocked = threading.Event()
+
+    class BlockingExporter(RecordingExporter):
+        def export(self, samples):
+            blocked.wait()
+            return RecordingExporter.export(self, samples)
+
+    exporter = BlockingExporter()
+    sink = exporters.QueuedExporter(exporter, metrics, queue_size=2)
+    for ts in range(5):
+        sink.submit([Sample(0, GPU_UTIL, ts, ts)])
+        time.sleep(0.02)
+    blocked.set()
+    sink.close()
+
+    exported = [s.timestamp for batch in exporter.batches for s in batch]
+    # The first batch was being exported, then 1 and 2 were dropped
+    assert exported == [0, 3, 4]
+    assert metrics.points_dropped.labels(sink='recording').value == 2
+
+
+def test_fan_out_flush(metrics):
+    slow = RecordingExporter(delay=0.2)
+    fast = RecordingExporter()
+    fast.name = 'fast'
+    sinks = exporters.FanOut(exporters.QueuedExporter(e, metrics) for e in (slow, fast))
+    sinks.publish([Sample(0, GPU_UTIL, 1, 1)])
+    sinks.publish([Sample(0, GPU_UTIL, 2, 2)])
+
+    # The queued batches are exported before the flush
+    assert sinks.flush(5.0)
+    assert slow.flushes == fast.flushes == 1
+    assert sum(len(batch) for batch in slow.batches) == 2
+    assert sinks.flush(5.0)
+    assert slow.flushes == 2
+
+    sinks.publish([Sample(0, GPU_UTIL, 3, 3)])
+    assert not sinks.flush(0.05)
+    assert sinks.flush(5.0)
+    assert sum(len(batch) for batch in slow.batches) == 3
+    sinks.close()
+
+
+def test_close_returns_unsent_samples(metrics):
+    release = threading.Event()
+
+    class BlockingExporter(RecordingExporter):
+        def export(self, samples):
+            release.wait()
+            return RecordingExporter.export(self, samples)
+
+    blocked = BlockingExporter()
+    fast = RecordingExporter()
+    fast.name = 'fast'
+    sinks = exporters.FanOut(exporters.QueuedExporter(e, metrics) for e in (blocked, fast))
+    for ts in range(3):
+        sinks.publish([Sample(0, GPU_UTIL, ts, ts)])
+        time.sleep(0.02)
+
+    start = time.monotonic()
+    unsent = sinks.close(0.2)
+    assert time.monotonic() - start < 1.0
+    # The stuck exporter is closed on its thread once its export call returns
+    assert not blocked.closed and blocked.flushes == 0
+    assert sinks.sinks[1].join(1.0) and fast.closed
+    release.set()
+    assert sinks.sinks[0].join(1.0) and blocked.closed
+    # The batch being exported counts as unsent
+    assert [s.timestamp for s in unsent['recording']] == [0, 1, 2]
+    assert unsent['fast'] == []
+    assert [s.timestamp for batch in fast.batches for s in batch] == [0, 1, 2]
+
+
+def test_downstream_sinks(metrics):
+    release = threading.Event()
+
+    class BlockingExporter(RecordingExporter):
+        name = 'forward'
+
+        def export(self, samples):
+            release.wait()
+            return RecordingExporter.export(self, samples)
+
+    class FeedingExporter(RecordingExporter):
+        def close(self):
+            RecordingExporter.close(self)
+            forward.submit([Sample(0, GPU_UTIL, 9, 9)])
+
+    blocked = BlockingExporter()
+    forward = exporters.QueuedExporter(blocked, metrics)
+    feeding = FeedingExporter()
+    sinks = exporters.FanOut([exporters.QueuedExporter(feeding, metrics)],
+                             downstream=[forward])
+    sinks.publish([Sample(0, GPU_UTIL, 1, 1)])
+    assert [sink.name for sink in sinks.sinks] == ['recording', 'forward']
+    assert forward.depth == 0
+
+    # The downstream sink is closed last, under the same deadline
+    start = time.monotonic()
+    unsent = sinks.close(0.2)
+    assert time.monotonic() - start < 1.0
+    release.set()
+    assert unsent == {'recording': [], 'forward': [Sample(0, GPU_UTIL, 9, 9)]}
+    assert feeding.batches == [[Sample(0, GPU_UTIL, 1, 1)]]
+
+
+def test_span_records_sink_outcome(metrics):
+    records = []
+    span = cycle_trace.CycleSpan(1, time.time(), on_complete=records.append)
+    sink = exporters.QueuedExporter(RecordingExporter(delay=0.1), metrics)
+    sink.submit([Sample(0, GPU_UTIL, 1, 1)], span)
+    span.end()
+    assert not records
+
+    sink.close()
+    assert records == [span]
+    assert span.attributes['sinks']['recording']['status'] == 'OK'
+    assert span.attributes['sinks']['recording']['samples'] == 1
+
+
+def test_cloud_monitoring_exporter(metrics):
+    client = FakeMetricServiceClient(errors=[exceptions.ServiceUnavailable('retry me')])
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'my-project', FIELDS, 'gce_instance', {'zone': 'us-west1-a'},
+        metrics)
+    assert {d.type for d in client.descriptors} >= {
+        FIELDS[GPU_UTIL]['name'], agent_metrics.AGENT_METRIC_PREFIX + 'points_written'}
+
+    samples = [Sample(gpu, GPU_UTIL, ts, 50 + ts) for gpu in range(150) for ts in (1, 2)]
+    samples += [Sample(gpu, POWER_USAGE, 2000001, 250.5) for gpu in range(150)]
+    samples.append(Sample(0, 999, 2, 1))
+    result = exporter.export(samples)
+
+    assert result['status'] == 'OK'
+    assert result['retries'] == 1
+    assert result['series'] == 300
+    assert [len(request) for request in client.requests] == [200, 100]
+    series = {(s.metric.type, s.metric.labels['gpu']): s
+              for request in client.requests for s in request}
+    util = series[(FIELDS[GPU_UTIL]['name'], '7')]
+    assert util.resource.type == 'gce_instance'
+    assert util.resource.labels['zone'] == 'us-west1-a'
+    assert util.points[0].value.int64_value == 52
+    power = series[(FIELDS[POWER_USAGE]['name'], '7')].points[0]
+    assert power.value.double_value == 250.5
+    assert (power.interval.end_time.seconds, power.interval.end_time.nanos) == (2, 1000)
+    assert metrics.points_written.labels(sink='cloud_monitoring').value == 300
+
+
+def test_cloud_monitoring_exporter_job_labels(metrics):
+    class Attribution(object):
+        def labels(self, gpu):
+            return {'job': 'bert'} if gpu == 0 else {}
+
+    client = FakeMetricServiceClient()
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'my-project', FIELDS, 'gce_instance', {}, metrics,
+        attribution=Attribution())
+    exporter.export([Sample(0, GPU_UTIL, 1, 1), Sample(1, GPU_UTIL, 1, 1)])
+
+    labels = sorted((dict(s.metric.labels) for s in client.requests[0]),
+                    key=lambda labels: labels['gpu'])
+    assert labels == [{'gpu': '0', 'job': 'bert'}, {'gpu': '1'}]
+    util = [d for d in client.descriptors if d.type == FIELDS[GPU_UTIL]['name']][0]
+    assert [label.key for label in util.labels] == ['gpu', 'job']
+
+
+def test_samples_from_entity_fvs():
+    values = {
+        entities.ENTITY_GPU: {0: {GPU_UTIL: [FieldValue(1, 10, False)]}},
+        entities.ENTITY_GPU_I: {3: {GPU_UTIL: [FieldValue(1, 5, False),
+                                               FieldValue(2, 0, True)]}},
+    }
+    samples, blank = exporters.samples_from_entity_fvs(values)
+
+    assert blank == 1
+    assert sorted(samples) == [Sample(0, GPU_UTIL, 1, 10),
+                               Sample(3, GPU_UTIL, 1, 5, entities.ENTITY_GPU_I)]
+    # GPU 0 and GPU instance 0 are different series
+    both = [Sample(0, GPU_UTIL, 1, 10), Sample(0, GPU_UTIL, 1, 5, entities.ENTITY_GPU_I)]
+    assert len(exporters.latest_samples(both)) == 2
+    assert exporters.gpu_samples(both) == both[:1]
+
+
+class FakeSinks(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def publish(self, samples, span=None):
+        self.batches.append(samples)
+
+
+def _mig_batch(gpus):
+    sinks = FakeSinks()
+    reader = synthetic_reader.SyntheticReader(FIELDS, sinks, gpus=gpus, gpu_instances=7)
+    reader.Process()
+    return reader.topology, sinks.batches[0]
+
+
+def test_cloud_monitoring_exporter_mig_labels(metrics):
+    topology, samples = _mig_batch(2)
+    client = FakeMetricServiceClient()
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'my-project', FIELDS, 'gce_instance', {}, metrics, topology=topology)
+    result = exporter.export(samples)
+
+    # 2 GPUs, 14 GPU instances and 14 compute instances
+    assert result['series'] == 30 * len(FIELDS)
+    labels = {tuple(sorted(series.metric.labels.items()))
+              for request in client.requests for series in request}
+    assert (('gpu', '1'),) in labels
+    assert (('gpu', '1'), ('gpu_instance', '6')) in labels
+    assert (('compute_instance', '0'), ('gpu', '1'), ('gpu_instance', '6')) in labels
+    util = [d for d in client.descriptors if d.type == FIELDS[GPU_UTIL]['name']][0]
+    assert [label.key for label in util.labels] == list(entities.LABEL_KEYS)
+
+
+def test_cloud_monitoring_export_scales_with_entities(metrics):
+    def build_seconds(gpus):
+        topology, samples = _mig_batch(gpus)
+        exporter = exporters.CloudMonitoringExporter(
+            FakeMetricServiceClient(), 'my-project', FIELDS, 'gce_instance', {}, metrics,
+            topology=topology)
+        best = None
+        for _ in range(7):
+            start = time.monotonic()
+            exporter.export(samples)
+            elapsed = time.monotonic() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    # 16 A100s with 7 instances each are 240 entities
+    small = build_seconds(4)
+    large = build_seconds(16)
+    # Linear, with room for noise; quadratic would be 16 times slower
+    assert large < small * 4 * 2
+
+
+def test_file_exporter_mig_records(tmp_path):
+    topology, samples = _mig_batch(1)
+    path = str(tmp_path / 'samples.jsonl')
+    exporter = exporters.FileExporter(path, FIELDS, topology=topology)
+    exporter.export([sample for sample in samples
+                     if sample.entity_group == entities.ENTITY_GPU_CI and sample.gpu == 2])
+    exporter.close()
+    with open(path) as f:
+        record = json.loads(f.readline())
+    assert record['entity_group'] == entities.ENTITY_GPU_CI
+    assert (record['entity_id'], record['gpu'], record['gpu_instance'],
+            record['compute_instance']) == (2, 0, 2, 0)
+
+
+def test_cloud_monitoring_exporter_remote_hosts(metrics):
+    client = FakeMetricServiceClient()
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'my-project', FIELDS, 'gce_instance', {}, metrics, host_label=True)
+    samples = [Sample(0, GPU_UTIL, 1, 10, host='node-{}'.format(index))
+               for index in range(150)]
+    result = exporter.export(samples * 2)
+
+    # Series of different hosts are not collapsed, and requests are packed
+    assert result['series'] == 150
+    assert [len(request) for request in client.requests] == [150]
+    assert client.requests[0][7].metric.labels == {'gpu': '0', 'host': 'node-7'}
+    util = [d for d in client.descriptors if d.type == FIELDS[GPU_UTIL]['name']][0]
+    assert [label.key for label in util.labels] == ['gpu', 'host']
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cloud_monitoring_exporter_write_budget(metrics):
+    fields = {field_id: dict(item) for field_id, item in FIELDS.items()}
+    fields[GPU_UTIL]['priority'] = 0
+    fields[POWER_USAGE]['priority'] = 1
+    clock = Clock()
+    # 10 points per minute
+    budget = rate_limit.WriteBudget(points_per_second=10 / 60.0, clock=clock)
+    client = FakeMetricServiceClient()
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'my-project', fields, 'gce_instance', {}, metrics, budget=budget)
+    assert POWER_TYPE + exporters.DISTRIBUTION_SUFFIX in [d.type for d in client.descriptors]
+
+    samples = [Sample(gpu, field_id, 10**6, 100.0 + gpu)
+               for gpu in range(8) for field_id in (GPU_UTIL, POWER_USAGE)]
+    result = exporter.export(samples)
+
+    # Utilization has priority, power is folded into a distribution
+    assert (result['series'], result['distributions'], result['deferred']) == (9, 1, 0)
+    series = client.requests[0]
+    assert [s.metric.type for s in series].count(FIELDS[GPU_UTIL]['name']) == 8
+    distribution = series[-1].points[0].value.distribution_value
+    assert series[-1].metric.type == POWER_TYPE + exporters.DISTRIBUTION_SUFFIX
+    assert (distribution.count, distribution.mean) == (8, 103.5)
+    assert sum(distribution.bucket_counts) == 8
+
+    # With one point left the priority field gets the distribution, power waits
+    result = exporter.export(samples)
+    assert (result['series'], result['distributions'], result['deferred']) == (1, 1, 8)
+    assert client.requests[1][0].metric.type == (FIELDS[GPU_UTIL]['name'] +
+                                                 exporters.DISTRIBUTION_SUFFIX)
+    assert metrics.points_degraded.labels(mode='deferred').value == 8
+
+    clock.now = 60
+    client.errors = [exceptions.ResourceExhausted('quota')]
+    result = exporter.export(samples)
+    assert result['status'] == 'ResourceExhausted'
+    assert metrics.write_budget_scale.labels().value == 0.5
+    clock.now = 180
+    exporter.export(samples)
+    assert metrics.write_budget_scale.labels().value == 0.6
+
+
+def test_routing_exporter(metrics):
+    client = FakeMetricServiceClient()
+    created = []
+
+    def factory(project_id):
+        created.append(project_id)
+        return exporters.CloudMonitoringExporter(
+            client, project_id, FIELDS, 'gce_instance', {}, metrics,
+            agent_metrics_interval=0 if project_id == 'default' else None)
+
+    router = routing.Router(routing.load_routes({'routes': [
+        {'project': 'team-b', 'gpus': [1]}]}), 'default')
+    exporter = exporters.RoutingExporter(router, factory)
+    result = exporter.export([Sample(0, GPU_UTIL, 1, 10), Sample(1, GPU_UTIL, 1, 20)])
+    assert result['series'] == 2
+    assert result['projects'] == {'default': 'OK', 'team-b': 'OK'}
+
+    # The default project gets the agent metrics even without GPU samples
+    client.requests = []
+    exporter.export([Sample(1, GPU_UTIL, 2, 20)])
+    assert created == ['default', 'team-b']
+    assert len(client.requests) >= 2
+    agent_types = [series.metric.type for request in client.requests for series in request
+                   if series.metric.type.startswith(agent_metrics.AGENT_METRIC_PREFIX)]
+    assert agent_types
+
+
+def test_cloud_monitoring_exporter_rejects(metrics):
+    client = FakeMetricServiceClient(errors=[exceptions.InvalidArgument('bad')])
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'my-project', FIELDS, 'gce_instance', {}, metrics)
+    result = exporter.export([Sample(0, GPU_UTIL, 1, 1)])
+
+    assert result['status'] == 'InvalidArgument'
+    assert metrics.points_rejected.labels(sink='cloud_monitoring').value == 1
+
+
+def test_cloud_monitoring_request_bytes_only_when_traced(metrics):
+    records = []
+    exporter = exporters.CloudMonitoringExporter(
+        FakeMetricServiceClient(), 'my-project', FIELDS, 'gce_instance', {}, metrics)
+    assert 'bytes' not in exporter.export([Sample(0, GPU_UTIL, 1, 1)])
+
+    sink = exporters.QueuedExporter(exporter, metrics)
+    span = cycle_trace.CycleSpan(1, time.time(), detailed=True, on_complete=records.append)
+    sink.submit([Sample(0, GPU_UTIL, 2, 2)], span)
+    span.end()
+    sink.close()
+    assert records[0].to_record()['sinks']['cloud_monitoring']['bytes'] > 0
+
+
+def test_cloud_monitoring_exporter_recreates_client(metrics):
+    stuck = FakeMetricServiceClient(errors=[exceptions.DeadlineExceeded('stuck')])
+    fresh = FakeMetricServiceClient()
+    exporter = exporters.CloudMonitoringExporter(
+        stuck, 'my-project', FIELDS, 'gce_instance', {}, metrics, timeout=0.1,
+        client_factory=lambda: fresh)
+    # The write may have been applied, it is not retried
+    result = exporter.export([Sample(0, GPU_UTIL, 1, 1)])
+    assert (result['status'], result['retries']) == ('DeadlineExceeded', 0)
+    assert stuck.requests == []
+    assert exporter.export([Sample(0, GPU_UTIL, 2, 2)])['status'] == 'OK'
+    assert len(fresh.requests) == 1
+    assert metrics.watchdog_events.labels(event='client_recreated').value == 1
+
+
+def test_file_and_stdout_exporters(tmp_path):
+    samples = [Sample(0, GPU_UTIL, 1, 10), Sample(0, GPU_UTIL, 2, 20)]
+    path = str(tmp_path / 'samples.jsonl')
+    file_exporter = exporters.FileExporter(path, FIELDS)
+    file_exporter.export(samples)
+    file_exporter.close()
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['value'] for r in records] == [10, 20]
+    assert records[0]['metric'] == FIELDS[GPU_UTIL]['name']
+
+    stream = io.StringIO()
+    exporters.StdoutExporter(FIELDS, stream).export(samples)
+    assert [json.loads(line)['value'] for line in stream.getvalue().splitlines()] == [20]
@@ -0,0 +1,410 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Aggregation gateway writing the series of many agents to Cloud Monitoring.
+
+Agents started with --exporters=gateway stream the latest value of their
+series to the gateway as JSON lines over a Unix or TCP socket. The metric
+descriptors come first on every connection, then one line per cycle:
+
+    {"project": "my-project", "descriptors": [{"type": "custom.googleapis.com/...", ...}]}
+    {"project": "my-project",
+     "resource": {"type": "gce_instance", "labels": {"instance_id": "...", "zone": "..."}},
+     "points": [["custom.googleapis.com/gce/gpu-test/utilization", {"gpu": "0"},
+                 87, 1600000000000000]]}
+
+The gateway keeps the latest point of every series per destination project
+and writes them in requests of MAX_SERIES_PER_REQUEST series: full requests
+as soon as they fill up, the rest every flush_seconds. Each project has its
+own request rate limit; series over it wait for the next flush, coalesced
+with their newer points. Requests that still fail after the retries are
+spooled to disk and replayed oldest first, before any newer point of the
+project is written, so the series stay in order.
+
+    python gateway.py --project_id=my-project --listen=unix:/run/dcgm-gateway.sock \\
+        --spool_dir=/var/spool/dcgm-gateway
+"""
+
+import json
+import os
+import socketserver
+import threading
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from google.api_core import exceptions
+from google.api_core import retry
+from google.cloud import monitoring_v3
+from google.protobuf import json_format
+
+import agent_metrics
+import exporters
+import rate_limit
+import spool as spool_lib
+
+DEFAULT_FLUSH_SECONDS = 10.0
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+
+# Errors after which a request is worth sending again later
+_TRANSIENT_ERRORS = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded,
+                     exceptions.ResourceExhausted, exceptions.InternalServerError,
+                     exceptions.RetryError)
+
+
+def _freeze(labels):
+    return tuple(sorted(labels.items()))
+
+
+class AggregationGateway(object):
+    """Coalesces the points of many agents into packed Cloud Monitoring writes."""
+
+    def __init__(self, client, metrics=None, flush_seconds=DEFAULT_FLUSH_SECONDS,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, spool=None, timeout=30.0,
+                 clock=time.monotonic):
+        self._client = client
+        self._metrics = metrics or agent_metrics.AgentMetrics()
+        self._flush_seconds = flush_seconds
+        self._requests_per_second = requests_per_second
+        self._spool = spool
+        self._timeout = timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = {}
+        self._limiters = {}
+        self._descriptors = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self._written = self._metrics.points_written.labels(sink='gateway')
+        self._rejected = self._metrics.points_rejected.labels(sink='gateway')
+        self._latency = self._metrics.export_latency.labels(sink='gateway')
+
+    def handle(self, message):
+        """Handles a message of the agent protocol."""
+
+        project = message['project']
+        if 'descriptors' in message:
+            self.add_descriptors(project, message['descriptors'])
+        if 'points' in message:
+            resource = message['resource']
+            self.add(project, resource['type'], resource.get('labels', {}), message['points'])
+
+    def add_descriptors(self, project, descriptors):
+        """Creates the metric descriptors a project does not have yet."""
+
+        for item in descriptors:
+            key = (project, item['type'])
+            with self._lock:
+                if key in self._descriptors:
+                    continue
+            descriptor = json_format.ParseDict(item, monitoring_v3.types.MetricDescriptor())
+            self._client.create_metric_descriptor(self._client.project_path(project),
+                                                  descriptor)
+            with self._lock:
+                self._descriptors.add(key)
+
+    def add(self, project, resource_type, resource_labels, points):
+        """Queues points, keeping the latest point of every series."""
+
+        resource_key = (resource_type, _freeze(resource_labels))
+        coalesced = 0
+        with self._lock:
+            series = self._pending.setdefault(project, {})
+            for metric_type, labels, value, timestamp in points:
+                key = (resource_key, metric_type, _freeze(labels))
+                current = series.get(key)
+                if current is not None:
+                    coalesced += 1
+                    if current[-1] > timestamp:
+                        continue
+                series[key] = (resource_type, resource_labels, metric_type, labels, value,
+                               timestamp)
+            if len(series) >= exporters.MAX_SERIES_PER_REQUEST:
+                self._wakeup.notify()
+        self._metrics.gateway_points.labels(outcome='received').inc(len(points))
+        self._metrics.gateway_points.labels(outcome='coalesced').inc(coalesced)
+
+    def pending(self, project=None):
+        with self._lock:
+            return sum(len(series) for name, series in self._pending.items()
+                       if project is None or name == project)
+
+    def _limiter(self, project):
+        limiter = self._limiters.get(project)
+        if limiter is None:
+            limiter = self._limiters[project] = rate_limit.TokenBucket(
+                self._requests_per_second, clock=self._clock)
+        return limiter
+
+    @staticmethod
+    def _time_series(record):
+        resource_type, resource_labels, metric_type, labels, value, timestamp = record
+        series = monitoring_v3.types.TimeSeries()
+        series.resource.type = resource_type
+        series.resource.labels.update(resource_labels)
+        series.metric.type = metric_type
+        series.metric.labels.update(labels)
+        point = series.points.add()
+        point.interval.end_time.seconds = timestamp // 10**6
+        point.interval.end_time.nanos = (timestamp % 10**6) * 10**3
+        exporters.set_typed_value(point.value, value)
+        return series
+
+    def _write(self, project, records):
+        """Writes a request. Returns True if it was sent or can never succeed."""
+
+        start = time.monotonic()
+        try:
+            self._client.create_time_series(
+                name=self._client.project_path(project),
+                time_series=[self._time_series(record) for record in records],
+                # Not on DeadlineExceeded, the request may have been applied
+                retry=retry.Retry(predicate=retry.if_exception_type(
+                    exceptions.ServiceUnavailable), deadline=self._timeout))
+            self._written.inc(len(records))
+            return True
+        except _TRANSIENT_ERRORS as err:
+            logging.info('Write to {} failed, will retry: {}'.format(project, err))
+            return False
+        except exceptions.GoogleAPICallError as err:
+            logging.info('Write to {} rejected: {}'.format(project, err))
+            self._rejected.inc(len(records))
+            return True
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Write to {} failed, will retry: {}'.format(project, err))
+            return False
+        finally:
+            self._latency.observe(time.monotonic() - start)
+
+    def _spool_records(self, project, records):
+        if self._spool is None:
+            self._rejected.inc(len(records))
+            return
+        dropped = self._spool.put(project, [list(record) for record in records])
+        self._metrics.gateway_points.labels(outcome='spooled').inc(len(records))
+        if dropped:
+            logging.info('Spool full, dropped {} batches'.format(len(dropped)))
+            self._metrics.gateway_points.labels(outcome='dropped').inc(len(dropped))
+
+    def _replay(self, blocked):
+        """Replays spooled requests, oldest first, adding stuck projects to blocked."""
+
+        if self._spool is None:
+            return 0
+        requests = 0
+        for name in self._spool.names():
+            project = self._spool.key(name)
+            if project in blocked:
+                continue
+            if not self._limiter(project).try_acquire():
+                blocked.add(project)
+                continue
+            records = [tuple(record) for record in self._spool.load(name)]
+            requests += 1
+            if self._write(project, records):
+                self._spool.remove(name)
+                self._metrics.gateway_points.labels(outcome='replayed').inc(len(records))
+            else:
+                blocked.add(project)
+        return requests
+
+    def flush(self, partial=True):
+        """Writes the full requests, and the partial ones when partial is set.
+
+        Returns the number of requests made.
+        """
+
+        blocked = set()
+        requests = self._replay(blocked)
+        with self._lock:
+            projects = list(self._pending)
+        for project in projects:
+            # Newer points wait until the spooled ones of their project are written
+            if project in blocked or (self._spool is not None and self._spool.names(project)):
+                continue
+            while True:
+                with self._lock:
+                    series = self._pending[project]
+                    if not series or (len(series) < exporters.MAX_SERIES_PER_REQUEST
+                                      and not partial):
+                        break
+                    if not self._limiter(project).try_acquire():
+                        break
+                    keys = list(series)[:exporters.MAX_SERIES_PER_REQUEST]
+                    records = [series.pop(key) for key in keys]
+                requests += 1
+                if not self._write(project, records):
+                    self._spool_records(project, records)
+                    break
+        if self._spool is not None:
+            self._metrics.spool_batches.set(len(self._spool))
+        return requests
+
+    def _run(self):
+        next_flush = self._clock() + self._flush_seconds
+        while not self._stop.is_set():
+            with self._lock:
+                self._wakeup.wait(max(0.0, next_flush - self._clock()))
+            if self._stop.is_set():
+                return
+            due = self._clock() >= next_flush
+            try:
+                self.flush(partial=due)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Gateway flush failed: {}'.format(err))
+            if due:
+                next_flush = self._clock() + self._flush_seconds
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='gateway-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the flush thread, writes what it can and spools the rest."""
+
+        self._stop.set()
+        with self._lock:
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for project, series in pending.items():
+            records = list(series.values())
+            for start in range(0, len(records), exporters.MAX_SERIES_PER_REQUEST):
+                self._spool_records(project,
+                                    records[start:start + exporters.MAX_SERIES_PER_REQUEST])
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                self.server.gateway.handle(json.loads(line.decode('utf-8')))
+            except (ValueError, KeyError, TypeError) as err:
+                logging.info('Invalid gateway message: {}'.format(err))
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Gateway message failed: {}'.format(err))
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class GatewayServer(object):
+    """Accepts agent connections on unix:<path> or <host>:<port>."""
+
+    def __init__(self, gateway, address):
+        self._path = None
+        if address.startswith('unix:'):
+            self._path = address[len('unix:'):]
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+            self._server = _UnixServer(self._path, _Handler)
+        else:
+            host, port = address.rsplit(':', 1)
+            self._server = _TcpServer((host, int(port)), _Handler)
+        self._server.gateway = gateway
+        self._thread = None
+
+    @property
+    def address(self):
+        if self._path is not None:
+            return 'unix:' + self._path
+        host, port = self._server.server_address[:2]
+        return '{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='gateway-server', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._path is not None and os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+    del argv
+
+    metrics = agent_metrics.AgentMetrics()
+    client = monitoring_v3.MetricServiceClient()
+    spool = None
+    if FLAGS.spool_dir:
+        spool = spool_lib.Spool(FLAGS.spool_dir, max_bytes=FLAGS.spool_max_mb * 1024 * 1024)
+    gateway = AggregationGateway(client, metrics, flush_seconds=FLAGS.flush_seconds,
+                                 requests_per_second=FLAGS.requests_per_second, spool=spool)
+    server = GatewayServer(gateway, FLAGS.listen)
+    project_name = client.project_path(FLAGS.project_id)
+    agent_metrics.create_metric_descriptors(client, project_name, metrics.registry)
+    resource_labels = {'project_id': FLAGS.project_id}
+    gateway.start()
+    server.start()
+    logging.info('Gateway listening on {}'.format(server.address))
+    try:
+        while True:
+            time.sleep(FLAGS.agent_metrics_interval)
+            metrics.process_stats.update()
+            time_series = agent_metrics.to_time_series(metrics.registry, 'global',
+                                                       resource_labels)
+            try:
+                for start in range(0, len(time_series), exporters.MAX_SERIES_PER_REQUEST):
+                    client.create_time_series(
+                        name=project_name,
+                        time_series=time_series[start:start + exporters.MAX_SERIES_PER_REQUEST])
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Failed to log gateway metrics: {}'.format(err))
+    except KeyboardInterrupt:
+        logging.info('Caught CTRL-C. Exiting ...')
+    finally:
+        server.stop()
+        gateway.stop()
+
+
+def _define_flags():
+    flags.DEFINE_string('project_id', None, 'GCP project of the gateway\'s own metrics')
+    flags.DEFINE_string('listen', 'unix:/tmp/dcgm_gateway.sock',
+                        'unix:<path> or <host>:<port> the agents connect to')
+    flags.DEFINE_float('flush_seconds', DEFAULT_FLUSH_SECONDS,
+                       'Interval of the writes of partial requests - seconds', lower_bound=1)
+    flags.DEFINE_float('requests_per_second', DEFAULT_REQUESTS_PER_SECOND,
+                       'Write requests per second allowed per destination project',
+                       lower_bound=0.01)
+    flags.DEFINE_string('spool_dir', '', 'Directory spooling the requests that failed')
+    flags.DEFINE_integer('spool_max_mb', spool_lib.DEFAULT_MAX_BYTES // (1024 * 1024),
+                         'Size budget of the spool - MB', lower_bound=1)
+    flags.DEFINE_integer('agent_metrics_interval', 60,
+                         'Export frequency of the gateway\'s own metrics - seconds',
+                         lower_bound=10)
+    flags.mark_flag_as_required('project_id')
+
+
+if __name__ == '__main__':
+    _define_flags()
+    app.run(main)
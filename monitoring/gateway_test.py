@@ -0,0 +1,223 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import pytest
+
+from google.api_core import exceptions
+from google.cloud import monitoring_v3
+
+import agent_metrics
+import exporters
+import gateway
+import spool
+from exporters import Sample
+
+UTIL = 'custom.googleapis.com/gce/gpu-test/utilization'
+GPU_UTIL = 203
+
+FIELDS = {
+    GPU_UTIL: {
+        'name': UTIL,
+        'desc': 'GPU utilization',
+        'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
+        'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64,
+        'sd_units': '%',
+    },
+}
+
+
+class FakeMetricServiceClient(object):
+
+    def __init__(self, errors=()):
+        self.descriptors = []
+        self.requests = []
+        self.errors = list(errors)
+
+    def project_path(self, project_id):
+        return 'projects/' + project_id
+
+    def create_metric_descriptor(self, name, descriptor):
+        self.descriptors.append((name, descriptor))
+        return descriptor
+
+    def create_time_series(self, name, time_series, retry=None, timeout=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.requests.append((name, list(time_series)))
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _points(count, timestamp=1600000000000000, value=50):
+    return [[UTIL, {'gpu': str(gpu)}, value, timestamp] for gpu in range(count)]
+
+
+def _resource(instance):
+    return 'gce_instance', {'instance_id': instance, 'zone': 'us-central1-a'}
+
+
+def test_coalesces_and_packs_agents():
+    client = FakeMetricServiceClient()
+    metrics = agent_metrics.AgentMetrics()
+    gw = gateway.AggregationGateway(client, metrics, requests_per_second=100,
+                                    clock=Clock())
+    # 3 agents with 80 series each, the first one twice
+    gw.add('p', *_resource('a'), _points(80))
+    gw.add('p', *_resource('a'), _points(80, timestamp=1600000010000000, value=60))
+    gw.add('p', *_resource('b'), _points(80))
+    gw.add('p', *_resource('c'), _points(80))
+
+    assert gw.pending() == 240
+    assert metrics.gateway_points.labels(outcome='coalesced').value == 80
+    # Only full requests are written between flush intervals
+    assert gw.flush(partial=False) == 1
+    assert [len(series) for _, series in client.requests] == [200]
+    assert gw.flush(partial=False) == 0
+    assert gw.flush() == 1
+    assert [len(series) for _, series in client.requests] == [200, 40]
+
+    first = client.requests[0][1][0]
+    assert first.resource.labels['instance_id'] == 'a'
+    assert first.points[0].value.int64_value == 60
+    assert metrics.points_written.labels(sink='gateway').value == 240
+
+
+def test_rate_limits_per_project():
+    client = FakeMetricServiceClient()
+    clock = Clock()
+    gw = gateway.AggregationGateway(client, requests_per_second=1, clock=clock)
+    gw.add('p', *_resource('a'), _points(400))
+    gw.add('q', *_resource('a'), _points(10))
+
+    assert gw.flush() == 2
+    assert sorted((name, len(series)) for name, series in client.requests) == [
+        ('projects/p', 200), ('projects/q', 10)]
+    assert gw.pending('p') == 200
+    clock.now = 1
+    assert gw.flush() == 1
+    assert gw.pending() == 0
+
+
+def test_spools_and_replays_in_order(tmp_path):
+    client = FakeMetricServiceClient(errors=[exceptions.ResourceExhausted('quota')])
+    metrics = agent_metrics.AgentMetrics()
+    clock = Clock()
+    batches = spool.Spool(str(tmp_path))
+    gw = gateway.AggregationGateway(client, metrics, requests_per_second=100,
+                                    spool=batches, clock=clock)
+    gw.add('p', *_resource('a'), _points(2, timestamp=1))
+    gw.flush()
+    assert client.requests == []
+    assert len(batches) == 1
+    assert metrics.spool_batches.labels().value == 1
+
+    # Newer points of the project wait for the spooled ones
+    gw.add('p', *_resource('a'), _points(2, timestamp=2))
+    client.errors = [exceptions.ServiceUnavailable('down')]
+    gw.flush()
+    assert client.requests == [] and gw.pending('p') == 2
+
+    clock.now = 1
+    gw.flush()
+    assert [series[0].points[0].interval.end_time.nanos for _, series in client.requests] == [
+        1000, 2000]
+    assert len(batches) == 0
+    assert metrics.gateway_points.labels(outcome='replayed').value == 2
+
+
+def test_invalid_requests_are_not_spooled(tmp_path):
+    client = FakeMetricServiceClient(errors=[exceptions.InvalidArgument('bad')])
+    batches = spool.Spool(str(tmp_path))
+    gw = gateway.AggregationGateway(client, requests_per_second=100, spool=batches,
+                                    clock=Clock())
+    gw.add('p', *_resource('a'), _points(2))
+    gw.flush()
+    assert len(batches) == 0 and gw.pending() == 0
+
+
+def test_stop_spools_pending_points(tmp_path):
+    client = FakeMetricServiceClient()
+    batches = spool.Spool(str(tmp_path))
+    gw = gateway.AggregationGateway(client, requests_per_second=1, spool=batches,
+                                    clock=Clock())
+    gw.add('p', *_resource('a'), _points(450))
+    gw.stop()
+    assert len(client.requests) == 1
+    assert [len(batches.load(name)) for name in batches.names('p')] == [200, 50]
+
+    # A new gateway replays the spool
+    gw = gateway.AggregationGateway(client, requests_per_second=100,
+                                    spool=spool.Spool(str(tmp_path)), clock=Clock())
+    gw.flush()
+    assert [len(series) for _, series in client.requests] == [200, 200, 50]
+
+
+def test_spool_budget(tmp_path):
+    batches = spool.Spool(str(tmp_path), max_bytes=250)
+    for index in range(5):
+        batches.put('p', ['x' * 100, index])
+    assert [batches.load(name)[1] for name in batches.names()] == [3, 4]
+    assert batches.keys() == {'p'}
+
+
+@pytest.mark.parametrize('address', ['127.0.0.1:0', 'unix'])
+def test_agents_stream_to_gateway(address, tmp_path):
+    client = FakeMetricServiceClient()
+    metrics = agent_metrics.AgentMetrics()
+    gw = gateway.AggregationGateway(client, metrics, clock=Clock())
+    if address == 'unix':
+        address = 'unix:' + str(tmp_path / 'gateway.sock')
+    server = gateway.GatewayServer(gw, address)
+    server.start()
+    try:
+        agents = [exporters.GatewayExporter(server.address, 'p', FIELDS, *_resource(name),
+                                            metrics)
+                  for name in ('a', 'b')]
+        for agent in agents:
+            result = agent.export([Sample(0, GPU_UTIL, 1, 10.4), Sample(0, GPU_UTIL, 2, 20.6),
+                                   Sample(1, GPU_UTIL, 2, 30.0)])
+            assert result['status'] == 'OK' and result['series'] == 2
+        deadline = time.monotonic() + 5
+        while gw.pending() < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for agent in agents:
+            agent.close()
+    finally:
+        server.stop()
+
+    # Descriptors are created once per project
+    assert [descriptor.type for _, descriptor in client.descriptors] == [UTIL]
+    gw.flush()
+    values = sorted(series.points[0].value.int64_value for _, request in client.requests
+                    for series in request)
+    assert values == [21, 21, 30, 30]
+
+
+def test_gateway_exporter_unavailable(tmp_path):
+    metrics = agent_metrics.AgentMetrics()
+    agent = exporters.GatewayExporter('unix:' + str(tmp_path / 'missing.sock'), 'p', FIELDS,
+                                      *_resource('a'), metrics)
+    result = agent.export([Sample(0, GPU_UTIL, 1, 10)])
+    assert result['status'] == 'FileNotFoundError'
+    assert metrics.points_rejected.labels(sink='gateway').value == 1
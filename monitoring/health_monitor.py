@@ -0,0 +1,286 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GPU health events: XID errors, ECC counters, retired pages and throttling.
+
+A health source reads the health state of every GPU. The monitor polls it on
+its own thread, at a much lower rate than the profiling fields, and only
+reports changes:
+
+    throttle            the clock throttle reasons changed
+    ecc                 ECC error counters increased, with the deltas
+    page_retirement     pages were retired
+    retirement_pending  a page retirement is pending a reset, or no longer
+    xid                 the driver reported an XID error
+
+Events are appended to a JSON lines log and counted in the agent metrics:
+
+    {"time": 1600000000.0, "gpu": 3, "event": "throttle",
+     "reasons": ["sw_power_cap"], "started": ["sw_power_cap"], "ended": []}
+"""
+
+import threading
+import time
+
+from absl import logging
+
+import cycle_trace
+
+DEFAULT_INTERVAL_SECONDS = 30
+
+THROTTLE = 'throttle'
+ECC = 'ecc'
+PAGE_RETIREMENT = 'page_retirement'
+RETIREMENT_PENDING = 'retirement_pending'
+XID = 'xid'
+EVENTS = (THROTTLE, ECC, PAGE_RETIREMENT, RETIREMENT_PENDING, XID)
+
+# NVML clock throttle reason bits
+GPU_IDLE = 0x1
+THROTTLE_REASONS = (
+    (GPU_IDLE, 'gpu_idle'),
+    (0x2, 'applications_clocks_setting'),
+    (0x4, 'sw_power_cap'),
+    (0x8, 'hw_slowdown'),
+    (0x10, 'sync_boost'),
+    (0x20, 'sw_thermal_slowdown'),
+    (0x40, 'hw_thermal_slowdown'),
+    (0x80, 'hw_power_brake_slowdown'),
+    (0x100, 'display_clock_setting'),
+)
+
+ECC_COUNTERS = ('volatile_corrected', 'volatile_uncorrected',
+                'aggregate_corrected', 'aggregate_uncorrected')
+RETIRED_PAGE_CAUSES = ('multiple_single_bit', 'double_bit')
+
+
+def throttle_reason_names(mask):
+    return [name for bit, name in THROTTLE_REASONS if mask & bit]
+
+
+class HealthSource(object):
+    """Reads the health state of every GPU."""
+
+    def readings(self):
+        """Returns a dict mapping GPU ids to their health readings.
+
+        A reading is a dict of any of: throttle_reasons (bitmask), the
+        ECC_COUNTERS, retired_<cause> page counts and retirement_pending.
+        Fields a GPU does not support are left out.
+        """
+        raise NotImplementedError
+
+    def xid_errors(self):
+        """Returns the (gpu, xid) errors reported since the last call."""
+        return []
+
+    def close(self):
+        pass
+
+
+class NvmlHealthSource(HealthSource):
+    """Reads health state through NVML; requires the optional pynvml package.
+
+    NVML device indexes are assumed to match the DCGM GPU ids.
+    """
+
+    def __init__(self):
+        try:
+            import pynvml
+        except ImportError:
+            raise ImportError('NVML health monitoring requires the pynvml package')
+        self._nvml = pynvml
+        pynvml.nvmlInit()
+        self._handles = [pynvml.nvmlDeviceGetHandleByIndex(index)
+                         for index in range(pynvml.nvmlDeviceGetCount())]
+        self._events = pynvml.nvmlEventSetCreate()
+        for index, handle in enumerate(self._handles):
+            try:
+                pynvml.nvmlDeviceRegisterEvents(
+                    handle, pynvml.nvmlEventTypeXidCriticalError, self._events)
+            except pynvml.NVMLError as err:
+                logging.info('GPU {}: XID events not supported: {}'.format(index, err))
+
+    def _query(self, reading, key, function, *args):
+        try:
+            reading[key] = function(*args)
+        except self._nvml.NVMLError:
+            pass
+
+    def readings(self):
+        nvml = self._nvml
+        result = {}
+        for index, handle in enumerate(self._handles):
+            reading = {}
+            self._query(reading, 'throttle_reasons',
+                        nvml.nvmlDeviceGetCurrentClocksThrottleReasons, handle)
+            for name in ECC_COUNTERS:
+                counter, error_type = name.split('_')
+                self._query(reading, name, nvml.nvmlDeviceGetTotalEccErrors, handle,
+                            nvml.NVML_MEMORY_ERROR_TYPE_CORRECTED if error_type == 'corrected'
+                            else nvml.NVML_MEMORY_ERROR_TYPE_UNCORRECTED,
+                            nvml.NVML_VOLATILE_ECC if counter == 'volatile'
+                            else nvml.NVML_AGGREGATE_ECC)
+            for cause, name in enumerate(RETIRED_PAGE_CAUSES):
+                try:
+                    reading['retired_' + name] = len(nvml.nvmlDeviceGetRetiredPages(handle, cause))
+                except nvml.NVMLError:
+                    pass
+            try:
+                reading['retirement_pending'] = (
+                    nvml.nvmlDeviceGetRetiredPagesPendingStatus(handle) ==
+                    nvml.NVML_FEATURE_ENABLED)
+            except nvml.NVMLError:
+                pass
+            result[index] = reading
+        return result
+
+    def xid_errors(self):
+        nvml = self._nvml
+        errors = []
+        while True:
+            try:
+                data = nvml.nvmlEventSetWait(self._events, 0)
+            except nvml.NVMLError:
+                # NVML_ERROR_TIMEOUT once no event is left
+                return errors
+            errors.append((nvml.nvmlDeviceGetIndex(data.device), int(data.eventData)))
+
+    def close(self):
+        self._nvml.nvmlEventSetFree(self._events)
+
+
+class HealthMonitor(object):
+    """Polls a health source and reports the changes."""
+
+    def __init__(self, source, interval_seconds=DEFAULT_INTERVAL_SECONDS, log_path=None,
+                 metrics=None, attribution=None, ignored_throttle_reasons=GPU_IDLE):
+        self._source = source
+        self._interval_seconds = interval_seconds
+        self._log = cycle_trace.JsonLinesWriter(log_path) if log_path else None
+        self._metrics = metrics
+        self._attribution = attribution
+        self._ignored = ignored_throttle_reasons
+        self._previous = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _changes(self, gpu, reading, previous):
+        events = []
+        reasons = reading.get('throttle_reasons')
+        if reasons is not None:
+            reasons &= ~self._ignored
+            before = previous.get('throttle_reasons', 0) & ~self._ignored
+            if reasons != before:
+                events.append({'event': THROTTLE, 'reasons': throttle_reason_names(reasons),
+                               'started': throttle_reason_names(reasons & ~before),
+                               'ended': throttle_reason_names(before & ~reasons)})
+
+        # The first reading of a GPU is the baseline of its counters
+        if previous:
+            deltas = {}
+            for name in ECC_COUNTERS:
+                if name in reading and name in previous:
+                    delta = reading[name] - previous[name]
+                    if delta < 0:
+                        # Volatile counters restart from zero on a driver reload
+                        delta = reading[name]
+                    if delta:
+                        deltas[name] = delta
+            if deltas:
+                events.append({'event': ECC, 'deltas': deltas})
+
+            retired = {}
+            for cause in RETIRED_PAGE_CAUSES:
+                key = 'retired_' + cause
+                if reading.get(key, 0) > previous.get(key, 0):
+                    retired[cause] = reading[key] - previous.get(key, 0)
+            if retired:
+                events.append({'event': PAGE_RETIREMENT, 'retired': retired})
+
+        pending = reading.get('retirement_pending')
+        if pending is not None and pending != previous.get('retirement_pending', False):
+            events.append({'event': RETIREMENT_PENDING, 'pending': pending})
+        return events
+
+    def poll(self):
+        """Reads the health of every GPU once. Returns the change events."""
+
+        try:
+            readings = self._source.readings()
+            xid_errors = self._source.xid_errors()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Health poll failed: {}'.format(err))
+            return []
+
+        now = time.time()
+        events = []
+        for gpu, reading in sorted(readings.items()):
+            for event in self._changes(gpu, reading, self._previous.get(gpu, {})):
+                event.update({'time': now, 'gpu': gpu})
+                events.append(event)
+            # Keep the last known value of fields a poll failed to read
+            self._previous[gpu] = dict(self._previous.get(gpu, {}), **reading)
+        for gpu, xid in xid_errors:
+            events.append({'time': now, 'gpu': gpu, 'event': XID, 'xid': xid})
+
+        for event in events:
+            self._emit(event)
+        if self._log is not None and events:
+            self._log.flush()
+        self._update_gauges()
+        return events
+
+    def _emit(self, event):
+        if self._attribution is not None:
+            event.update(self._attribution.labels(event['gpu']))
+        logging.info('GPU {} health: {}'.format(event['gpu'], event))
+        if self._log is not None:
+            self._log.write(event)
+        if self._metrics is None:
+            return
+        self._metrics.gpu_health_events.labels(event=event['event']).inc()
+        if event['event'] == ECC:
+            for name, delta in event['deltas'].items():
+                if name.startswith('volatile'):
+                    self._metrics.gpu_ecc_errors.labels(type=name.split('_')[1]).inc(delta)
+        elif event['event'] == XID:
+            self._metrics.gpu_xid_errors.labels(xid=str(event['xid'])).inc()
+
+    def _update_gauges(self):
+        if self._metrics is None:
+            return
+        for bit, name in THROTTLE_REASONS:
+            if bit & self._ignored:
+                continue
+            self._metrics.gpus_throttled.labels(reason=name).set(
+                sum(1 for reading in self._previous.values()
+                    if reading.get('throttle_reasons', 0) & bit))
+
+    def _run(self):
+        while not self._stop.wait(self._interval_seconds):
+            self.poll()
+
+    def start(self):
+        self.poll()
+        self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._source.close()
+        if self._log is not None:
+            self._log.close()
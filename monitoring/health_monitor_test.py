@@ -0,0 +1,122 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+import agent_metrics
+import health_monitor
+
+
+class FakeHealthSource(health_monitor.HealthSource):
+
+    def __init__(self):
+        self.state = {}
+        self.xids = []
+        self.fail = False
+
+    def readings(self):
+        if self.fail:
+            raise RuntimeError('NVML not ready')
+        return {gpu: dict(reading) for gpu, reading in self.state.items()}
+
+    def xid_errors(self):
+        xids, self.xids = self.xids, []
+        return xids
+
+
+def _healthy():
+    return {'throttle_reasons': health_monitor.GPU_IDLE, 'volatile_corrected': 0,
+            'volatile_uncorrected': 0, 'aggregate_corrected': 10,
+            'aggregate_uncorrected': 0, 'retired_multiple_single_bit': 2,
+            'retired_double_bit': 0, 'retirement_pending': False}
+
+
+def _events(events):
+    return [(event['gpu'], event['event']) for event in events]
+
+
+def test_only_changes_are_reported(tmp_path):
+    source = FakeHealthSource()
+    source.state = {0: _healthy(), 1: _healthy()}
+    metrics = agent_metrics.AgentMetrics()
+    path = str(tmp_path / 'health.jsonl')
+    monitor = health_monitor.HealthMonitor(source, log_path=path, metrics=metrics)
+
+    # Non-zero counters of the first reading are a baseline, idle throttling is ignored
+    assert monitor.poll() == []
+    assert monitor.poll() == []
+
+    source.state[1]['throttle_reasons'] = 0x4 | 0x40
+    source.state[1]['volatile_corrected'] = 3
+    source.state[1]['aggregate_corrected'] = 13
+    source.xids = [(0, 79)]
+    events = monitor.poll()
+    assert _events(events) == [(1, 'throttle'), (1, 'ecc'), (0, 'xid')]
+    assert events[0]['reasons'] == ['sw_power_cap', 'hw_thermal_slowdown']
+    assert events[0]['started'] == events[0]['reasons']
+    assert events[1]['deltas'] == {'volatile_corrected': 3, 'aggregate_corrected': 3}
+    assert events[2]['xid'] == 79
+    assert monitor.poll() == []
+
+    source.state[1]['throttle_reasons'] = 0x4
+    events = monitor.poll()
+    assert events[0]['started'] == [] and events[0]['ended'] == ['hw_thermal_slowdown']
+
+    monitor.stop()
+    with open(path) as f:
+        assert [json.loads(line)['event'] for line in f] == [
+            'throttle', 'ecc', 'xid', 'throttle']
+    assert metrics.gpu_health_events.labels(event='throttle').value == 2
+    assert metrics.gpu_ecc_errors.labels(type='corrected').value == 3
+    assert metrics.gpu_xid_errors.labels(xid='79').value == 1
+    assert metrics.gpus_throttled.labels(reason='sw_power_cap').value == 1
+    assert metrics.gpus_throttled.labels(reason='hw_thermal_slowdown').value == 0
+
+
+def test_page_retirement_and_counter_reset():
+    source = FakeHealthSource()
+    source.state = {0: _healthy()}
+    monitor = health_monitor.HealthMonitor(source)
+    monitor.poll()
+
+    source.state[0].update({'retired_double_bit': 1, 'retirement_pending': True,
+                            'volatile_uncorrected': 1, 'aggregate_uncorrected': 1})
+    events = monitor.poll()
+    assert [event['event'] for event in events] == ['ecc', 'page_retirement',
+                                                    'retirement_pending']
+    assert events[1]['retired'] == {'double_bit': 1}
+    assert events[2]['pending'] is True
+
+    # After a reset the volatile counters restart from zero
+    source.state[0].update({'volatile_uncorrected': 0, 'retirement_pending': False})
+    assert [event['event'] for event in monitor.poll()] == ['retirement_pending']
+    source.state[0]['volatile_uncorrected'] = 2
+    assert monitor.poll()[0]['deltas'] == {'volatile_uncorrected': 2}
+
+
+def test_failed_poll_and_missing_fields():
+    source = FakeHealthSource()
+    source.state = {0: _healthy()}
+    monitor = health_monitor.HealthMonitor(source)
+    monitor.poll()
+    source.fail = True
+    assert monitor.poll() == []
+    source.fail = False
+
+    # A field missing from one reading is not a change
+    del source.state[0]['volatile_corrected']
+    assert monitor.poll() == []
+    source.state[0]['volatile_corrected'] = 1
+    assert monitor.poll()[0]['deltas'] == {'volatile_corrected': 1}
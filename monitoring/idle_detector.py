@@ -0,0 +1,218 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming detection of idle and stalled GPUs.
+
+Every batch of samples is reduced to the mean GPU utilization, SM activity
+and power of each GPU, and fed to a per-GPU state machine:
+
+    idle       utilization and SM activity near zero, e.g. a notebook kernel
+               left open
+    stalled    utilization high while SM activity and power are near idle,
+               e.g. a job deadlocked in an NCCL collective whose kernel
+               stays resident without doing any work
+    active     anything else
+
+A GPU enters idle or stalled once the condition held for idle_seconds or
+stall_seconds, and recovers once it has been active for recover_seconds.
+Exit thresholds are looser than entry thresholds, so values hovering around
+a threshold do not flap. Only the current and candidate state are kept per
+GPU.
+"""
+
+from absl import logging
+
+import cycle_trace
+
+ACTIVE = 'active'
+IDLE = 'idle'
+STALLED = 'stalled'
+STATES = (ACTIVE, IDLE, STALLED)
+RECOVERED = 'recovered'
+
+# DCGM field ids
+POWER_USAGE = 155
+GPU_UTIL = 203
+SM_ACTIVE = 1002
+_COLUMNS = {GPU_UTIL: 0, SM_ACTIVE: 1, POWER_USAGE: 2}
+
+DEFAULT_IDLE_SECONDS = 600
+DEFAULT_STALL_SECONDS = 300
+DEFAULT_RECOVER_SECONDS = 60
+
+
+class Thresholds(object):
+    """Entry and exit thresholds of the idle and stalled conditions."""
+
+    def __init__(self, idle_util=5.0, idle_util_exit=15.0,
+                 idle_sm_active=0.02, idle_sm_active_exit=0.05,
+                 stall_util=90.0, stall_util_exit=70.0,
+                 stall_sm_active=0.05, stall_sm_active_exit=0.1,
+                 stall_power=100.0, stall_power_exit=130.0):
+        self.idle_util = idle_util
+        self.idle_util_exit = idle_util_exit
+        self.idle_sm_active = idle_sm_active
+        self.idle_sm_active_exit = idle_sm_active_exit
+        self.stall_util = stall_util
+        self.stall_util_exit = stall_util_exit
+        self.stall_sm_active = stall_sm_active
+        self.stall_sm_active_exit = stall_sm_active_exit
+        self.stall_power = stall_power
+        self.stall_power_exit = stall_power_exit
+
+
+class _GpuState(object):
+
+    __slots__ = ('state', 'since', 'candidate', 'candidate_since')
+
+    def __init__(self, now):
+        self.state = ACTIVE
+        self.since = now
+        self.candidate = ACTIVE
+        self.candidate_since = now
+
+
+def _below(value, threshold):
+    # A field that is not collected does not veto the condition
+    return value is None or value < threshold
+
+
+class IdleDetector(object):
+    """Tracks the idle and stalled state of every GPU."""
+
+    def __init__(self, thresholds=None, idle_seconds=DEFAULT_IDLE_SECONDS,
+                 stall_seconds=DEFAULT_STALL_SECONDS,
+                 recover_seconds=DEFAULT_RECOVER_SECONDS):
+        self.thresholds = thresholds or Thresholds()
+        self._durations = {IDLE: idle_seconds, STALLED: stall_seconds,
+                           ACTIVE: recover_seconds}
+        self._gpus = {}
+
+    def _condition(self, current, util, sm_active, power):
+        t = self.thresholds
+        if util is None:
+            return current
+        # Staying in a state only requires the looser exit thresholds
+        idle_util, idle_sm = ((t.idle_util_exit, t.idle_sm_active_exit) if current == IDLE
+                              else (t.idle_util, t.idle_sm_active))
+        if util < idle_util and _below(sm_active, idle_sm):
+            return IDLE
+        if current == STALLED:
+            stall = (util > t.stall_util_exit and _below(sm_active, t.stall_sm_active_exit)
+                     and _below(power, t.stall_power_exit))
+        else:
+            stall = (util > t.stall_util and sm_active is not None and
+                     sm_active < t.stall_sm_active and _below(power, t.stall_power))
+        if stall:
+            return STALLED
+        return ACTIVE
+
+    def update(self, gpu, now, util, sm_active=None, power=None):
+        """Evaluates a GPU's latest readings at time now (seconds).
+
+        Returns an event dict when the GPU changed state, else None.
+        """
+
+        state = self._gpus.get(gpu)
+        if state is None:
+            state = self._gpus[gpu] = _GpuState(now)
+        condition = self._condition(state.state, util, sm_active, power)
+        if condition != state.candidate:
+            state.candidate = condition
+            state.candidate_since = now
+        if condition == state.state or now - state.candidate_since < self._durations[condition]:
+            return None
+
+        event = {'time': now, 'gpu': gpu,
+                 'event': RECOVERED if condition == ACTIVE else condition,
+                 'previous': state.state,
+                 'previous_seconds': round(state.candidate_since - state.since, 3),
+                 'since': state.candidate_since,
+                 'gpu_utilization': util, 'sm_active': sm_active, 'power_usage': power}
+        state.state = condition
+        state.since = state.candidate_since
+        return event
+
+    def states(self):
+        """Returns the current state of every GPU."""
+
+        return {gpu: state.state for gpu, state in self._gpus.items()}
+
+
+def batch_readings(samples):
+    """Returns the mean utilization, SM activity and power of every GPU.
+
+    The result maps GPU ids to (time in seconds, util, sm_active, power),
+    with None for the fields missing from the batch.
+    """
+
+    totals = {}
+    for sample in samples:
+        column = _COLUMNS.get(sample.field_id)
+        if column is None:
+            continue
+        entry = totals.get(sample.gpu)
+        if entry is None:
+            entry = totals[sample.gpu] = [0, [0.0] * 3, [0] * 3]
+        entry[0] = max(entry[0], sample.timestamp)
+        entry[1][column] += sample.value
+        entry[2][column] += 1
+
+    return {gpu: (timestamp / 10**6,) + tuple(total / count if count else None
+                                               for total, count in zip(sums, counts))
+            for gpu, (timestamp, sums, counts) in totals.items()}
+
+
+class IdleEventLog(object):
+    """Writes detector events to a JSON lines log and the agent metrics."""
+
+    def __init__(self, path=None, metrics=None, attribution=None):
+        self._writer = cycle_trace.JsonLinesWriter(path) if path else None
+        self._metrics = metrics
+        self._attribution = attribution
+
+    def emit(self, event):
+        if self._attribution is not None:
+            event.update(self._attribution.labels(event['gpu']))
+        logging.info('GPU {} {} after {:.0f} s {}'.format(
+            event['gpu'], event['event'], event['previous_seconds'], event['previous']))
+        if self._writer is not None:
+            self._writer.write(event)
+            self._writer.flush()
+        if self._metrics is not None:
+            self._metrics.gpu_state_events.labels(event=event['event']).inc()
+
+    def set_states(self, states):
+        if self._metrics is None:
+            return
+        for state in STATES:
+            self._metrics.gpus_in_state.labels(state=state).set(
+                sum(1 for value in states.values() if value == state))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def evaluate(detector, log, samples):
+    """Feeds a batch of samples to the detector. Returns the events."""
+
+    events = []
+    for gpu, (now, util, sm_active, power) in sorted(batch_readings(samples).items()):
+        event = detector.update(gpu, now, util, sm_active, power)
+        if event is not None:
+            log.emit(event)
+            events.append(event)
+    log.set_states(detector.states())
+    return events
@@ -0,0 +1,82 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+import agent_metrics
+import idle_detector
+from exporters import Sample
+
+START = 1600000000
+
+
+def _run(detector, readings, step=10):
+    events = []
+    for i, reading in enumerate(readings):
+        event = detector.update(0, START + i * step, *reading)
+        if event:
+            events.append((i * step, event['event']))
+    return events
+
+
+def test_idle_with_hysteresis():
+    detector = idle_detector.IdleDetector(idle_seconds=60, recover_seconds=30)
+    busy = (80.0, 0.6, 250.0)
+    idle = (0.0, 0.0, 50.0)
+    hovering = (10.0, 0.03, 60.0)
+    events = _run(detector, [busy] * 3 + [idle] * 10 + [hovering] * 10 + [busy] * 5)
+
+    # Readings between the entry and exit thresholds keep the GPU idle
+    assert events == [(90, 'idle'), (260, 'recovered')]
+    assert detector.states() == {0: 'active'}
+
+
+def test_short_dips_are_ignored():
+    detector = idle_detector.IdleDetector(idle_seconds=60)
+    events = _run(detector, [(80.0, 0.6, 250.0), (0.0, 0.0, 50.0)] * 20)
+    assert events == []
+
+
+def test_stall():
+    detector = idle_detector.IdleDetector(stall_seconds=120, recover_seconds=10)
+    # A resident NCCL kernel keeps the utilization at 100% with the SMs idle
+    stalled = (100.0, 0.01, 70.0)
+    events = _run(detector, [(95.0, 0.7, 300.0)] * 2 + [stalled] * 20 + [(95.0, 0.7, 300.0)] * 3)
+    assert events == [(140, 'stalled'), (230, 'recovered')]
+
+    # Without SM activity a busy GPU is never reported stalled
+    detector = idle_detector.IdleDetector(stall_seconds=10)
+    assert _run(detector, [(100.0, None, 70.0)] * 10) == []
+
+
+def test_event_log_and_metrics(tmp_path):
+    metrics = agent_metrics.AgentMetrics()
+    path = str(tmp_path / 'events.jsonl')
+    log = idle_detector.IdleEventLog(path, metrics)
+    detector = idle_detector.IdleDetector(idle_seconds=15)
+    for second in range(0, 40, 10):
+        samples = [Sample(gpu, field_id, (START + second) * 10**6, 0.0 if gpu else 50.0)
+                   for gpu in range(3)
+                   for field_id in (idle_detector.GPU_UTIL, idle_detector.SM_ACTIVE)]
+        idle_detector.evaluate(detector, log, samples)
+    log.close()
+
+    with open(path) as f:
+        events = [json.loads(line) for line in f]
+    assert [(e['gpu'], e['event'], e['time']) for e in events] == [
+        (1, 'idle', START + 20), (2, 'idle', START + 20)]
+    assert metrics.gpus_in_state.labels(state='idle').value == 2
+    assert metrics.gpus_in_state.labels(state='active').value == 1
+    assert metrics.gpu_state_events.labels(event='idle').value == 2
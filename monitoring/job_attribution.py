@@ -0,0 +1,215 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Attributes GPUs to the jobs running on them.
+
+A process source lists the processes using each GPU. Every process is
+resolved to a job name: the value of the first of job_env_vars set in its
+environment, else its container, else its command, which keeps the label
+cardinality bounded. Processes the agent cannot see, outside its pid
+namespace, are not attributed; run it with --pid=host. The mapping of
+GPU to job labels is refreshed on its own thread, slower than sampling, and
+published as an immutable snapshot, so exporters look labels up with a
+single dict read.
+
+Job changes are appended to a JSON lines log, which gives the time range of
+every job on every GPU:
+
+    {"time": 1600000000.0, "gpu": 0, "job": "bert-pretraining", "pids": [4242]}
+
+An empty job marks the GPU as unused from then on.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+from absl import logging
+
+import cycle_trace
+
+JOB_LABEL = 'job'
+DEFAULT_REFRESH_SECONDS = 30
+DEFAULT_JOB_ENV_VARS = ('JOB_ID', 'CLOUD_ML_JOB_ID', 'SLURM_JOB_ID', 'TORCHELASTIC_RUN_ID')
+
+_CONTAINER_ID = re.compile(r'([0-9a-f]{64})')
+
+
+class ProcessSource(object):
+    """Lists the processes using each GPU."""
+
+    def processes(self):
+        """Returns a dict mapping GPU ids to the pids using them."""
+        raise NotImplementedError
+
+
+class NvmlProcessSource(ProcessSource):
+    """Lists the compute and graphics processes NVML reports per device.
+
+    Requires the optional pynvml package. NVML device indexes are assumed to
+    match the DCGM GPU ids, as they do without CUDA_VISIBLE_DEVICES remapping.
+    """
+
+    def __init__(self):
+        try:
+            import pynvml
+        except ImportError:
+            raise ImportError('NVML job attribution requires the pynvml package')
+        self._nvml = pynvml
+        pynvml.nvmlInit()
+
+    def processes(self):
+        nvml = self._nvml
+        result = {}
+        for index in range(nvml.nvmlDeviceGetCount()):
+            handle = nvml.nvmlDeviceGetHandleByIndex(index)
+            running = (nvml.nvmlDeviceGetComputeRunningProcesses(handle) +
+                       nvml.nvmlDeviceGetGraphicsRunningProcesses(handle))
+            result[index] = sorted({process.pid for process in running})
+        return result
+
+
+class ProcResolver(object):
+    """Resolves pids to job names from /proc."""
+
+    def __init__(self, job_env_vars=DEFAULT_JOB_ENV_VARS, proc_root='/proc'):
+        self._job_env_vars = tuple(job_env_vars)
+        self._proc_root = proc_root
+
+    def _read(self, pid, name):
+        try:
+            with open(os.path.join(self._proc_root, str(pid), name), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def job(self, pid):
+        environ = self._read(pid, 'environ')
+        if environ:
+            variables = dict(item.split(b'=', 1) for item in environ.split(b'\0')
+                             if b'=' in item)
+            for name in self._job_env_vars:
+                value = variables.get(name.encode('utf-8'))
+                if value:
+                    return value.decode('utf-8', 'replace')
+
+        cgroup = self._read(pid, 'cgroup')
+        if cgroup:
+            match = _CONTAINER_ID.search(cgroup.decode('utf-8', 'replace'))
+            if match:
+                return 'container-' + match.group(1)[:12]
+
+        comm = self._read(pid, 'comm')
+        return comm.decode('utf-8', 'replace').strip() if comm else ''
+
+
+class JobAttribution(object):
+    """Caches the job labels of every GPU, refreshed in the background."""
+
+    def __init__(self, source, resolver=None, refresh_seconds=DEFAULT_REFRESH_SECONDS,
+                 log_path=None):
+        self._source = source
+        self._resolver = resolver or ProcResolver()
+        self._refresh_seconds = refresh_seconds
+        self._log = cycle_trace.JsonLinesWriter(log_path) if log_path else None
+        self._snapshot = {}
+        self._pids = {}
+        self._jobs = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def labels(self, gpu):
+        """Returns the job labels of a GPU, empty when it is not in use."""
+
+        return self._snapshot.get(gpu, {})
+
+    def job(self, gpu):
+        return self._snapshot.get(gpu, {}).get(JOB_LABEL, '')
+
+    def refresh(self):
+        """Re-reads the processes of every GPU and resolves changed ones."""
+
+        try:
+            processes = self._source.processes()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Job attribution refresh failed: {}'.format(err))
+            return
+
+        now = time.time()
+        snapshot = {}
+        for gpu in sorted(set(processes) | set(self._jobs)):
+            pids = tuple(processes.get(gpu, ()))
+            if pids != self._pids.get(gpu):
+                self._pids[gpu] = pids
+                jobs = {self._resolver.job(pid) for pid in pids}
+                job = ','.join(sorted(job for job in jobs if job))
+                if job != self._jobs.get(gpu, ''):
+                    if self._log is not None:
+                        self._log.write({'time': now, 'gpu': gpu, 'job': job,
+                                         'pids': list(pids)})
+                    logging.info('GPU {} job: {}'.format(gpu, job or '(none)'))
+                self._jobs[gpu] = job
+            if self._jobs.get(gpu):
+                snapshot[gpu] = {JOB_LABEL: self._jobs[gpu]}
+        self._snapshot = snapshot
+        if self._log is not None:
+            self._log.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._refresh_seconds):
+            self.refresh()
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='job-attribution',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._log is not None:
+            self._log.close()
+
+
+def read_job_log(path):
+    """Returns the job log records in time order."""
+
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return sorted(records, key=lambda record: record['time'])
+
+
+def job_intervals(records, job):
+    """Returns the (gpu, start, end) intervals a job ran, end None if running."""
+
+    intervals = []
+    running = {}
+    for record in records:
+        gpu = record['gpu']
+        jobs = set(record['job'].split(',')) if record['job'] else set()
+        if job in jobs and gpu not in running:
+            running[gpu] = record['time']
+        elif job not in jobs and gpu in running:
+            intervals.append((gpu, running.pop(gpu), record['time']))
+    for gpu, start in running.items():
+        intervals.append((gpu, start, None))
+    return sorted(intervals)
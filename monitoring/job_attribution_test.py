@@ -0,0 +1,97 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import job_attribution
+
+CONTAINER_ID = 'a' * 64
+
+
+class FakeProcessSource(job_attribution.ProcessSource):
+
+    def __init__(self):
+        self.gpus = {}
+        self.calls = 0
+
+    def processes(self):
+        self.calls += 1
+        return dict(self.gpus)
+
+
+def _make_proc(root, pid, environ=b'', cgroup=b'', comm=b'python3\n'):
+    directory = root / str(pid)
+    directory.mkdir()
+    (directory / 'environ').write_bytes(environ)
+    (directory / 'cgroup').write_bytes(cgroup)
+    (directory / 'comm').write_bytes(comm)
+
+
+def test_resolver(tmp_path):
+    _make_proc(tmp_path, 10, environ=b'HOME=/root\0JOB_ID=bert-pretraining\0')
+    _make_proc(tmp_path, 11, cgroup=('0::/docker/' + CONTAINER_ID + '\n').encode())
+    _make_proc(tmp_path, 12)
+    resolver = job_attribution.ProcResolver(proc_root=str(tmp_path))
+
+    assert resolver.job(10) == 'bert-pretraining'
+    assert resolver.job(11) == 'container-aaaaaaaaaaaa'
+    assert resolver.job(12) == 'python3'
+    # Not visible, for example in another pid namespace
+    assert resolver.job(13) == ''
+
+
+def test_snapshot_and_job_log(tmp_path):
+    proc = tmp_path / 'proc'
+    proc.mkdir()
+    _make_proc(proc, 10, environ=b'JOB_ID=bert\0')
+    _make_proc(proc, 11, environ=b'JOB_ID=bert\0')
+    source = FakeProcessSource()
+    log_path = str(tmp_path / 'jobs.jsonl')
+    attribution = job_attribution.JobAttribution(
+        source, job_attribution.ProcResolver(proc_root=str(proc)), log_path=log_path)
+
+    source.gpus = {0: [10], 1: [11], 2: []}
+    attribution.refresh()
+    assert attribution.labels(0) == {'job': 'bert'}
+    assert attribution.labels(2) == {}
+    assert attribution.job(1) == 'bert'
+
+    source.gpus = {0: [10, 11], 1: [], 2: []}
+    attribution.refresh()
+    source.gpus = {0: [], 1: [], 2: []}
+    attribution.refresh()
+    attribution.stop()
+
+    records = job_attribution.read_job_log(log_path)
+    # The second pid of the same job is not a job change
+    assert [(r['gpu'], r['job']) for r in records] == [
+        (0, 'bert'), (1, 'bert'), (1, ''), (0, '')]
+    intervals = job_attribution.job_intervals(records, 'bert')
+    assert [(gpu, end is not None) for gpu, _, end in intervals] == [(0, True), (1, True)]
+
+
+def test_refresh_failure_keeps_snapshot(tmp_path):
+    class FailingSource(FakeProcessSource):
+        def processes(self):
+            if self.calls:
+                raise RuntimeError('NVML gone')
+            return FakeProcessSource.processes(self)
+
+    source = FailingSource()
+    _make_proc(tmp_path, 1)
+    source.gpus = {0: [1, 2]}
+    attribution = job_attribution.JobAttribution(
+        source, job_attribution.ProcResolver(proc_root=str(tmp_path)))
+    attribution.refresh()
+    attribution.refresh()
+    assert attribution.job(0) == 'python3'
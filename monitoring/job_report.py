@@ -0,0 +1,365 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GPU efficiency report of a job, computed from the collected samples.
+
+The samples come from the local sample store or from a trace recorded by the
+file exporter. The time range is either given or taken, per GPU, from the
+job log written by job attribution:
+
+    python job_report.py --store_dir=/var/lib/dcgm_stackdriver/samples \\
+        --job_log=/var/lib/dcgm_stackdriver/jobs.jsonl --job=bert-mnli \\
+        --output=bert-mnli.json
+
+The bottleneck classification is a heuristic over the averages:
+
+    idle                   the GPUs were idle most of the time
+    compute-bound          SM or tensor pipes were busy
+    communication-bound    PCIe or NVLink busy while the SMs were not
+    input-bound            SMs mostly waiting, with idle gaps and little
+                           interconnect traffic, i.e. starved by the input
+                           pipeline
+"""
+
+import json
+import sys
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+import job_attribution
+import sample_store
+
+# DCGM field ids
+POWER_USAGE = 155
+GPU_UTIL = 203
+FB_FREE = 251
+FB_USED = 252
+SM_ACTIVE = 1002
+TENSOR_ACTIVE = 1004
+DRAM_ACTIVE = 1005
+PCIE_TX_BYTES = 1009
+PCIE_RX_BYTES = 1010
+NVLINK_TX_BYTES = 1011
+NVLINK_RX_BYTES = 1012
+
+REPORT_FIELDS = (POWER_USAGE, GPU_UTIL, FB_FREE, FB_USED, SM_ACTIVE, TENSOR_ACTIVE,
+                 DRAM_ACTIVE, PCIE_TX_BYTES, PCIE_RX_BYTES, NVLINK_TX_BYTES,
+                 NVLINK_RX_BYTES)
+
+# SM activity below which a GPU counts as idle
+IDLE_SM_ACTIVE = 0.05
+# Per direction bandwidths - bytes per second
+DEFAULT_PCIE_BANDWIDTH = 16e9
+DEFAULT_NVLINK_BANDWIDTH = 300e9
+QUANTILES = (0.5, 0.9, 0.99)
+_END_OF_TIME = 2**62
+
+
+def load_store(reader, gpu_ranges):
+    """Reads the report fields of the GPUs from a sample_store.StoreReader.
+
+    gpu_ranges maps GPU ids to a (start, end) range in microseconds. Returns
+    a dict mapping (gpu, field id) to (timestamps, values) arrays.
+    """
+
+    series = {}
+    for gpu, (start, end) in gpu_ranges.items():
+        for field_id in REPORT_FIELDS:
+            timestamps, values = reader.read_series(gpu, field_id, start, end)
+            if len(timestamps):
+                series[(gpu, field_id)] = (timestamps, values)
+    return series
+
+
+def load_trace(path):
+    """Reads the report fields from a JSON lines trace of the file exporter."""
+
+    columns = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Records of MIG instances carry their entity group
+            if record['field_id'] in REPORT_FIELDS and 'entity_group' not in record:
+                key = (record['gpu'], record['field_id'])
+                columns.setdefault(key, []).append((record['timestamp'], record['value']))
+
+    series = {}
+    for key, points in columns.items():
+        timestamps = np.asarray([point[0] for point in points], dtype=np.int64)
+        values = np.asarray([point[1] for point in points], dtype=np.float64)
+        order = np.argsort(timestamps, kind='stable')
+        series[key] = (timestamps[order], values[order])
+    return series
+
+
+def restrict(series, gpu_ranges):
+    """Keeps the samples of the GPUs within their (start, end) range."""
+
+    restricted = {}
+    for (gpu, field_id), (timestamps, values) in series.items():
+        if gpu not in gpu_ranges:
+            continue
+        start, end = gpu_ranges[gpu]
+        keep = (timestamps >= start) & (timestamps < end)
+        if np.any(keep):
+            restricted[(gpu, field_id)] = (timestamps[keep], values[keep])
+    return restricted
+
+
+def job_ranges(records, job, now=None):
+    """Returns the (start, end) range in microseconds of a job per GPU.
+
+    A GPU the job ran on several times gets the range covering all runs.
+    """
+
+    ranges = {}
+    for gpu, start, end in job_attribution.job_intervals(records, job):
+        if end is None:
+            end = now if now is not None else _END_OF_TIME / 10**6
+        start_us = int(start * 10**6)
+        end_us = int(end * 10**6)
+        if gpu in ranges:
+            start_us = min(start_us, ranges[gpu][0])
+            end_us = max(end_us, ranges[gpu][1])
+        ranges[gpu] = (start_us, end_us)
+    return ranges
+
+
+def _stats(values):
+    if values is None or not len(values):
+        return None
+    result = {'mean': float(values.mean())}
+    for quantile, estimate in zip(QUANTILES, np.quantile(values, QUANTILES)):
+        result['p{:g}'.format(quantile * 100)] = float(estimate)
+    return result
+
+
+def _values(series, gpu, field_id):
+    item = series.get((gpu, field_id))
+    return None if item is None else item[1]
+
+
+def _throughput(series, gpu, tx_field, rx_field, bandwidth):
+    tx = _values(series, gpu, tx_field)
+    rx = _values(series, gpu, rx_field)
+    if tx is None and rx is None:
+        return None
+    mean = sum(float(v.mean()) for v in (tx, rx) if v is not None)
+    peak = max(float(v.max()) for v in (tx, rx) if v is not None)
+    return {'mean_bytes_per_second': mean,
+            'peak_bytes_per_second': peak,
+            'utilization': mean / (2 * bandwidth)}
+
+
+def gpu_report(series, gpu, pcie_bandwidth=DEFAULT_PCIE_BANDWIDTH,
+               nvlink_bandwidth=DEFAULT_NVLINK_BANDWIDTH, fb_total_mib=None):
+    """Computes the efficiency metrics of one GPU."""
+
+    spans = [item[0] for key, item in series.items() if key[0] == gpu]
+    first = min(int(ts[0]) for ts in spans)
+    last = max(int(ts[-1]) for ts in spans)
+    seconds = (last - first) / 10**6
+
+    report = {'gpu': gpu, 'start': first / 10**6, 'end': last / 10**6,
+              'gpu_hours': seconds / 3600}
+
+    power = series.get((gpu, POWER_USAGE))
+    if power is not None and len(power[0]) > 1:
+        # Trapezoidal integration of the power over time
+        joules = np.sum((power[1][1:] + power[1][:-1]) / 2 * np.diff(power[0]) / 10**6)
+        report['energy_kwh'] = float(joules) / 3.6e6
+        report['power_watts'] = _stats(power[1])
+
+    sm_active = _values(series, gpu, SM_ACTIVE)
+    util = _values(series, gpu, GPU_UTIL)
+    report['sm_active'] = _stats(sm_active)
+    report['tensor_active'] = _stats(_values(series, gpu, TENSOR_ACTIVE))
+    report['dram_active'] = _stats(_values(series, gpu, DRAM_ACTIVE))
+    report['gpu_utilization'] = _stats(util)
+    if sm_active is not None:
+        report['idle_fraction'] = float(np.mean(sm_active < IDLE_SM_ACTIVE))
+    elif util is not None:
+        report['idle_fraction'] = float(np.mean(util < IDLE_SM_ACTIVE * 100))
+
+    fb_used = _values(series, gpu, FB_USED)
+    fb_free = _values(series, gpu, FB_FREE)
+    if fb_used is not None:
+        memory = {'peak_used_mib': float(fb_used.max()), 'mean_used_mib': float(fb_used.mean())}
+        if fb_free is not None:
+            memory['min_headroom_mib'] = float(fb_free.min())
+        elif fb_total_mib:
+            memory['min_headroom_mib'] = fb_total_mib - float(fb_used.max())
+        report['memory'] = memory
+
+    report['pcie'] = _throughput(series, gpu, PCIE_TX_BYTES, PCIE_RX_BYTES, pcie_bandwidth)
+    report['nvlink'] = _throughput(series, gpu, NVLINK_TX_BYTES, NVLINK_RX_BYTES,
+                                   nvlink_bandwidth)
+    report['bottleneck'] = classify(report)
+    return report
+
+
+def classify(report):
+    """Classifies the likely bottleneck of a GPU or job report."""
+
+    idle = report.get('idle_fraction', 0.0)
+    sm_active = (report.get('sm_active') or {}).get('mean')
+    if sm_active is None:
+        utilization = (report.get('gpu_utilization') or {}).get('mean')
+        sm_active = utilization / 100 if utilization is not None else 0.0
+    tensor_active = (report.get('tensor_active') or {}).get('mean', 0.0)
+    interconnect = max((report.get(link) or {}).get('utilization', 0.0)
+                       for link in ('pcie', 'nvlink'))
+
+    if idle >= 0.5:
+        return 'idle'
+    if sm_active >= 0.7 or tensor_active >= 0.5:
+        return 'compute-bound'
+    if interconnect >= 0.3:
+        return 'communication-bound'
+    return 'input-bound'
+
+
+def job_report(series, job=None, **kwargs):
+    """Returns the report of a job from its series."""
+
+    gpus = sorted({gpu for gpu, _ in series})
+    gpu_reports = [gpu_report(series, gpu, **kwargs) for gpu in gpus]
+    report = {'job': job, 'gpus': gpu_reports}
+    if not gpu_reports:
+        return report
+
+    def mean_of(key):
+        means = [r[key]['mean'] for r in gpu_reports if r.get(key)]
+        return {'mean': float(np.mean(means))} if means else None
+
+    weights = np.asarray([r['gpu_hours'] for r in gpu_reports])
+    totals = {
+        'start': min(r['start'] for r in gpu_reports),
+        'end': max(r['end'] for r in gpu_reports),
+        'gpu_hours': float(weights.sum()),
+        'energy_kwh': sum(r.get('energy_kwh', 0.0) for r in gpu_reports),
+        'sm_active': mean_of('sm_active'),
+        'tensor_active': mean_of('tensor_active'),
+        'gpu_utilization': mean_of('gpu_utilization'),
+    }
+    idle = [r['idle_fraction'] for r in gpu_reports if 'idle_fraction' in r]
+    if idle:
+        totals['idle_fraction'] = float(np.mean(idle))
+    for link in ('pcie', 'nvlink'):
+        utilizations = [r[link]['utilization'] for r in gpu_reports if r.get(link)]
+        if utilizations:
+            totals[link] = {'utilization': float(np.mean(utilizations))}
+    totals['bottleneck'] = classify(totals)
+    report['totals'] = totals
+    return report
+
+
+def _percent(stats, key='mean', scale=100):
+    if not stats:
+        return '   n/a'
+    return '{:5.1f}%'.format(stats[key] * scale)
+
+
+def text_summary(report):
+    """Formats a compact text summary of a job report."""
+
+    lines = []
+    totals = report.get('totals')
+    if not totals:
+        return 'Job {}: no samples\n'.format(report['job'] or '')
+    lines.append('Job {}: {:.2f} GPU-hours, {:.3f} kWh, bottleneck: {}'.format(
+        report['job'] or '(all)', totals['gpu_hours'], totals['energy_kwh'],
+        totals['bottleneck']))
+    lines.append('GPU  hours   SM avg  SM p90  tensor  idle    mem peak  PCIe   NVLink  bottleneck')
+    for r in report['gpus']:
+        memory = r.get('memory')
+        lines.append('{:<4} {:6.2f}  {}  {}  {}  {}  {:>8}  {}  {}  {}'.format(
+            r['gpu'], r['gpu_hours'], _percent(r['sm_active']),
+            _percent(r['sm_active'], 'p90'), _percent(r['tensor_active']),
+            '{:5.1f}%'.format(r['idle_fraction'] * 100) if 'idle_fraction' in r else '   n/a',
+            '{:.0f}MiB'.format(memory['peak_used_mib']) if memory else 'n/a',
+            _percent(r['pcie'], 'utilization'), _percent(r['nvlink'], 'utilization'),
+            r['bottleneck']))
+    return '\n'.join(lines) + '\n'
+
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+    del argv
+
+    reader = None
+    if FLAGS.trace:
+        series = load_trace(FLAGS.trace)
+        gpus = {gpu for gpu, _ in series}
+    elif FLAGS.store_dir:
+        reader = sample_store.StoreReader(FLAGS.store_dir)
+        gpus = set(int(gpu) for gpu in np.unique(reader.index['entity_id']))
+    else:
+        raise app.UsageError('One of --store_dir or --trace is required')
+    if FLAGS.gpus:
+        gpus &= {int(gpu) for gpu in FLAGS.gpus}
+
+    if FLAGS.job:
+        if not FLAGS.job_log:
+            raise app.UsageError('--job requires --job_log')
+        gpu_ranges = job_ranges(job_attribution.read_job_log(FLAGS.job_log), FLAGS.job)
+        gpu_ranges = {gpu: r for gpu, r in gpu_ranges.items() if gpu in gpus}
+    else:
+        start = int(float(FLAGS.start) * 10**6) if FLAGS.start else 0
+        end = int(float(FLAGS.end) * 10**6) if FLAGS.end else _END_OF_TIME
+        gpu_ranges = {gpu: (start, end) for gpu in gpus}
+
+    if reader is not None:
+        series = load_store(reader, gpu_ranges)
+        reader.close()
+    else:
+        series = restrict(series, gpu_ranges)
+
+    report = job_report(series, FLAGS.job or None,
+                        pcie_bandwidth=FLAGS.pcie_bandwidth_gbps * 1e9,
+                        nvlink_bandwidth=FLAGS.nvlink_bandwidth_gbps * 1e9,
+                        fb_total_mib=FLAGS.fb_total_mib)
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    sys.stdout.write(text_summary(report))
+
+
+def _define_flags():
+    flags.DEFINE_string('store_dir', '', 'Directory of the local sample store')
+    flags.DEFINE_string('trace', '', 'JSON lines trace recorded by the file exporter')
+    flags.DEFINE_string('job', '', 'Job to report on, as named in --job_log')
+    flags.DEFINE_string('job_log', '', 'Job log written by job attribution')
+    flags.DEFINE_string('start', '', 'Start of the range without --job - epoch seconds')
+    flags.DEFINE_string('end', '', 'End of the range without --job - epoch seconds')
+    flags.DEFINE_list('gpus', [], 'GPU ids, all by default')
+    flags.DEFINE_float('pcie_bandwidth_gbps', DEFAULT_PCIE_BANDWIDTH / 1e9,
+                       'PCIe bandwidth per direction - GB/s')
+    flags.DEFINE_float('nvlink_bandwidth_gbps', DEFAULT_NVLINK_BANDWIDTH / 1e9,
+                       'Total NVLink bandwidth per direction - GB/s')
+    flags.DEFINE_float('fb_total_mib', None,
+                       'GPU memory size, for the headroom when FB_FREE is not collected')
+    flags.DEFINE_string('output', '', 'Write the JSON report to this file')
+
+
+if __name__ == '__main__':
+    _define_flags()
+    app.run(main)
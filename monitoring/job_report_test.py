@@ -0,0 +1,96 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+import numpy as np
+import pytest
+
+import job_report
+import sample_store
+
+START = 1600000000
+SECONDS = 3600
+
+
+def _series(gpu, sm_active, power=300.0, pcie=0.0, tensor=0.0):
+    timestamps = (START + np.arange(SECONDS + 1)) * 10**6
+    n = len(timestamps)
+    return {
+        (gpu, job_report.SM_ACTIVE): (timestamps, np.resize(sm_active, n).astype(float)),
+        (gpu, job_report.TENSOR_ACTIVE): (timestamps, np.full(n, tensor)),
+        (gpu, job_report.POWER_USAGE): (timestamps, np.full(n, power)),
+        (gpu, job_report.FB_USED): (timestamps, np.linspace(1000, 9000, n)),
+        (gpu, job_report.PCIE_TX_BYTES): (timestamps, np.full(n, pcie)),
+        (gpu, job_report.PCIE_RX_BYTES): (timestamps, np.full(n, pcie)),
+    }
+
+
+def test_report_and_classification():
+    series = {}
+    series.update(_series(0, [0.9], tensor=0.6))
+    series.update(_series(1, [0.0, 0.4, 0.4, 0.4]))
+    series.update(_series(2, [0.2], pcie=8e9))
+    series.update(_series(3, [0.0], power=60.0))
+    report = job_report.job_report(series, 'bert', fb_total_mib=16000)
+
+    gpus = {r['gpu']: r for r in report['gpus']}
+    assert gpus[0]['gpu_hours'] == pytest.approx(1.0)
+    assert gpus[0]['energy_kwh'] == pytest.approx(0.3)
+    assert gpus[0]['sm_active']['p90'] == pytest.approx(0.9)
+    assert gpus[1]['idle_fraction'] == pytest.approx(0.25, abs=0.001)
+    assert gpus[0]['memory']['min_headroom_mib'] == 7000
+    assert gpus[2]['pcie']['utilization'] == pytest.approx(0.5)
+    assert [gpus[gpu]['bottleneck'] for gpu in range(4)] == [
+        'compute-bound', 'input-bound', 'communication-bound', 'idle']
+
+    totals = report['totals']
+    assert totals['gpu_hours'] == pytest.approx(4.0)
+    assert totals['energy_kwh'] == pytest.approx(0.96)
+    summary = job_report.text_summary(report)
+    assert summary.startswith('Job bert: 4.00 GPU-hours, 0.960 kWh')
+    assert len(summary.splitlines()) == 6
+
+
+def test_job_ranges_from_store(tmp_path):
+    store = sample_store.SampleStore(str(tmp_path / 'samples'))
+    for (gpu, field_id), (timestamps, values) in _series(0, [0.5]).items():
+        store.append_series(gpu, field_id, timestamps, values)
+    store.close()
+    records = [{'time': START + 600, 'gpu': 0, 'job': 'bert', 'pids': [1]},
+               {'time': START + 1200, 'gpu': 0, 'job': '', 'pids': []}]
+
+    gpu_ranges = job_report.job_ranges(records, 'bert')
+    reader = sample_store.StoreReader(str(tmp_path / 'samples'))
+    report = job_report.job_report(job_report.load_store(reader, gpu_ranges), 'bert')
+    reader.close()
+    assert report['gpus'][0]['gpu_hours'] == pytest.approx(599 / 3600)
+
+
+def test_recorded_trace(tmp_path):
+    path = tmp_path / 'trace.jsonl'
+    with open(str(path), 'w') as f:
+        for t in range(10, 0, -1):
+            for field_id, value in ((job_report.SM_ACTIVE, 0.8), (job_report.POWER_USAGE, 200),
+                                    (203, 80)):
+                f.write(json.dumps({'gpu': 0, 'field_id': field_id,
+                                    'timestamp': (START + t) * 10**6, 'value': value}) + '\n')
+
+    series = job_report.restrict(job_report.load_trace(str(path)),
+                                 {0: ((START + 2) * 10**6, (START + 10) * 10**6)})
+    report = job_report.job_report(series)
+    assert report['gpus'][0]['gpu_hours'] == pytest.approx(7 / 3600)
+    assert report['gpus'][0]['gpu_utilization']['mean'] == 80
+    assert report['totals']['bottleneck'] == 'compute-bound'
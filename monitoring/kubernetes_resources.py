@@ -0,0 +1,281 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Kubernetes monitored resources of the GPUs of a GKE node.
+
+The kubelet pod-resources API lists the devices allocated to every
+container. Its gRPC List call is made on the kubelet socket without
+generated stubs, and the few response fields needed are decoded from the
+protobuf wire format:
+
+    ListPodResourcesResponse  1: repeated PodResources
+    PodResources              1: name, 2: namespace, 3: repeated ContainerResources
+    ContainerResources        1: name, 2: repeated ContainerDevices
+    ContainerDevices          1: resource_name, 2: repeated device_ids
+
+GPU device ids are nvidia<index> with the GKE device plugin, or GPU UUIDs
+with the NVIDIA device plugin. The series of a GPU allocated to a container
+are written to its k8s_container resource, the others to the k8s_node.
+The GPU to container mapping is refreshed on its own thread. The resource
+labels of a GPU are only rebuilt when its assignment changes, and listeners
+are notified of the changes.
+"""
+
+import collections
+import re
+import threading
+
+from absl import logging
+
+POD_RESOURCES_SOCKET = '/var/lib/kubelet/pod-resources/kubelet.sock'
+LIST_METHOD = '/v1.PodResourcesLister/List'
+GPU_RESOURCE = 'nvidia.com/gpu'
+DEFAULT_REFRESH_SECONDS = 30
+
+K8S_NODE = 'k8s_node'
+K8S_CONTAINER = 'k8s_container'
+NODE_LABEL_KEYS = ('project_id', 'location', 'cluster_name', 'node_name')
+
+Assignment = collections.namedtuple('Assignment', ['namespace', 'pod', 'container'])
+ContainerDevices = collections.namedtuple('ContainerDevices', [
+    'namespace', 'pod', 'container', 'resource_name', 'device_ids'])
+
+_DEVICE_INDEX = re.compile(r'^nvidia(\d+)$')
+
+
+def _varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(data):
+    """Yields the (field number, value) pairs of a protobuf message."""
+
+    pos = 0
+    while pos < len(data):
+        key, pos = _varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield number, value
+
+
+def decode_list_response(data):
+    """Decodes a ListPodResourcesResponse into ContainerDevices tuples."""
+
+    result = []
+    for number, pod in _fields(data):
+        if number != 1:
+            continue
+        name = namespace = ''
+        containers = []
+        for field, value in _fields(pod):
+            if field == 1:
+                name = value.decode('utf-8')
+            elif field == 2:
+                namespace = value.decode('utf-8')
+            elif field == 3:
+                containers.append(value)
+        for container in containers:
+            container_name = ''
+            devices = []
+            for field, value in _fields(container):
+                if field == 1:
+                    container_name = value.decode('utf-8')
+                elif field == 2:
+                    devices.append(value)
+            for device in devices:
+                resource_name = ''
+                device_ids = []
+                for field, value in _fields(device):
+                    if field == 1:
+                        resource_name = value.decode('utf-8')
+                    elif field == 2:
+                        device_ids.append(value.decode('utf-8'))
+                result.append(ContainerDevices(namespace, name, container_name, resource_name,
+                                               tuple(device_ids)))
+    return result
+
+
+class PodResourcesClient(object):
+    """Lists the devices of every container through the kubelet socket."""
+
+    def __init__(self, socket_path=POD_RESOURCES_SOCKET, timeout=5.0):
+        import grpc
+
+        self._channel = grpc.insecure_channel('unix://' + socket_path)
+        # Without serializers the call takes and returns the raw messages
+        self._list = self._channel.unary_unary(LIST_METHOD)
+        self._timeout = timeout
+
+    def list(self):
+        return decode_list_response(self._list(b'', timeout=self._timeout))
+
+    def close(self):
+        self._channel.close()
+
+
+def nvml_gpu_uuids():
+    """Maps the GPU UUIDs to their indexes, empty without pynvml."""
+
+    try:
+        import pynvml
+    except ImportError:
+        return {}
+    try:
+        pynvml.nvmlInit()
+        try:
+            uuids = {}
+            for index in range(pynvml.nvmlDeviceGetCount()):
+                uuid = pynvml.nvmlDeviceGetUUID(pynvml.nvmlDeviceGetHandleByIndex(index))
+                uuids[uuid.decode('utf-8') if isinstance(uuid, bytes) else uuid] = index
+            return uuids
+        finally:
+            pynvml.nvmlShutdown()
+    except pynvml.NVMLError as err:
+        logging.info('Cannot read the GPU UUIDs: {}'.format(err))
+        return {}
+
+
+def device_gpu(device_id, uuids=None):
+    """Returns the GPU id of a device plugin device id, or None."""
+
+    match = _DEVICE_INDEX.match(device_id)
+    if match:
+        return int(match.group(1))
+    return (uuids or {}).get(device_id)
+
+
+class KubernetesResources(object):
+    """Maps every GPU to the monitored resource its series are written to.
+
+    node_labels are the k8s_node resource labels (NODE_LABEL_KEYS). They are
+    held, not copied, so updates apply to the node and to the containers
+    assigned afterwards.
+    """
+
+    def __init__(self, client, node_labels, uuids=None, resource_name=GPU_RESOURCE,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        self._client = client
+        self._node = (K8S_NODE, node_labels)
+        self._uuids = uuids or {}
+        self._resource_name = resource_name
+        self._refresh_seconds = refresh_seconds
+        self._assignments = {}
+        self._resources = {}
+        self._listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def node(self):
+        return self._node
+
+    def add_listener(self, listener):
+        """Calls listener(changes) with the changed {gpu: Assignment or None}."""
+
+        self._listeners.append(listener)
+
+    def assignment(self, gpu):
+        return self._assignments.get(gpu)
+
+    def resource(self, gpu):
+        """Returns the (type, labels) resource of a GPU; do not modify the labels."""
+
+        return self._resources.get(gpu, self._node)
+
+    def _container_resource(self, assignment):
+        node_labels = self._node[1]
+        return (K8S_CONTAINER, {
+            'project_id': node_labels.get('project_id', ''),
+            'location': node_labels.get('location', ''),
+            'cluster_name': node_labels.get('cluster_name', ''),
+            'namespace_name': assignment.namespace,
+            'pod_name': assignment.pod,
+            'container_name': assignment.container,
+        })
+
+    def refresh(self):
+        """Re-reads the allocations. Returns the changes, if any."""
+
+        try:
+            allocations = self._client.list()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Pod resources refresh failed: {}'.format(err))
+            return {}
+
+        assignments = {}
+        for allocation in allocations:
+            if allocation.resource_name != self._resource_name:
+                continue
+            for device_id in allocation.device_ids:
+                gpu = device_gpu(device_id, self._uuids)
+                if gpu is None:
+                    logging.info('Unknown GPU device id: {}'.format(device_id))
+                    continue
+                assignments[gpu] = Assignment(allocation.namespace, allocation.pod,
+                                              allocation.container)
+        changes = {gpu: assignments.get(gpu)
+                   for gpu in set(assignments) | set(self._assignments)
+                   if assignments.get(gpu) != self._assignments.get(gpu)}
+        if not changes:
+            return changes
+
+        # Unchanged GPUs keep their resource, so their series labels do not move
+        resources = {gpu: resource for gpu, resource in self._resources.items()
+                     if gpu not in changes}
+        for gpu, assignment in changes.items():
+            if assignment is not None:
+                resources[gpu] = self._container_resource(assignment)
+            logging.info('GPU {} assigned to {}'.format(
+                gpu, '{}/{}/{}'.format(*assignment) if assignment else '(none)'))
+        self._assignments = assignments
+        self._resources = resources
+        for listener in self._listeners:
+            try:
+                listener(changes)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Pod resources listener failed: {}'.format(err))
+        return changes
+
+    def _run(self):
+        while not self._stop.wait(self._refresh_seconds):
+            self.refresh()
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='pod-resources', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._client.close()
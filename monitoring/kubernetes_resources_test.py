@@ -0,0 +1,217 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from concurrent import futures
+
+import grpc
+import pytest
+
+from google.cloud import monitoring_v3
+
+import agent_metrics
+import exporters
+import kubernetes_resources
+from exporters import Sample
+
+UTIL = 'custom.googleapis.com/gce/gpu-test/utilization'
+GPU_UTIL = 203
+
+FIELDS = {
+    GPU_UTIL: {
+        'name': UTIL,
+        'desc': 'GPU utilization',
+        'metric_kind': monitoring_v3.enums.MetricDescriptor.MetricKind.GAUGE,
+        'value_type': monitoring_v3.enums.MetricDescriptor.ValueType.INT64,
+        'sd_units': '%',
+    },
+}
+
+NODE_LABELS = {'project_id': 'p', 'location': 'us-central1', 'cluster_name': 'c',
+               'node_name': 'n'}
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _encode(pods):
+    """Encodes {(namespace, pod): {container: {resource: [device ids]}}}."""
+
+    data = b''
+    for (namespace, pod), containers in pods.items():
+        message = _field(1, pod) + _field(2, namespace)
+        for container, devices in containers.items():
+            container_message = _field(1, container)
+            for resource_name, device_ids in devices.items():
+                device = _field(1, resource_name) + b''.join(
+                    _field(2, device_id) for device_id in device_ids)
+                # cpu_ids of the container, skipped by the decoder
+                container_message += _field(2, device) + _varint(3 << 3) + _varint(300)
+            message += _field(3, container_message)
+        data += _field(1, message)
+    return data
+
+
+class FakeKubelet(object):
+    """Serves the pod-resources List method on a unix socket."""
+
+    def __init__(self, path):
+        self.pods = {}
+        self.calls = 0
+        handler = grpc.method_handlers_generic_handler('v1.PodResourcesLister', {
+            'List': grpc.unary_unary_rpc_method_handler(self._list),
+        })
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+        self._server.add_generic_rpc_handlers((handler,))
+        self._server.add_insecure_port('unix://' + path)
+        self._server.start()
+
+    def _list(self, request, context):
+        self.calls += 1
+        return _encode(self.pods)
+
+    def stop(self):
+        self._server.stop(None)
+
+
+class FakeClient(object):
+
+    def __init__(self, allocations=()):
+        self.allocations = list(allocations)
+        self.error = None
+
+    def list(self):
+        if self.error:
+            raise self.error
+        return self.allocations
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def kubelet(tmp_path):
+    server = FakeKubelet(str(tmp_path / 'kubelet.sock'))
+    yield server
+    server.stop()
+
+
+def test_lists_pod_resources(kubelet, tmp_path):
+    kubelet.pods = {
+        ('ml', 'trainer-0'): {'main': {'nvidia.com/gpu': ['nvidia0', 'nvidia1'],
+                                       'example.com/nic': ['eth1']},
+                              'sidecar': {}},
+        ('ml', 'eval-0'): {'main': {'nvidia.com/gpu': ['GPU-2b9a']}},
+    }
+    client = kubernetes_resources.PodResourcesClient(str(tmp_path / 'kubelet.sock'))
+    try:
+        allocations = client.list()
+    finally:
+        client.close()
+    assert sorted(allocations) == sorted([
+        kubernetes_resources.ContainerDevices('ml', 'trainer-0', 'main', 'nvidia.com/gpu',
+                                              ('nvidia0', 'nvidia1')),
+        kubernetes_resources.ContainerDevices('ml', 'trainer-0', 'main', 'example.com/nic',
+                                              ('eth1',)),
+        kubernetes_resources.ContainerDevices('ml', 'eval-0', 'main', 'nvidia.com/gpu',
+                                              ('GPU-2b9a',)),
+    ])
+
+
+def test_maps_gpus_to_containers(kubelet, tmp_path):
+    kubelet.pods = {('ml', 'trainer-0'): {'main': {'nvidia.com/gpu': ['nvidia0', 'GPU-2b9a']}}}
+    resources = kubernetes_resources.KubernetesResources(
+        kubernetes_resources.PodResourcesClient(str(tmp_path / 'kubelet.sock')), NODE_LABELS,
+        uuids={'GPU-2b9a': 3})
+    changes = []
+    resources.add_listener(changes.append)
+    try:
+        resources.refresh()
+        container = resources.resource(0)
+        assert container == ('k8s_container', {
+            'project_id': 'p', 'location': 'us-central1', 'cluster_name': 'c',
+            'namespace_name': 'ml', 'pod_name': 'trainer-0', 'container_name': 'main'})
+        assert resources.resource(3) == container
+        assert resources.resource(1) == ('k8s_node', NODE_LABELS)
+        assert resources.assignment(3) == ('ml', 'trainer-0', 'main')
+
+        # Nothing changed: same labels and no notification
+        assert resources.refresh() == {}
+        assert resources.resource(0) is container
+        assert len(changes) == 1
+
+        kubelet.pods = {('ml', 'trainer-0'): {'main': {'nvidia.com/gpu': ['nvidia0']}},
+                        ('ml', 'eval-0'): {'main': {'nvidia.com/gpu': ['nvidia1']}}}
+        resources.refresh()
+        assert changes[-1] == {1: ('ml', 'eval-0', 'main'), 3: None}
+        assert resources.resource(0) is container
+        assert resources.resource(1)[1]['pod_name'] == 'eval-0'
+        assert resources.resource(3)[0] == 'k8s_node'
+    finally:
+        resources.stop()
+
+
+def test_refresh_failure_keeps_mapping():
+    client = FakeClient([kubernetes_resources.ContainerDevices(
+        'ml', 'trainer-0', 'main', 'nvidia.com/gpu', ('nvidia2', 'unknown'))])
+    resources = kubernetes_resources.KubernetesResources(client, NODE_LABELS)
+    assert resources.refresh() == {2: ('ml', 'trainer-0', 'main')}
+    client.error = RuntimeError('kubelet restarting')
+    assert resources.refresh() == {}
+    assert resources.resource(2)[0] == 'k8s_container'
+
+
+class FakeMetricServiceClient(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def project_path(self, project_id):
+        return 'projects/' + project_id
+
+    def create_metric_descriptor(self, name, descriptor):
+        return descriptor
+
+    def create_time_series(self, name, time_series, retry=None, timeout=None):
+        self.requests.append((name, list(time_series)))
+
+
+def test_cloud_monitoring_container_resources():
+    resources = kubernetes_resources.KubernetesResources(FakeClient([
+        kubernetes_resources.ContainerDevices('ml', 'trainer-0', 'main', 'nvidia.com/gpu',
+                                              ('nvidia1',))]), NODE_LABELS)
+    resources.refresh()
+    client = FakeMetricServiceClient()
+    exporter = exporters.CloudMonitoringExporter(
+        client, 'p', FIELDS, 'k8s_node', NODE_LABELS, agent_metrics.AgentMetrics(),
+        agent_metrics_interval=None, resources=resources)
+    exporter.export([Sample(0, GPU_UTIL, 1, 10), Sample(1, GPU_UTIL, 1, 20)])
+
+    series = {s.metric.labels['gpu']: s.resource for s in client.requests[0][1]}
+    assert series['0'].type == 'k8s_node'
+    assert dict(series['0'].labels) == NODE_LABELS
+    assert series['1'].type == 'k8s_container'
+    assert series['1'].labels['pod_name'] == 'trainer-0'
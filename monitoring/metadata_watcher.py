@@ -0,0 +1,114 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Watches GCE metadata keys for changes without polling.
+
+Every watched key gets a thread making hanging GETs: the metadata server
+holds a wait_for_change request until the ETag of the key differs from
+last_etag, or until timeout_sec passes and it returns the unchanged value.
+The callback of a key is only called when its ETag changes. Directory keys
+such as instance/attributes/ are read recursively and passed as dicts.
+
+The agent watches the instance attributes, instance/preempted, which turns
+TRUE about 30 seconds before a preempted VM stops, and
+instance/maintenance-event, which is NONE outside host maintenance.
+"""
+
+import threading
+
+from absl import logging
+
+METADATA_URI = 'http://metadata.google.internal/computeMetadata/v1/'
+METADATA_HEADERS = {'Metadata-Flavor': 'Google'}
+ATTRIBUTES = 'instance/attributes/'
+PREEMPTED = 'instance/preempted'
+MAINTENANCE_EVENT = 'instance/maintenance-event'
+DEFAULT_TIMEOUT_SECONDS = 60
+DEFAULT_RETRY_SECONDS = 5
+
+
+class MetadataWatcher(object):
+    """Calls back on changes of metadata keys, one hanging GET thread per key."""
+
+    def __init__(self, uri=METADATA_URI, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                 retry_seconds=DEFAULT_RETRY_SECONDS, metrics=None):
+        import requests
+
+        self._requests = requests
+        self._uri = uri
+        self._timeout_seconds = timeout_seconds
+        self._retry_seconds = retry_seconds
+        self._metrics = metrics
+        self._watches = []
+        self._stop = threading.Event()
+        self._threads = []
+
+    def watch(self, key, callback, initial=False):
+        """Calls callback(value) on every change of key, and first if initial."""
+
+        self._watches.append((key, callback, initial))
+
+    def _get(self, session, key, etag):
+        params = {}
+        if key.endswith('/'):
+            params['recursive'] = 'true'
+        if etag is not None:
+            params.update(wait_for_change='true', last_etag=etag,
+                          timeout_sec=str(self._timeout_seconds))
+        response = session.get(self._uri + key, params=params, headers=METADATA_HEADERS,
+                               timeout=self._timeout_seconds + 10)
+        response.raise_for_status()
+        value = response.json() if key.endswith('/') else response.text
+        return value, response.headers.get('ETag')
+
+    def _run(self, key, callback, initial):
+        session = self._requests.Session()
+        etag = None
+        while not self._stop.is_set():
+            try:
+                value, new_etag = self._get(session, key, etag)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Metadata watch of {} failed: {}'.format(key, err))
+                if self._metrics is not None:
+                    self._metrics.metadata_events.labels(event='watch_failed').inc()
+                self._stop.wait(self._retry_seconds)
+                continue
+            changed = etag is not None and new_etag != etag
+            etag = new_etag
+            if not self._stop.is_set() and (changed or initial):
+                initial = False
+                try:
+                    callback(value)
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.info('Metadata callback of {} failed: {}'.format(key, err))
+            if etag is None:
+                # The next GET cannot wait for a change and would return at once
+                logging.info('Metadata watch of {} got no ETag, retrying in {} seconds'.format(
+                    key, self._retry_seconds))
+                self._stop.wait(self._retry_seconds)
+        session.close()
+
+    def start(self):
+        for key, callback, initial in self._watches:
+            thread = threading.Thread(target=self._run, args=(key, callback, initial),
+                                      name='metadata-' + key.strip('/'), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=1.0):
+        """Stops watching. Threads blocked in a hanging GET are left to exit."""
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
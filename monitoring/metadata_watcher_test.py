@@ -0,0 +1,175 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import queue
+import threading
+import time
+from http import server
+from urllib import parse
+
+import pytest
+
+import agent_metrics
+import metadata_watcher
+
+
+class FakeMetadataServer(object):
+    """Serves metadata keys, holding wait_for_change requests like the real one."""
+
+    def __init__(self, values):
+        self.values = dict(values)
+        self.versions = {key: 1 for key in values}
+        self.requests = []
+        self.failures = 0
+        self.etags = True
+        self._condition = threading.Condition()
+        fake = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = parse.urlparse(self.path)
+                key = url.path[len('/computeMetadata/v1/'):]
+                params = dict(parse.parse_qsl(url.query))
+                fake.requests.append((key, params))
+                if self.headers.get('Metadata-Flavor') != 'Google' or key not in fake.values:
+                    self.send_error(404)
+                    return
+                if fake.failures:
+                    fake.failures -= 1
+                    self.send_error(503)
+                    return
+                with fake._condition:
+                    if params.get('wait_for_change') == 'true':
+                        fake._condition.wait_for(
+                            lambda: fake._etag(key) != params.get('last_etag'),
+                            float(params['timeout_sec']))
+                    value, etag = fake.values[key], fake._etag(key)
+                body = (json.dumps(value) if key.endswith('/') else value).encode('utf-8')
+                self.send_response(200)
+                if fake.etags:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.uri = 'http://127.0.0.1:{}/computeMetadata/v1/'.format(
+            self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _etag(self, key):
+        return '{:016x}'.format(self.versions[key])
+
+    def set(self, key, value):
+        with self._condition:
+            self.values[key] = value
+            self.versions[key] += 1
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self.versions = {key: version + 1 for key, version in self.versions.items()}
+            self._condition.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def metadata():
+    fake = FakeMetadataServer({
+        metadata_watcher.ATTRIBUTES: {'cluster-name': 'c'},
+        metadata_watcher.PREEMPTED: 'FALSE',
+        metadata_watcher.MAINTENANCE_EVENT: 'NONE',
+    })
+    yield fake
+    fake.stop()
+
+
+def test_calls_back_on_changes(metadata):
+    events = queue.Queue()
+    watcher = metadata_watcher.MetadataWatcher(metadata.uri, timeout_seconds=1)
+    watcher.watch(metadata_watcher.ATTRIBUTES,
+                  lambda value: events.put(('attributes', value)))
+    watcher.watch(metadata_watcher.PREEMPTED,
+                  lambda value: events.put(('preempted', value)), initial=True)
+    watcher.start()
+    try:
+        assert events.get(timeout=5) == ('preempted', 'FALSE')
+        metadata.set(metadata_watcher.ATTRIBUTES, {'cluster-name': 'd'})
+        assert events.get(timeout=5) == ('attributes', {'cluster-name': 'd'})
+        metadata.set(metadata_watcher.PREEMPTED, 'TRUE')
+        assert events.get(timeout=5) == ('preempted', 'TRUE')
+    finally:
+        watcher.stop()
+    assert events.empty()
+
+    # The first read is plain, the next ones hang on the last ETag
+    attributes = [params for key, params in metadata.requests
+                  if key == metadata_watcher.ATTRIBUTES]
+    assert attributes[0] == {'recursive': 'true'}
+    assert attributes[1] == {'recursive': 'true', 'wait_for_change': 'true',
+                             'last_etag': '0000000000000001', 'timeout_sec': '1'}
+
+
+def test_unchanged_timeouts_do_not_call_back(metadata):
+    events = queue.Queue()
+    watcher = metadata_watcher.MetadataWatcher(metadata.uri, timeout_seconds=1)
+    watcher.watch(metadata_watcher.MAINTENANCE_EVENT, events.put)
+    watcher.start()
+    try:
+        with pytest.raises(queue.Empty):
+            events.get(timeout=1.5)
+        metadata.set(metadata_watcher.MAINTENANCE_EVENT, 'TERMINATE_ON_HOST_MAINTENANCE')
+        assert events.get(timeout=5) == 'TERMINATE_ON_HOST_MAINTENANCE'
+    finally:
+        watcher.stop()
+
+
+def test_retries_failed_requests(metadata):
+    metadata.failures = 2
+    metrics = agent_metrics.AgentMetrics()
+    events = queue.Queue()
+    watcher = metadata_watcher.MetadataWatcher(metadata.uri, timeout_seconds=1,
+                                               retry_seconds=0.01, metrics=metrics)
+    watcher.watch(metadata_watcher.PREEMPTED, events.put, initial=True)
+    watcher.start()
+    try:
+        assert events.get(timeout=5) == 'FALSE'
+    finally:
+        watcher.stop()
+    assert metrics.metadata_events.labels(event='watch_failed').value == 2
+
+
+def test_waits_without_etag(metadata):
+    metadata.etags = False
+    events = queue.Queue()
+    watcher = metadata_watcher.MetadataWatcher(metadata.uri, timeout_seconds=1,
+                                               retry_seconds=0.2)
+    watcher.watch(metadata_watcher.PREEMPTED, events.put, initial=True)
+    watcher.start()
+    try:
+        assert events.get(timeout=5) == 'FALSE'
+        time.sleep(0.5)
+    finally:
+        watcher.stop()
+    # Not a busy loop: one request per retry interval
+    assert len([key for key, _ in metadata.requests if key == metadata_watcher.PREEMPTED]) <= 4
@@ -0,0 +1,265 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""NVML sampling backend used while DCGM is unavailable.
+
+NvmlReader has the Process interface of the DCGM reader and publishes the
+same samples for the watched fields NVML can read: utilization, framebuffer
+memory, power and PCIe throughput. The profiling fields (SM activity, tensor
+activity, ...) only exist in DCGM and are skipped.
+
+Device handles are looked up once, and every NVML query needed by the
+watched fields is compiled per device up front. A query that fails as not
+supported is dropped for that device, so each cycle is a fixed list of
+direct NVML calls.
+
+SwitchingReader samples through DCGM when nv-hostengine is reachable and
+through NVML otherwise, probing DCGM again every retry_seconds, so the agent
+upgrades to DCGM without a restart once the host engine comes up.
+"""
+
+import time
+
+from absl import logging
+
+import agent_metrics
+import cycle_trace
+import exporters
+
+DEFAULT_RETRY_SECONDS = 60
+
+DCGM = 'dcgm'
+NVML = 'nvml'
+
+# DCGM field ids
+POWER_USAGE = 155
+GPU_UTIL = 203
+MEM_COPY_UTIL = 204
+FB_TOTAL = 250
+FB_FREE = 251
+FB_USED = 252
+PCIE_TX_BYTES = 1009
+PCIE_RX_BYTES = 1010
+
+_MIB = 1024 * 1024
+
+
+def _utilization(nvml, handle):
+    rates = nvml.nvmlDeviceGetUtilizationRates(handle)
+    return {GPU_UTIL: rates.gpu, MEM_COPY_UTIL: rates.memory}
+
+
+def _memory(nvml, handle):
+    memory = nvml.nvmlDeviceGetMemoryInfo(handle)
+    return {FB_TOTAL: memory.total / _MIB, FB_FREE: memory.free / _MIB,
+            FB_USED: memory.used / _MIB}
+
+
+def _power(nvml, handle):
+    return {POWER_USAGE: nvml.nvmlDeviceGetPowerUsage(handle) / 1000.0}
+
+
+def _pcie_tx(nvml, handle):
+    # NVML reports KB/s over a 20 ms window
+    return {PCIE_TX_BYTES: nvml.nvmlDeviceGetPcieThroughput(
+        handle, nvml.NVML_PCIE_UTIL_TX_BYTES) * 1024.0}
+
+
+def _pcie_rx(nvml, handle):
+    return {PCIE_RX_BYTES: nvml.nvmlDeviceGetPcieThroughput(
+        handle, nvml.NVML_PCIE_UTIL_RX_BYTES) * 1024.0}
+
+
+# NVML queries and the DCGM fields each of them reads
+QUERIES = (
+    ((GPU_UTIL, MEM_COPY_UTIL), _utilization),
+    ((FB_TOTAL, FB_FREE, FB_USED), _memory),
+    ((POWER_USAGE,), _power),
+    ((PCIE_TX_BYTES,), _pcie_tx),
+    ((PCIE_RX_BYTES,), _pcie_rx),
+)
+
+
+class ReaderUnavailable(Exception):
+    """Raised by a reader whose backend cannot be reached."""
+
+
+def _import_nvml():
+    try:
+        import pynvml
+    except ImportError:
+        raise ImportError('The NVML reader requires the pynvml package')
+    return pynvml
+
+
+class NvmlReader(object):
+    """Publishes the watched fields NVML can read to the exporter sinks."""
+
+    def __init__(self, fields_to_watch, sinks, metrics=None, nvml=None):
+        self._nvml = nvml or _import_nvml()
+        self._sinks = sinks
+        self._metrics = metrics or agent_metrics.AgentMetrics()
+        self._nvml.nvmlInit()
+        watched = set(fields_to_watch)
+        queries = [(query, [field_id for field_id in field_ids if field_id in watched])
+                   for field_ids, query in QUERIES]
+        queries = [(query, field_ids) for query, field_ids in queries if field_ids]
+        self._devices = [
+            (index, self._nvml.nvmlDeviceGetHandleByIndex(index), list(queries))
+            for index in range(self._nvml.nvmlDeviceGetCount())]
+        skipped = sorted(watched.difference(*[field_ids for field_ids, _ in QUERIES]))
+        logging.info('NVML reader: {} GPUs, fields not available in NVML: {}'.format(
+            len(self._devices), skipped))
+
+    def _read(self):
+        nvml = self._nvml
+        samples = []
+        for gpu, handle, queries in self._devices:
+            timestamp = int(time.time() * 10**6)
+            for query, field_ids in list(queries):
+                try:
+                    values = query(nvml, handle)
+                except nvml.NVMLError as err:
+                    if getattr(err, 'value', None) == nvml.NVML_ERROR_NOT_SUPPORTED:
+                        queries.remove((query, field_ids))
+                        logging.info('GPU {}: {} not supported by NVML'.format(
+                            gpu, query.__name__.lstrip('_')))
+                        continue
+                    if getattr(err, 'value', None) in (nvml.NVML_ERROR_UNINITIALIZED,
+                                                       nvml.NVML_ERROR_DRIVER_NOT_LOADED):
+                        raise ReaderUnavailable(str(err))
+                    self._metrics.blank_values.inc(len(field_ids))
+                    continue
+                samples.extend(exporters.Sample(gpu, field_id, timestamp, float(values[field_id]))
+                               for field_id in field_ids)
+        return samples
+
+    def Process(self, span=None):
+        """Reads the fields of every GPU once and publishes them."""
+
+        span = span or cycle_trace.CycleSpan(0, time.time())
+        start = time.monotonic()
+        samples = self._read()
+        fetch_seconds = time.monotonic() - start
+        self._metrics.dcgm_fetch_latency.observe(fetch_seconds)
+        span.add_phase('fetch', fetch_seconds)
+        span.set(samples=len(samples), backend=NVML)
+        with span.phase('publish'):
+            self._sinks.publish(samples, span)
+
+    def close(self):
+        try:
+            self._nvml.nvmlShutdown()
+        except self._nvml.NVMLError as err:
+            logging.info('NVML shutdown failed: {}'.format(err))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SwitchingReader(object):
+    """Samples through the primary reader, or the fallback while it is down.
+
+    The factories create the readers; the primary factory or the primary
+    reader's Process raise ReaderUnavailable, or any error, when DCGM cannot
+    be reached.
+    """
+
+    def __init__(self, primary_factory, fallback_factory, retry_seconds=DEFAULT_RETRY_SECONDS,
+                 metrics=None, clock=time.monotonic):
+        self._factories = {DCGM: primary_factory, NVML: fallback_factory}
+        self._retry_seconds = retry_seconds
+        self._metrics = metrics
+        self._clock = clock
+        self._reader = None
+        self.backend = None
+        self._next_probe = clock()
+
+    def _create(self, backend):
+        try:
+            return self._factories[backend]()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Cannot create the {} reader: {}'.format(backend, err))
+            return None
+
+    def _use(self, reader, backend):
+        if self._reader is not None:
+            self._close(self._reader)
+        self._reader = reader
+        self.backend = backend if reader is not None else None
+        if reader is not None:
+            logging.info('Sampling through {}'.format(backend))
+        if self._metrics is not None:
+            for name in (DCGM, NVML):
+                self._metrics.sampling_backend.labels(backend=name).set(
+                    int(name == self.backend))
+
+    @staticmethod
+    def _close(reader):
+        try:
+            reader.close()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Closing the reader failed: {}'.format(err))
+
+    def _probe(self, span):
+        # The fallback keeps running until DCGM answered a full cycle
+        self._next_probe = self._clock() + self._retry_seconds
+        reader = self._create(DCGM)
+        if reader is None:
+            return False
+        try:
+            reader.Process(span)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('DCGM not available yet: {}'.format(err))
+            self._close(reader)
+            return False
+        self._use(reader, DCGM)
+        return True
+
+    def Process(self, span=None):
+        if self.backend != DCGM and self._clock() >= self._next_probe:
+            if self._probe(span):
+                return
+
+        if self.backend == DCGM:
+            try:
+                self._reader.Process(span)
+                return
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('DCGM unavailable, falling back to NVML: {}'.format(err))
+                self._next_probe = self._clock() + self._retry_seconds
+                self._use(None, None)
+
+        if self._reader is None:
+            self._use(self._create(NVML), NVML)
+        if self._reader is not None:
+            try:
+                self._reader.Process(span)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('NVML read failed: {}'.format(err))
+                self._use(None, None)
+
+    def close(self):
+        if self._reader is not None:
+            self._close(self._reader)
+            self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,206 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+
+import agent_metrics
+import nvml_reader
+
+Utilization = collections.namedtuple('Utilization', ['gpu', 'memory'])
+Memory = collections.namedtuple('Memory', ['total', 'free', 'used'])
+MIB = 1024 * 1024
+
+
+class NVMLError(Exception):
+
+    def __init__(self, value):
+        Exception.__init__(self, 'NVML error {}'.format(value))
+        self.value = value
+
+
+class FakeNvml(object):
+    NVMLError = NVMLError
+    NVML_ERROR_UNINITIALIZED = 1
+    NVML_ERROR_NOT_SUPPORTED = 3
+    NVML_ERROR_DRIVER_NOT_LOADED = 9
+    NVML_ERROR_UNKNOWN = 999
+    NVML_PCIE_UTIL_TX_BYTES = 0
+    NVML_PCIE_UTIL_RX_BYTES = 1
+
+    def __init__(self, count=2):
+        self.count = count
+        self.calls = collections.Counter()
+        self.pcie_supported = True
+        self.power_error = None
+        self.shutdown = False
+
+    def nvmlInit(self):
+        pass
+
+    def nvmlShutdown(self):
+        self.shutdown = True
+
+    def nvmlDeviceGetCount(self):
+        return self.count
+
+    def nvmlDeviceGetHandleByIndex(self, index):
+        self.calls['handle'] += 1
+        return 'handle-{}'.format(index)
+
+    def nvmlDeviceGetUtilizationRates(self, handle):
+        self.calls['utilization'] += 1
+        return Utilization(gpu=40 + int(handle[-1]), memory=10)
+
+    def nvmlDeviceGetMemoryInfo(self, handle):
+        self.calls['memory'] += 1
+        return Memory(total=16384 * MIB, free=12288 * MIB, used=4096 * MIB)
+
+    def nvmlDeviceGetPowerUsage(self, handle):
+        self.calls['power'] += 1
+        if self.power_error:
+            raise NVMLError(self.power_error)
+        return 250500
+
+    def nvmlDeviceGetPcieThroughput(self, handle, counter):
+        self.calls['pcie'] += 1
+        if not self.pcie_supported:
+            raise NVMLError(self.NVML_ERROR_NOT_SUPPORTED)
+        return 1000 if counter == self.NVML_PCIE_UTIL_TX_BYTES else 2000
+
+
+class FakeSinks(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def publish(self, samples, span=None):
+        self.batches.append(samples)
+
+
+FIELDS = (nvml_reader.GPU_UTIL, nvml_reader.FB_USED, nvml_reader.POWER_USAGE,
+          nvml_reader.PCIE_TX_BYTES, 1002)
+
+
+def test_reads_watched_fields_with_cached_handles():
+    nvml = FakeNvml()
+    sinks = FakeSinks()
+    reader = nvml_reader.NvmlReader(FIELDS, sinks, nvml=nvml)
+    reader.Process()
+    reader.Process()
+
+    values = {(s.gpu, s.field_id): s.value for s in sinks.batches[-1]}
+    assert values == {
+        (0, nvml_reader.GPU_UTIL): 40.0, (1, nvml_reader.GPU_UTIL): 41.0,
+        (0, nvml_reader.FB_USED): 4096.0, (1, nvml_reader.FB_USED): 4096.0,
+        (0, nvml_reader.POWER_USAGE): 250.5, (1, nvml_reader.POWER_USAGE): 250.5,
+        (0, nvml_reader.PCIE_TX_BYTES): 1024000.0, (1, nvml_reader.PCIE_TX_BYTES): 1024000.0,
+    }
+    # One call per query and device, no query for unwatched fields
+    assert nvml.calls == {'handle': 2, 'utilization': 4, 'memory': 4, 'power': 4, 'pcie': 4}
+    reader.close()
+    assert nvml.shutdown
+
+
+def test_unsupported_queries_are_dropped():
+    nvml = FakeNvml(count=1)
+    sinks = FakeSinks()
+    metrics = agent_metrics.AgentMetrics()
+    reader = nvml_reader.NvmlReader(FIELDS, sinks, metrics, nvml=nvml)
+    nvml.pcie_supported = False
+    nvml.power_error = nvml.NVML_ERROR_UNKNOWN
+    reader.Process()
+    reader.Process()
+
+    assert nvml.calls['pcie'] == 1
+    # Other errors only skip the cycle
+    assert nvml.calls['power'] == 2
+    assert metrics.blank_values.labels().value == 2
+    assert {s.field_id for s in sinks.batches[-1]} == {nvml_reader.GPU_UTIL,
+                                                       nvml_reader.FB_USED}
+
+
+class FakeReader(object):
+
+    def __init__(self, name, log, fail=False):
+        self.name = name
+        self.log = log
+        self.fail = fail
+        self.closed = False
+
+    def Process(self, span=None):
+        if self.fail:
+            raise nvml_reader.ReaderUnavailable('down')
+        self.log.append(self.name)
+
+    def close(self):
+        self.closed = True
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_switches_between_dcgm_and_nvml():
+    log = []
+    dcgm_up = [False]
+    readers = []
+
+    def dcgm_factory():
+        reader = FakeReader('dcgm', log, fail=not dcgm_up[0])
+        readers.append(reader)
+        return reader
+
+    def nvml_factory():
+        reader = FakeReader('nvml', log)
+        readers.append(reader)
+        return reader
+
+    clock = Clock()
+    metrics = agent_metrics.AgentMetrics()
+    reader = nvml_reader.SwitchingReader(dcgm_factory, nvml_factory, retry_seconds=60,
+                                         metrics=metrics, clock=clock)
+    for second in range(0, 120, 10):
+        clock.now = second
+        if second == 70:
+            dcgm_up[0] = True
+        reader.Process()
+
+    # DCGM is probed every 60 s; it is down at 0 s and 60 s
+    assert log[:7] == ['nvml'] * 7
+    clock.now = 120
+    reader.Process()
+    assert log[-1] == 'dcgm'
+    assert reader.backend == nvml_reader.DCGM
+    assert readers[1].closed and not readers[-1].closed
+    assert metrics.sampling_backend.labels(backend='dcgm').value == 1
+    assert metrics.sampling_backend.labels(backend='nvml').value == 0
+
+    # Losing DCGM falls back to NVML within the same cycle
+    readers[-1].fail = True
+    clock.now = 130
+    reader.Process()
+    assert log[-1] == 'nvml'
+    assert reader.backend == nvml_reader.NVML
+    clock.now = 140
+    reader.Process()
+    assert [r.name for r in readers].count('dcgm') == 3
+
+    reader.close()
+    assert all(r.closed for r in readers if r.name == 'nvml')
@@ -0,0 +1,306 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-demand profiling of a running agent.
+
+Profiling sessions are started with a signal or a command sent to a local
+control socket and write their results to files in the output directory:
+
+    SIGUSR1                 cProfile the sampling loop for the default duration
+    SIGUSR2                 trace allocations for the default duration
+    cprofile <seconds>      cProfile the sampling loop
+    sample <seconds> [ms]   sample the stacks of all threads
+    tracemalloc <seconds>   report the top allocation sites
+    status                  report the running sessions
+
+Nothing is installed unless the controller is started, and an idle
+controller only holds a thread blocked on the control socket. Only the
+owner of the agent process can connect to the socket.
+
+When the sampling loop runs its cycles on a worker thread, as under the
+watchdog, profile_calls() makes cProfile sessions cover the calls made
+through profiled() instead of the main thread.
+"""
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from absl import logging
+
+DEFAULT_SAMPLE_INTERVAL_MS = 10
+CONNECTION_TIMEOUT_SECONDS = 5
+TOP_ALLOCATION_SITES = 25
+
+
+def _timestamp():
+    return time.strftime('%Y%m%d-%H%M%S')
+
+
+def _write_file(path, text):
+    """Writes a report so that readers never see a partial file."""
+
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.rename(path + '.tmp', path)
+
+
+class ProfilingController(object):
+    """Runs profiling sessions requested by signals or a control socket."""
+
+    def __init__(self, output_dir, control_socket=None, default_seconds=30):
+        self._output_dir = output_dir
+        self._control_socket = control_socket
+        self._default_seconds = default_seconds
+        self._main_thread = threading.main_thread().ident
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._profiler = None
+        self._profile_calls = False
+        self._sampling = False
+        self._tracing = False
+        self._server = None
+        self._previous_handlers = {}
+
+    def start(self):
+        """Installs the signal handlers and the control socket listener."""
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        for signum, handler in ((signal.SIGUSR1, self._on_sigusr1),
+                                (signal.SIGUSR2, self._on_sigusr2)):
+            self._previous_handlers[signum] = signal.signal(signum, handler)
+
+        if self._control_socket:
+            if os.path.exists(self._control_socket):
+                os.unlink(self._control_socket)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self._control_socket)
+            os.chmod(self._control_socket, 0o600)
+            self._server.listen(1)
+            threading.Thread(target=self._serve, name='profiling-control',
+                             daemon=True).start()
+        logging.info('Profiling controls enabled, output in {}'.format(
+            self._output_dir))
+
+    def stop(self):
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+        if self._server:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self._control_socket)
+            except FileNotFoundError:
+                pass
+
+    def handle_command(self, command):
+        """Executes a control command and returns a one line reply."""
+
+        args = command.split()
+        if not args:
+            return 'error: empty command'
+        try:
+            if args[0] == 'cprofile':
+                seconds = float(args[1]) if len(args) > 1 else self._default_seconds
+                return self._request_main_thread(('cprofile', seconds))
+            if args[0] == 'sample':
+                seconds = float(args[1]) if len(args) > 1 else self._default_seconds
+                interval = float(args[2]) if len(args) > 2 else DEFAULT_SAMPLE_INTERVAL_MS
+                return self.start_sampling(seconds, interval / 1000.0)
+            if args[0] == 'tracemalloc':
+                seconds = float(args[1]) if len(args) > 1 else self._default_seconds
+                return self.start_tracemalloc(seconds)
+            if args[0] == 'status':
+                return 'cprofile={} sample={} tracemalloc={}'.format(
+                    self._profiler is not None, self._sampling, self._tracing)
+        except ValueError as err:
+            return 'error: {}'.format(err)
+        return 'error: unknown command {}'.format(args[0])
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            # A stuck or vanished client must not end the control thread
+            try:
+                with conn:
+                    conn.settimeout(CONNECTION_TIMEOUT_SECONDS)
+                    command = conn.recv(1024).decode('utf-8', 'replace').strip()
+                    reply = self.handle_command(command)
+                    conn.sendall((reply + '\n').encode('utf-8'))
+            except OSError as err:
+                logging.info('Profiling control connection failed: {}'.format(err))
+
+    def profile_calls(self):
+        """Profiles the calls made through profiled() rather than the main thread."""
+
+        self._profile_calls = True
+
+    def profiled(self, fn, *args):
+        """Calls fn, under the running cProfile session if profile_calls() was set."""
+
+        profiler = self._profiler
+        if profiler is None or not self._profile_calls:
+            return fn(*args)
+        return profiler.runcall(fn, *args)
+
+    # cProfile only sees the thread that enabled it, so sessions are started
+    # and stopped by the signal handler, which runs on the main thread.
+
+    def _request_main_thread(self, request):
+        self._pending.append(request)
+        if threading.get_ident() == self._main_thread:
+            self._drain_pending()
+        else:
+            signal.pthread_kill(self._main_thread, signal.SIGUSR1)
+        return 'ok'
+
+    def _on_sigusr1(self, signum, frame):
+        if not self._pending:
+            self._pending.append(('cprofile', self._default_seconds))
+        self._drain_pending()
+
+    def _on_sigusr2(self, signum, frame):
+        self.start_tracemalloc(self._default_seconds)
+
+    def _drain_pending(self):
+        while self._pending:
+            request = self._pending.popleft()
+            if request[0] == 'cprofile':
+                self._start_cprofile(request[1])
+            elif request[0] == 'cprofile_stop':
+                self._stop_cprofile()
+
+    def _start_cprofile(self, seconds):
+        if self._profiler is not None:
+            logging.info('cProfile session already running')
+            return
+        self._profiler = cProfile.Profile()
+        if not self._profile_calls:
+            self._profiler.enable()
+        timer = threading.Timer(seconds, self._request_main_thread,
+                                args=(('cprofile_stop',),))
+        timer.daemon = True
+        timer.start()
+        logging.info('cProfile started for {} seconds'.format(seconds))
+
+    def _stop_cprofile(self):
+        profiler, self._profiler = self._profiler, None
+        if profiler is None:
+            return
+        if not self._profile_calls:
+            profiler.disable()
+        path = os.path.join(self._output_dir, 'cprofile-{}'.format(_timestamp()))
+        profiler.dump_stats(path + '.pstats')
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(50)
+        _write_file(path + '.txt', summary.getvalue())
+        logging.info('cProfile results written to {}.pstats'.format(path))
+
+    def start_sampling(self, seconds, interval):
+        """Samples all thread stacks into a collapsed stack file."""
+
+        with self._lock:
+            if self._sampling:
+                return 'error: sampling already running'
+            self._sampling = True
+        threading.Thread(target=self._sample, args=(seconds, interval),
+                         name='profiling-sampler', daemon=True).start()
+        return 'ok'
+
+    def _sample(self, seconds, interval):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = collections.Counter()
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                    if ident == own:
+                        continue
+                    frames = []
+                    while frame is not None:
+                        code = frame.f_code
+                        frames.append('{}:{}:{}'.format(
+                            os.path.basename(code.co_filename), code.co_name,
+                            frame.f_lineno))
+                        frame = frame.f_back
+                    frames.append(names.get(ident, str(ident)))
+                    stacks[';'.join(reversed(frames))] += 1
+                time.sleep(interval)
+
+            path = os.path.join(self._output_dir,
+                                'samples-{}.folded'.format(_timestamp()))
+            _write_file(path, ''.join('{} {}\n'.format(stack, count)
+                                      for stack, count in stacks.most_common()))
+            logging.info('Stack samples written to {}'.format(path))
+        finally:
+            self._sampling = False
+
+    def start_tracemalloc(self, seconds, top=TOP_ALLOCATION_SITES):
+        """Traces allocations and reports the top growing allocation sites."""
+
+        with self._lock:
+            if self._tracing:
+                return 'error: tracemalloc already running'
+            self._tracing = True
+        threading.Thread(target=self._trace, args=(seconds, top),
+                         name='profiling-tracemalloc', daemon=True).start()
+        return 'ok'
+
+    def _trace(self, seconds, top):
+        was_tracing = tracemalloc.is_tracing()
+        try:
+            if not was_tracing:
+                tracemalloc.start(16)
+            baseline = tracemalloc.take_snapshot()
+            time.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+
+            path = os.path.join(self._output_dir,
+                                'tracemalloc-{}.txt'.format(_timestamp()))
+            lines = ['traced current={} peak={}'.format(current, peak), '',
+                     'Top allocation sites']
+            lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:top])
+            lines.extend(['', 'Top growth over {} seconds'.format(seconds)])
+            lines.extend(str(stat) for stat in
+                         snapshot.compare_to(baseline, 'lineno')[:top])
+            _write_file(path, '\n'.join(lines) + '\n')
+            logging.info('Allocation report written to {}'.format(path))
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+            self._tracing = False
+
+
+def send_command(control_socket, command, timeout=5.0):
+    """Sends a command to a running agent and returns its reply."""
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(control_socket)
+        conn.sendall(command.encode('utf-8'))
+        return conn.recv(1024).decode('utf-8').strip()
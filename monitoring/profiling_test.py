@@ -0,0 +1,133 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+import profiling
+
+
+def _wait_for(pattern, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        files = glob.glob(pattern)
+        if files:
+            return files
+        time.sleep(0.05)
+    return []
+
+
+def _busy(seconds):
+    deadline = time.monotonic() + seconds
+    total = 0
+    while time.monotonic() < deadline:
+        total += sum(range(100))
+    return total
+
+
+@pytest.fixture
+def controller(tmp_path):
+    controller = profiling.ProfilingController(
+        output_dir=str(tmp_path),
+        control_socket=str(tmp_path / 'control.sock'),
+        default_seconds=0.2)
+    controller.start()
+    yield controller
+    controller.stop()
+
+
+def test_cprofile_over_socket(controller, tmp_path):
+    reply = profiling.send_command(str(tmp_path / 'control.sock'), 'cprofile 0.2')
+    assert reply == 'ok'
+    _busy(0.5)
+
+    files = _wait_for(str(tmp_path / 'cprofile-*.txt'))
+    assert files
+    with open(files[0]) as f:
+        assert '_busy' in f.read()
+
+
+def test_cprofile_worker_calls(controller, tmp_path):
+    controller.profile_calls()
+
+    def worker():
+        while not _wait_for(str(tmp_path / 'cprofile-*.txt'), timeout=0.01):
+            controller.profiled(_busy, 0.05)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert profiling.send_command(str(tmp_path / 'control.sock'), 'cprofile 0.2') == 'ok'
+    thread.join(5.0)
+
+    with open(_wait_for(str(tmp_path / 'cprofile-*.txt'))[0]) as f:
+        assert '_busy' in f.read()
+
+
+def test_stack_sampling(controller, tmp_path):
+    assert controller.handle_command('sample 0.3 5') == 'ok'
+    assert controller.handle_command('sample 0.3').startswith('error')
+    _busy(0.5)
+
+    files = _wait_for(str(tmp_path / 'samples-*.folded'))
+    assert files
+    with open(files[0]) as f:
+        assert 'MainThread' in f.read()
+
+
+def test_tracemalloc_report(controller, tmp_path):
+    assert controller.handle_command('tracemalloc 0.2') == 'ok'
+    garbage = [bytearray(1024) for _ in range(1000)]
+
+    files = _wait_for(str(tmp_path / 'tracemalloc-*.txt'))
+    assert files and garbage
+    with open(files[0]) as f:
+        assert 'Top allocation sites' in f.read()
+
+
+def test_unknown_command(controller):
+    assert controller.handle_command('flamegraph').startswith('error')
+    assert controller.handle_command('cprofile soon').startswith('error')
+    assert 'cprofile=False' in controller.handle_command('status')
+
+
+def test_silent_client_does_not_block_control(controller, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'CONNECTION_TIMEOUT_SECONDS', 0.1)
+    path = str(tmp_path / 'control.sock')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.connect(path)
+    try:
+        assert profiling.send_command(path, 'status').startswith('cprofile=False')
+    finally:
+        silent.close()
+
+
+def test_stop_removes_socket(tmp_path):
+    controller = profiling.ProfilingController(
+        output_dir=str(tmp_path), control_socket=str(tmp_path / 'c.sock'))
+    controller.start()
+    controller.stop()
+    assert not os.path.exists(str(tmp_path / 'c.sock'))
+
+    # Already removed, for example by a new agent instance
+    controller.start()
+    os.unlink(str(tmp_path / 'c.sock'))
+    controller.stop()
@@ -0,0 +1,227 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus-compatible /metrics endpoint serving the latest DCGM values.
+
+The exposition body is kept pre-encoded and only the lines of series that
+changed are re-encoded on each sampling cycle. Scrapes return the current
+body as is, so they never touch DCGM or build any protobufs.
+"""
+
+import gzip
+import http.server
+import math
+import threading
+
+from absl import logging
+
+import entities
+import exporters
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRIC_PREFIX = 'dcgm_'
+
+
+def metric_name(sd_name, prefix=METRIC_PREFIX):
+    """Derives a Prometheus metric name from a Cloud Monitoring metric type."""
+
+    return prefix + sd_name.rsplit('/', 1)[-1].replace('-', '_')
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    """Escapes a label value; unlike HELP text it also escapes double quotes."""
+
+    return _escape(str(value)).replace('"', '\\"')
+
+
+class _Family(object):
+    """Pre-encoded lines of a single metric family."""
+
+    def __init__(self, name, description):
+        self.header = '# HELP {} {}\n# TYPE {} gauge\n'.format(
+            name, _escape(description), name).encode('utf-8')
+        self.name = name
+        self.lines = {}
+        self.block = b''
+        self.dirty = False
+
+    def set(self, key, labels, value, timestamp_ms):
+        line = '{}{{{}}} {} {}\n'.format(
+            self.name, labels, _format_value(value), timestamp_ms).encode('utf-8')
+        if self.lines.get(key) != line:
+            self.lines[key] = line
+            self.dirty = True
+
+    def encode(self):
+        if self.dirty:
+            self.block = (self.header + b''.join(self.lines[key] for key in sorted(self.lines))
+                          if self.lines else b'')
+            self.dirty = False
+        return self.block
+
+
+class ExpositionBuffer(object):
+    """Holds the text exposition of the latest value of every series.
+
+    fields maps DCGM field ids to the field catalog entries ('name' and
+    'desc'). derived maps derived metric names to a (description, field ids)
+    pair; a derived series is the sum of its source fields. The series of
+    MIG instances are labelled from the entity topology.
+    """
+
+    def __init__(self, fields, derived=None, topology=None):
+        self._topology = topology or entities.EntityTopology()
+        self._label_text = {}
+        self._families = {}
+        self._order = []
+        for field_id, item in fields.items():
+            self._add_family(field_id, metric_name(item['name']), item['desc'])
+        self._derived = {}
+        for name, (description, field_ids) in (derived or {}).items():
+            self._add_family(name, name, description)
+            self._derived[name] = tuple(field_ids)
+
+        self._lock = threading.Lock()
+        self._body = b''
+        self._gzip_body = None
+        self.version = 0
+
+    def _add_family(self, key, name, description):
+        self._families[key] = _Family(name, description)
+        self._order.append(key)
+
+    def _labels(self, entity):
+        text = self._label_text.get(entity)
+        if text is None:
+            host, entity_group, entity_id = entity
+            labels = self._topology.labels(entity_group, entity_id)
+            pairs = ['{}="{}"'.format(key, _escape_label(labels[key]))
+                     for key in entities.LABEL_KEYS if key in labels]
+            if host is not None:
+                pairs.insert(0, '{}="{}"'.format(exporters.HOST_LABEL, _escape_label(host)))
+            text = self._label_text[entity] = ','.join(pairs)
+        return text
+
+    def update(self, samples):
+        """Updates the buffer with the latest values of a batch of samples."""
+
+        latest = {}
+        for sample in samples:
+            if sample.field_id not in self._families:
+                continue
+            key = (sample.host, sample.entity_group, sample.gpu, sample.field_id)
+            current = latest.get(key)
+            if current is None or sample.timestamp >= current.timestamp:
+                latest[key] = sample
+
+        with self._lock:
+            by_entity = {}
+            for (host, entity_group, entity_id, field_id), sample in latest.items():
+                entity = (host, entity_group, entity_id)
+                self._families[field_id].set(entity, self._labels(entity), sample.value,
+                                             sample.timestamp // 1000)
+                by_entity.setdefault(entity, {})[field_id] = sample
+
+            for entity, entity_samples in by_entity.items():
+                for name, field_ids in self._derived.items():
+                    sources = [entity_samples[field_id] for field_id in field_ids
+                               if field_id in entity_samples]
+                    if len(sources) == len(field_ids):
+                        self._families[name].set(
+                            entity, self._labels(entity), sum(sample.value for sample in sources),
+                            max(sample.timestamp for sample in sources) // 1000)
+
+            if any(family.dirty for family in self._families.values()):
+                self._body = b''.join(self._families[key].encode()
+                                      for key in self._order)
+                self._gzip_body = None
+                self.version += 1
+
+    def body(self):
+        return self._body
+
+    def gzip_body(self):
+        """Returns the compressed body, compressing at most once per version."""
+
+        body = self._gzip_body
+        if body is None:
+            with self._lock:
+                if self._gzip_body is None:
+                    self._gzip_body = gzip.compress(self._body, compresslevel=5)
+                body = self._gzip_body
+        return body
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the exposition buffer on /metrics."""
+
+    buffer = None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = self.buffer.gzip_body()
+            encoding = 'gzip'
+        else:
+            body = self.buffer.body()
+            encoding = None
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class PrometheusServer(object):
+    """Serves an exposition buffer from a background thread."""
+
+    def __init__(self, buffer, port, address=''):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'buffer': buffer})
+        self._server = http.server.ThreadingHTTPServer((address, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='prometheus-server', daemon=True)
+        self._thread.start()
+        logging.info('Serving Prometheus metrics on port {}'.format(self.port))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
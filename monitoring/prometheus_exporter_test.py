@@ -0,0 +1,153 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import gzip
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import entities
+import prometheus_exporter
+import synthetic_reader
+from exporters import Sample
+
+GPU_UTIL = 203
+PCIE_TX = 1011
+PCIE_RX = 1012
+
+FIELDS = {
+    GPU_UTIL: {'name': 'custom.googleapis.com/gce/gpu-test/utilization',
+               'desc': 'GPU utilization'},
+    PCIE_TX: {'name': 'custom.googleapis.com/gce/gpu-test/pcie_tx_throughput',
+              'desc': 'PCIE transmit througput'},
+    PCIE_RX: {'name': 'custom.googleapis.com/gce/gpu-test/pcie_rx_throughput',
+              'desc': 'PCIE receive througput'},
+}
+
+DERIVED = {
+    'dcgm_pcie_throughput': ('PCIE throughput', (PCIE_TX, PCIE_RX)),
+}
+
+
+def _samples(util, tx=100, rx=50, ts=1600000000000000):
+    return [
+        Sample(0, GPU_UTIL, ts - 1000000, 99),
+        Sample(0, GPU_UTIL, ts, util),
+        Sample(0, PCIE_TX, ts, tx),
+        Sample(0, PCIE_RX, ts, rx),
+        Sample(1, PCIE_TX, ts, tx),
+        Sample(1, 1234, ts, 1),
+    ]
+
+
+@pytest.fixture
+def buffer():
+    return prometheus_exporter.ExpositionBuffer(FIELDS, DERIVED)
+
+
+def test_metric_name():
+    assert prometheus_exporter.metric_name(
+        'custom.googleapis.com/gce/gpu-test/mem_used') == 'dcgm_mem_used'
+
+
+def test_exposition(buffer):
+    buffer.update(_samples(util=87))
+    body = buffer.body().decode('utf-8')
+
+    assert '# TYPE dcgm_utilization gauge' in body
+    assert 'dcgm_utilization{gpu="0"} 87.0 1600000000000\n' in body
+    assert 'dcgm_pcie_throughput{gpu="0"} 150.0 1600000000000\n' in body
+    assert 'dcgm_pcie_tx_throughput{gpu="1"} 100.0 1600000000000\n' in body
+    # Derived series need all of their source fields
+    assert 'dcgm_pcie_throughput{gpu="1"}' not in body
+
+
+def test_incremental_update(buffer):
+    buffer.update(_samples(util=87))
+    version = buffer.version
+    buffer.update(_samples(util=87))
+    assert buffer.version == version
+
+    buffer.update(_samples(util=12, ts=1600000010000000))
+    assert buffer.version == version + 1
+    body = buffer.body().decode('utf-8')
+    assert 'dcgm_utilization{gpu="0"} 12.0 1600000010000\n' in body
+    assert body.count('dcgm_utilization{') == 1
+
+
+def test_mig_labels():
+    topology = synthetic_reader.synthetic_topology(1, gpu_instances=2, compute_instances=2)
+    buffer = prometheus_exporter.ExpositionBuffer(FIELDS, topology=topology)
+    ts = 1600000000000000
+    buffer.update([Sample(0, GPU_UTIL, ts, 10),
+                   Sample(1, GPU_UTIL, ts, 20, entities.ENTITY_GPU_I),
+                   Sample(3, GPU_UTIL, ts, 30, entities.ENTITY_GPU_CI)])
+    body = buffer.body().decode('utf-8')
+
+    assert 'dcgm_utilization{gpu="0"} 10.0 1600000000000\n' in body
+    assert 'dcgm_utilization{gpu="0",gpu_instance="1"} 20.0 1600000000000\n' in body
+    assert ('dcgm_utilization{gpu="0",gpu_instance="1",compute_instance="1"} 30.0 '
+            '1600000000000\n') in body
+
+
+def test_host_labels(buffer):
+    ts = 1600000000000000
+    buffer.update([Sample(0, GPU_UTIL, ts, 10, host='node-1:5555'),
+                   Sample(0, GPU_UTIL, ts, 20, host='node-2:5555')])
+    body = buffer.body().decode('utf-8')
+
+    assert 'dcgm_utilization{host="node-1:5555",gpu="0"} 10.0 1600000000000\n' in body
+    assert 'dcgm_utilization{host="node-2:5555",gpu="0"} 20.0 1600000000000\n' in body
+
+
+def test_label_values_are_escaped(buffer):
+    ts = 1600000000000000
+    buffer.update([Sample(0, GPU_UTIL, ts, 10, host='a"b\\c\nd')])
+    body = buffer.body().decode('utf-8')
+
+    assert 'dcgm_utilization{host="a\\"b\\\\c\\nd",gpu="0"} 10.0 1600000000000\n' in body
+
+
+def test_scrapes(buffer):
+    buffer.update(_samples(util=42))
+    server = prometheus_exporter.PrometheusServer(buffer, port=0,
+                                                  address='127.0.0.1')
+    server.start()
+    url = 'http://127.0.0.1:{}/metrics'.format(server.port)
+    try:
+        results = []
+
+        def scrape():
+            with urllib.request.urlopen(url) as response:
+                results.append(response.read())
+
+        threads = [threading.Thread(target=scrape) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [buffer.body()] * 8
+
+        request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+        with urllib.request.urlopen(request) as response:
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert gzip.decompress(response.read()) == buffer.body()
+
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen('http://127.0.0.1:{}/'.format(server.port))
+    finally:
+        server.stop()
@@ -0,0 +1,323 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mergeable quantile sketches of the sampled series.
+
+DDSketch: a value v > 0 is counted in bucket ceil(log_gamma(v)) with
+gamma = (1 + alpha) / (1 - alpha), so every quantile is returned within a
+relative error alpha of the exact value. Buckets are kept in a dense numpy
+array; when it would exceed max_buckets the lowest buckets are collapsed,
+which bounds memory while keeping the accuracy of the upper quantiles.
+Sketches with the same alpha merge exactly.
+
+Sketch files hold any number of sketches keyed by (gpu, field id, job). To
+merge the files of many nodes into a fleet-wide distribution:
+
+    python quantile_sketch.py --inputs=node1.sketch,node2.sketch \\
+        --output=fleet.sketch --group_by=field,job --quantiles=0.5,0.9,0.99
+"""
+
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+DEFAULT_ALPHA = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+
+_MAGIC = b'DDSK'
+_VERSION = 1
+_HEADER = struct.Struct('<4sBI')
+_SKETCH = struct.Struct('<ddQqQdd')
+_ENTRY = struct.Struct('<IHHI')
+
+
+class _Store(object):
+    """Dense bucket counts starting at bucket key offset."""
+
+    __slots__ = ('offset', 'counts')
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.uint64)
+
+    def add(self, keys, counts, max_buckets):
+        low = int(keys.min())
+        high = int(keys.max())
+        if len(self.counts):
+            low = min(low, self.offset)
+            high = max(high, self.offset + len(self.counts) - 1)
+        grown = np.zeros(high - low + 1, dtype=np.uint64)
+        if len(self.counts):
+            grown[self.offset - low:self.offset - low + len(self.counts)] = self.counts
+        grown += np.bincount(keys - low, weights=counts,
+                             minlength=len(grown)).astype(np.uint64)
+        self.offset = low
+        self.counts = grown
+        if len(self.counts) > max_buckets:
+            # Collapse the lowest buckets into the first one kept
+            excess = len(self.counts) - max_buckets
+            self.counts[excess] += self.counts[:excess].sum(dtype=np.uint64)
+            self.counts = self.counts[excess:].copy()
+            self.offset += excess
+
+    def total(self):
+        return int(self.counts.sum(dtype=np.uint64))
+
+
+class DDSketch(object):
+    """Quantile sketch with relative accuracy alpha."""
+
+    def __init__(self, alpha=DEFAULT_ALPHA, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.alpha = alpha
+        self.max_buckets = max_buckets
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = np.log(self._gamma)
+        self._positive = _Store()
+        self._negative = _Store()
+        self.zero_count = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.0
+
+    def _keys(self, magnitudes):
+        return np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64)
+
+    def update(self, values):
+        """Adds a batch of values."""
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        # Values too small to tell from zero at this accuracy count as zero
+        tiny = np.finfo(np.float64).tiny * self._gamma
+        positive = values[values > tiny]
+        negative = -values[values < -tiny]
+        self.zero_count += len(values) - len(positive) - len(negative)
+        if len(positive):
+            self._positive.add(self._keys(positive), None, self.max_buckets)
+        if len(negative):
+            self._negative.add(self._keys(negative), None, self.max_buckets)
+
+    def merge(self, other):
+        """Adds the values counted by another sketch of the same accuracy."""
+
+        if other.alpha != self.alpha:
+            raise ValueError('Cannot merge sketches of different accuracy')
+        if not other.count:
+            return
+        for store, other_store in ((self._positive, other._positive),
+                                   (self._negative, other._negative)):
+            if other_store.total():
+                keys = other_store.offset + np.arange(len(other_store.counts))
+                store.add(keys, other_store.counts.astype(np.float64), self.max_buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _value(self, key):
+        return 2 * self._gamma**key / (self._gamma + 1)
+
+    def quantiles(self, quantiles):
+        """Returns the estimates of the given quantiles, NaN when empty."""
+
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        if not self.count:
+            return np.full(quantiles.shape, np.nan)
+        ranks = quantiles * (self.count - 1)
+        negative = self._negative.counts[::-1]
+        cumulative = np.concatenate((
+            np.cumsum(negative, dtype=np.float64),
+            [float(negative.sum()) + self.zero_count],
+            float(negative.sum()) + self.zero_count +
+            np.cumsum(self._positive.counts, dtype=np.float64)))
+        positions = np.searchsorted(cumulative, ranks, side='right')
+        positions = np.minimum(positions, len(cumulative) - 1)
+        estimates = np.empty(len(ranks))
+        for row, position in enumerate(positions):
+            if position < len(negative):
+                key = self._negative.offset + len(negative) - 1 - position
+                estimates[row] = -self._value(key)
+            elif position == len(negative):
+                estimates[row] = 0.0
+            else:
+                estimates[row] = self._value(self._positive.offset + position - len(negative) - 1)
+        return np.clip(estimates, self.min, self.max)
+
+    def quantile(self, quantile):
+        return float(self.quantiles([quantile])[0])
+
+    def to_bytes(self):
+        header = _SKETCH.pack(self.alpha, self.sum, self.count, self._positive.offset,
+                              self.zero_count, self.min, self.max)
+        stores = struct.pack('<qII', self._negative.offset, len(self._positive.counts),
+                             len(self._negative.counts))
+        counts = np.concatenate((self._positive.counts, self._negative.counts))
+        return header + stores + zlib.compress(counts.astype('<u8').tobytes(), 1)
+
+    @classmethod
+    def from_bytes(cls, payload, max_buckets=DEFAULT_MAX_BUCKETS):
+        alpha, total, count, positive_offset, zero_count, minimum, maximum = (
+            _SKETCH.unpack_from(payload))
+        negative_offset, positive_len, negative_len = struct.unpack_from(
+            '<qII', payload, _SKETCH.size)
+        counts = np.frombuffer(zlib.decompress(payload[_SKETCH.size + 16:]), dtype='<u8')
+        sketch = cls(alpha, max_buckets)
+        sketch.sum, sketch.count, sketch.zero_count = total, count, zero_count
+        sketch.min, sketch.max = minimum, maximum
+        sketch._positive.offset = positive_offset
+        sketch._positive.counts = counts[:positive_len].astype(np.uint64)
+        sketch._negative.offset = negative_offset
+        sketch._negative.counts = counts[positive_len:positive_len + negative_len].astype(np.uint64)
+        return sketch
+
+
+class SketchSet(object):
+    """Sketches keyed by (gpu, field id, job)."""
+
+    def __init__(self, alpha=DEFAULT_ALPHA, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.alpha = alpha
+        self.max_buckets = max_buckets
+        self.sketches = {}
+
+    def sketch(self, gpu, field_id, job=''):
+        key = (gpu, field_id, job)
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            sketch = self.sketches[key] = DDSketch(self.alpha, self.max_buckets)
+        return sketch
+
+    def update(self, samples, field_ids=None, job_for_gpu=None):
+        """Adds a batch of samples, one vectorized update per series."""
+
+        series = {}
+        for sample in samples:
+            if field_ids is None or sample.field_id in field_ids:
+                series.setdefault((sample.gpu, sample.field_id), []).append(sample.value)
+        for (gpu, field_id), values in series.items():
+            job = job_for_gpu(gpu) if job_for_gpu else ''
+            self.sketch(gpu, field_id, job).update(values)
+
+    def merge(self, other, key_fn=None):
+        """Merges another set, optionally re-keying its sketches."""
+
+        for key, sketch in other.sketches.items():
+            target_key = key_fn(key) if key_fn else key
+            self.sketch(*target_key).merge(sketch)
+
+    def to_bytes(self):
+        chunks = [_HEADER.pack(_MAGIC, _VERSION, len(self.sketches))]
+        for (gpu, field_id, job), sketch in sorted(self.sketches.items()):
+            job_bytes = job.encode('utf-8')
+            payload = sketch.to_bytes()
+            chunks.append(_ENTRY.pack(gpu, field_id, len(job_bytes), len(payload)))
+            chunks.append(job_bytes)
+            chunks.append(payload)
+        return b''.join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data, max_buckets=DEFAULT_MAX_BUCKETS):
+        magic, version, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Not a sketch file')
+        sketches = {}
+        offset = _HEADER.size
+        alpha = DEFAULT_ALPHA
+        for _ in range(count):
+            gpu, field_id, job_len, payload_len = _ENTRY.unpack_from(data, offset)
+            offset += _ENTRY.size
+            job = data[offset:offset + job_len].decode('utf-8')
+            offset += job_len
+            sketch = DDSketch.from_bytes(data[offset:offset + payload_len], max_buckets)
+            offset += payload_len
+            alpha = sketch.alpha
+            sketches[(gpu, field_id, job)] = sketch
+        sketch_set = cls(alpha, max_buckets)
+        sketch_set.sketches = sketches
+        return sketch_set
+
+    def save(self, path):
+        """Writes the set to path atomically."""
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+    del argv
+
+    group_by = set(FLAGS.group_by)
+    unknown = group_by - {'gpu', 'field', 'job'}
+    if unknown:
+        raise app.UsageError('Unknown --group_by keys: {}'.format(sorted(unknown)))
+
+    def key_fn(key):
+        gpu, field_id, job = key
+        return (gpu if 'gpu' in group_by else 0,
+                field_id if 'field' in group_by else 0,
+                job if 'job' in group_by else '')
+
+    merged = None
+    for path in FLAGS.inputs:
+        sketch_set = SketchSet.load(path)
+        if merged is None:
+            merged = SketchSet(sketch_set.alpha)
+        merged.merge(sketch_set, key_fn)
+    if merged is None:
+        raise app.UsageError('No --inputs given')
+    if FLAGS.output:
+        merged.save(FLAGS.output)
+
+    quantiles = [float(q) for q in FLAGS.quantiles]
+    for (gpu, field_id, job), sketch in sorted(merged.sketches.items()):
+        estimates = ' '.join('p{:g}={:.6g}'.format(q * 100, v)
+                             for q, v in zip(quantiles, sketch.quantiles(quantiles)))
+        print('gpu={} field={} job={} count={} {}'.format(
+            gpu if 'gpu' in group_by else '*', field_id if 'field' in group_by else '*',
+            job if 'job' in group_by else '*', sketch.count, estimates))
+
+
+def _define_flags():
+    flags.DEFINE_list('inputs', [], 'Sketch files to merge')
+    flags.DEFINE_string('output', '', 'Write the merged sketches to this file')
+    flags.DEFINE_list('group_by', ['field', 'job'],
+                      'Keys kept when merging: any of gpu, field, job')
+    flags.DEFINE_list('quantiles', ['0.5', '0.9', '0.99'], 'Quantiles to print')
+
+
+if __name__ == '__main__':
+    _define_flags()
+    app.run(main)
@@ -0,0 +1,86 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+import pytest
+
+import exporters
+import quantile_sketch
+from exporters import Sample
+
+SM_ACTIVE = 1002
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _assert_relative(sketch, values):
+    for q, estimate in zip(QUANTILES, sketch.quantiles(QUANTILES)):
+        exact = np.quantile(values, q, method='lower')
+        assert abs(estimate - exact) <= 0.011 * abs(exact)
+
+
+def test_relative_accuracy():
+    rng = np.random.default_rng(0)
+    for values in (rng.random(100000), rng.lognormal(0, 3, 100000),
+                   -rng.random(10000), np.concatenate((np.zeros(5000), rng.random(5000)))):
+        sketch = quantile_sketch.DDSketch()
+        for batch in np.array_split(values, 10):
+            sketch.update(batch)
+        assert sketch.count == len(values)
+        _assert_relative(sketch, values)
+
+
+def test_memory_is_bounded():
+    sketch = quantile_sketch.DDSketch(max_buckets=256)
+    sketch.update(np.logspace(-10, 10, 100000))
+    assert len(sketch.to_bytes()) < 4096
+    # Collapsing only affects the lowest values
+    assert sketch.quantile(0.99) == pytest.approx(np.quantile(np.logspace(-10, 10, 100000), 0.99),
+                                                  rel=0.011)
+
+
+def test_merge_and_serialize(tmp_path):
+    rng = np.random.default_rng(1)
+    parts = [rng.random(20000) * scale for scale in (1, 2, 3)]
+    sets = []
+    for node, values in enumerate(parts):
+        sketch_set = quantile_sketch.SketchSet()
+        sketch_set.update([Sample(0, SM_ACTIVE, t, v) for t, v in enumerate(values)],
+                          job_for_gpu=lambda gpu: 'job-a')
+        path = str(tmp_path / 'node{}.sketch'.format(node))
+        sketch_set.save(path)
+        sets.append(quantile_sketch.SketchSet.load(path))
+
+    fleet = quantile_sketch.SketchSet()
+    for sketch_set in sets:
+        fleet.merge(sketch_set, key_fn=lambda key: (0, key[1], key[2]))
+    sketch = fleet.sketches[(0, SM_ACTIVE, 'job-a')]
+    assert sketch.count == 60000
+    _assert_relative(sketch, np.concatenate(parts))
+
+    with pytest.raises(ValueError):
+        sketch.merge(quantile_sketch.DDSketch(alpha=0.05))
+
+
+def test_sketch_exporter(tmp_path):
+    path = str(tmp_path / 'agent.sketch')
+    sketches = quantile_sketch.SketchSet()
+    exporter = exporters.QuantileSketchExporter(sketches, path, field_ids=[SM_ACTIVE])
+    exporter.export([Sample(gpu, field_id, 1, 0.5)
+                     for gpu in range(2) for field_id in (SM_ACTIVE, 203)])
+    exporter.flush()
+
+    loaded = quantile_sketch.SketchSet.load(path)
+    assert sorted(loaded.sketches) == [(0, SM_ACTIVE, ''), (1, SM_ACTIVE, '')]
+    assert loaded.sketches[(1, SM_ACTIVE, '')].quantile(0.5) == pytest.approx(0.5, rel=0.01)
@@ -0,0 +1,138 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token buckets and the Cloud Monitoring write budget.
+
+Cloud Monitoring enforces per-project quotas on the points written and on
+the write requests made. A WriteBudget holds a points-per-second and a
+requests-per-minute bucket and tells the exporter how many series it can
+write now. It backs off on RESOURCE_EXHAUSTED errors, halving its rates,
+and recovers a fraction of the configured rates after every successful
+write, so a fleet that outgrows its quota settles just below it.
+"""
+
+import math
+import time
+
+DEFAULT_MIN_SCALE = 0.05
+DEFAULT_RECOVERY = 0.1
+
+
+class TokenBucket(object):
+    """Allows rate tokens per second on average, in bursts of up to burst."""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self._rate = rate
+        self._burst = burst or max(1.0, rate)
+        self._clock = clock
+        self._tokens = self._burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def available(self):
+        self._refill()
+        return self._tokens
+
+    def try_acquire(self, amount=1):
+        self._refill()
+        if self._tokens < amount:
+            return False
+        self._tokens -= amount
+        return True
+
+    def spend(self, amount):
+        """Takes tokens even if the bucket goes into debt."""
+
+        self._refill()
+        self._tokens -= amount
+
+    def set_rate(self, rate, burst):
+        self._refill()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = min(self._tokens, burst)
+
+
+class WriteBudget(object):
+    """Points-per-second and requests-per-minute budget of the writes.
+
+    A rate of 0 is unlimited. The buckets hold burst_seconds of points and a
+    minute of requests, so a budget sized for the average rate absorbs the
+    burst of a sampling cycle.
+    """
+
+    def __init__(self, points_per_second=0, requests_per_minute=0, series_per_request=200,
+                 burst_seconds=60, min_scale=DEFAULT_MIN_SCALE, recovery=DEFAULT_RECOVERY,
+                 clock=time.monotonic):
+        self._points_per_second = points_per_second
+        self._requests_per_minute = requests_per_minute
+        self._series_per_request = series_per_request
+        self._burst_seconds = burst_seconds
+        self._min_scale = min_scale
+        self._recovery = recovery
+        self.scale = 1.0
+        self._points = None
+        self._requests = None
+        if points_per_second:
+            self._points = TokenBucket(points_per_second, points_per_second * burst_seconds,
+                                       clock)
+        if requests_per_minute:
+            self._requests = TokenBucket(requests_per_minute / 60.0, requests_per_minute,
+                                         clock)
+
+    @property
+    def limited(self):
+        return self._points is not None or self._requests is not None
+
+    def capacity(self):
+        """Returns the number of series that can be written now."""
+
+        capacity = math.inf
+        if self._points is not None:
+            capacity = min(capacity, math.floor(self._points.available()))
+        if self._requests is not None:
+            capacity = min(capacity,
+                           math.floor(self._requests.available()) * self._series_per_request)
+        return max(0, capacity)
+
+    def spend(self, series):
+        if self._points is not None:
+            self._points.spend(series)
+        if self._requests is not None:
+            self._requests.spend(math.ceil(series / float(self._series_per_request)))
+
+    def _apply(self):
+        if self._points is not None:
+            rate = self._points_per_second * self.scale
+            self._points.set_rate(rate, rate * self._burst_seconds)
+        if self._requests is not None:
+            rate = self._requests_per_minute * self.scale
+            self._requests.set_rate(rate / 60.0, rate)
+
+    def throttle(self):
+        """Halves the rates after the quota was exceeded."""
+
+        self.scale = max(self._min_scale, self.scale / 2)
+        self._apply()
+
+    def recover(self):
+        """Raises the rates back towards the configured ones."""
+
+        if self.scale < 1.0:
+            self.scale = min(1.0, self.scale + self._recovery)
+            self._apply()
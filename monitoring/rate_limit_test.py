@@ -0,0 +1,63 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+
+import rate_limit
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = rate_limit.TokenBucket(2, burst=4, clock=clock)
+    assert [bucket.try_acquire() for _ in range(5)] == [True] * 4 + [False]
+    clock.now = 1
+    assert bucket.available() == 2
+    bucket.spend(3)
+    assert not bucket.try_acquire()
+    clock.now = 10
+    assert bucket.available() == 4
+
+
+def test_write_budget():
+    clock = Clock()
+    assert rate_limit.WriteBudget(clock=clock).capacity() == math.inf
+
+    # 100 points per second, but only 6 requests of 200 series per minute
+    budget = rate_limit.WriteBudget(points_per_second=100, requests_per_minute=6, clock=clock)
+    assert budget.capacity() == 1200
+    budget.spend(250)
+    assert budget.capacity() == 800
+
+    budget.throttle()
+    budget.throttle()
+    assert budget.scale == 0.25
+    # The buckets shrink to the reduced rates
+    assert budget.capacity() == 200
+    clock.now = 60
+    assert budget.capacity() == 200
+    for _ in range(10):
+        budget.recover()
+    assert budget.scale == 1.0
+    clock.now = 120
+    assert budget.capacity() == 1200
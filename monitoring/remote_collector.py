@@ -0,0 +1,189 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collector sampling the DCGM host engines of many remote nodes.
+
+nv-hostengine serves remote clients (port 5555 by default), so one collector
+process can sample a whole fleet of small GPU nodes. It keeps one reader,
+and its host engine connection, per host and polls all hosts concurrently on
+a bounded worker pool every cycle. The samples of all hosts are tagged with
+their host and published as a single batch, so the exporters pack series of
+many hosts into each request.
+
+A host that has not answered within timeout_seconds is left to finish on its
+worker and skipped until it does; its samples are published with the next
+cycle. A host whose reader fails is disconnected and only retried every
+retry_seconds, so unreachable hosts cost neither workers nor cycle time.
+"""
+
+import concurrent.futures
+import time
+
+from absl import logging
+
+import agent_metrics
+import cycle_trace
+
+DEFAULT_WORKERS = 16
+DEFAULT_TIMEOUT_SECONDS = 5.0
+DEFAULT_RETRY_SECONDS = 60
+
+REMOTE = 'remote'
+
+OK = 'ok'
+SLOW = 'slow'
+UNREACHABLE = 'unreachable'
+HOST_STATES = (OK, SLOW, UNREACHABLE)
+
+
+class _HostBuffer(object):
+    """Sink of a host reader, collecting its samples tagged with the host."""
+
+    def __init__(self, address):
+        self._address = address
+        self._samples = []
+
+    def publish(self, samples, span=None):
+        address = self._address
+        self._samples.extend(sample._replace(host=address) for sample in samples)
+
+    def take(self):
+        samples, self._samples = self._samples, []
+        return samples
+
+
+class _Host(object):
+
+    def __init__(self, address):
+        self.address = address
+        self.buffer = _HostBuffer(address)
+        self.reader = None
+        self.future = None
+        self.state = OK
+        self.next_attempt = 0.0
+
+
+class RemoteCollector(object):
+    """Polls the readers of many hosts and publishes their merged samples.
+
+    reader_factory(address, sinks) creates the reader of a host; its Process
+    raises when the host engine cannot be reached.
+    """
+
+    def __init__(self, hosts, reader_factory, sinks, metrics=None,
+                 max_workers=DEFAULT_WORKERS, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                 retry_seconds=DEFAULT_RETRY_SECONDS, clock=time.monotonic):
+        if not hosts:
+            raise ValueError('The remote collector needs at least one host')
+        self._hosts = [_Host(address) for address in hosts]
+        self._factory = reader_factory
+        self._sinks = sinks
+        self._metrics = metrics or agent_metrics.AgentMetrics()
+        self._timeout_seconds = timeout_seconds
+        self._retry_seconds = retry_seconds
+        self._clock = clock
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self._hosts))),
+            thread_name_prefix='remote-collector')
+
+    def _poll(self, host):
+        # Runs on a worker; the reader keeps its connection between cycles
+        if host.reader is None:
+            host.reader = self._factory(host.address, host.buffer)
+        host.reader.Process()
+        return host.buffer.take()
+
+    def _disconnect(self, host):
+        reader, host.reader = host.reader, None
+        host.buffer.take()
+        if reader is not None:
+            try:
+                reader.close()
+            except Exception as err:  # pylint: disable=broad-except
+                logging.info('Closing the reader of {} failed: {}'.format(host.address, err))
+
+    def _collect(self, host, now):
+        """Returns the samples of a finished poll, or None."""
+
+        future, host.future = host.future, None
+        try:
+            samples = future.result()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.info('Host engine {} unavailable: {}'.format(host.address, err))
+            self._metrics.remote_host_failures.labels(reason='error').inc()
+            self._disconnect(host)
+            host.state = UNREACHABLE
+            host.next_attempt = now + self._retry_seconds
+            return None
+        host.state = OK
+        return samples
+
+    def Process(self, span=None):
+        """Polls every available host once and publishes all samples."""
+
+        span = span or cycle_trace.CycleSpan(0, time.time())
+        start = time.monotonic()
+        now = self._clock()
+        for host in self._hosts:
+            # Slow hosts hold at most one worker; unreachable ones wait for their retry
+            if host.future is None and (host.reader is not None or now >= host.next_attempt):
+                host.future = self._executor.submit(self._poll, host)
+        concurrent.futures.wait([host.future for host in self._hosts if host.future],
+                                timeout=self._timeout_seconds)
+
+        samples = []
+        for host in self._hosts:
+            if host.future is None:
+                continue
+            if not host.future.done():
+                if host.state != SLOW:
+                    logging.info('Host engine {} did not answer within {} seconds'.format(
+                        host.address, self._timeout_seconds))
+                    self._metrics.remote_host_failures.labels(reason='timeout').inc()
+                    host.state = SLOW
+                continue
+            host_samples = self._collect(host, now)
+            if host_samples:
+                samples.extend(host_samples)
+
+        for state in HOST_STATES:
+            self._metrics.remote_hosts.labels(state=state).set(
+                sum(1 for host in self._hosts if host.state == state))
+        fetch_seconds = time.monotonic() - start
+        self._metrics.dcgm_fetch_latency.observe(fetch_seconds)
+        span.add_phase('fetch', fetch_seconds)
+        span.set(samples=len(samples), backend=REMOTE,
+                 hosts={state: sum(1 for host in self._hosts if host.state == state)
+                        for state in HOST_STATES})
+        with span.phase('publish'):
+            self._sinks.publish(samples, span)
+
+    @property
+    def states(self):
+        """Maps every host address to its state."""
+
+        return {host.address: host.state for host in self._hosts}
+
+    def close(self):
+        # Hosts still stuck in a poll are abandoned with their worker
+        self._executor.shutdown(wait=False)
+        for host in self._hosts:
+            if host.future is None:
+                self._disconnect(host)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,152 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+
+import agent_metrics
+import remote_collector
+from exporters import Sample
+
+GPU_UTIL = 203
+
+
+class FakeSinks(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def publish(self, samples, span=None):
+        self.batches.append(samples)
+
+
+class FakeReader(object):
+
+    def __init__(self, address, sinks, host):
+        self._address = address
+        self._sinks = sinks
+        self._host = host
+        self.closed = False
+
+    def Process(self):
+        if self._host.get('blocked') is not None:
+            self._host['blocked'].wait()
+        if self._host.get('down'):
+            raise IOError('Cannot connect to {}'.format(self._address))
+        self._sinks.publish([Sample(0, GPU_UTIL, 1, 50), Sample(1, GPU_UTIL, 1, 60)])
+
+    def close(self):
+        self.closed = True
+
+
+class Fleet(object):
+
+    def __init__(self, addresses):
+        self.hosts = {address: {} for address in addresses}
+        self.readers = []
+
+    def factory(self, address, sinks):
+        reader = FakeReader(address, sinks, self.hosts[address])
+        self.readers.append(reader)
+        return reader
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _collector(fleet, sinks, metrics, clock):
+    return remote_collector.RemoteCollector(
+        sorted(fleet.hosts), fleet.factory, sinks, metrics, max_workers=4,
+        timeout_seconds=0.2, retry_seconds=60, clock=clock)
+
+
+def test_merges_hosts_and_reuses_readers():
+    fleet = Fleet(['node-{}:5555'.format(index) for index in range(10)])
+    sinks = FakeSinks()
+    with _collector(fleet, sinks, agent_metrics.AgentMetrics(), Clock()) as collector:
+        collector.Process()
+        collector.Process()
+
+    # One batch per cycle, with the samples of all hosts
+    assert len(sinks.batches) == 2
+    assert len(sinks.batches[0]) == 20
+    assert {sample.host for sample in sinks.batches[0]} == set(fleet.hosts)
+    assert Sample(1, GPU_UTIL, 1, 60, host='node-3:5555') in sinks.batches[0]
+    # Connections are kept between cycles and closed with the collector
+    assert len(fleet.readers) == 10
+    assert all(reader.closed for reader in fleet.readers)
+
+
+def test_isolates_slow_hosts():
+    fleet = Fleet(['fast:5555', 'slow:5555'])
+    fleet.hosts['slow:5555']['blocked'] = threading.Event()
+    sinks = FakeSinks()
+    metrics = agent_metrics.AgentMetrics()
+    collector = _collector(fleet, sinks, metrics, Clock())
+    try:
+        start = time.monotonic()
+        collector.Process()
+        assert time.monotonic() - start < 2
+        assert {sample.host for sample in sinks.batches[0]} == {'fast:5555'}
+        assert collector.states == {'fast:5555': 'ok', 'slow:5555': 'slow'}
+        assert metrics.remote_hosts.labels(state='slow').value == 1
+
+        # The stuck poll is not submitted again
+        collector.Process()
+        assert len([r for r in fleet.readers if r._address == 'slow:5555']) == 1
+
+        # Its samples are published once it answers, and it is polled again
+        fleet.hosts['slow:5555']['blocked'].set()
+        time.sleep(0.05)
+        collector.Process()
+        assert [sample.host for sample in sinks.batches[2]].count('slow:5555') == 2
+        assert collector.states['slow:5555'] == 'ok'
+        collector.Process()
+        assert [sample.host for sample in sinks.batches[3]].count('slow:5555') == 2
+        assert metrics.remote_host_failures.labels(reason='timeout').value == 1
+    finally:
+        fleet.hosts['slow:5555']['blocked'].set()
+        collector.close()
+
+
+def test_retries_unreachable_hosts():
+    fleet = Fleet(['up:5555', 'down:5555'])
+    fleet.hosts['down:5555']['down'] = True
+    sinks = FakeSinks()
+    metrics = agent_metrics.AgentMetrics()
+    clock = Clock()
+    with _collector(fleet, sinks, metrics, clock) as collector:
+        collector.Process()
+        assert collector.states['down:5555'] == 'unreachable'
+        assert metrics.remote_host_failures.labels(reason='error').value == 1
+        down_readers = [r for r in fleet.readers if r._address == 'down:5555']
+        assert len(down_readers) == 1 and down_readers[0].closed
+
+        # Not retried before retry_seconds
+        clock.now = 30
+        collector.Process()
+        assert len(fleet.readers) == 2
+
+        fleet.hosts['down:5555']['down'] = False
+        clock.now = 61
+        collector.Process()
+        assert collector.states['down:5555'] == 'ok'
+        assert len(sinks.batches[2]) == 4
@@ -0,0 +1,290 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental multi-resolution rollups of the sampled series.
+
+The engine keeps running aggregates (count, sum, min, max, sum of squares and
+a histogram) of the open window of every series at each resolution, and emits
+a ROLLUP_DTYPE record when the window closes. Closed rollups are appended to
+one tier per resolution:
+
+    <rollup dir>/<resolution>s/<file start>.rlp   ROLLUP_DTYPE records
+
+so long-range queries read the coarsest sufficient tier instead of the raw
+samples.
+"""
+
+import os
+import time
+
+import numpy as np
+
+from absl import logging
+
+DEFAULT_RESOLUTIONS = (60, 3600)
+# Exponential bounds covering percentages through bytes per second
+DEFAULT_HISTOGRAM_BOUNDS = tuple(2.0**exponent for exponent in range(-4, 44, 2))
+DEFAULT_RETENTION_SECONDS = {60: 90 * 24 * 3600, 3600: 2 * 365 * 24 * 3600}
+ROLLUP_SUFFIX = '.rlp'
+# Each tier file holds this many windows
+_WINDOWS_PER_FILE = 1440
+
+ROLLUP_DTYPE = np.dtype([
+    ('entity_group', '<u1'),
+    ('entity_id', '<u4'),
+    ('field_id', '<u2'),
+    ('start', '<i8'),
+    ('count', '<u4'),
+    ('sum', '<f8'),
+    ('min', '<f8'),
+    ('max', '<f8'),
+    ('sum_sq', '<f8'),
+    ('histogram', '<u4', (len(DEFAULT_HISTOGRAM_BOUNDS) + 1,)),
+])
+
+
+class _Window(object):
+    """Running aggregates of the open window of a series."""
+
+    __slots__ = ('start', 'count', 'sum', 'min', 'max', 'sum_sq', 'histogram')
+
+    def __init__(self, start, buckets):
+        self.start = start
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum_sq = 0.0
+        self.histogram = np.zeros(buckets, dtype=np.uint32)
+
+
+class RollupEngine(object):
+    """Maintains rollups of every series at several resolutions.
+
+    Resolutions are in seconds. Not thread-safe.
+    """
+
+    def __init__(self, resolutions=DEFAULT_RESOLUTIONS):
+        self.resolutions = tuple(sorted(resolutions))
+        self._bounds = np.asarray(DEFAULT_HISTOGRAM_BOUNDS)
+        self._buckets = len(DEFAULT_HISTOGRAM_BOUNDS) + 1
+        self._windows = {resolution: {} for resolution in self.resolutions}
+
+    def add(self, samples, entity_group=None):
+        """Adds a batch of samples.
+
+        Returns a dict mapping each resolution to the ROLLUP_DTYPE records
+        of the windows that closed. entity_group overrides the entity group
+        of the samples.
+        """
+
+        count = len(samples)
+        if not count:
+            return {resolution: np.zeros(0, ROLLUP_DTYPE) for resolution in self.resolutions}
+        if entity_group is None:
+            entity_groups = np.fromiter((s.entity_group for s in samples), np.int64, count)
+        else:
+            entity_groups = np.full(count, entity_group, dtype=np.int64)
+        entity_ids = np.fromiter((s.gpu for s in samples), np.int64, count)
+        field_ids = np.fromiter((s.field_id for s in samples), np.int64, count)
+        timestamps = np.fromiter((s.timestamp for s in samples), np.int64, count)
+        values = np.fromiter((s.value for s in samples), np.float64, count)
+        bins = np.searchsorted(self._bounds, values, side='right')
+
+        closed = {}
+        for resolution in self.resolutions:
+            starts = timestamps // (resolution * 10**6) * (resolution * 10**6)
+            keys = np.stack((entity_groups, entity_ids, field_ids, starts), axis=1)
+            groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            sums = np.bincount(inverse, weights=values, minlength=len(groups))
+            sums_sq = np.bincount(inverse, weights=values * values, minlength=len(groups))
+            counts = np.bincount(inverse, minlength=len(groups))
+            mins = np.full(len(groups), np.inf)
+            maxs = np.full(len(groups), -np.inf)
+            np.minimum.at(mins, inverse, values)
+            np.maximum.at(maxs, inverse, values)
+            histograms = np.zeros((len(groups), self._buckets), dtype=np.uint32)
+            np.add.at(histograms, (inverse, bins), 1)
+
+            records = []
+            windows = self._windows[resolution]
+            # Groups are sorted by series, then window start
+            for row, (group, entity_id, field_id, start) in enumerate(groups.tolist()):
+                key = (group, entity_id, field_id)
+                window = windows.get(key)
+                if window is None or window.start < start:
+                    if window is not None:
+                        records.append((key, window))
+                    window = windows[key] = _Window(start, self._buckets)
+                elif window.start > start:
+                    # Late samples of a closed window are emitted on their own
+                    window = _Window(start, self._buckets)
+                    records.append((key, window))
+                window.count += int(counts[row])
+                window.sum += sums[row]
+                window.sum_sq += sums_sq[row]
+                window.min = min(window.min, mins[row])
+                window.max = max(window.max, maxs[row])
+                window.histogram += histograms[row]
+
+            # Series that stopped reporting close a window later
+            watermark = int(timestamps.max()) - resolution * 10**6
+            records.extend(self._expire(resolution, watermark))
+            closed[resolution] = self._records(records)
+        return closed
+
+    def _expire(self, resolution, watermark):
+        windows = self._windows[resolution]
+        expired = [key for key, window in windows.items()
+                   if watermark is None or window.start + resolution * 10**6 <= watermark]
+        return [(key, windows.pop(key)) for key in expired]
+
+    def flush(self):
+        """Emits all open windows, closed or not."""
+
+        return {resolution: self._records(self._expire(resolution, None))
+                for resolution in self.resolutions}
+
+    def _records(self, windows):
+        records = np.zeros(len(windows), dtype=ROLLUP_DTYPE)
+        for row, ((entity_group, entity_id, field_id), window) in enumerate(windows):
+            records[row] = (entity_group, entity_id, field_id, window.start, window.count,
+                            window.sum, window.min, window.max, window.sum_sq,
+                            window.histogram)
+        return records
+
+
+def _tier_path(path, resolution):
+    return os.path.join(path, '{}s'.format(resolution))
+
+
+def _file_start(name):
+    return int(name[:-len(ROLLUP_SUFFIX)])
+
+
+class RollupStore(object):
+    """Appends closed rollups to their tier files. Not thread-safe."""
+
+    def __init__(self, path, resolutions=DEFAULT_RESOLUTIONS, retention_seconds=None):
+        self._path = path
+        self._retention_seconds = dict(DEFAULT_RETENTION_SECONDS)
+        self._retention_seconds.update(retention_seconds or {})
+        self._files = {}
+        for resolution in resolutions:
+            os.makedirs(_tier_path(path, resolution), exist_ok=True)
+
+    def append(self, resolution, records):
+        if not len(records):
+            return
+        span = resolution * 10**6 * _WINDOWS_PER_FILE
+        file_starts = records['start'] // span * span
+        for file_start in np.unique(file_starts):
+            current = self._files.get(resolution)
+            if current is None or current[0] != file_start:
+                if current is not None:
+                    current[1].close()
+                name = os.path.join(_tier_path(self._path, resolution),
+                                    str(file_start) + ROLLUP_SUFFIX)
+                self._files[resolution] = current = (file_start, open(name, 'ab'))
+                self.enforce_retention(resolution)
+            current[1].write(records[file_starts == file_start].tobytes())
+            current[1].flush()
+
+    def enforce_retention(self, resolution, now=None):
+        """Deletes the tier files that only hold windows beyond retention."""
+
+        retention = self._retention_seconds.get(resolution)
+        if retention is None:
+            return
+        span = resolution * 10**6 * _WINDOWS_PER_FILE
+        limit = int((now or time.time()) * 10**6) - retention * 10**6
+        directory = _tier_path(self._path, resolution)
+        for name in os.listdir(directory):
+            if name.endswith(ROLLUP_SUFFIX) and _file_start(name) + span <= limit:
+                try:
+                    os.remove(os.path.join(directory, name))
+                    logging.info('Rollup retention removed {}'.format(name))
+                except OSError:
+                    pass
+
+    def close(self):
+        for _, f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class RollupReader(object):
+    """Reads rollup tiers."""
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def resolutions(self):
+        """The resolutions of the tiers that exist, coarsest first."""
+
+        if not os.path.isdir(self._path):
+            return []
+        resolutions = []
+        for name in os.listdir(self._path):
+            if name.endswith('s') and name[:-1].isdigit():
+                resolutions.append(int(name[:-1]))
+        return sorted(resolutions, reverse=True)
+
+    def read(self, resolution, entity_group=None, entity_ids=None, field_ids=None,
+             start=None, end=None):
+        """Returns the records of the windows starting within [start, end)."""
+
+        span = resolution * 10**6 * _WINDOWS_PER_FILE
+        directory = _tier_path(self._path, resolution)
+        chunks = []
+        for name in sorted((n for n in os.listdir(directory) if n.endswith(ROLLUP_SUFFIX)),
+                           key=_file_start):
+            file_start = _file_start(name)
+            if (start is not None and file_start + span <= start) or (
+                    end is not None and file_start >= end):
+                continue
+            path = os.path.join(directory, name)
+            count = os.path.getsize(path) // ROLLUP_DTYPE.itemsize
+            if count:
+                chunks.append(np.memmap(path, dtype=ROLLUP_DTYPE, mode='r', shape=(count,)))
+        if not chunks:
+            return np.zeros(0, ROLLUP_DTYPE)
+        records = np.concatenate(chunks)
+        mask = np.ones(len(records), dtype=bool)
+        if entity_group is not None:
+            mask &= records['entity_group'] == entity_group
+        if entity_ids is not None:
+            mask &= np.isin(records['entity_id'], list(entity_ids))
+        if field_ids is not None:
+            mask &= np.isin(records['field_id'], list(field_ids))
+        if start is not None:
+            mask &= records['start'] >= start
+        if end is not None:
+            mask &= records['start'] < end
+        return records[mask]
+
+    def bounds(self, resolution):
+        """Returns the first window start and last window end of a tier."""
+
+        directory = _tier_path(self._path, resolution)
+        names = sorted((n for n in os.listdir(directory) if n.endswith(ROLLUP_SUFFIX)),
+                       key=_file_start)
+        starts = [self.read(resolution, start=_file_start(name),
+                            end=_file_start(name) + resolution * 10**6 * _WINDOWS_PER_FILE)['start']
+                  for name in (names[0], names[-1])] if names else []
+        if not len(starts) or not len(starts[0]) or not len(starts[1]):
+            return None
+        return int(starts[0].min()), int(starts[1].max()) + resolution * 10**6
@@ -0,0 +1,110 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+
+import exporters
+import rollups
+import sample_query
+import sample_store
+from exporters import Sample
+
+START_US = 1600000000 * 10**6 - 1600000000 * 10**6 % (3600 * 10**6)
+SECOND = 10**6
+GPU_UTIL = 203
+
+
+def _samples(seconds, gpus=2):
+    return [Sample(gpu, GPU_UTIL, START_US + t * SECOND, float(t % 100))
+            for t in range(seconds) for gpu in range(gpus)]
+
+
+def test_windows_close_incrementally():
+    engine = rollups.RollupEngine()
+    samples = _samples(150)
+    closed = engine.add(samples[:140])
+    assert len(closed[60]) == 2 and len(closed[3600]) == 0
+    first = closed[60][closed[60]['entity_id'] == 0][0]
+    assert first['start'] == START_US
+    assert first['count'] == 60
+    assert first['sum'] == sum(range(60))
+    assert (first['min'], first['max']) == (0, 59)
+    assert first['sum_sq'] == sum(t * t for t in range(60))
+    assert first['histogram'].sum() == 60
+
+    closed = engine.add(samples[140:])
+    assert closed[60]['start'].tolist() == [START_US + 60 * SECOND] * 2
+
+    remaining = engine.flush()
+    assert remaining[60]['count'].sum() == 2 * 30
+    assert remaining[3600]['count'].sum() == 2 * 150
+
+
+def test_late_samples_are_emitted_separately():
+    engine = rollups.RollupEngine(resolutions=(60,))
+    engine.add([Sample(0, GPU_UTIL, START_US + 61 * SECOND, 1.0)])
+    closed = engine.add([Sample(0, GPU_UTIL, START_US + SECOND, 5.0)])
+    assert closed[60]['start'].tolist() == [START_US]
+    assert closed[60]['sum'].tolist() == [5.0]
+
+
+def test_query_reads_coarsest_tier(tmp_path):
+    samples = _samples(3 * 3600 + 90)
+    store = sample_store.SampleStore(str(tmp_path))
+    store.append(samples)
+    store.close()
+    sink = exporters.RollupExporter(
+        rollups.RollupEngine(), rollups.RollupStore(str(tmp_path / 'rollups')))
+    for offset in range(0, len(samples), 200):
+        sink.export(samples[offset:offset + 200])
+    sink.close()
+
+    reader = sample_store.StoreReader(str(tmp_path))
+    rollup_reader = rollups.RollupReader(str(tmp_path / 'rollups'))
+    assert rollup_reader.resolutions == [3600, 60]
+    kwargs = dict(start=START_US, end=START_US + 4 * 3600 * SECOND, step=3600 * SECOND,
+                  aggregations=('count', 'mean', 'min', 'max', 'stddev'))
+    raw = sample_query.query(reader, **kwargs)
+    tiered = sample_query.query(reader, rollup_reader=rollup_reader, **kwargs)
+
+    assert list(raw) == list(tiered) == [(0, GPU_UTIL), (1, GPU_UTIL)]
+    for key in raw:
+        # The last, open hour comes from the raw samples
+        assert tiered[key]['count'].tolist() == [3600, 3600, 3600, 90]
+        for column in ('count', 'mean', 'min', 'max', 'stddev'):
+            np.testing.assert_allclose(tiered[key][column], raw[key][column])
+    reader.close()
+
+
+def test_forwards_window_means(tmp_path):
+    forwarded = []
+
+    class Forward(object):
+        def submit(self, samples, span=None):
+            forwarded.extend(samples)
+
+        def close(self):
+            pass
+
+    sink = exporters.RollupExporter(rollups.RollupEngine(), forward=Forward())
+    sink.export(_samples(130, gpus=1))
+    assert forwarded == [Sample(0, GPU_UTIL, START_US + 60 * SECOND, 29.5),
+                         Sample(0, GPU_UTIL, START_US + 120 * SECOND, 3370 / 60)]
+
+    # A flush leaves the open window alone, close emits it
+    sink.flush()
+    assert len(forwarded) == 2
+    sink.close()
+    assert forwarded[2] == Sample(0, GPU_UTIL, START_US + 180 * SECOND, 24.5)
@@ -0,0 +1,112 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Routing of the exported series to the Cloud Monitoring project of their team.
+
+Routes are read from a JSON file and tried in order; the first route that
+matches a series gives its project, and series no route matches go to the
+default --project_id:
+
+    {
+      "routes": [
+        {"project": "team-a-metrics", "job": "team-a-*"},
+        {"project": "team-b-metrics", "gpus": [4, 5, 6, 7]},
+        {"project": "pool-us-east", "resource": {"zone": "us-east1-*"}}
+      ]
+    }
+
+job        fnmatch pattern of the job label of the GPU (requires job attribution)
+gpus       GPU ids; MIG instances follow their GPU
+resource   fnmatch patterns of resource labels, all of which must match
+
+A route may combine conditions. Resource labels do not change while the
+agent runs, so they are matched once; the project of every GPU and job is
+cached, so routing a sample is a dict lookup.
+"""
+
+import collections
+import fnmatch
+import json
+
+import entities
+
+Route = collections.namedtuple('Route', ['project', 'gpus', 'job', 'resource'])
+
+
+def load_routes(config):
+    """Reads the routes from a JSON file name or an already parsed dict."""
+
+    if isinstance(config, str):
+        with open(config) as f:
+            config = json.load(f)
+    routes = []
+    for item in config.get('routes', []):
+        unknown = set(item) - set(Route._fields)
+        if unknown or 'project' not in item:
+            raise ValueError('Invalid route: {}'.format(item))
+        gpus = item.get('gpus')
+        routes.append(Route(item['project'],
+                            frozenset(int(gpu) for gpu in gpus) if gpus is not None else None,
+                            item.get('job'), dict(item.get('resource') or {})))
+    return routes
+
+
+class Router(object):
+    """Maps samples to the project of the first matching route."""
+
+    def __init__(self, routes, default_project, resource_labels=None, attribution=None,
+                 topology=None):
+        resource_labels = resource_labels or {}
+        self.default_project = default_project
+        self._routes = [route for route in routes
+                        if all(fnmatch.fnmatchcase(resource_labels.get(key, ''), pattern)
+                               for key, pattern in route.resource.items())]
+        self._attribution = attribution
+        self._topology = topology or entities.EntityTopology()
+        self._by_job = any(route.job is not None for route in self._routes)
+        self._cache = {}
+
+    @property
+    def projects(self):
+        return sorted(set([self.default_project] + [route.project for route in self._routes]))
+
+    def _match(self, gpu, job):
+        for route in self._routes:
+            if route.gpus is not None and gpu not in route.gpus:
+                continue
+            if route.job is not None and not fnmatch.fnmatchcase(job, route.job):
+                continue
+            return route.project
+        return self.default_project
+
+    def route(self, sample):
+        gpu = self._topology.gpu(sample.entity_group, sample.gpu)
+        job = ''
+        if self._by_job and self._attribution is not None and sample.host is None:
+            job = self._attribution.job(gpu)
+        key = (sample.host, gpu, job)
+        project = self._cache.get(key)
+        if project is None:
+            project = self._cache[key] = self._match(gpu, job)
+        return project
+
+    def split(self, samples):
+        """Returns the samples of each project."""
+
+        if not self._routes:
+            return {self.default_project: samples}
+        by_project = collections.defaultdict(list)
+        for sample in samples:
+            by_project[self.route(sample)].append(sample)
+        return by_project
@@ -0,0 +1,76 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+import pytest
+
+import entities
+import routing
+import synthetic_reader
+from exporters import Sample
+
+GPU_UTIL = 203
+
+
+class FakeAttribution(object):
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def job(self, gpu):
+        return self.jobs.get(gpu, '')
+
+    def labels(self, gpu):
+        return {'job': self.jobs[gpu]} if gpu in self.jobs else {}
+
+
+ROUTES = {
+    'routes': [
+        {'project': 'team-a', 'job': 'team-a-*'},
+        {'project': 'team-b', 'gpus': [4, 5, 6, 7]},
+        {'project': 'east', 'resource': {'zone': 'us-east1-*'}},
+        {'project': 'west', 'resource': {'zone': 'us-west1-*'}},
+    ]
+}
+
+
+def test_routes(tmp_path):
+    path = tmp_path / 'routes.json'
+    path.write_text(json.dumps(ROUTES))
+    attribution = FakeAttribution({0: 'team-a-train', 5: 'team-a-eval'})
+    topology = synthetic_reader.synthetic_topology(8, gpu_instances=2)
+    router = routing.Router(routing.load_routes(str(path)), 'default',
+                            {'zone': 'us-west1-b'}, attribution, topology)
+
+    assert router.projects == ['default', 'team-a', 'team-b', 'west']
+    samples = [Sample(gpu, GPU_UTIL, 1, 1) for gpu in range(8)]
+    by_project = router.split(samples)
+    assert [sample.gpu for sample in by_project['team-a']] == [0, 5]
+    assert [sample.gpu for sample in by_project['team-b']] == [4, 6, 7]
+    assert [sample.gpu for sample in by_project['west']] == [1, 2, 3]
+    # GPU instance 9 is on GPU 4
+    assert router.route(Sample(9, GPU_UTIL, 1, 1, entities.ENTITY_GPU_I)) == 'team-b'
+
+    # Jobs are followed as they change
+    attribution.jobs[0] = 'team-c'
+    assert router.route(samples[0]) == 'west'
+
+
+def test_invalid_routes():
+    with pytest.raises(ValueError):
+        routing.load_routes({'routes': [{'project': 'p', 'gpu': [1]}]})
+    with pytest.raises(ValueError):
+        routing.load_routes({'routes': [{'job': 'x'}]})
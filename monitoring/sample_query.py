@@ -0,0 +1,452 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Downsampling queries over the local sample store.
+
+    python sample_query.py --store_dir=/var/lib/dcgm_stackdriver/samples \\
+        --start=-1d --step=300 --fields=DCGM_FI_PROF_SM_ACTIVE --gpus=0,1 \\
+        --aggregations=mean,max --quantiles=0.5,0.99
+
+Aggregates are computed per step-aligned bucket with numpy over the decoded
+segments. Segments outside the time range are skipped through the store
+index, and when only count/min/max are requested segments that fall inside
+a single bucket are answered from the index without being decoded. Queries
+without quantiles whose step is a multiple of a rollup resolution are
+answered from the rollup tiers.
+"""
+
+import calendar
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+import rollups
+import sample_store
+
+AGGREGATIONS = ('count', 'mean', 'min', 'max', 'sum', 'stddev')
+_INDEX_AGGREGATIONS = frozenset(('count', 'min', 'max'))
+
+
+class SeriesResult(object):
+    """Aggregates of one series: arrays aligned with the bucket start times."""
+
+    def __init__(self, entity_id, field_id, timestamps, columns):
+        self.entity_id = entity_id
+        self.field_id = field_id
+        self.timestamps = timestamps
+        self.columns = columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+
+class QueryResult(object):
+    """The series returned by a query keyed by (entity id, field id)."""
+
+    def __init__(self, start, end, step, series):
+        self.start = start
+        self.end = end
+        self.step = step
+        self.series = series
+
+    def __getitem__(self, key):
+        return self.series[key]
+
+    def __iter__(self):
+        return iter(sorted(self.series))
+
+    def __len__(self):
+        return len(self.series)
+
+    def to_dataframe(self):
+        """Returns a long format pandas DataFrame. Requires pandas."""
+
+        import pandas as pd
+
+        frames = []
+        for key in self:
+            result = self.series[key]
+            data = {'time': pd.to_datetime(result.timestamps, unit='us', utc=True),
+                    'gpu': result.entity_id, 'field_id': result.field_id}
+            data.update(result.columns)
+            frames.append(pd.DataFrame(data))
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def records(self):
+        """Yields one dict per series and bucket."""
+
+        for key in self:
+            result = self.series[key]
+            names = sorted(result.columns)
+            for row, timestamp in enumerate(result.timestamps):
+                record = {'time': int(timestamp), 'gpu': result.entity_id,
+                          'field_id': result.field_id}
+                for name in names:
+                    record[name] = result.columns[name][row].item()
+                yield record
+
+
+def _quantile_name(quantile):
+    return 'p{:g}'.format(quantile * 100)
+
+
+def _bucket_quantiles(values, bounds, counts, quantiles):
+    """Computes quantiles of every bucket of time ordered values."""
+
+    width = int(counts.max())
+    rows = np.repeat(np.arange(len(counts)), counts)
+    if len(counts) * width <= 2 * len(values):
+        # Buckets are of similar size: sort the rows of a padded matrix
+        padded = np.full((len(counts), width), np.inf)
+        padded[rows, np.arange(len(values)) - np.repeat(bounds, counts)] = values
+        padded.sort(axis=1)
+        ordered = padded.ravel()
+        bounds = np.arange(len(counts)) * width
+    else:
+        ordered = values[np.lexsort((values, rows))]
+
+    results = {}
+    for quantile in quantiles:
+        position = quantile * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        weight = position - lower
+        low = ordered[bounds + lower]
+        high = ordered[bounds + upper]
+        results[_quantile_name(quantile)] = low + (high - low) * weight
+    return results
+
+
+def _aggregate(timestamps, values, start, step, buckets, aggregations, quantiles):
+    """Aggregates time ordered samples into step-aligned buckets."""
+
+    edges = start + step * np.arange(buckets + 1, dtype=np.int64)
+    positions = np.searchsorted(timestamps, edges)
+    counts = np.diff(positions)
+    present = counts > 0
+    bounds = positions[:-1][present]
+    non_empty = counts[present]
+
+    columns = {'count': counts}
+    if len(values):
+        sums = np.add.reduceat(values, bounds)
+        if 'mean' in aggregations or 'stddev' in aggregations:
+            means = sums / non_empty
+        if 'mean' in aggregations:
+            columns['mean'] = means
+        if 'sum' in aggregations:
+            columns['sum'] = sums
+        if 'min' in aggregations:
+            columns['min'] = np.minimum.reduceat(values, bounds)
+        if 'max' in aggregations:
+            columns['max'] = np.maximum.reduceat(values, bounds)
+        if 'stddev' in aggregations:
+            squares = np.add.reduceat(values * values, bounds)
+            columns['stddev'] = np.sqrt(np.maximum(squares / non_empty - means * means, 0))
+        if quantiles:
+            columns.update(_bucket_quantiles(values, bounds, non_empty, quantiles))
+
+    for name in list(columns):
+        if name == 'count':
+            continue
+        full = np.full(buckets, np.nan)
+        full[present] = columns[name]
+        columns[name] = full
+    for name in list(aggregations) + [_quantile_name(q) for q in quantiles]:
+        columns.setdefault(name, np.full(buckets, np.nan))
+    return edges[:-1], columns
+
+
+def _aggregate_from_index(reader, positions, start, step, buckets, aggregations):
+    """Count/min/max aggregation that only decodes segments spanning buckets."""
+
+    index = reader.index[positions]
+    first = (index['t_min'] - start) // step
+    last = (index['t_max'] - start) // step
+    inside = (first == last) & (first >= 0) & (first < buckets)
+
+    counts = np.zeros(buckets, dtype=np.int64)
+    mins = np.full(buckets, np.inf)
+    maxs = np.full(buckets, -np.inf)
+    bucket = first[inside]
+    np.add.at(counts, bucket, index['count'][inside].astype(np.int64))
+    np.minimum.at(mins, bucket, index['v_min'][inside])
+    np.maximum.at(maxs, bucket, index['v_max'][inside])
+
+    spanning = positions[~inside]
+    spanning = spanning[np.argsort(reader.index['t_min'][spanning], kind='stable')]
+    if len(spanning):
+        decoded = [reader.decode(position) for position in spanning]
+        timestamps = np.concatenate([d[0] for d in decoded])
+        values = np.concatenate([d[1] for d in decoded])
+        # Segments spanning the query edges hold samples outside [start, end)
+        keep = (timestamps >= start) & (timestamps < start + step * buckets)
+        timestamps, values = timestamps[keep], values[keep]
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, values = timestamps[order], values[order]
+        _, partial = _aggregate(timestamps, values, start, step, buckets,
+                                ('min', 'max'), ())
+        counts += partial['count']
+        mins = np.fmin(mins, partial['min'])
+        maxs = np.fmax(maxs, partial['max'])
+
+    empty = counts == 0
+    mins[empty] = np.nan
+    maxs[empty] = np.nan
+    columns = {'count': counts}
+    if 'min' in aggregations:
+        columns['min'] = mins
+    if 'max' in aggregations:
+        columns['max'] = maxs
+    return start + step * np.arange(buckets, dtype=np.int64), columns
+
+
+def _aggregate_rollups(records, start, step, buckets, aggregations):
+    """Aggregates rollup records of one series into step-aligned buckets."""
+
+    bucket = (records['start'] - start) // step
+    counts = np.bincount(bucket, weights=records['count'], minlength=buckets)
+    sums = np.bincount(bucket, weights=records['sum'], minlength=buckets)
+    present = counts > 0
+    columns = {'count': counts.astype(np.int64)}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(present, sums / counts, np.nan)
+        if 'mean' in aggregations:
+            columns['mean'] = means
+        if 'sum' in aggregations:
+            columns['sum'] = np.where(present, sums, np.nan)
+        if 'stddev' in aggregations:
+            squares = np.bincount(bucket, weights=records['sum_sq'], minlength=buckets)
+            columns['stddev'] = np.sqrt(np.maximum(squares / counts - means * means, 0))
+    if 'min' in aggregations:
+        mins = np.full(buckets, np.inf)
+        np.minimum.at(mins, bucket, records['min'])
+        columns['min'] = np.where(present, mins, np.nan)
+    if 'max' in aggregations:
+        maxs = np.full(buckets, -np.inf)
+        np.maximum.at(maxs, bucket, records['max'])
+        columns['max'] = np.where(present, maxs, np.nan)
+    return columns
+
+
+def _choose_tier(reader, rollup_reader, start, end, step, quantiles):
+    """Picks the coarsest rollup tier that can answer the query.
+
+    Returns the resolution and the end of the range the tier covers, the
+    rest of the range is read from the raw samples.
+    """
+
+    if rollup_reader is None or quantiles:
+        return None
+    raw_start = int(reader.index['t_min'].min()) if len(reader.index) else None
+    for resolution in rollup_reader.resolutions:
+        resolution_us = resolution * 10**6
+        if step % resolution_us or start % resolution_us:
+            continue
+        bounds = rollup_reader.bounds(resolution)
+        if bounds is None:
+            continue
+        first, last = bounds
+        # The tier must reach back as far as the raw samples do
+        if first > (start if raw_start is None else max(start, raw_start)):
+            continue
+        split = start + min((end - start) // step, max(0, (last - start) // step)) * step
+        if split > start:
+            return resolution, split
+    return None
+
+
+def _query_raw(reader, start, step, buckets, entity_ids, field_ids, aggregations,
+               quantiles, entity_group):
+    end = start + buckets * step
+    positions = reader.select(entity_group, entity_ids, field_ids, start, end)
+    index = reader.index
+    series_keys = np.stack((index['entity_id'][positions],
+                            index['field_id'][positions]), axis=1)
+    from_index = set(aggregations) <= _INDEX_AGGREGATIONS and not quantiles
+
+    results = {}
+    for entity_id, field_id in sorted(set(map(tuple, series_keys))):
+        if from_index:
+            mask = (series_keys[:, 0] == entity_id) & (series_keys[:, 1] == field_id)
+            _, columns = _aggregate_from_index(
+                reader, positions[mask], start, step, buckets, aggregations)
+        else:
+            ts, values = reader.read_series(entity_id, field_id, start, end,
+                                            entity_group)
+            _, columns = _aggregate(ts, values, start, step,
+                                    buckets, aggregations, quantiles)
+        results[(int(entity_id), int(field_id))] = columns
+    return results
+
+
+def _empty_columns(buckets, names):
+    columns = {name: np.full(buckets, np.nan) for name in names}
+    columns['count'] = np.zeros(buckets, dtype=np.int64)
+    return columns
+
+
+def query(reader, start, end, step, entity_ids=None, field_ids=None,
+          aggregations=('mean', 'min', 'max'), quantiles=(),
+          entity_group=sample_store.ENTITY_GPU, rollup_reader=None):
+    """Aggregates the samples in [start, end) into buckets of step.
+
+    Times are in microseconds. reader is a sample_store.StoreReader. When
+    rollup_reader, a rollups.RollupReader, is given, the part of the range
+    its coarsest sufficient tier covers is answered from the rollups.
+    """
+
+    unknown = set(aggregations) - set(AGGREGATIONS)
+    if unknown:
+        raise ValueError('Unsupported aggregations: {}'.format(sorted(unknown)))
+    if step <= 0 or end <= start:
+        raise ValueError('Invalid time range or step')
+    buckets = int(-(-(end - start) // step))
+    end = start + buckets * step
+    names = ['count'] + list(aggregations) + [_quantile_name(q) for q in quantiles]
+
+    parts = []
+    split = start
+    tier = _choose_tier(reader, rollup_reader, start, end, step, quantiles)
+    if tier is not None:
+        resolution, split = tier
+        records = rollup_reader.read(resolution, entity_group, entity_ids, field_ids,
+                               start, split)
+        tier_buckets = (split - start) // step
+        keys = np.stack((records['entity_id'], records['field_id']), axis=1)
+        tier_results = {}
+        for entity_id, field_id in set(map(tuple, keys.tolist())):
+            mask = (keys[:, 0] == entity_id) & (keys[:, 1] == field_id)
+            tier_results[(entity_id, field_id)] = _aggregate_rollups(
+                records[mask], start, step, tier_buckets, aggregations)
+        parts.append((tier_buckets, tier_results))
+    if split < end:
+        raw_buckets = (end - split) // step
+        parts.append((raw_buckets, _query_raw(
+            reader, split, step, raw_buckets, entity_ids, field_ids, aggregations,
+            quantiles, entity_group)))
+
+    timestamps = start + step * np.arange(buckets, dtype=np.int64)
+    results = {}
+    for key in sorted(set(key for _, part in parts for key in part)):
+        columns = [part.get(key) or _empty_columns(part_buckets, names)
+                   for part_buckets, part in parts]
+        merged = {name: np.concatenate([c[name] for c in columns]) for name in names}
+        results[key] = SeriesResult(key[0], key[1], timestamps, merged)
+    return QueryResult(start, end, step, results)
+
+
+def parse_time(text, now=None):
+    """Parses a time as epoch seconds, ISO 8601 UTC or relative (-2h, -30m)."""
+
+    now = time.time() if now is None else now
+    text = text.strip()
+    if text == 'now':
+        return now
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if text.startswith('-') and text[-1] in units:
+        return now - float(text[1:-1]) * units[text[-1]]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d'):
+        try:
+            return float(calendar.timegm(time.strptime(text, fmt)))
+        except ValueError:
+            continue
+    raise ValueError('Cannot parse time: {}'.format(text))
+
+
+def parse_field(text):
+    """Resolves a numeric field id or a dcgm_fields constant name."""
+
+    if text.isdigit():
+        return int(text)
+    import dcgm_fields
+    field_id = getattr(dcgm_fields, text, None)
+    if field_id is None:
+        field_id = getattr(dcgm_fields, 'DCGM_FI_' + text.upper(), None)
+    if field_id is None:
+        raise ValueError('Unknown DCGM field: {}'.format(text))
+    return field_id
+
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+    del argv
+
+    start = parse_time(FLAGS.start)
+    end = parse_time(FLAGS.end)
+    reader = sample_store.StoreReader(FLAGS.store_dir)
+    rollup_reader = None
+    if FLAGS.use_rollups:
+        rollup_reader = rollups.RollupReader(os.path.join(FLAGS.store_dir, 'rollups'))
+    result = query(
+        reader,
+        start=int(start * 10**6),
+        end=int(end * 10**6),
+        step=int(FLAGS.step * 10**6),
+        entity_ids=[int(gpu) for gpu in FLAGS.gpus] if FLAGS.gpus else None,
+        field_ids=[parse_field(field) for field in FLAGS.fields] if FLAGS.fields else None,
+        aggregations=FLAGS.aggregations,
+        quantiles=[float(q) for q in FLAGS.quantiles],
+        rollup_reader=rollup_reader)
+    reader.close()
+
+    records = result.records()
+    if FLAGS.format == 'json':
+        for record in records:
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+    else:
+        writer = None
+        for record in records:
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=sorted(record))
+                writer.writeheader()
+            writer.writerow(record)
+
+
+def _define_flags():
+    flags.DEFINE_string('store_dir', None, 'Directory of the local sample store')
+    flags.DEFINE_string('start', '-1h', 'Start time: epoch seconds, ISO 8601 UTC or -<n>[smhdw]')
+    flags.DEFINE_string('end', 'now', 'End time, same formats as --start')
+    flags.DEFINE_float('step', 60, 'Bucket width - seconds', lower_bound=0.001)
+    flags.DEFINE_list('gpus', [], 'GPU ids, all by default')
+    flags.DEFINE_list('fields', [], 'DCGM field ids or dcgm_fields names, all by default')
+    flags.DEFINE_list('aggregations', ['mean', 'min', 'max'],
+                      'Aggregations: ' + ', '.join(AGGREGATIONS))
+    flags.DEFINE_list('quantiles', [], 'Quantiles to compute, e.g. 0.5,0.99')
+    flags.DEFINE_bool('use_rollups', True,
+                      'Answer from the coarsest sufficient rollup tier when possible')
+    flags.DEFINE_enum('format', 'csv', ['csv', 'json'], 'Output format')
+    flags.mark_flag_as_required('store_dir')
+
+
+if __name__ == '__main__':
+    _define_flags()
+    app.run(main)
@@ -0,0 +1,126 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import numpy as np
+import pytest
+
+import sample_query
+import sample_store
+
+START_US = 1600000000 * 10**6
+SECOND = 10**6
+GPU_UTIL = 203
+
+
+@pytest.fixture
+def reader(tmp_path):
+    store = sample_store.SampleStore(str(tmp_path), segment_points=50)
+    timestamps = START_US + np.arange(600) * SECOND
+    for gpu in range(2):
+        store.append_series(gpu, GPU_UTIL, timestamps, np.arange(600.0) + gpu)
+    store.close()
+    reader = sample_store.StoreReader(str(tmp_path))
+    yield reader
+    reader.close()
+
+
+def test_aggregates(reader):
+    result = sample_query.query(reader, START_US, START_US + 600 * SECOND,
+                                60 * SECOND, entity_ids=[1],
+                                aggregations=('mean', 'min', 'max', 'stddev'),
+                                quantiles=(0.5, 0.99))
+
+    assert list(result) == [(1, GPU_UTIL)]
+    series = result[(1, GPU_UTIL)]
+    assert series.timestamps.tolist() == [START_US + i * 60 * SECOND for i in range(10)]
+    values = (np.arange(600.0) + 1).reshape(10, 60)
+    np.testing.assert_array_equal(series['count'], 60)
+    np.testing.assert_allclose(series['mean'], values.mean(axis=1))
+    np.testing.assert_array_equal(series['min'], values.min(axis=1))
+    np.testing.assert_array_equal(series['max'], values.max(axis=1))
+    np.testing.assert_allclose(series['stddev'], values.std(axis=1))
+    np.testing.assert_allclose(series['p50'], np.quantile(values, 0.5, axis=1))
+    np.testing.assert_allclose(series['p99'], np.quantile(values, 0.99, axis=1))
+
+
+def test_empty_buckets_and_partial_range(reader):
+    result = sample_query.query(reader, START_US + 550 * SECOND,
+                                START_US + 700 * SECOND, 100 * SECOND,
+                                entity_ids=[0])
+    series = result[(0, GPU_UTIL)]
+
+    assert series['count'].tolist() == [50, 0]
+    assert series['max'][0] == 599
+    assert np.isnan(series['mean'][1])
+
+
+def test_index_only_aggregation_matches_decoding(reader):
+    kwargs = dict(start=START_US + 25 * SECOND, end=START_US + 575 * SECOND,
+                  step=100 * SECOND, aggregations=('count', 'min', 'max'))
+    from_index = sample_query.query(reader, **kwargs)
+    decoded = sample_query.query(reader, quantiles=(0.5,), **kwargs)
+
+    for key in decoded:
+        for column in ('count', 'min', 'max'):
+            np.testing.assert_array_equal(from_index[key][column], decoded[key][column])
+
+
+def test_index_aggregation_clips_partial_segments(tmp_path):
+    store = sample_store.SampleStore(str(tmp_path), segment_points=30)
+    store.append_series(0, GPU_UTIL, START_US + np.arange(100) * SECOND, np.arange(100.0))
+    store.close()
+    reader = sample_store.StoreReader(str(tmp_path))
+    # Segments 30..59 and 0..29 cross the end and the start of the query
+    kwargs = dict(start=START_US + 5 * SECOND, end=START_US + 55 * SECOND,
+                  step=10 * SECOND, aggregations=('count', 'min', 'max'))
+    from_index = sample_query.query(reader, **kwargs)[(0, GPU_UTIL)]
+    decoded = sample_query.query(reader, quantiles=(0.5,), **kwargs)[(0, GPU_UTIL)]
+    reader.close()
+
+    assert from_index['max'].tolist() == [14, 24, 34, 44, 54]
+    assert from_index['min'].tolist() == [5, 15, 25, 35, 45]
+    for column in ('count', 'min', 'max'):
+        np.testing.assert_array_equal(from_index[column], decoded[column])
+
+
+def test_records_and_parse_time():
+    now = 1600000000.0
+    assert sample_query.parse_time('-2h', now) == now - 7200
+    assert sample_query.parse_time('2020-09-13T12:26:40Z') == now
+    assert sample_query.parse_time('now', now) == now
+    with pytest.raises(ValueError):
+        sample_query.parse_time('yesterday')
+
+
+def test_week_on_eight_gpus(tmp_path):
+    store = sample_store.SampleStore(str(tmp_path))
+    timestamps = START_US + np.arange(7 * 24 * 3600, dtype=np.int64) * SECOND
+    values = np.random.default_rng(0).random(len(timestamps)) * 100
+    for gpu in range(8):
+        store.append_series(gpu, GPU_UTIL, timestamps, values)
+    store.close()
+    reader = sample_store.StoreReader(str(tmp_path))
+
+    start = time.monotonic()
+    result = sample_query.query(reader, START_US, START_US + 7 * 24 * 3600 * SECOND,
+                                3600 * SECOND, quantiles=(0.99,))
+    elapsed = time.monotonic() - start
+
+    assert len(result) == 8
+    assert int(result[(7, GPU_UTIL)]['count'].sum()) == len(timestamps)
+    assert elapsed < 1.0
+    reader.close()
@@ -0,0 +1,363 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local append-only columnar store of every DCGM sample.
+
+Samples are buffered per series (entity, field) and written as segments of
+at most segment_points points. A segment holds the timestamps, delta-of-delta
+encoded, and the values, XOR encoded against the previous value and byte
+shuffled, each compressed with zlib. Encoding and decoding are vectorized.
+
+Segments are appended to data files that roll over by size and age. Every
+data file has an index file with one fixed-size record per segment carrying
+its series, point count and time and value bounds, so readers can select
+segments without touching the data, which they memory-map.
+
+    <store>/<first timestamp>.dat   concatenated segment payloads
+    <store>/<first timestamp>.idx   INDEX_DTYPE records
+
+Retention deletes whole data files, oldest first, once the store exceeds its
+size budget or a file only holds samples older than the age limit.
+"""
+
+import mmap
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from absl import logging
+
+import entities
+
+# DCGM entity groups
+ENTITY_GPU = entities.ENTITY_GPU
+
+INDEX_DTYPE = np.dtype([
+    ('entity_group', '<u1'),
+    ('entity_id', '<u4'),
+    ('field_id', '<u2'),
+    ('count', '<u4'),
+    ('t_min', '<i8'),
+    ('t_max', '<i8'),
+    ('v_min', '<f8'),
+    ('v_max', '<f8'),
+    ('offset', '<u8'),
+    ('ts_bytes', '<u4'),
+    ('value_bytes', '<u4'),
+])
+
+DATA_SUFFIX = '.dat'
+INDEX_SUFFIX = '.idx'
+
+DEFAULT_SEGMENT_POINTS = 4096
+DEFAULT_FILE_BYTES = 64 * 1024 * 1024
+DEFAULT_FILE_SECONDS = 3600
+DEFAULT_FLUSH_SECONDS = 120
+DEFAULT_RETENTION_BYTES = 10 * 1024**3
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+_COMPRESSION_LEVEL = 1
+
+
+def encode_timestamps(timestamps):
+    ts = np.asarray(timestamps, dtype=np.int64)
+    delta = np.diff(ts, prepend=np.int64(0))
+    delta_of_delta = np.diff(delta, prepend=np.int64(0))
+    return zlib.compress(delta_of_delta.astype('<i8').tobytes(), _COMPRESSION_LEVEL)
+
+
+def decode_timestamps(payload, count):
+    delta_of_delta = np.frombuffer(zlib.decompress(payload), dtype='<i8', count=count)
+    return np.cumsum(np.cumsum(delta_of_delta))
+
+
+def encode_values(values):
+    bits = np.asarray(values, dtype='<f8').view('<u8')
+    xored = bits ^ np.concatenate((np.zeros(1, dtype='<u8'), bits[:-1]))
+    # Group the bytes by significance; XORed neighbours share the high bytes
+    shuffled = xored.view(np.uint8).reshape(-1, 8).T
+    return zlib.compress(shuffled.tobytes(), _COMPRESSION_LEVEL)
+
+
+def decode_values(payload, count):
+    shuffled = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    xored = np.ascontiguousarray(shuffled.reshape(8, count).T).view('<u8').ravel()
+    return np.bitwise_xor.accumulate(xored).view('<f8')
+
+
+def _file_start(name):
+    return int(name[:-len(DATA_SUFFIX)])
+
+
+class _SeriesBuffer(object):
+    """Points of a series that have not been written yet."""
+
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self):
+        self.timestamps = []
+        self.values = []
+
+
+class SampleStore(object):
+    """Appends samples to the columnar store. Not thread-safe."""
+
+    def __init__(self, path, segment_points=DEFAULT_SEGMENT_POINTS,
+                 file_bytes=DEFAULT_FILE_BYTES, file_seconds=DEFAULT_FILE_SECONDS,
+                 flush_seconds=DEFAULT_FLUSH_SECONDS,
+                 retention_bytes=DEFAULT_RETENTION_BYTES,
+                 retention_seconds=DEFAULT_RETENTION_SECONDS):
+        self._path = path
+        self._segment_points = segment_points
+        self._file_bytes = file_bytes
+        self._file_seconds = file_seconds
+        self._flush_seconds = flush_seconds
+        self._retention_bytes = retention_bytes
+        self._retention_seconds = retention_seconds
+        os.makedirs(path, exist_ok=True)
+
+        self._buffers = {}
+        self._data = None
+        self._index = None
+        self._file_opened = 0.0
+        self._last_flush = time.monotonic()
+
+    def append(self, samples, entity_group=None):
+        """Buffers samples and writes the series segments that filled up.
+
+        entity_group overrides the entity group of the samples.
+        """
+
+        buffers = self._buffers
+        full = []
+        for sample in samples:
+            key = (entity_group or sample.entity_group, sample.gpu, sample.field_id)
+            buffer = buffers.get(key)
+            if buffer is None:
+                buffer = buffers[key] = _SeriesBuffer()
+            buffer.timestamps.append(sample.timestamp)
+            buffer.values.append(sample.value)
+            if len(buffer.timestamps) == self._segment_points:
+                full.append(key)
+
+        for key in full:
+            self._write_segment(key, buffers.pop(key))
+        if time.monotonic() - self._last_flush >= self._flush_seconds:
+            self.flush()
+
+    def append_series(self, entity_id, field_id, timestamps, values,
+                      entity_group=ENTITY_GPU):
+        """Writes time ordered arrays of one series as full segments."""
+
+        key = (entity_group, entity_id, field_id)
+        pending = self._buffers.pop(key, None)
+        if pending is not None:
+            self._write_segment(key, pending)
+        for offset in range(0, len(timestamps), self._segment_points):
+            buffer = _SeriesBuffer()
+            buffer.timestamps = timestamps[offset:offset + self._segment_points]
+            buffer.values = values[offset:offset + self._segment_points]
+            self._write_segment(key, buffer)
+
+    def flush(self):
+        """Writes all buffered points, possibly as partial segments."""
+
+        buffers, self._buffers = self._buffers, {}
+        for key, buffer in buffers.items():
+            self._write_segment(key, buffer)
+        if self._data is not None:
+            self._data.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._close_file()
+
+    def _write_segment(self, key, buffer):
+        if not len(buffer.timestamps):
+            return
+        self._maybe_roll(buffer.timestamps[0])
+        timestamps = np.asarray(buffer.timestamps, dtype=np.int64)
+        values = np.asarray(buffer.values, dtype=np.float64)
+        # Samples are appended in time order per series, except across
+        # a DCGM reconnect; keep segments sorted for the readers
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, values = timestamps[order], values[order]
+        ts_payload = encode_timestamps(timestamps)
+        value_payload = encode_values(values)
+
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record['entity_group'], record['entity_id'], record['field_id'] = key
+        record['count'] = len(timestamps)
+        record['t_min'] = timestamps[0]
+        record['t_max'] = timestamps[-1]
+        record['v_min'] = values.min()
+        record['v_max'] = values.max()
+        record['offset'] = self._data.tell()
+        record['ts_bytes'] = len(ts_payload)
+        record['value_bytes'] = len(value_payload)
+
+        self._data.write(ts_payload)
+        self._data.write(value_payload)
+        # Readers trust the index, so the data must be on disk first
+        self._data.flush()
+        self._index.write(record.tobytes())
+
+    def _maybe_roll(self, first_timestamp):
+        if self._data is not None and (
+                self._data.tell() < self._file_bytes and
+                time.monotonic() - self._file_opened < self._file_seconds):
+            return
+        self._close_file()
+        name = str(first_timestamp)
+        while os.path.exists(os.path.join(self._path, name + DATA_SUFFIX)):
+            first_timestamp += 1
+            name = str(first_timestamp)
+        self._data = open(os.path.join(self._path, name + DATA_SUFFIX), 'ab')
+        self._index = open(os.path.join(self._path, name + INDEX_SUFFIX), 'ab',
+                           buffering=0)
+        self._file_opened = time.monotonic()
+        self.enforce_retention()
+
+    def _close_file(self):
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def enforce_retention(self, now=None):
+        """Deletes the oldest data files beyond the size or age limits."""
+
+        now_us = int((now or time.time()) * 10**6)
+        names = sorted((n for n in os.listdir(self._path) if n.endswith(DATA_SUFFIX)),
+                       key=_file_start)
+        sizes = [os.path.getsize(os.path.join(self._path, n)) for n in names]
+        total = sum(sizes)
+        # The current file is always kept
+        for position, name in enumerate(names[:-1]):
+            # A file only holds samples older than the start of the next one
+            expired = _file_start(names[position + 1]) < now_us - self._retention_seconds * 10**6
+            if not expired and total <= self._retention_bytes:
+                break
+            base = os.path.join(self._path, name[:-len(DATA_SUFFIX)])
+            for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+                try:
+                    os.remove(base + suffix)
+                except OSError:
+                    pass
+            total -= sizes[position]
+            logging.info('Sample store retention removed {}'.format(name))
+
+
+class StoreReader(object):
+    """Reads segments from a store directory through memory maps."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._maps = {}
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the segment index of all data files."""
+
+        names = sorted((n[:-len(INDEX_SUFFIX)] for n in os.listdir(self._path)
+                        if n.endswith(INDEX_SUFFIX)), key=int)
+        indexes, files = [], []
+        for number, name in enumerate(names):
+            path = os.path.join(self._path, name + INDEX_SUFFIX)
+            size = os.path.getsize(path) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize
+            index = np.fromfile(path, dtype=INDEX_DTYPE, count=size // INDEX_DTYPE.itemsize)
+            indexes.append(index)
+            files.append(np.full(len(index), number, dtype=np.int32))
+        self.files = names
+        self.index = np.concatenate(indexes) if indexes else np.zeros(0, INDEX_DTYPE)
+        self.file_numbers = np.concatenate(files) if files else np.zeros(0, np.int32)
+        with self._lock:
+            for data in self._maps.values():
+                data.close()
+            self._maps = {}
+
+    def _map(self, number, end):
+        with self._lock:
+            data = self._maps.get(number)
+            if data is None or len(data) < end:
+                if data is not None:
+                    data.close()
+                path = os.path.join(self._path, self.files[number] + DATA_SUFFIX)
+                with open(path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[number] = data
+            return data
+
+    def select(self, entity_group=None, entity_ids=None, field_ids=None,
+               start=None, end=None):
+        """Returns the positions of the segments overlapping the filter."""
+
+        index = self.index
+        mask = np.ones(len(index), dtype=bool)
+        if entity_group is not None:
+            mask &= index['entity_group'] == entity_group
+        if entity_ids is not None:
+            mask &= np.isin(index['entity_id'], list(entity_ids))
+        if field_ids is not None:
+            mask &= np.isin(index['field_id'], list(field_ids))
+        if start is not None:
+            mask &= index['t_max'] >= start
+        if end is not None:
+            mask &= index['t_min'] < end
+        return np.nonzero(mask)[0]
+
+    def decode(self, position):
+        """Returns the timestamps and values of a segment."""
+
+        record = self.index[position]
+        offset = int(record['offset'])
+        ts_end = offset + int(record['ts_bytes'])
+        end = ts_end + int(record['value_bytes'])
+        data = self._map(int(self.file_numbers[position]), end)
+        count = int(record['count'])
+        return (decode_timestamps(data[offset:ts_end], count),
+                decode_values(data[ts_end:end], count))
+
+    def read_series(self, entity_id, field_id, start=None, end=None,
+                    entity_group=ENTITY_GPU):
+        """Returns the time ordered samples of a series within [start, end)."""
+
+        positions = self.select(entity_group, [entity_id], [field_id], start, end)
+        positions = positions[np.argsort(self.index['t_min'][positions], kind='stable')]
+        timestamps, values = [], []
+        for position in positions:
+            ts, vals = self.decode(position)
+            timestamps.append(ts)
+            values.append(vals)
+        if not timestamps:
+            return np.zeros(0, np.int64), np.zeros(0, np.float64)
+        timestamps = np.concatenate(timestamps)
+        values = np.concatenate(values)
+        mask = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if end is not None:
+            mask &= timestamps < end
+        return timestamps[mask], values[mask]
+
+    def close(self):
+        with self._lock:
+            for data in self._maps.values():
+                data.close()
+            self._maps = {}
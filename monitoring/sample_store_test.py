@@ -0,0 +1,124 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import time
+
+import numpy as np
+
+import sample_store
+from exporters import Sample
+
+START_US = 1600000000 * 10**6
+# All fields in DCGM_FIELDS
+FIELD_IDS = (155, 203, 252, 1001, 1002, 1003, 1004, 1005, 1007, 1009, 1010,
+             1011, 1012)
+
+
+def _samples(gpus, seconds, interval_us=100000, start=START_US):
+    samples = []
+    for step in range(int(seconds * 10**6 // interval_us)):
+        ts = start + step * interval_us
+        for gpu in range(gpus):
+            for field_id in FIELD_IDS:
+                samples.append(Sample(gpu, field_id, ts, float((step + gpu + field_id) % 97)))
+    return samples
+
+
+def test_encoding_roundtrip():
+    rng = np.random.default_rng(0)
+    timestamps = START_US + np.cumsum(rng.integers(90000, 110000, size=1000))
+    for values in (rng.random(1000), rng.integers(0, 2**40, size=1000).astype(float),
+                   np.full(1000, 0.5)):
+        encoded = sample_store.encode_values(values)
+        np.testing.assert_array_equal(sample_store.decode_values(encoded, 1000), values)
+    encoded = sample_store.encode_timestamps(timestamps)
+    np.testing.assert_array_equal(sample_store.decode_timestamps(encoded, 1000), timestamps)
+
+
+def test_regular_series_compress_well():
+    timestamps = START_US + np.arange(4096) * 100000
+    assert len(sample_store.encode_timestamps(timestamps)) < 256
+    values = np.repeat(np.arange(16, dtype=float), 256)
+    assert len(sample_store.encode_values(values)) < 512
+
+
+def test_append_and_read(tmp_path):
+    store = sample_store.SampleStore(str(tmp_path), segment_points=64)
+    samples = _samples(gpus=2, seconds=20)
+    store.append(samples[:len(samples) // 2])
+    store.append(samples[len(samples) // 2:])
+    store.close()
+
+    reader = sample_store.StoreReader(str(tmp_path))
+    expected = [s for s in samples if s.gpu == 1 and s.field_id == 1002]
+    timestamps, values = reader.read_series(1, 1002)
+    np.testing.assert_array_equal(timestamps, [s.timestamp for s in expected])
+    np.testing.assert_array_equal(values, [s.value for s in expected])
+
+    timestamps, _ = reader.read_series(1, 1002, start=START_US + 10**6,
+                                       end=START_US + 2 * 10**6)
+    assert len(timestamps) == 10
+    # Segments outside the range are skipped through the index
+    positions = reader.select(field_ids=[1002], start=START_US + 19 * 10**6)
+    assert 0 < len(positions) <= 2
+    assert reader.read_series(7, 1002)[0].size == 0
+    reader.close()
+
+
+def test_partial_segments_are_flushed(tmp_path):
+    store = sample_store.SampleStore(str(tmp_path), flush_seconds=0)
+    store.append([Sample(0, 203, START_US, 42.0)])
+
+    reader = sample_store.StoreReader(str(tmp_path))
+    assert reader.read_series(0, 203)[1].tolist() == [42.0]
+    store.close()
+
+
+def test_retention(tmp_path):
+    start = int((time.time() - 4 * 3600 + 60) * 10**6)
+    store = sample_store.SampleStore(str(tmp_path), segment_points=16,
+                                     file_bytes=1, retention_bytes=10**9,
+                                     retention_seconds=3600)
+    for hour in range(4):
+        store.append([Sample(0, 203, start + hour * 3600 * 10**6 + i, i)
+                      for i in range(16)])
+    names = sorted(n for n in os.listdir(str(tmp_path)) if n.endswith('.dat'))
+    # Files followed by one starting more than an hour ago are gone
+    assert len(names) == 2
+    store.close()
+
+    store = sample_store.SampleStore(str(tmp_path), retention_bytes=1)
+    store.enforce_retention()
+    assert len([n for n in os.listdir(str(tmp_path)) if n.endswith('.dat')]) == 1
+    store.close()
+
+
+def test_throughput(tmp_path):
+    # 16 GPUs, all fields, 100 ms sampling: one minute of data
+    samples = _samples(gpus=16, seconds=60)
+    store = sample_store.SampleStore(str(tmp_path))
+
+    start = time.process_time()
+    for offset in range(0, len(samples), 16 * len(FIELD_IDS) * 100):
+        store.append(samples[offset:offset + 16 * len(FIELD_IDS) * 100])
+    store.close()
+    elapsed = time.process_time() - start
+
+    # Well within the 60 seconds of CPU a single core has for it
+    assert elapsed < 6.0
+    reader = sample_store.StoreReader(str(tmp_path))
+    assert int(reader.index['count'].sum()) == len(samples)
+    reader.close()
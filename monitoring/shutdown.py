@@ -0,0 +1,163 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Orderly shutdown of the agent on SIGTERM and SIGINT.
+
+A signal only stops the sampling loop. The sinks are then drained and
+closed in parallel under a deadline; docker stop waits 10 seconds by
+default and a preempted VM gets about 30. The samples a sink did not export
+in time are spooled under the sink name and replayed to that sink on the
+next start, before any new sample. They include the batch of an export call
+still running at the deadline, which may complete nonetheless, so a replay
+can duplicate points but does not lose them.
+
+The watermarks file keeps the latest published timestamp of every series.
+DCGM returns the samples it buffered before the agent started, so the first
+measurement after a restart is published from the watermark on instead of
+being skipped, which neither loses nor duplicates points.
+
+The exit status tells whether data was lost:
+
+    0  every sample was exported
+    3  unsent samples were spooled
+    4  samples were lost: no spool, or the spool was over its budget
+"""
+
+import json
+import os
+import signal
+import threading
+
+from absl import logging
+
+from exporters import Sample
+
+EXIT_OK = 0
+EXIT_SPOOLED = 3
+EXIT_DATA_LOSS = 4
+WATERMARKS_FILE = 'watermarks.json'
+DEFAULT_DEADLINE_SECONDS = 20
+
+
+class ShutdownSignal(object):
+    """Turns SIGTERM and SIGINT into an event the sampling loop waits on.
+
+    A second signal during shutdown raises KeyboardInterrupt.
+    """
+
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        self._signals = signals
+        self._event = threading.Event()
+        self.signal = None
+
+    def install(self):
+        for signum in self._signals:
+            signal.signal(signum, self._handle)
+
+    def _handle(self, signum, frame):
+        del frame
+        if self._event.is_set():
+            raise KeyboardInterrupt
+        logging.info('Caught signal {}. Exiting ...'.format(signum))
+        self.signal = signum
+        self._event.set()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        """Sleeps for timeout seconds. Returns True if shutdown was requested."""
+
+        return self._event.wait(timeout)
+
+
+class Watermarks(object):
+    """The latest published timestamp of every series, kept in a JSON file."""
+
+    def __init__(self, path):
+        self._path = path
+        self._latest = {}
+        self.restored = False
+        try:
+            with open(path) as f:
+                for host, group, gpu, field, timestamp in json.load(f):
+                    self._latest[(host, group, gpu, field)] = timestamp
+            self.restored = True
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as err:
+            logging.info('Ignoring invalid watermarks {}: {}'.format(path, err))
+
+    def observe(self, samples):
+        latest = self._latest
+        for sample in samples:
+            key = (sample.host, sample.entity_group, sample.gpu, sample.field_id)
+            if sample.timestamp > latest.get(key, -1):
+                latest[key] = sample.timestamp
+
+    def newer(self, samples):
+        """Returns the samples past the watermark of their series."""
+
+        latest = self._latest
+        return [sample for sample in samples
+                if sample.timestamp > latest.get((sample.host, sample.entity_group,
+                                                  sample.gpu, sample.field_id), -1)]
+
+    def save(self):
+        records = [list(key) + [timestamp] for key, timestamp in sorted(
+            self._latest.items(), key=lambda item: str(item[0]))]
+        with open(self._path + '.tmp', 'w') as f:
+            json.dump(records, f)
+        os.replace(self._path + '.tmp', self._path)
+
+
+def replay(spool, sinks):
+    """Submits the samples spooled at the last shutdown to their sinks."""
+
+    by_name = {sink.name: sink for sink in sinks.sinks}
+    replayed = 0
+    for name in spool.names():
+        sink = by_name.get(spool.key(name))
+        if sink is not None:
+            samples = [Sample(*record) for record in spool.load(name)]
+            sink.submit(samples)
+            replayed += len(samples)
+        else:
+            logging.info('Dropping spooled batch {} of a disabled sink'.format(name))
+        spool.remove(name)
+    if replayed:
+        logging.info('Replayed {} spooled samples'.format(replayed))
+    return replayed
+
+
+def finish(sinks, timeout=DEFAULT_DEADLINE_SECONDS, spool=None, watermarks=None):
+    """Closes the sinks within timeout, spools what is unsent. Returns the exit status."""
+
+    status = EXIT_OK
+    for name, samples in sinks.close(timeout).items():
+        if not samples:
+            continue
+        if spool is None:
+            logging.info('Lost {} unsent samples of {}'.format(len(samples), name))
+            status = EXIT_DATA_LOSS
+            continue
+        dropped = spool.put(name, [list(sample) for sample in samples])
+        logging.info('Spooled {} unsent samples of {}'.format(len(samples), name))
+        status = max(status, EXIT_DATA_LOSS if dropped else EXIT_SPOOLED)
+    if watermarks is not None:
+        watermarks.save()
+    return status
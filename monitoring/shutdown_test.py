@@ -0,0 +1,130 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import agent_metrics
+import exporters
+import shutdown
+import spool
+from exporters import Sample
+
+GPU_UTIL = 203
+
+
+class RecordingExporter(exporters.Exporter):
+
+    def __init__(self, name, release=None):
+        self.name = name
+        self.release = release
+        self.batches = []
+
+    def export(self, samples):
+        if self.release is not None:
+            self.release.wait()
+        self.batches.append(list(samples))
+
+
+def _sinks(*exporter_list, watermarks=None):
+    metrics = agent_metrics.AgentMetrics()
+    return exporters.FanOut([exporters.QueuedExporter(exporter, metrics)
+                             for exporter in exporter_list], watermarks)
+
+
+def test_watermarks(tmp_path):
+    path = str(tmp_path / shutdown.WATERMARKS_FILE)
+    watermarks = shutdown.Watermarks(path)
+    assert not watermarks.restored
+    watermarks.observe([Sample(0, GPU_UTIL, 5, 1), Sample(0, GPU_UTIL, 3, 1),
+                        Sample(1, GPU_UTIL, 4, 1, host='h1')])
+    watermarks.save()
+
+    restored = shutdown.Watermarks(path)
+    assert restored.restored
+    assert restored.newer([Sample(0, GPU_UTIL, 5, 1), Sample(0, GPU_UTIL, 6, 1),
+                           Sample(1, GPU_UTIL, 4, 1), Sample(1, GPU_UTIL, 4, 1, host='h1'),
+                           Sample(2, GPU_UTIL, 1, 1)]) == [
+        Sample(0, GPU_UTIL, 6, 1), Sample(1, GPU_UTIL, 4, 1), Sample(2, GPU_UTIL, 1, 1)]
+
+
+def test_finish_spools_unsent_samples(tmp_path):
+    release = threading.Event()
+    stuck = RecordingExporter('stuck', release)
+    fast = RecordingExporter('fast')
+    watermarks = shutdown.Watermarks(str(tmp_path / shutdown.WATERMARKS_FILE))
+    sinks = _sinks(stuck, fast, watermarks=watermarks)
+    for ts in range(3):
+        sinks.publish([Sample(0, GPU_UTIL, ts, ts)])
+        time.sleep(0.02)
+
+    batches = spool.Spool(str(tmp_path))
+    start = time.monotonic()
+    assert shutdown.finish(sinks, 0.2, batches, watermarks) == shutdown.EXIT_SPOOLED
+    assert time.monotonic() - start < 1.0
+    release.set()
+    assert [spool_name.split('.')[1] for spool_name in batches.names()] == ['stuck']
+    assert os.path.exists(str(tmp_path / shutdown.WATERMARKS_FILE))
+
+    # The next start replays them to the same sink only
+    stuck, fast = RecordingExporter('stuck'), RecordingExporter('fast')
+    sinks = _sinks(stuck, fast)
+    assert shutdown.replay(spool.Spool(str(tmp_path)), sinks) == 3
+    assert shutdown.finish(sinks, 5.0) == shutdown.EXIT_OK
+    assert stuck.batches == [[Sample(0, GPU_UTIL, ts, ts) for ts in range(3)]]
+    assert fast.batches == []
+    assert len(spool.Spool(str(tmp_path))) == 0
+
+
+def test_finish_without_spool_loses_samples():
+    release = threading.Event()
+    sinks = _sinks(RecordingExporter('stuck', release))
+    sinks.publish([Sample(0, GPU_UTIL, 1, 1)])
+    assert shutdown.finish(sinks, 0.1) == shutdown.EXIT_DATA_LOSS
+    release.set()
+
+
+def test_finish_over_spool_budget_loses_samples(tmp_path):
+    release = threading.Event()
+    sinks = _sinks(RecordingExporter('stuck', release))
+    sinks.publish([Sample(0, GPU_UTIL, 1, 1)])
+    batches = spool.Spool(str(tmp_path), max_bytes=10)
+    batches.put('stuck', ['x' * 100])
+    assert shutdown.finish(sinks, 0.1, batches) == shutdown.EXIT_DATA_LOSS
+    release.set()
+
+
+@pytest.fixture
+def restore_handlers():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_shutdown_signal(restore_handlers):
+    stop = shutdown.ShutdownSignal()
+    stop.install()
+    assert not stop.wait(0.01)
+    os.kill(os.getpid(), signal.SIGTERM)
+    assert stop.wait(1.0)
+    assert stop.signal == signal.SIGTERM
+    with pytest.raises(KeyboardInterrupt):
+        os.kill(os.getpid(), signal.SIGINT)
+        time.sleep(1.0)
@@ -0,0 +1,110 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Disk spool of batches that could not be sent.
+
+Each batch is a JSON file named after its sequence number and a key, such
+as the destination project, so batches are replayed oldest first and the
+spool knows which keys have a backlog without reading any file. Batches are
+written to a temporary file and renamed, so a crash never leaves a partial
+batch behind. When the spool exceeds its size budget the oldest batches are
+dropped.
+"""
+
+import json
+import os
+import re
+import threading
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+_NAME = re.compile(r'^(\d{16})\.([\w.-]+)\.json$')
+
+
+class Spool(object):
+    """Batches kept in a directory until they are replayed."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._entries = {}
+        for name in os.listdir(directory):
+            match = _NAME.match(name)
+            if match:
+                self._entries[name] = (match.group(2),
+                                       os.path.getsize(os.path.join(directory, name)))
+            elif name.endswith('.tmp'):
+                os.unlink(os.path.join(directory, name))
+        self._bytes = sum(size for _, size in self._entries.values())
+        self._sequence = max([int(name[:16]) for name in self._entries] or [0])
+
+    def put(self, key, record):
+        """Spools a batch. Returns the names of the batches dropped to make room."""
+
+        data = json.dumps(record, sort_keys=True).encode('utf-8')
+        with self._lock:
+            self._sequence += 1
+            name = '{:016d}.{}.json'.format(self._sequence, key)
+            path = os.path.join(self._directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self._entries[name] = (key, len(data))
+            self._bytes += len(data)
+            dropped = []
+            for oldest in sorted(self._entries):
+                if self._bytes <= self._max_bytes or oldest == name:
+                    break
+                self._remove(oldest)
+                dropped.append(oldest)
+            return dropped
+
+    def names(self, key=None):
+        """Returns the names of the spooled batches, oldest first."""
+
+        with self._lock:
+            return sorted(name for name, (entry_key, _) in self._entries.items()
+                          if key is None or entry_key == key)
+
+    def keys(self):
+        with self._lock:
+            return set(key for key, _ in self._entries.values())
+
+    def key(self, name):
+        return self._entries[name][0]
+
+    def load(self, name):
+        with open(os.path.join(self._directory, name), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        _, size = self._entries.pop(name)
+        self._bytes -= size
+        try:
+            os.unlink(os.path.join(self._directory, name))
+        except FileNotFoundError:
+            pass
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
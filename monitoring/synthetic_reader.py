@@ -0,0 +1,92 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic sampling backend for load tests without GPUs.
+
+SyntheticReader has the Process interface of the DCGM reader and publishes
+random values of the watched fields for a configurable number of GPUs, MIG
+GPU instances per GPU and compute instances per GPU instance, with the
+entity ids and topology DCGM would report.
+"""
+
+import time
+
+import numpy as np
+
+import agent_metrics
+import cycle_trace
+import entities
+import exporters
+
+
+def synthetic_topology(gpus, gpu_instances=0, compute_instances=1, topology=None):
+    """Adds the entities of a synthetic MIG partitioning to a topology."""
+
+    topology = topology if topology is not None else entities.EntityTopology()
+    for gpu in range(gpus):
+        topology.add(entities.Entity(entities.ENTITY_GPU, gpu, gpu, None, None))
+        for instance in range(gpu_instances):
+            gpu_instance_id = gpu * gpu_instances + instance
+            topology.add(entities.Entity(entities.ENTITY_GPU_I, gpu_instance_id, gpu,
+                                         instance, None))
+            for compute in range(compute_instances):
+                topology.add(entities.Entity(
+                    entities.ENTITY_GPU_CI, gpu_instance_id * compute_instances + compute,
+                    gpu, instance, compute))
+    return topology
+
+
+class SyntheticReader(object):
+    """Publishes random values of the watched fields for synthetic entities."""
+
+    def __init__(self, fields_to_watch, sinks, metrics=None, gpus=8, gpu_instances=0,
+                 compute_instances=1, samples_per_cycle=1, topology=None, seed=0):
+        self._field_ids = sorted(fields_to_watch)
+        self._sinks = sinks
+        self._metrics = metrics or agent_metrics.AgentMetrics()
+        self._samples_per_cycle = samples_per_cycle
+        self.topology = synthetic_topology(gpus, gpu_instances, compute_instances, topology)
+        self._entities = [(entity.group, entity.entity_id)
+                          for entity in self.topology.entities()]
+        self._random = np.random.RandomState(seed)
+
+    def Process(self, span=None):
+        """Publishes samples_per_cycle samples of every entity and field."""
+
+        span = span or cycle_trace.CycleSpan(0, time.time())
+        start = time.monotonic()
+        now = int(time.time() * 10**6)
+        count = self._samples_per_cycle
+        values = self._random.random_sample(
+            (len(self._entities), len(self._field_ids), count)).tolist()
+        samples = [exporters.Sample(entity_id, field_id, now - (count - 1 - k) * 1000, value,
+                                    group)
+                   for (group, entity_id), entity_values in zip(self._entities, values)
+                   for field_id, field_values in zip(self._field_ids, entity_values)
+                   for k, value in enumerate(field_values)]
+        fetch_seconds = time.monotonic() - start
+        self._metrics.dcgm_fetch_latency.observe(fetch_seconds)
+        span.add_phase('fetch', fetch_seconds)
+        span.set(samples=len(samples), backend='synthetic')
+        with span.phase('publish'):
+            self._sinks.publish(samples, span)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,276 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Watchdog of the sampling cycles and the liveness and readiness probes.
+
+WatchdogReader runs the reader on a worker thread and waits for each cycle,
+and for the creation of the reader, at most deadline_seconds. A hung DCGM
+call cannot be interrupted, so a reader that misses its deadline or fails
+is abandoned on its worker, closed if the call ever returns, and a new
+reader, with a new host engine connection, is created on a new worker. The
+attempts back off exponentially up to max_backoff_seconds. Workers are
+daemon threads, so an abandoned call never keeps the agent from exiting.
+
+Exporter calls carry their own deadlines (the gRPC and socket timeouts of
+the exporters), and the Cloud Monitoring exporter recreates its client
+after a call that missed its deadline. A sink whose export call has been
+running longer than the export deadline is reported as stalled.
+
+ProbeServer serves the probes for the container orchestrator:
+
+    /healthz  200 while the sampling loop completes cycles, else 503; a
+              failing liveness probe restarts the container
+    /readyz   200 while the last cycle succeeded and no sink is stalled
+"""
+
+import concurrent.futures
+import http.server
+import queue
+import threading
+import time
+
+from absl import logging
+
+DEFAULT_DEADLINE_SECONDS = 30
+DEFAULT_BACKOFF_SECONDS = 1
+DEFAULT_MAX_BACKOFF_SECONDS = 300
+
+
+def _close(reader):
+    try:
+        reader.close()
+    except Exception as err:  # pylint: disable=broad-except
+        logging.info('Closing the reader failed: {}'.format(err))
+
+
+def _close_created(future):
+    if not future.cancelled() and future.exception() is None:
+        _close(future.result())
+
+
+class _Worker(object):
+    """Daemon thread running the submitted calls in order."""
+
+    def __init__(self):
+        self._calls = queue.Queue()
+        threading.Thread(target=self._run, name='reader', daemon=True).start()
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        self._calls.put((future, fn, args))
+        return future
+
+    def _run(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            future, fn, args = call
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as err:  # pylint: disable=broad-except
+                future.set_exception(err)
+
+    def shutdown(self):
+        """Ends the thread once the submitted calls are done."""
+
+        self._calls.put(None)
+
+
+class WatchdogReader(object):
+    """Runs the cycles of the readers made by factory under a deadline.
+
+    run(fn, *args), if set, makes the cycle calls on the worker, for example
+    ProfilingController.profiled.
+    """
+
+    def __init__(self, factory, deadline_seconds=DEFAULT_DEADLINE_SECONDS, metrics=None,
+                 backoff_seconds=DEFAULT_BACKOFF_SECONDS,
+                 max_backoff_seconds=DEFAULT_MAX_BACKOFF_SECONDS, clock=time.monotonic,
+                 run=None):
+        self._factory = factory
+        self._run = run
+        self._deadline_seconds = deadline_seconds
+        self._metrics = metrics
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._clock = clock
+        self._reader = None
+        self._worker = None
+        self._failures = 0
+        self._next_attempt = clock()
+        self.last_cycle = None
+        self.last_success = None
+
+    @property
+    def reader(self):
+        return self._reader
+
+    def _event(self, event):
+        if self._metrics is not None:
+            self._metrics.watchdog_events.labels(event=event).inc()
+
+    def _abandon(self, future, event, reason):
+        reader, worker = self._reader, self._worker
+        self._reader = self._worker = None
+        if reader is not None:
+            # Runs once the stuck call, if any, returns
+            worker.submit(_close, reader)
+        elif future is not None:
+            future.add_done_callback(_close_created)
+        worker.shutdown()
+        self._failures += 1
+        delay = min(self._max_backoff_seconds,
+                    self._backoff_seconds * 2 ** (self._failures - 1))
+        self._next_attempt = self._clock() + delay
+        self._event(event)
+        logging.info('Reader {}, recreating it in {} seconds'.format(reason, delay))
+
+    def Process(self, span=None):
+        future = None
+        try:
+            if self._reader is None:
+                if self._clock() < self._next_attempt:
+                    return
+                self._worker = _Worker()
+                future = self._worker.submit(self._factory)
+                self._reader = future.result(self._deadline_seconds)
+                if self._failures:
+                    self._event('reconnected')
+            if self._run is not None:
+                future = self._worker.submit(self._run, self._reader.Process, span)
+            else:
+                future = self._worker.submit(self._reader.Process, span)
+            future.result(self._deadline_seconds)
+            self._failures = 0
+            self.last_success = self._clock()
+        except concurrent.futures.TimeoutError:
+            self._abandon(future, 'timeout', 'missed its {} second deadline'.format(
+                self._deadline_seconds))
+        except Exception as err:  # pylint: disable=broad-except
+            self._abandon(future, 'failure', 'failed: {}'.format(err))
+        finally:
+            self.last_cycle = self._clock()
+
+    def close(self):
+        if self._reader is not None:
+            future = self._worker.submit(_close, self._reader)
+            try:
+                future.result(self._deadline_seconds)
+            except concurrent.futures.TimeoutError:
+                logging.info('Closing the reader timed out')
+            self._reader = None
+        if self._worker is not None:
+            self._worker.shutdown()
+            self._worker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Probes(object):
+    """Liveness and readiness of the agent.
+
+    The agent is live while the sampling loop completed a cycle within
+    stuck_seconds, and ready while the last cycle succeeded and no sink has
+    been exporting for longer than export_deadline_seconds.
+    """
+
+    def __init__(self, reader, sinks, stuck_seconds, export_deadline_seconds,
+                 clock=time.monotonic):
+        self._reader = reader
+        self._sinks = sinks
+        self._stuck_seconds = stuck_seconds
+        self._export_deadline_seconds = export_deadline_seconds
+        self._clock = clock
+        self._started = clock()
+
+    def liveness(self):
+        """Returns (live, reason)."""
+
+        last_cycle = self._reader.last_cycle
+        idle = self._clock() - (last_cycle if last_cycle is not None else self._started)
+        if idle > self._stuck_seconds:
+            return False, 'no sampling cycle for {:.0f} seconds'.format(idle)
+        return True, 'ok'
+
+    def readiness(self):
+        """Returns (ready, reason)."""
+
+        live, reason = self.liveness()
+        if not live:
+            return live, reason
+        if self._reader.last_success is None or (
+                self._reader.last_cycle is not None and
+                self._reader.last_success < self._reader.last_cycle):
+            return False, 'reader not available'
+        stalled = [sink.name for sink in self._sinks.sinks
+                   if sink.busy_seconds() > self._export_deadline_seconds]
+        if stalled:
+            return False, 'sinks stalled: {}'.format(', '.join(stalled))
+        return True, 'ok'
+
+
+class _ProbeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the probes on /healthz and /readyz."""
+
+    probes = None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = self.path.split('?', 1)[0]
+        if path == '/healthz':
+            ok, reason = self.probes.liveness()
+        elif path == '/readyz':
+            ok, reason = self.probes.readiness()
+        else:
+            self.send_error(404)
+            return
+        body = (reason + '\n').encode('utf-8')
+        self.send_response(200 if ok else 503)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class ProbeServer(object):
+    """Serves the liveness and readiness probes from a background thread."""
+
+    def __init__(self, probes, port, address=''):
+        handler = type('ProbeHandler', (_ProbeHandler,), {'probes': probes})
+        self._server = http.server.ThreadingHTTPServer((address, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='probe-server', daemon=True)
+        self._thread.start()
+        logging.info('Serving the liveness and readiness probes on port {}'.format(self.port))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,183 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+from urllib import error, request
+
+import pytest
+
+import agent_metrics
+import exporters
+import watchdog
+from exporters import Sample
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeReader(object):
+
+    def __init__(self, hang=None, error=None):
+        self.hang = hang
+        self.error = error
+        self.cycles = 0
+        self.closed = threading.Event()
+
+    def Process(self, span=None):
+        if self.hang is not None:
+            self.hang.wait()
+        if self.error:
+            raise self.error
+        self.cycles += 1
+
+    def close(self):
+        self.closed.set()
+
+
+class Factory(object):
+
+    def __init__(self, readers):
+        self.readers = list(readers)
+        self.created = []
+
+    def __call__(self):
+        reader = self.readers.pop(0)
+        if isinstance(reader, threading.Event):
+            reader.wait()
+            reader = FakeReader()
+        self.created.append(reader)
+        return reader
+
+
+def test_recreates_hung_reader_with_backoff():
+    release = threading.Event()
+    hung, healthy = FakeReader(hang=release), FakeReader()
+    factory = Factory([hung, healthy])
+    metrics = agent_metrics.AgentMetrics()
+    clock = Clock()
+    reader = watchdog.WatchdogReader(factory, deadline_seconds=0.1, metrics=metrics,
+                                     backoff_seconds=5, clock=clock)
+    reader.Process()
+    assert reader.reader is None
+    assert metrics.watchdog_events.labels(event='timeout').value == 1
+
+    # No new connection during the backoff
+    reader.Process()
+    assert factory.created == [hung]
+    clock.now = 5
+    reader.Process()
+    assert reader.reader is healthy and healthy.cycles == 1
+    assert reader.last_success == 5
+    assert metrics.watchdog_events.labels(event='reconnected').value == 1
+
+    # The hung reader is closed once its call returns
+    assert not hung.closed.is_set()
+    release.set()
+    assert hung.closed.wait(1.0)
+    reader.close()
+    assert healthy.closed.is_set()
+
+
+def test_backoff_grows_on_repeated_failures():
+    factory = Factory([FakeReader(error=RuntimeError('down')) for _ in range(4)])
+    clock = Clock()
+    reader = watchdog.WatchdogReader(factory, deadline_seconds=1, backoff_seconds=1,
+                                     max_backoff_seconds=3, clock=clock)
+    attempts = []
+    for second in range(12):
+        clock.now = second
+        created = len(factory.created)
+        reader.Process()
+        if len(factory.created) > created:
+            attempts.append(second)
+    assert attempts == [0, 1, 3, 6]
+
+
+def test_hung_connection_is_closed_when_made():
+    connecting = threading.Event()
+    factory = Factory([connecting, FakeReader()])
+    clock = Clock()
+    reader = watchdog.WatchdogReader(factory, deadline_seconds=0.1, clock=clock)
+    reader.Process()
+    assert reader.reader is None and reader.last_success is None
+    connecting.set()
+    deadline = time.monotonic() + 1
+    while not factory.created and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert factory.created[0].closed.wait(1.0)
+
+
+class SlowExporter(exporters.Exporter):
+
+    name = 'slow'
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def export(self, samples):
+        self.release.wait()
+
+
+@pytest.fixture
+def probe_server():
+    clock = Clock()
+    reader = watchdog.WatchdogReader(Factory([FakeReader()]), deadline_seconds=1, clock=clock)
+    exporter = SlowExporter()
+    sinks = exporters.FanOut([exporters.QueuedExporter(exporter,
+                                                       agent_metrics.AgentMetrics())])
+    probes = watchdog.Probes(reader, sinks, stuck_seconds=60, export_deadline_seconds=0.05,
+                             clock=clock)
+    server = watchdog.ProbeServer(probes, 0, '127.0.0.1')
+    server.start()
+    yield server, reader, sinks, exporter, clock
+    server.stop()
+    exporter.release.set()
+    sinks.close()
+
+
+def _get(server, path):
+    try:
+        with request.urlopen('http://127.0.0.1:{}{}'.format(server.port, path)) as response:
+            return response.status, response.read().decode('utf-8').strip()
+    except error.HTTPError as err:
+        return err.code, err.read().decode('utf-8').strip()
+
+
+def test_probes(probe_server):
+    server, reader, sinks, exporter, clock = probe_server
+    assert _get(server, '/healthz') == (200, 'ok')
+    assert _get(server, '/readyz') == (503, 'reader not available')
+
+    reader.Process()
+    assert _get(server, '/readyz') == (200, 'ok')
+
+    sinks.publish([Sample(0, 203, 1, 1)])
+    time.sleep(0.1)
+    assert _get(server, '/readyz') == (503, 'sinks stalled: slow')
+    exporter.release.set()
+    sinks.sinks[0].drain(1.0)
+    assert _get(server, '/readyz') == (200, 'ok')
+
+    clock.now = 61
+    assert _get(server, '/healthz') == (503, 'no sampling cycle for 61 seconds')
+    assert _get(server, '/readyz')[0] == 503
+    assert _get(server, '/metrics')[0] == 404